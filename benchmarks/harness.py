@@ -0,0 +1,258 @@
+"""
+A small harness for writing benchmark suites with reproducible reports.
+
+A suite is a function that returns a list of :class:`Benchmark` instances (or
+a deferred that fires with one). :func:`main` runs the suite, prints a summary
+table and can write the results to a JSON file and compare them to a baseline
+JSON file written by an earlier run::
+
+    python benchmarks/sandbox.py --output before.json
+    # ... make changes ...
+    python benchmarks/sandbox.py --baseline before.json --output after.json
+
+The process exits with status 1 if any benchmark's median time is worse than
+the baseline by more than the regression threshold.
+"""
+
+import json
+import platform
+import sys
+import time
+
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
+from twisted.internet.task import react
+from twisted.python import usage
+
+
+REPORT_VERSION = 1
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of a sorted list of values."""
+    if not sorted_values:
+        return None
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def summarize(samples, ops_per_sample=1):
+    """Summarise a list of durations (in seconds) as a dictionary."""
+    values = sorted(samples)
+    total = sum(values)
+    return {
+        "samples": len(values),
+        "ops_per_sample": ops_per_sample,
+        "total": total,
+        "mean": total / len(values),
+        "min": values[0],
+        "max": values[-1],
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "ops_per_sec": (len(values) * ops_per_sample / total
+                        if total else None),
+    }
+
+
+class Benchmark(object):
+    """A single benchmark.
+
+    :param str name:
+        Name of the benchmark in reports.
+    :param callable func:
+        Function that performs one sample. It may return a deferred.
+    :param int ops_per_sample:
+        Number of operations each call to ``func`` performs. This is only used
+        to calculate operations per second for throughput benchmarks.
+    :param callable setup:
+        Optional function to call (and wait for) before the first sample.
+    :param callable teardown:
+        Optional function to call (and wait for) after the last sample.
+    """
+
+    def __init__(self, name, func, ops_per_sample=1, setup=None,
+                 teardown=None):
+        self.name = name
+        self.func = func
+        self.ops_per_sample = ops_per_sample
+        self.setup = setup
+        self.teardown = teardown
+
+    @inlineCallbacks
+    def run(self, samples, warmup):
+        if self.setup is not None:
+            yield maybeDeferred(self.setup)
+        try:
+            for _ in xrange(warmup):
+                yield maybeDeferred(self.func)
+            durations = []
+            for _ in xrange(samples):
+                start = time.time()
+                yield maybeDeferred(self.func)
+                durations.append(time.time() - start)
+        finally:
+            if self.teardown is not None:
+                yield maybeDeferred(self.teardown)
+        returnValue(summarize(durations, self.ops_per_sample))
+
+
+class BenchmarkReport(object):
+    """The results of a run of a benchmark suite."""
+
+    def __init__(self, suite, samples, warmup):
+        self.suite = suite
+        self.samples = samples
+        self.warmup = warmup
+        self.results = {}
+        self.names = []
+
+    def add(self, name, result):
+        self.names.append(name)
+        self.results[name] = result
+
+    def to_dict(self):
+        return {
+            "version": REPORT_VERSION,
+            "suite": self.suite,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "samples": self.samples,
+            "warmup": self.warmup,
+            "results": self.results,
+        }
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def compare(self, baseline, threshold):
+        """Compare median times against a baseline report dictionary.
+
+        Returns a list of ``(name, baseline_p50, p50, ratio, regressed)``
+        tuples for the benchmarks present in both reports.
+        """
+        comparisons = []
+        baseline_results = baseline.get("results", {})
+        for name in self.names:
+            if name not in baseline_results:
+                continue
+            old = baseline_results[name]["p50"]
+            new = self.results[name]["p50"]
+            ratio = new / old if old else None
+            regressed = ratio is not None and ratio > 1 + threshold
+            comparisons.append((name, old, new, ratio, regressed))
+        return comparisons
+
+
+def format_time(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1e-3:
+        return "%.1fus" % (seconds * 1e6,)
+    if seconds < 1:
+        return "%.2fms" % (seconds * 1e3,)
+    return "%.2fs" % (seconds,)
+
+
+class BenchmarkOptions(usage.Options):
+    optParameters = [
+        ["samples", "n", "100", "Number of timed samples per benchmark."],
+        ["warmup", "w", "5", "Number of untimed samples per benchmark."],
+        ["output", "o", None, "File to write JSON results to."],
+        ["baseline", "b", None, "JSON results file to compare against."],
+        ["threshold", "t", "0.1",
+         "Fraction by which the median time may exceed the baseline before"
+         " it is reported as a regression."],
+    ]
+
+    optFlags = [
+        ["list", "l", "List the benchmarks in the suite and exit."],
+    ]
+
+    def parseArgs(self, *names):
+        self["names"] = names
+
+    def postOptions(self):
+        self["samples"] = int(self["samples"])
+        self["warmup"] = int(self["warmup"])
+        self["threshold"] = float(self["threshold"])
+        if self["samples"] < 1:
+            raise usage.UsageError("At least one sample is required.")
+
+    def getSynopsis(self):
+        return "Usage: %s [options] [benchmark names ...]" % (sys.argv[0],)
+
+
+@inlineCallbacks
+def run_suite(suite_name, get_benchmarks, options, emit):
+    benchmarks = yield maybeDeferred(get_benchmarks, options)
+    if options["list"]:
+        for benchmark in benchmarks:
+            emit(benchmark.name)
+        returnValue(0)
+    if options["names"]:
+        benchmarks = [b for b in benchmarks if b.name in options["names"]]
+
+    report = BenchmarkReport(
+        suite_name, options["samples"], options["warmup"])
+    emit("%-32s %10s %10s %10s %12s" % (
+        "benchmark", "p50", "p90", "p99", "ops/sec"))
+    for benchmark in benchmarks:
+        result = yield benchmark.run(options["samples"], options["warmup"])
+        report.add(benchmark.name, result)
+        emit("%-32s %10s %10s %10s %12.1f" % (
+            benchmark.name, format_time(result["p50"]),
+            format_time(result["p90"]), format_time(result["p99"]),
+            result["ops_per_sec"] or 0))
+
+    if options["output"] is not None:
+        report.write(options["output"])
+
+    status = 0
+    if options["baseline"] is not None:
+        with open(options["baseline"]) as f:
+            baseline = json.load(f)
+        emit("")
+        emit("Compared to %s (threshold %d%%):" % (
+            options["baseline"], options["threshold"] * 100))
+        for name, old, new, ratio, regressed in report.compare(
+                baseline, options["threshold"]):
+            if regressed:
+                status = 1
+            emit("%-32s %10s -> %10s %7s%s" % (
+                name, format_time(old), format_time(new),
+                "x%.2f" % (ratio,) if ratio is not None else "-",
+                "  REGRESSION" if regressed else ""))
+    returnValue(status)
+
+
+def main(suite_name, get_benchmarks, options_class=BenchmarkOptions,
+         argv=None):
+    """Parse the command line, run the suite and exit."""
+    if argv is None:
+        argv = sys.argv[1:]
+    options = options_class()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0],)
+        sys.exit(1)
+
+    def _main(reactor):
+        def emit(line):
+            print line
+        d = run_suite(suite_name, get_benchmarks, options, emit)
+        d.addCallback(lambda status: setattr(options, "exit_status", status))
+        return d
+
+    options.exit_status = 0
+    try:
+        react(_main, [])
+    except SystemExit, e:
+        if e.code:
+            raise
+    sys.exit(options.exit_status)
@@ -0,0 +1,83 @@
+"""
+Benchmark message serialization, deserialization and copying.
+
+This compares the old generic JSON path (which probes every string in the
+payload for a timestamp and copies messages with a JSON round trip) with the
+field-aware codec and structural copy.
+
+Usage: python benchmarks/message_codec.py [loops]
+"""
+
+import sys
+import timeit
+
+from vumi.message import (
+    TransportUserMessage, from_json, to_json, get_message_serializer)
+from vumi.utils import to_kwargs
+
+
+def make_message():
+    return TransportUserMessage(
+        to_addr="+27831234567",
+        from_addr="12345",
+        transport_name="bench_transport",
+        transport_type="sms",
+        content="Hello, this is a benchmark message.",
+        transport_metadata={"bench": {"id": "1234", "tags": ["a", "b"]}},
+        helper_metadata={
+            "tag": {"tag": ["pool", "12345"]},
+            "go": {"conversation_key": "abc", "user_account": "def"},
+        },
+    )
+
+
+def old_from_json(data):
+    return TransportUserMessage(
+        _process_fields=False, **to_kwargs(from_json(data)))
+
+
+def old_copy(msg):
+    return old_from_json(to_json(msg.payload))
+
+
+def get_benchmarks():
+    msg = make_message()
+    data = msg.to_json()
+    benchmarks = [
+        ("to_json", lambda: msg.to_json()),
+        ("from_json", lambda: TransportUserMessage.from_json(data)),
+        ("deserialize", lambda: TransportUserMessage.deserialize(data)),
+        ("deserialize (fields)", lambda: TransportUserMessage.deserialize(
+            data, datetime_fields_only=True)),
+        ("copy (old)", lambda: old_copy(msg)),
+        ("copy (new)", lambda: msg.copy()),
+    ]
+    try:
+        msgpack_type = 'application/x-msgpack'
+        get_message_serializer(msgpack_type)
+    except ImportError:
+        print "msgpack not installed, skipping msgpack benchmarks."
+    else:
+        packed = msg.serialize(msgpack_type)
+        benchmarks.extend([
+            ("serialize (msgpack)", lambda: msg.serialize(msgpack_type)),
+            ("deserialize (msgpack)", lambda: TransportUserMessage.deserialize(
+                packed, msgpack_type, datetime_fields_only=True)),
+        ])
+    return benchmarks
+
+
+def run_bench(loops):
+    print "Running %d loops per benchmark ..." % (loops,)
+    for name, func in get_benchmarks():
+        total = min(timeit.repeat(func, number=loops, repeat=3))
+        print "%-24s %8.2f us/op" % (name, total * 1e6 / loops)
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args:
+        loops = int(args[0])
+    else:
+        loops = 10000
+    run_bench(loops)
@@ -1,153 +1,334 @@
 """
-Benchmark sandbox message processing round trip.
+Benchmark the sandbox worker.
+
+The suite covers:
+
+* ``round_trip.*``: processing a single message or event in a sandbox,
+  with and without a pool of reusable sandbox processes.
+* ``throughput.*``: processing batches of concurrent messages or events.
+* ``dispatch.*``: dispatching sandbox commands to the ``kv`` (Redis),
+  ``outbound`` and ``http`` resources without a sandbox process.
+* ``parse.out_received``: splitting and parsing commands read from a
+  sandbox's stdout.
+
+Everything runs offline. Redis is faked, the HTTP resource talks to a local
+web server and, unless ``--js`` is given, the sandbox runs
+``benchmarks/sandbox_stub.py`` instead of node.js.
+
+Usage: python benchmarks/sandbox.py [options] [benchmark names ...]
+
+See ``benchmarks/harness.py`` for writing results and comparing them to a
+baseline.
 """
 
+import os
 import sys
-import time
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, DeferredQueue
-from twisted.python import log
+from twisted.internet.defer import inlineCallbacks, gatherResults, succeed
+from twisted.python import usage
+from twisted.web.server import Site
+from twisted.web.static import Data
+
+from harness import Benchmark, BenchmarkOptions, main
+
+from vumi.application.sandbox import (
+    Sandbox, JsSandbox, SandboxCommand, SandboxProtocol)
+from vumi.tests.helpers import MessageHelper, WorkerHelper
+
+
+SANDBOX_ID = "bench"
+
+JAVASCRIPT = """
+    api.on_inbound_message = function(command) {
+        this.request('outbound.reply_to', {
+            content: 'reply',
+            in_reply_to: command.msg.message_id,
+        }, function (reply) {
+            this.done();
+        });
+    };
+    api.on_inbound_event = function(command) {
+        this.request('kv.incr', {key: 'events'}, function (reply) {
+            this.done();
+        });
+    };
+"""
 
-from vumi.application.sandbox import JsSandbox
-from vumi.transports.base import Transport
-from vumi.service import WorkerCreator
-from vumi.servicemaker import VumiOptions
 
+class SandboxOptions(BenchmarkOptions):
+    optParameters = [
+        ["concurrency", "c", "10",
+         "Number of messages or events per sample in throughput benchmarks."],
+        ["commands", None, "100",
+         "Number of commands per sample in the command parsing benchmark."],
+        ["pool-size", None, "10",
+         "Sandbox pool size for the pooled benchmarks."],
+    ]
 
-class BenchTransport(Transport):
+    optFlags = [
+        ["js", None, "Run the JavaScript sandbox with node.js instead of the"
+         " stub sandbox script."],
+    ]
 
-    WORKER_QUEUE = DeferredQueue()
+    def postOptions(self):
+        super(SandboxOptions, self).postOptions()
+        self["concurrency"] = int(self["concurrency"])
+        self["commands"] = int(self["commands"])
+        self["pool-size"] = int(self["pool-size"])
+        if self["js"] and JsSandbox.find_nodejs() is None:
+            raise usage.UsageError("Could not find node.js.")
 
-    @inlineCallbacks
-    def startWorker(self):
-        yield Transport.startWorker(self)
-        self.message_queue = DeferredQueue()
-        self.WORKER_QUEUE.put(self)
 
-    def handle_outbound_message(self, msg):
-        self.message_queue.put(msg)
+class BenchJsSandbox(JsSandbox):
+    def get_rlimits(self, config):
+        # Let the benchmark sandbox do what it likes.
+        return {}
 
 
-class BenchApp(JsSandbox):
+class CommandSink(object):
+    """Stands in for a sandbox protocol when dispatching commands directly."""
 
-    WORKER_QUEUE = DeferredQueue()
+    pooled = False
 
-    @inlineCallbacks
-    def startWorker(self):
-        yield JsSandbox.startWorker(self)
-        self.WORKER_QUEUE.put(self)
+    def __init__(self, api):
+        self.sandbox_id = SANDBOX_ID
+        self.replies = 0
+        api.set_sandbox(self)
 
-    def sandbox_id_for_message(self, msg_or_event):
-        return "DUMMY_SANDBOX_ID"
+    def send(self, command):
+        self.replies += 1
 
-    def get_rlimits(self, config):
-        # let the benchmark sandbox do what it likes
-        return {}
+    def kill(self):
+        pass
 
 
-class Timer(object):
-    def __init__(self):
-        self.current_time = None
-        self.times = []
+class SandboxFixture(object):
+    """A sandbox worker running on a fake AMQP broker."""
 
-    def __enter__(self, *args, **kw):
-        assert self.current_time is None
-        self.current_time = time.time()
+    def __init__(self, options, pool_size=0):
+        self.options = options
+        self.pool_size = pool_size
+        self.msg_helper = MessageHelper(transport_name="bench")
+        self.worker_helper = None
+        self.app = None
 
-    def __exit__(self, *args, **kw):
-        assert self.current_time is not None
-        self.times.append(time.time() - self.current_time)
-        self.current_time = None
+    def get_config(self):
+        config = {
+            "transport_name": "bench",
+            "timeout": 10,
+            "pool_size": self.pool_size,
+            "sandbox": {
+                "kv": {
+                    "cls": "vumi.application.sandbox.RedisResource",
+                    "redis_manager": {"FAKE_REDIS": True},
+                    "keys_per_user": 1000,
+                },
+                "outbound": {
+                    "cls": "vumi.application.sandbox.OutboundResource",
+                },
+                "http": {
+                    "cls": "vumi.application.sandbox.HttpClientResource",
+                },
+            },
+        }
+        if self.options["js"]:
+            config["javascript"] = JAVASCRIPT
+        else:
+            stub = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "sandbox_stub.py")
+            config["executable"] = sys.executable
+            config["args"] = [stub]
+            if self.pool_size:
+                config["args"].append("--pooled")
+        return config
 
-    def total(self):
-        return sum(self.times)
+    @inlineCallbacks
+    def start(self):
+        app_class = BenchJsSandbox if self.options["js"] else Sandbox
+        self.worker_helper = WorkerHelper()
+        self.app = yield self.worker_helper.get_worker(
+            app_class, self.get_config())
 
-    def loops(self):
-        return len(self.times)
+    @inlineCallbacks
+    def stop(self):
+        yield self.worker_helper.cleanup()
+        self.worker_helper = None
+        self.app = None
 
-    def mean(self):
-        return self.total() / self.loops()
+    def clear_outbound(self):
+        self.worker_helper.broker.clear_messages("vumi", "bench.outbound")
 
-    def max(self):
-        return max(self.times)
+    def make_inbound(self):
+        return self.msg_helper.make_inbound("hi", sandbox_id=SANDBOX_ID)
 
-    def min(self):
-        return min(self.times)
+    def make_ack(self):
+        return self.msg_helper.make_ack(sandbox_id=SANDBOX_ID)
 
+    def check_status(self, status):
+        if status != 0:
+            raise RuntimeError("Sandbox failed with status %r." % (status,))
 
-@inlineCallbacks
-def run_bench(loops):
-    opts = VumiOptions()
-    opts.postOptions()
-    worker_creator = WorkerCreator(opts.vumi_options)
+    def process_message(self):
+        d = self.app.process_message_in_sandbox(self.make_inbound())
+        d.addCallback(self.check_status)
+        d.addCallback(lambda _: self.clear_outbound())
+        return d
 
-    app = worker_creator.create_worker_by_class(BenchApp, {
-        "transport_name": "dummy",
-        "javascript": """
-            api.on_inbound_message = function(command) {
-                this.request('outbound.reply_to', {
-                    content: 'reply',
-                    in_reply_to: command.msg.message_id,
-                },
-                function (reply) {
-                    this.done();
-                });
-            };
-        """,
-        "sandbox": {
-            'log': {
-                'cls': 'vumi.application.sandbox.LoggingResource',
-            },
-            'outbound': {
-                'cls': 'vumi.application.sandbox.OutboundResource',
-            },
-        },
-    })
-
-    transport = worker_creator.create_worker_by_class(BenchTransport, {
-        "transport_name": "dummy",
-    })
-
-    yield transport.startService()
-    log.msg("Waiting for transport ...")
-    yield BenchTransport.WORKER_QUEUE.get()
-
-    yield app.startService()
-    log.msg("Waiting for worker ...")
-    yield BenchApp.WORKER_QUEUE.get()
-
-    print "Starting %d loops ..." % (loops,)
-    timer = Timer()
-    for i in range(loops):
-        with timer:
-            transport.publish_message(
-                content="Hi!",
-                to_addr="+1234",
-                from_addr="+5678",
-                transport_type="ussd",
-            )
-            reply = yield transport.message_queue.get()
-            log.msg("Reply ID: %s" % reply['message_id'])
-
-    print "Total time: %.2f" % timer.total()
-    print "Time per message: %g" % timer.mean()
-    print "  max: %g, min: %g" % (timer.max(), timer.min())
-    print "  loops: %d" % timer.loops()
-
-    yield transport.stopService()
-    yield app.stopService()
-    reactor.stop()
+    def process_event(self):
+        d = self.app.process_event_in_sandbox(self.make_ack())
+        return d.addCallback(self.check_status)
+
+    def process_messages(self):
+        d = gatherResults([
+            self.app.process_message_in_sandbox(self.make_inbound())
+            for _ in xrange(self.options["concurrency"])])
+        d.addCallback(lambda statuses: map(self.check_status, statuses))
+        d.addCallback(lambda _: self.clear_outbound())
+        return d
+
+    def process_events(self):
+        d = gatherResults([
+            self.app.process_event_in_sandbox(self.make_ack())
+            for _ in xrange(self.options["concurrency"])])
+        return d.addCallback(
+            lambda statuses: map(self.check_status, statuses))
+
+
+class DispatchFixture(SandboxFixture):
+    """Dispatches commands to sandbox resources without a sandbox process."""
+
+    @inlineCallbacks
+    def start(self):
+        yield super(DispatchFixture, self).start()
+        self.web_server = yield reactor.listenTCP(
+            0, Site(Data("ok", "text/plain")), interface="127.0.0.1")
+        addr = self.web_server.getHost()
+        self.url = "http://%s:%s/" % (addr.host, addr.port)
+        self.msg = self.make_inbound()
+        config = yield self.app.get_config(self.msg)
+        self.api = self.app.create_sandbox_api(self.app.resources, config)
+        self.sink = CommandSink(self.api)
+        self.api.sandbox_inbound_message(self.msg)
+
+    @inlineCallbacks
+    def stop(self):
+        yield self.web_server.stopListening()
+        yield super(DispatchFixture, self).stop()
+
+    def dispatch(self, cmd, **fields):
+        command = SandboxCommand(cmd=cmd, **fields)
+        # Round trip through JSON so the command looks like one read from a
+        # sandbox.
+        return self.api.dispatch_request(
+            SandboxCommand.from_json(command.to_json()))
+
+    def kv_set(self):
+        return self.dispatch("kv.set", key="foo", value={"a": [1, 2, 3]})
+
+    def kv_get(self):
+        return self.dispatch("kv.get", key="foo")
+
+    def kv_incr(self):
+        return self.dispatch("kv.incr", key="counter")
+
+    def outbound_reply_to(self):
+        d = self.dispatch(
+            "outbound.reply_to", content="reply",
+            in_reply_to=self.msg["message_id"])
+        d.addCallback(lambda _: self.clear_outbound())
+        return d
+
+    def http_get(self):
+        return self.dispatch("http.get", url=self.url)
+
+
+class NullApi(object):
+    """A sandbox API that accepts and ignores every command."""
+
+    def set_sandbox(self, sandbox):
+        pass
+
+    def dispatch_request(self, command):
+        return succeed(None)
+
+
+class OutReceivedFixture(object):
+    """Feeds a sandbox protocol's stdout with a stream of commands."""
+
+    CHUNK_SIZE = 4096
+
+    def __init__(self, options):
+        self.options = options
+
+    def start(self):
+        lines = []
+        for i in xrange(self.options["commands"]):
+            if i % 2:
+                command = SandboxCommand(
+                    cmd="kv.set", key="key-%d" % (i,),
+                    value={"answer": "2014-07-18 15:00:00.000000",
+                           "items": range(10)})
+            else:
+                command = SandboxCommand(
+                    cmd="log.info", msg="Log message %d " % (i,) + "x" * 80)
+            lines.append(command.to_json())
+        data = "\n".join(lines) + "\n"
+        self.chunks = [data[i:i + self.CHUNK_SIZE]
+                       for i in xrange(0, len(data), self.CHUNK_SIZE)]
+        self.protocol = SandboxProtocol(
+            SANDBOX_ID, NullApi(), None, {}, {}, 60, sys.maxint)
+        self.protocol.timeout_task.cancel()
+
+    def out_received(self):
+        protocol = self.protocol
+        for chunk in self.chunks:
+            protocol.outReceived(chunk)
+        protocol.recv_bytes = 0
+        protocol._pending_requests = []
+
+
+def fixture_benchmark(name, fixture, func_name, **kw):
+    """Create a benchmark that starts the fixture before its first sample and
+    stops it after its last one."""
+    return Benchmark(name, lambda: getattr(fixture, func_name)(),
+                     setup=fixture.start, teardown=fixture.stop, **kw)
+
+
+def get_benchmarks(options):
+    benchmarks = []
+    concurrency = options["concurrency"]
+    for suffix, pool_size in [("", 0), (".pooled", options["pool-size"])]:
+        fixture = SandboxFixture(options, pool_size)
+        benchmarks.extend([
+            fixture_benchmark(
+                "round_trip.message" + suffix, fixture, "process_message"),
+            fixture_benchmark(
+                "round_trip.event" + suffix, fixture, "process_event"),
+            fixture_benchmark(
+                "throughput.message" + suffix, fixture, "process_messages",
+                ops_per_sample=concurrency),
+            fixture_benchmark(
+                "throughput.event" + suffix, fixture, "process_events",
+                ops_per_sample=concurrency),
+        ])
+
+    fixture = DispatchFixture(options)
+    benchmarks.extend([
+        fixture_benchmark("dispatch.kv.set", fixture, "kv_set"),
+        fixture_benchmark("dispatch.kv.get", fixture, "kv_get"),
+        fixture_benchmark("dispatch.kv.incr", fixture, "kv_incr"),
+        fixture_benchmark(
+            "dispatch.outbound.reply_to", fixture, "outbound_reply_to"),
+        fixture_benchmark("dispatch.http.get", fixture, "http_get"),
+    ])
+
+    fixture = OutReceivedFixture(options)
+    benchmarks.append(Benchmark(
+        "parse.out_received", fixture.out_received,
+        ops_per_sample=options["commands"], setup=fixture.start))
+    return benchmarks
 
 
 if __name__ == "__main__":
-    args = sys.argv[1:]
-    if "log" in args:
-        log.startLogging(sys.stdout)
-        args.remove("log")
-    if args:
-        loops = int(args[0])
-    else:
-        loops = 100
-    reactor.callLater(0, run_bench, loops=loops)
-    reactor.run()
+    main("sandbox", get_benchmarks, SandboxOptions)
@@ -0,0 +1,50 @@
+"""
+A stand-in for the node.js sandboxer used by the sandbox benchmarks.
+
+It speaks the sandbox command protocol over stdin and stdout without needing
+node.js. Inbound messages are answered with an ``outbound.reply_to`` command
+and inbound events increment a key via ``kv.incr``. Once the reply to that
+command arrives the stub either exits or, if ``--pooled`` is given, sends a
+``done`` command and waits for the next message or event.
+"""
+
+import json
+import sys
+
+
+class Stub(object):
+    def __init__(self, pooled):
+        self.pooled = pooled
+        self.next_id = 0
+        self.pending = None
+
+    def send(self, cmd, **fields):
+        self.next_id += 1
+        fields.update(cmd=cmd, cmd_id=str(self.next_id), reply=False)
+        sys.stdout.write(json.dumps(fields) + "\n")
+        sys.stdout.flush()
+        return fields["cmd_id"]
+
+    def handle(self, command):
+        if command.get("reply"):
+            if command["cmd_id"] == self.pending:
+                self.pending = None
+                if not self.pooled:
+                    return False
+                self.send("done")
+        elif command["cmd"] == "inbound-message":
+            self.pending = self.send(
+                "outbound.reply_to", content="reply",
+                in_reply_to=command["msg"]["message_id"])
+        elif command["cmd"] == "inbound-event":
+            self.pending = self.send("kv.incr", key="events")
+        return True
+
+    def run(self):
+        for line in iter(sys.stdin.readline, ""):
+            if line.strip() and not self.handle(json.loads(line)):
+                break
+
+
+if __name__ == "__main__":
+    Stub("--pooled" in sys.argv[1:]).run()
@@ -32,6 +32,7 @@ setup(
         'vumi/scripts/vumi_model_migrator.py',
         'vumi/scripts/vumi_count_models.py',
         'vumi/scripts/vumi_list_messages.py',
+        'vumi/scripts/vumi_reconcile_cache.py',
     ],
     install_requires=[
         cryptography,  # See above for pypy-version-dependent requirement.
@@ -21,6 +21,7 @@ from twisted.internet.defer import (
     Deferred, inlineCallbacks, maybeDeferred, returnValue, DeferredList,
     succeed)
 from twisted.internet.error import ProcessDone
+from twisted.internet.task import LoopingCall
 from twisted.python.failure import Failure
 from twisted.web.client import WebClientContextFactory, Agent
 
@@ -77,6 +78,109 @@ class SandboxError(Exception):
     """An error occurred inside the sandbox."""
 
 
+class LineFramer(object):
+    """Incrementally split a stream of data into newline separated lines.
+
+    Partial lines are buffered until the rest of the line arrives, so each
+    chunk of data is only scanned once. Lines longer than ``max_length``
+    bytes are discarded without being buffered in full and counted in
+    :attr:`lines_dropped`.
+    """
+
+    def __init__(self, max_length):
+        self.max_length = max_length
+        self.lines_dropped = 0
+        self._parts = []
+        self._buffered = 0
+        self._discarding = False
+
+    def feed(self, data):
+        """Add data to the stream and return the lines it completes."""
+        lines = []
+        start = 0
+        end = data.find("\n")
+        while end != -1:
+            self._end_line(data[start:end], lines)
+            start = end + 1
+            end = data.find("\n", start)
+        if start < len(data):
+            self._add_partial(data[start:])
+        return lines
+
+    def flush(self):
+        """Return the buffered partial line (if any) and reset the framer."""
+        line = "".join(self._parts)
+        self._parts = []
+        self._buffered = 0
+        self._discarding = False
+        return line
+
+    def _end_line(self, part, lines):
+        if self._discarding:
+            self._discarding = False
+            return
+        if self._parts:
+            self._parts.append(part)
+            line = self.flush()
+        else:
+            line = part
+        if len(line) > self.max_length:
+            self.lines_dropped += 1
+        else:
+            lines.append(line)
+
+    def _add_partial(self, part):
+        if self._discarding:
+            return
+        self._buffered += len(part)
+        if self._buffered > self.max_length:
+            self.flush()
+            self._discarding = True
+            self.lines_dropped += 1
+        else:
+            self._parts.append(part)
+
+
+class SandboxCounters(object):
+    """Counts the commands and data a sandbox sends to the worker.
+
+    :meth:`snapshot` reports the totals and rates since the previous
+    snapshot, which makes it easy to spot chatty sandboxes.
+    """
+
+    clock = reactor
+
+    def __init__(self):
+        self.commands = 0
+        self.bytes = 0
+        self.lines_dropped = 0
+        self._last_snapshot = (self.clock.seconds(), 0, 0)
+
+    def record(self, nbytes, ncommands=0):
+        self.bytes += nbytes
+        self.commands += ncommands
+
+    def snapshot(self):
+        """Return a dictionary of counts and per-second rates since the
+        previous snapshot.
+        """
+        now = self.clock.seconds()
+        then, commands, nbytes = self._last_snapshot
+        self._last_snapshot = (now, self.commands, self.bytes)
+        elapsed = now - then
+        commands = self.commands - commands
+        nbytes = self.bytes - nbytes
+        return {
+            'commands': commands,
+            'bytes': nbytes,
+            'commands_per_sec': commands / elapsed if elapsed > 0 else 0.0,
+            'bytes_per_sec': nbytes / elapsed if elapsed > 0 else 0.0,
+            'total_commands': self.commands,
+            'total_bytes': self.bytes,
+            'lines_dropped': self.lines_dropped,
+        }
+
+
 class SandboxProtocol(ProcessProtocol):
     """A protocol for communicating over stdin and stdout with a sandboxed
     process.
@@ -95,8 +199,11 @@ class SandboxProtocol(ProcessProtocol):
     via the supplied :class:`SandboxApi`.
     """
 
+    pooled = False
+
     def __init__(self, sandbox_id, api, executable, spawn_kwargs,
-                 rlimits, timeout, recv_limit):
+                 rlimits, timeout, recv_limit, max_line_length=None,
+                 counters=None):
         self.sandbox_id = sandbox_id
         self.api = api
         self.executable = executable
@@ -106,11 +213,19 @@ class SandboxProtocol(ProcessProtocol):
         self._done = MultiDeferred()
         self._pending_requests = []
         self.exit_reason = None
+        self.ended = False
+        self.timeout = timeout
         self.timeout_task = reactor.callLater(timeout, self.kill)
         self.recv_limit = recv_limit
         self.recv_bytes = 0
-        self.chunk = ''
-        self.error_chunk = ''
+        if max_line_length is None:
+            max_line_length = recv_limit
+        self.max_line_length = max_line_length
+        self.out_framer = LineFramer(max_line_length)
+        self.err_framer = LineFramer(max_line_length)
+        if counters is None:
+            counters = SandboxCounters()
+        self.counters = counters
         self.error_lines = []
         api.set_sandbox(self)
 
@@ -150,12 +265,20 @@ class SandboxProtocol(ProcessProtocol):
     def connectionMade(self):
         self._started.callback(self)
 
-    def _process_data(self, chunk, data):
+    def _process_data(self, framer, data):
         if not self.check_recv(len(data)):
-            return ['']  # skip the data if it's too big
-        line_parts = data.split("\n")
-        line_parts[0] = chunk + line_parts[0]
-        return line_parts
+            framer.flush()
+            return []  # skip the data if it's too big
+        dropped = framer.lines_dropped
+        lines = framer.feed(data)
+        if framer.lines_dropped > dropped:
+            self.counters.lines_dropped += framer.lines_dropped - dropped
+            self.kill()
+            self.api.log("Sandbox %r killed for writing a line longer than"
+                         " %d bytes." % (self.sandbox_id,
+                                         self.max_line_length),
+                         level=logging.ERROR)
+        return lines
 
     def _parse_command(self, line):
         try:
@@ -163,29 +286,30 @@ class SandboxProtocol(ProcessProtocol):
         except Exception, e:
             return SandboxCommand(cmd="unknown", line=line, exception=e)
 
+    def _handle_command(self, command):
+        d = self.api.dispatch_request(command)
+        self._pending_requests.append(d)
+
     def outReceived(self, data):
-        lines = self._process_data(self.chunk, data)
-        for i in range(len(lines) - 1):
-            d = self.api.dispatch_request(self._parse_command(lines[i]))
-            self._pending_requests.append(d)
-        self.chunk = lines[-1]
+        lines = self._process_data(self.out_framer, data)
+        self.counters.record(len(data), len(lines))
+        for line in lines:
+            self._handle_command(self._parse_command(line))
 
     def outConnectionLost(self):
-        if self.chunk:
-            line, self.chunk = self.chunk, ""
-            d = self.api.dispatch_request(self._parse_command(line))
-            self._pending_requests.append(d)
+        line = self.out_framer.flush()
+        if line:
+            self.counters.record(0, 1)
+            self._handle_command(self._parse_command(line))
 
     def errReceived(self, data):
-        lines = self._process_data(self.error_chunk, data)
-        for i in range(len(lines) - 1):
-            self.error_lines.append(lines[i])
-        self.error_chunk = lines[-1]
+        self.counters.record(len(data))
+        self.error_lines.extend(self._process_data(self.err_framer, data))
 
     def errConnectionLost(self):
-        if self.error_chunk:
-            self.error_lines.append(self.error_chunk)
-            self.error_chunk = ""
+        line = self.err_framer.flush()
+        if line:
+            self.error_lines.append(line)
 
     def _process_request_results(self, results):
         for success, result in results:
@@ -197,7 +321,13 @@ class SandboxProtocol(ProcessProtocol):
                 # api so that the sandbox owner gets to see them too
                 self.api.log(result.getErrorMessage(), logging.ERROR)
 
+    def _log_error_lines(self):
+        if self.error_lines:
+            self.api.log("\n".join(self.error_lines), logging.ERROR)
+            self.error_lines = []
+
     def processEnded(self, reason):
+        self.ended = True
         if self.timeout_task.active():
             self.timeout_task.cancel()
         if isinstance(reason.value, ProcessDone):
@@ -207,14 +337,207 @@ class SandboxProtocol(ProcessProtocol):
         if not self._started.fired():
             self._started.callback(Failure(
                 SandboxError("Process failed to start.")))
-        if self.error_lines:
-            self.api.log("\n".join(self.error_lines), logging.ERROR)
-            self.error_lines = []
+        self._log_error_lines()
         requests_done = DeferredList(self._pending_requests)
         requests_done.addCallback(self._process_request_results)
         requests_done.addCallback(lambda _r: self._done.callback(result))
 
 
+class PooledSandboxProtocol(SandboxProtocol):
+    """A :class:`SandboxProtocol` for a long-lived sandbox process that
+    handles several messages or events, one after the other.
+
+    Each message or event is handled in a run started by calling
+    :meth:`begin_run`. The run ends when the sandboxed process sends a
+    ``done`` command (or when the process ends) and the process is then
+    ready for the next run.
+
+    The ``timeout`` and ``recv_limit`` apply to each run rather than to the
+    lifetime of the process. The rlimits still apply to the whole process, so
+    limits such as ``RLIMIT_CPU`` accumulate across runs.
+    """
+
+    pooled = True
+
+    def __init__(self, *args, **kw):
+        SandboxProtocol.__init__(self, *args, **kw)
+        self.runs = 0
+        self._run_done = None
+
+    def begin_run(self):
+        """Start a new run.
+
+        Returns a deferred that fires with ``0`` once the sandboxed process
+        reports that it is done, or with the process exit status (or
+        failure) if the process ends first.
+        """
+        if self._run_done is not None:
+            raise SandboxError("Sandbox %r is already running."
+                               % (self.sandbox_id,))
+        self.runs += 1
+        self.recv_bytes = 0
+        if self.timeout_task.active():
+            self.timeout_task.cancel()
+        self.timeout_task = reactor.callLater(self.timeout, self.kill)
+        self._run_done = Deferred()
+        return self._run_done
+
+    def _end_run(self, result):
+        if self.timeout_task.active():
+            self.timeout_task.cancel()
+        d, self._run_done = self._run_done, None
+        if d is not None:
+            d.callback(result)
+
+    def _finish_run(self):
+        requests, self._pending_requests = self._pending_requests, []
+        requests_done = DeferredList(requests)
+        requests_done.addCallback(self._process_request_results)
+        requests_done.addCallback(lambda _r: self._log_error_lines())
+        requests_done.addCallback(lambda _r: self._end_run(0))
+
+    def _handle_command(self, command):
+        if command['cmd'] == 'done' and self._run_done is not None:
+            self._finish_run()
+        else:
+            SandboxProtocol._handle_command(self, command)
+
+    def processEnded(self, reason):
+        SandboxProtocol.processEnded(self, reason)
+        self.done().addBoth(self._end_run)
+
+
+class SandboxPool(object):
+    """A pool of warm sandbox processes, keyed by sandbox id.
+
+    Processes are spawned and initialised on demand and returned to the pool
+    after each successful run. A process is stopped instead of being returned
+    to the pool if it ended, timed out or failed, if it has handled
+    ``max_messages`` runs or if the pool already holds ``max_idle`` processes
+    for its sandbox id. Idle processes are stopped after ``idle_timeout``
+    seconds.
+
+    :param Sandbox app_worker:
+        The sandbox worker to create sandbox protocols with.
+    :param int max_idle:
+        Maximum number of idle processes to keep for each sandbox id.
+    :param int max_messages:
+        Maximum number of runs a process handles before it is replaced.
+    :param float idle_timeout:
+        Number of seconds an idle process is kept for.
+    """
+
+    clock = reactor
+
+    def __init__(self, app_worker, max_idle, max_messages, idle_timeout):
+        self.app_worker = app_worker
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        self.idle_timeout = idle_timeout
+        self.spawned = 0
+        self._idle = {}
+        self._busy = set()
+
+    def idle_count(self, sandbox_id):
+        return len(self._idle.get(sandbox_id, []))
+
+    def _pop_idle(self, sandbox_id):
+        idle = self._idle.get(sandbox_id, [])
+        protocol = None
+        while idle and protocol is None:
+            protocol, eviction = idle.pop()
+            eviction.cancel()
+            if protocol.ended:
+                protocol = None
+        if not idle:
+            self._idle.pop(sandbox_id, None)
+        return protocol
+
+    @inlineCallbacks
+    def acquire(self, msg_or_event, config):
+        """Return a started and initialised sandbox protocol for the sandbox
+        id in ``config``, spawning a new process if there is no idle one.
+        """
+        protocol = self._pop_idle(config.sandbox_id)
+        if protocol is None:
+            protocol = yield self.app_worker.sandbox_protocol_for_message(
+                msg_or_event, config)
+            protocol.spawn()
+            self.spawned += 1
+            yield protocol.started()
+            protocol.api.sandbox_init()
+        self._busy.add(protocol)
+        returnValue(protocol)
+
+    def release(self, protocol, status):
+        """Return a sandbox protocol to the pool after a run, or stop it if
+        it should not be reused.
+        """
+        self._busy.discard(protocol)
+        sandbox_id = protocol.sandbox_id
+        reusable = (status == 0 and not protocol.ended and
+                    protocol.runs < self.max_messages)
+        if reusable and self.idle_count(sandbox_id) < self.max_idle:
+            eviction = self.clock.callLater(
+                self.idle_timeout, self._evict, protocol)
+            self._idle.setdefault(sandbox_id, []).append((protocol, eviction))
+        else:
+            protocol.kill()
+
+    def _evict(self, protocol):
+        idle = self._idle.get(protocol.sandbox_id, [])
+        for entry in idle:
+            if entry[0] is protocol:
+                idle.remove(entry)
+                break
+        if not idle:
+            self._idle.pop(protocol.sandbox_id, None)
+        protocol.kill()
+
+    @inlineCallbacks
+    def process_in_sandbox(self, msg_or_event, config, api_callback):
+        """Run ``api_callback`` with the :class:`SandboxApi` of a pooled
+        sandbox and return a deferred that fires with the run status, which
+        is ``0`` on success and ``None`` if the run failed.
+        """
+        try:
+            protocol = yield self.acquire(msg_or_event, config)
+        except Exception:
+            log.error()
+            returnValue(None)
+        d = protocol.begin_run()
+        protocol.api.clear_inbound_messages()
+        api_callback(protocol.api)
+        try:
+            status = yield d
+        except Exception:
+            log.error()
+            status = None
+        self.release(protocol, status)
+        returnValue(status)
+
+    def close(self):
+        """Stop all pooled processes.
+
+        Returns a deferred that fires once they have all ended.
+        """
+        protocols = list(self._busy)
+        for idle in self._idle.itervalues():
+            for protocol, eviction in idle:
+                eviction.cancel()
+                protocols.append(protocol)
+        self._idle = {}
+        self._busy = set()
+        ds = []
+        for protocol in protocols:
+            if not protocol.ended:
+                d = protocol.done()
+                d.addErrback(lambda f: None)
+                ds.append(d)
+                protocol.kill()
+        return DeferredList(ds)
+
+
 class SandboxResources(object):
     """Class for holding resources common to a set of sandboxes."""
 
@@ -631,9 +954,12 @@ class JsSandboxResource(SandboxResource):
     def sandbox_init(self, api):
         javascript = self.app_worker.javascript_for_api(api)
         app_context = self.app_worker.app_context_for_api(api)
+        extra = {}
+        if api.pooled:
+            extra['pooled'] = True
         api.sandbox_send(SandboxCommand(cmd="initialize",
                                         javascript=javascript,
-                                        app_context=app_context))
+                                        app_context=app_context, **extra))
 
 
 class LoggingResource(SandboxResource):
@@ -1050,6 +1376,10 @@ class SandboxApi(object):
     def sandbox_id(self):
         return self._sandbox.sandbox_id
 
+    @property
+    def pooled(self):
+        return self._sandbox.pooled
+
     def set_sandbox(self, sandbox):
         if self._sandbox is not None:
             raise SandboxError("Sandbox already set ("
@@ -1061,6 +1391,9 @@ class SandboxApi(object):
         for resource in self.resources.resources.values():
             resource.sandbox_init(self)
 
+    def clear_inbound_messages(self):
+        self._inbound_messages.clear()
+
     def sandbox_inbound_message(self, msg):
         self._inbound_messages[msg['message_id']] = msg
         self.sandbox_send(SandboxCommand(cmd="inbound-message",
@@ -1165,6 +1498,14 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
     recv_limit = ConfigInt(
         "Maximum number of bytes that will be read from a sandboxed"
         " process' stdout and stderr combined.", default=1024 * 1024)
+    max_line_length = ConfigInt(
+        "Maximum number of bytes in a single line written to a sandboxed"
+        " process' stdout or stderr. Processes that write longer lines are"
+        " killed. Defaults to `recv_limit`.", default=None)
+    counters_log_interval = ConfigInt(
+        "Number of seconds between logging the number of commands and bytes"
+        " each sandbox has sent since the previous interval. Set to null"
+        " (the default) to disable.", default=None, static=True)
     rlimits = ConfigDict(
         "Dictionary of resource limits to be applied to sandboxed"
         " processes. Defaults are fairly restricted. Keys maybe"
@@ -1178,6 +1519,20 @@ class SandboxConfig(ApplicationWorker.CONFIG_CLASS):
         " these directly using Twisted logging instead.",
         default=None)
     sandbox_id = ConfigText("This is set based on individual messages.")
+    pool_size = ConfigInt(
+        "Maximum number of idle sandbox processes to keep for each sandbox"
+        " id so that later messages and events can reuse them. The sandboxed"
+        " code must send a `done` command instead of exiting for a process"
+        " to be reused. The default of 0 disables pooling and spawns a new"
+        " process for every message and event.", default=0, static=True)
+    pool_max_messages = ConfigInt(
+        "Number of messages and events a pooled sandbox process handles"
+        " before it is replaced. Rlimits apply to the whole life of a pooled"
+        " process, so keep this low enough that cumulative limits such as"
+        " RLIMIT_CPU are not reached.", default=100, static=True)
+    pool_idle_timeout = ConfigInt(
+        "Number of seconds an idle pooled sandbox process is kept for.",
+        default=60, static=True)
 
 
 class Sandbox(ApplicationWorker):
@@ -1198,15 +1553,24 @@ class Sandbox(ApplicationWorker):
         resource.RLIMIT_AS: (196 * MB, 196 * MB),
     }
 
+    sandbox_pool = None
+    _counters_logger = None
+
     def validate_config(self):
         config = self.get_static_config()
         self.resources = self.create_sandbox_resources(config.sandbox)
         self.resources.validate_config()
 
     def get_config(self, msg):
-        config = self.config.copy()
-        config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        sandbox_id = self.sandbox_id_for_message(msg)
+
+        def get_config_data():
+            config = self.config.copy()
+            config['sandbox_id'] = sandbox_id
+            return config
+
+        return succeed(self.get_cached_config(
+            ('sandbox_id', sandbox_id), get_config_data))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -1217,10 +1581,54 @@ class Sandbox(ApplicationWorker):
         return rlimits
 
     def setup_application(self):
+        config = self.get_static_config()
+        if config.pool_size > 0:
+            self.sandbox_pool = self.create_sandbox_pool(config)
+        self.sandbox_counters = {}
+        if config.counters_log_interval:
+            self._counters_logger = LoopingCall(self.log_sandbox_counters)
+            self._counters_logger.start(
+                config.counters_log_interval, now=False)
         return self.resources.setup_resources()
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.resources.teardown_resources()
+        if self._counters_logger is not None:
+            if self._counters_logger.running:
+                self._counters_logger.stop()
+            self._counters_logger = None
+        if self.sandbox_pool is not None:
+            yield self.sandbox_pool.close()
+        yield self.resources.teardown_resources()
+
+    def get_sandbox_counters(self, sandbox_id):
+        """Return the :class:`SandboxCounters` shared by all processes for
+        the given sandbox id.
+
+        Counters are only shared so that they can be logged, so if
+        ``counters_log_interval`` isn't set, new counters are returned
+        instead.
+        """
+        if self._counters_logger is None:
+            return SandboxCounters()
+        counters = self.sandbox_counters.get(sandbox_id)
+        if counters is None:
+            counters = self.sandbox_counters[sandbox_id] = SandboxCounters()
+        return counters
+
+    def log_sandbox_counters(self):
+        for sandbox_id, counters in sorted(self.sandbox_counters.items()):
+            stats = counters.snapshot()
+            if not (stats['commands'] or stats['bytes']):
+                # Forget idle sandboxes so that we don't keep counters for
+                # every sandbox id we've ever seen.
+                del self.sandbox_counters[sandbox_id]
+                continue
+            log.info("Sandbox %r sent %d commands (%.1f/s) and %d bytes"
+                     " (%.1f/s)." % (
+                         sandbox_id, stats['commands'],
+                         stats['commands_per_sec'], stats['bytes'],
+                         stats['bytes_per_sec']))
 
     def setup_connectors(self):
         # Set the default event handler so we can handle events from any
@@ -1244,14 +1652,24 @@ class Sandbox(ApplicationWorker):
         rlimits.update(self._convert_rlimits(config.rlimits))
         return rlimits
 
+    def create_sandbox_pool(self, config):
+        return SandboxPool(
+            self, config.pool_size, config.pool_max_messages,
+            config.pool_idle_timeout)
+
     def create_sandbox_protocol(self, api):
         executable, args = self.get_executable_and_args(api.config)
         rlimits = self.get_rlimits(api.config)
         spawn_kwargs = dict(
             args=args, env=api.config.env, path=api.config.path)
-        return SandboxProtocol(
+        protocol_cls = SandboxProtocol
+        if self.sandbox_pool is not None:
+            protocol_cls = PooledSandboxProtocol
+        return protocol_cls(
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
-            api.config.timeout, api.config.recv_limit)
+            api.config.timeout, api.config.recv_limit,
+            max_line_length=api.config.max_line_length,
+            counters=self.get_sandbox_counters(api.config.sandbox_id))
 
     def create_sandbox_api(self, resources, config):
         return SandboxApi(resources, config)
@@ -1289,6 +1707,10 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_message_in_sandbox(self, msg):
         config = yield self.get_config(msg)
+        if self.sandbox_pool is not None:
+            status = yield self.sandbox_pool.process_in_sandbox(
+                msg, config, lambda api: api.sandbox_inbound_message(msg))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(msg, config)
 
         def sandbox_init():
@@ -1300,6 +1722,10 @@ class Sandbox(ApplicationWorker):
     @inlineCallbacks
     def process_event_in_sandbox(self, event):
         config = yield self.get_config(event)
+        if self.sandbox_pool is not None:
+            status = yield self.sandbox_pool.process_in_sandbox(
+                event, config, lambda api: api.sandbox_inbound_event(event))
+            returnValue(status)
         sandbox_protocol = yield self.sandbox_protocol_for_message(
             event, config)
 
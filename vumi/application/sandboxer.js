@@ -57,6 +57,7 @@ var SandboxRunner = function (api) {
     self.chunk = "";
     self.pending_requests = {};
     self.loaded = false;
+    self.pooled = false;
 
     self.emitter.on('command', function (command) {
         var handler_name = "on_" + command.cmd.replace('.', '_').replace('-', '_');
@@ -89,15 +90,27 @@ var SandboxRunner = function (api) {
     });
 
     self.api.emitter.on('done', function() {
-        self.exit();
+        if (self.pooled) {
+            self.finish();
+        }
+        else {
+            self.exit();
+        }
     });
 
     self.exit = function() {
         process.exit(0);
     };
 
+    self.finish = function() {
+        // Pooled sandboxes are reused for the next command, so tell the
+        // parent we're done instead of exiting.
+        self.send_command(self.api.populate_command("done", {}));
+    };
+
     self.load_code = function (command) {
         self.log("Loading sandboxed code ...");
+        self.pooled = !!command.pooled;
         var ctxt;
         var loaded_module = vm.createScript(command.javascript);
         if (command.app_context) {
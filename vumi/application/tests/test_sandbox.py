@@ -16,12 +16,14 @@ from OpenSSL.SSL import (
     TLSv1_METHOD)
 
 from twisted.internet.defer import (
-    inlineCallbacks, fail, succeed, DeferredQueue)
+    inlineCallbacks, fail, succeed, DeferredQueue, returnValue)
 from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
 from twisted.web.http_headers import Headers
 
 from vumi.application.sandbox import (
-    Sandbox, SandboxApi, SandboxCommand, SandboxResources,
+    Sandbox, SandboxApi, SandboxCommand, SandboxResources, SandboxCounters,
+    LineFramer,
     SandboxResource, RedisResource, OutboundResource, JsSandboxResource,
     LoggingResource, HttpClientResource, JsSandbox, JsFileSandbox,
     HttpClientContextFactory, HttpClientPolicyForHTTPS, make_context_factory)
@@ -397,6 +399,307 @@ class TestSandbox(SandboxTestCaseBase):
         cmd = SandboxCommand.from_json(json_cmd)
         self.assertEqual(cmd['timestamp'], "2014-07-18 15:00:00.000000")
 
+    @inlineCallbacks
+    def test_max_line_length(self):
+        app = yield self.setup_app(
+            "import sys, time\n"
+            "sys.stdout.write('a' * 50)\n"
+            "sys.stdout.flush()\n"
+            "time.sleep(0.1)\n"
+            "sys.stdout.write('a' * 60)\n"
+            "sys.stdout.flush()\n"
+            "time.sleep(5)\n",
+            {'max_line_length': '100', 'counters_log_interval': 60})
+        with LogCatcher(log_level=logging.ERROR) as lc:
+            status = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+            msgs = lc.messages()
+        self.assertEqual(status, None)
+        self.assertEqual(msgs, [
+            "Sandbox 'sandbox1' killed for writing a line longer than 100"
+            " bytes."])
+        [kill_err] = self.flushLoggedErrors(ProcessTerminated)
+        self.assertTrue('process ended by signal' in str(kill_err.value))
+        counters = app.get_sandbox_counters('sandbox1')
+        self.assertEqual(counters.lines_dropped, 1)
+        self.assertEqual(counters.commands, 0)
+
+    @inlineCallbacks
+    def test_sandbox_counters(self):
+        log_line = json.dumps({'cmd': 'log.info', 'cmd_id': '1',
+                               'reply': False, 'msg': 'hi'}) + '\n'
+        app = yield self.setup_app(
+            "import sys\n"
+            "sys.stdout.write(%r * 3)\n" % (log_line,),
+            {'sandbox': {
+                'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+            }, 'counters_log_interval': 60})
+        for _ in range(2):
+            status = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+            self.assertEqual(status, 0)
+        counters = app.get_sandbox_counters('sandbox1')
+        self.assertEqual(counters.commands, 6)
+        self.assertEqual(counters.bytes, 6 * len(log_line))
+        self.assertEqual(app.sandbox_counters.keys(), ['sandbox1'])
+
+    @inlineCallbacks
+    def test_sandbox_counters_not_kept_without_logging(self):
+        app = yield self.setup_app("")
+        counters = app.get_sandbox_counters('sandbox1')
+        self.assertNotIdentical(
+            app.get_sandbox_counters('sandbox1'), counters)
+        self.assertEqual(app.sandbox_counters, {})
+
+    @inlineCallbacks
+    def test_log_sandbox_counters(self):
+        app = yield self.setup_app("", {'counters_log_interval': 60})
+        clock = Clock()
+        self.patch(SandboxCounters, 'clock', clock)
+        counters = app.get_sandbox_counters('sandbox1')
+        app.get_sandbox_counters('sandbox2')
+        counters.record(1000, 10)
+        clock.advance(5)
+        with LogCatcher() as lc:
+            app.log_sandbox_counters()
+            # Idle sandboxes are forgotten.
+            self.assertEqual(app.sandbox_counters.keys(), ['sandbox1'])
+            app.log_sandbox_counters()
+            self.assertEqual(app.sandbox_counters, {})
+            msgs = lc.messages()
+        self.assertEqual(msgs, [
+            "Sandbox 'sandbox1' sent 10 commands (2.0/s) and 1000 bytes"
+            " (200.0/s)."])
+
+    @inlineCallbacks
+    def test_counters_log_interval(self):
+        app = yield self.setup_app("", {'counters_log_interval': 60})
+        self.assertTrue(app._counters_logger.running)
+        self.assertEqual(app._counters_logger.interval, 60)
+        yield self.app_helper.cleanup_worker(app)
+        self.assertEqual(app._counters_logger, None)
+
+
+class TestLineFramer(VumiTestCase):
+    def test_complete_lines(self):
+        framer = LineFramer(100)
+        self.assertEqual(framer.feed("a\nbb\n\nccc\n"),
+                         ["a", "bb", "", "ccc"])
+        self.assertEqual(framer.flush(), "")
+
+    def test_partial_lines(self):
+        framer = LineFramer(100)
+        self.assertEqual(framer.feed("a\nb"), ["a"])
+        self.assertEqual(framer.feed("b"), [])
+        self.assertEqual(framer.feed("b\nc"), ["bbb"])
+        self.assertEqual(framer.flush(), "c")
+        self.assertEqual(framer.flush(), "")
+
+    def test_line_split_over_many_chunks(self):
+        framer = LineFramer(1000)
+        lines = []
+        for _ in range(99):
+            lines.extend(framer.feed("x" * 10))
+        lines.extend(framer.feed("x" * 10 + "\n"))
+        self.assertEqual(lines, ["x" * 1000])
+
+    def test_long_complete_line_dropped(self):
+        framer = LineFramer(5)
+        self.assertEqual(framer.feed("12345\n123456\n1\n"), ["12345", "1"])
+        self.assertEqual(framer.lines_dropped, 1)
+
+    def test_long_partial_line_discarded(self):
+        framer = LineFramer(5)
+        self.assertEqual(framer.feed("1234"), [])
+        self.assertEqual(framer.feed("56"), [])
+        self.assertEqual(framer.lines_dropped, 1)
+        self.assertEqual(framer.feed("789"), [])
+        self.assertEqual(framer.feed("0\nok\n"), ["ok"])
+        self.assertEqual(framer.lines_dropped, 1)
+
+    def test_long_line_completed_in_later_chunk(self):
+        framer = LineFramer(5)
+        self.assertEqual(framer.feed("123"), [])
+        self.assertEqual(framer.feed("456\nok\n"), ["ok"])
+        self.assertEqual(framer.lines_dropped, 1)
+
+
+class TestSandboxCounters(VumiTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(SandboxCounters, 'clock', self.clock)
+
+    def test_snapshot(self):
+        counters = SandboxCounters()
+        counters.record(100, 2)
+        counters.record(50)
+        self.clock.advance(2)
+        self.assertEqual(counters.snapshot(), {
+            'commands': 2,
+            'bytes': 150,
+            'commands_per_sec': 1.0,
+            'bytes_per_sec': 75.0,
+            'total_commands': 2,
+            'total_bytes': 150,
+            'lines_dropped': 0,
+        })
+        counters.record(10, 1)
+        self.clock.advance(10)
+        snapshot = counters.snapshot()
+        self.assertEqual(snapshot['commands'], 1)
+        self.assertEqual(snapshot['bytes'], 10)
+        self.assertEqual(snapshot['commands_per_sec'], 0.1)
+        self.assertEqual(snapshot['total_commands'], 3)
+
+    def test_snapshot_no_time_elapsed(self):
+        counters = SandboxCounters()
+        counters.record(10, 1)
+        snapshot = counters.snapshot()
+        self.assertEqual(snapshot['commands_per_sec'], 0.0)
+        self.assertEqual(snapshot['bytes_per_sec'], 0.0)
+
+
+class TestPooledSandbox(SandboxTestCaseBase):
+
+    POOLED_ECHO = (
+        "import sys, os, json\n"
+        "while True:\n"
+        "    line = sys.stdin.readline()\n"
+        "    if not line:\n"
+        "        break\n"
+        "    cmd = json.loads(line)\n"
+        "    if cmd['reply']:\n"
+        "        continue\n"
+        "    log = {'cmd': 'log.info', 'cmd_id': '1', 'reply': False,\n"
+        "           'msg': '%s %s' % (os.getpid(), cmd['cmd'])}\n"
+        "    sys.stdout.write(json.dumps(log) + '\\n')\n"
+        "    done = {'cmd': 'done', 'cmd_id': '2', 'reply': False}\n"
+        "    sys.stdout.write(json.dumps(done) + '\\n')\n"
+        "    sys.stdout.flush()\n"
+    )
+
+    def setup_app(self, python_code=POOLED_ECHO, extra_config=None):
+        config = {
+            'pool_size': 1,
+            'sandbox': {
+                'log': {'cls': 'vumi.application.sandbox.LoggingResource'},
+            },
+        }
+        config.update(extra_config or {})
+        return super(TestPooledSandbox, self).setup_app(
+            sys.executable, ['-c', python_code], extra_config=config)
+
+    @inlineCallbacks
+    def process_messages(self, app, *sandbox_ids):
+        statuses = []
+        with LogCatcher() as lc:
+            for sandbox_id in sandbox_ids:
+                statuses.append((yield app.process_message_in_sandbox(
+                    self.app_helper.make_inbound(
+                        "foo", sandbox_id=sandbox_id))))
+            msgs = lc.messages()
+        returnValue((statuses, msgs))
+
+    @inlineCallbacks
+    def test_process_reused(self):
+        app = yield self.setup_app()
+        statuses, msgs = yield self.process_messages(
+            app, 'sandbox1', 'sandbox1')
+        self.assertEqual(statuses, [0, 0])
+        [(pid1, cmd1), (pid2, cmd2)] = [msg.split() for msg in msgs]
+        self.assertEqual(pid1, pid2)
+        self.assertEqual([cmd1, cmd2], ['inbound-message'] * 2)
+        self.assertEqual(app.sandbox_pool.spawned, 1)
+        self.assertEqual(app.sandbox_pool.idle_count('sandbox1'), 1)
+
+    @inlineCallbacks
+    def test_events_reuse_process(self):
+        app = yield self.setup_app()
+        with LogCatcher() as lc:
+            yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+            status = yield app.process_event_in_sandbox(
+                self.app_helper.make_ack(sandbox_id='sandbox1'))
+            msgs = lc.messages()
+        self.assertEqual(status, 0)
+        self.assertEqual([msg.split()[1] for msg in msgs],
+                         ['inbound-message', 'inbound-event'])
+        self.assertEqual(app.sandbox_pool.spawned, 1)
+
+    @inlineCallbacks
+    def test_processes_keyed_by_sandbox_id(self):
+        app = yield self.setup_app()
+        statuses, msgs = yield self.process_messages(
+            app, 'sandbox1', 'sandbox2', 'sandbox1')
+        self.assertEqual(statuses, [0, 0, 0])
+        pids = [msg.split()[0] for msg in msgs]
+        self.assertNotEqual(pids[0], pids[1])
+        self.assertEqual(pids[0], pids[2])
+        self.assertEqual(app.sandbox_pool.spawned, 2)
+
+    @inlineCallbacks
+    def test_max_messages(self):
+        app = yield self.setup_app(extra_config={'pool_max_messages': 2})
+        statuses, msgs = yield self.process_messages(
+            app, 'sandbox1', 'sandbox1', 'sandbox1')
+        self.assertEqual(statuses, [0, 0, 0])
+        pids = [msg.split()[0] for msg in msgs]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+        self.assertEqual(app.sandbox_pool.spawned, 2)
+
+    @inlineCallbacks
+    def test_exited_process_not_reused(self):
+        app = yield self.setup_app(
+            "import sys, json\n"
+            "cmd = json.loads(sys.stdin.readline())\n"
+            "log = {'cmd': 'log.info', 'cmd_id': '1',\n"
+            "       'reply': False, 'msg': cmd['cmd']}\n"
+            "sys.stdout.write(json.dumps(log) + '\\n')\n")
+        statuses, msgs = yield self.process_messages(
+            app, 'sandbox1', 'sandbox1')
+        self.assertEqual(statuses, [0, 0])
+        self.assertEqual(msgs, ['inbound-message'] * 2)
+        self.assertEqual(app.sandbox_pool.spawned, 2)
+        self.assertEqual(app.sandbox_pool.idle_count('sandbox1'), 0)
+
+    @inlineCallbacks
+    def test_idle_eviction(self):
+        app = yield self.setup_app(extra_config={'pool_idle_timeout': 30})
+        clock = app.sandbox_pool.clock = Clock()
+        yield self.process_messages(app, 'sandbox1')
+        [(protocol, _)] = app.sandbox_pool._idle['sandbox1']
+        clock.advance(29)
+        self.assertEqual(app.sandbox_pool.idle_count('sandbox1'), 1)
+        clock.advance(1)
+        self.assertEqual(app.sandbox_pool.idle_count('sandbox1'), 0)
+        yield self.assertFailure(protocol.done(), ProcessTerminated)
+        self.assertTrue(protocol.ended)
+
+    @inlineCallbacks
+    def test_timed_out_process_recycled(self):
+        app = yield self.setup_app(
+            "import sys, time\n"
+            "sys.stdin.readline()\n"
+            "time.sleep(5)\n",
+            {'timeout': '1'})
+        statuses, msgs = yield self.process_messages(app, 'sandbox1')
+        self.assertEqual(statuses, [None])
+        [kill_err] = self.flushLoggedErrors(ProcessTerminated)
+        self.assertTrue('process ended by signal' in str(kill_err.value))
+        self.assertEqual(app.sandbox_pool.idle_count('sandbox1'), 0)
+
+    @inlineCallbacks
+    def test_process_failed_to_start(self):
+        app = yield self.setup_app()
+        self.patch(app, 'get_executable_and_args',
+                   lambda config: ('/nonexistent', ['/nonexistent']))
+        statuses, msgs = yield self.process_messages(app, 'sandbox1')
+        self.assertEqual(statuses, [None])
+        errors = self.flushLoggedErrors()
+        self.assertTrue(errors)
+        self.assertEqual(app.sandbox_pool.idle_count('sandbox1'), 0)
+
 
 class JsSandboxTestMixin(object):
 
@@ -428,6 +731,37 @@ class JsSandboxTestMixin(object):
             'Done.',
         ])
 
+    @inlineCallbacks
+    def test_js_sandboxer_pooled(self):
+        app_js = pkg_resources.resource_filename('vumi.application.tests',
+                                                 'app.js')
+        javascript = file(app_js).read()
+        app = yield self.setup_app(javascript, extra_config={
+            "pool_size": 1,
+        })
+
+        with LogCatcher() as lc:
+            status1 = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("foo", sandbox_id='sandbox1'))
+            status2 = yield app.process_message_in_sandbox(
+                self.app_helper.make_inbound("bar", sandbox_id='sandbox1'))
+            failures = [log['failure'].value for log in lc.errors]
+            msgs = lc.messages()
+        self.assertEqual(failures, [])
+        self.assertEqual([status1, status2], [0, 0])
+        self.assertEqual(app.sandbox_pool.spawned, 1)
+        self.assertEqual(msgs, [
+            'Starting sandbox ...',
+            'Loading sandboxed code ...',
+            'From init!',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+            'From command: inbound-message',
+            'Log successful: true',
+            'Done.',
+        ])
+
     @inlineCallbacks
     def test_js_sandboxer_with_app_context(self):
         app_js = pkg_resources.resource_filename('vumi.application.tests',
@@ -525,6 +859,8 @@ class TestJsFileSandbox(SandboxTestCaseBase, JsSandboxTestMixin):
 class DummyAppWorker(object):
 
     class DummyApi(object):
+        pooled = False
+
         def __init__(self):
             self.logs = []
 
@@ -902,6 +1238,17 @@ class TestJsSandboxResource(ResourceTestCaseBase):
                                                javascript='testscript',
                                                app_context='appcontext')])
 
+    def test_sandbox_init_pooled(self):
+        msgs = []
+        self.api.pooled = True
+        self.api.sandbox_send = lambda msg: msgs.append(msg)
+        self.resource.sandbox_init(self.api)
+        self.assertEqual(msgs, [SandboxCommand(cmd='initialize',
+                                               cmd_id=msgs[0]['cmd_id'],
+                                               javascript='testscript',
+                                               app_context='appcontext',
+                                               pooled=True)])
+
 
 class TestLoggingResource(ResourceTestCaseBase):
 
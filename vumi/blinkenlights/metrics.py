@@ -5,6 +5,7 @@
 Includes a publisher, a consumer and a set of simple metrics.
 """
 
+import math
 import time
 import warnings
 
@@ -170,6 +171,149 @@ class AggregatorAlreadyDefinedError(Exception):
     pass
 
 
+class SketchAccuracyError(ValueError):
+    """Raised when merging sketches with different relative accuracies."""
+
+
+class SketchNotSupportedError(ValueError):
+    """Raised when aggregating a sketch with an aggregator that can't."""
+
+
+class QuantileSketch(object):
+    """Mergeable summary of a stream of values.
+
+    Positive and negative values are counted in logarithmically sized bins,
+    so quantiles are accurate to within ``relative_accuracy`` of the true
+    value and the size of the sketch depends on the range of the values
+    rather than on how many of them there are. The count, sum, minimum,
+    maximum and last value are tracked exactly.
+
+    :type relative_accuracy: float
+    :param relative_accuracy:
+        The relative accuracy of the quantiles returned. The default is 1%.
+    """
+
+    DEFAULT_RELATIVE_ACCURACY = 0.01
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(
+                "Relative accuracy must be between 0 and 1, not %r"
+                % (relative_accuracy,))
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.bins = {}  # bin index -> count, for positive values
+        self.negative_bins = {}  # bin index -> count, for negative values
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def _index(self, value):
+        return int(math.ceil(math.log(value) / self._log_gamma))
+
+    def _bin_value(self, index):
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+    def add(self, value):
+        """Add a single value to the sketch."""
+        if value > 0:
+            index = self._index(value)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        elif value < 0:
+            index = self._index(-value)
+            self.negative_bins[index] = self.negative_bins.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.last = value
+
+    def merge(self, other):
+        """Merge another sketch with the same accuracy into this one."""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise SketchAccuracyError(
+                "Can't merge sketch with relative accuracy %r into sketch"
+                " with relative accuracy %r" % (
+                    other.relative_accuracy, self.relative_accuracy))
+        if not other.count:
+            return
+        for index, count in other.bins.iteritems():
+            self.bins[index] = self.bins.get(index, 0) + count
+        for index, count in other.negative_bins.iteritems():
+            self.negative_bins[index] = (
+                self.negative_bins.get(index, 0) + count)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.last = other.last
+
+    def avg(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+    def quantile(self, q):
+        """Return the value at quantile ``q`` (between 0 and 1).
+
+        Returns 0.0 if the sketch is empty.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(int(math.ceil(q * self.count)) - 1, 0)
+        seen = 0
+        for index in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[index]
+            if seen > rank:
+                return self._clamp(-self._bin_value(index))
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return self._clamp(self._bin_value(index))
+        return self.max
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'bins': dict((str(k), v) for k, v in self.bins.iteritems()),
+            'negative_bins': dict(
+                (str(k), v) for k, v in self.negative_bins.iteritems()),
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'last': self.last,
+        }
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        sketch = cls(sketch_dict['relative_accuracy'])
+        sketch.bins = dict(
+            (int(k), v) for k, v in sketch_dict['bins'].iteritems())
+        sketch.negative_bins = dict(
+            (int(k), v) for k, v in sketch_dict['negative_bins'].iteritems())
+        for field in ['zero_count', 'count', 'sum', 'min', 'max', 'last']:
+            setattr(sketch, field, sketch_dict[field])
+        return sketch
+
+    @staticmethod
+    def is_sketch(value):
+        """Check whether a datapoint value is a serialised sketch."""
+        return isinstance(value, dict)
+
+
 class Aggregator(object):
     """Registry of aggregate functions for metrics.
 
@@ -180,15 +324,20 @@ class Aggregator(object):
     :param func:
        The aggregation function. Should return a default value
        if the list of values is empty (usually this default is 0.0).
+    :type sketch_func: f(:class:`QuantileSketch`) -> float, optional
+    :param sketch_func:
+       The aggregation function to use for metrics published as sketches.
+       Aggregators without one can't be used with sketch metrics.
     """
 
     REGISTRY = {}
 
-    def __init__(self, name, func):
+    def __init__(self, name, func, sketch_func=None):
         if name in self.REGISTRY:
             raise AggregatorAlreadyDefinedError(name)
         self.name = name
         self.func = func
+        self.sketch_func = sketch_func
         self.REGISTRY[name] = self
 
     @classmethod
@@ -198,13 +347,40 @@ class Aggregator(object):
     def __call__(self, values):
         return self.func(values)
 
+    def aggregate_sketch(self, sketch):
+        if self.sketch_func is None:
+            raise SketchNotSupportedError(
+                "Aggregator %r does not support sketches." % (self.name,))
+        return self.sketch_func(sketch)
+
+
+def percentile(percent):
+    """Return a function computing the given percentile of a list of values.
+
+    Uses the nearest-rank method and returns 0.0 for an empty list.
+    """
+    def func(values):
+        if not values:
+            return 0.0
+        values = sorted(values)
+        rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+        return values[max(rank, 0)]
+    return func
 
-SUM = Aggregator("sum", sum)
+
+SUM = Aggregator("sum", sum, lambda sketch: sketch.sum)
 AVG = Aggregator("avg",
-                 lambda values: sum(values) / len(values) if values else 0.0)
-MAX = Aggregator("max", lambda values: max(values) if values else 0.0)
-MIN = Aggregator("min", lambda values: min(values) if values else 0.0)
-LAST = Aggregator("last", lambda values: values[-1] if values else 0.0)
+                 lambda values: sum(values) / len(values) if values else 0.0,
+                 lambda sketch: sketch.avg())
+MAX = Aggregator("max", lambda values: max(values) if values else 0.0,
+                 lambda sketch: sketch.max if sketch.count else 0.0)
+MIN = Aggregator("min", lambda values: min(values) if values else 0.0,
+                 lambda sketch: sketch.min if sketch.count else 0.0)
+LAST = Aggregator("last", lambda values: values[-1] if values else 0.0,
+                  lambda sketch: sketch.last if sketch.count else 0.0)
+P50 = Aggregator("p50", percentile(50), lambda sketch: sketch.quantile(0.5))
+P95 = Aggregator("p95", percentile(95), lambda sketch: sketch.quantile(0.95))
+P99 = Aggregator("p99", percentile(99), lambda sketch: sketch.quantile(0.99))
 
 
 class MetricRegistrationError(Exception):
@@ -427,6 +603,65 @@ class Timer(Metric):
         return result
 
 
+class SketchMetric(Metric):
+    """A metric that summarises its values in a :class:`QuantileSketch`.
+
+    Instead of collecting every value set, values are added to a sketch and
+    a single serialised sketch is published each time the metric is polled.
+    This keeps memory use and message sizes constant for metrics that are
+    set very often.
+
+    :type relative_accuracy: float, optional
+    :param relative_accuracy:
+        The relative accuracy of the sketch. See :class:`QuantileSketch`.
+
+    Examples:
+
+    >>> mm = MetricManager('vumi.worker0.')
+    >>> my_size = mm.register(SketchMetric('msg.size'))
+    >>> my_size.set(140)
+    """
+
+    #: Default aggregators are [:data:`AVG`, :data:`P50`, :data:`P95`,
+    #: :data:`P99`]
+    DEFAULT_AGGREGATORS = [AVG, P50, P95, P99]
+
+    def __init__(self, name, aggregators=None,
+                 relative_accuracy=QuantileSketch.DEFAULT_RELATIVE_ACCURACY):
+        super(SketchMetric, self).__init__(name, aggregators)
+        self.relative_accuracy = relative_accuracy
+        self._sketch = QuantileSketch(relative_accuracy)
+        self._sketch_timestamp = None
+
+    def set(self, value):
+        """Add a value to the sketch for later polling."""
+        if self._sketch_timestamp is None:
+            self._sketch_timestamp = int(time.time())
+        self._sketch.add(value)
+
+    def poll(self):
+        """Called periodically by the :class:`MetricManager`."""
+        if not self._sketch.count:
+            return []
+        values = [(self._sketch_timestamp, self._sketch.to_dict())]
+        self._sketch = QuantileSketch(self.relative_accuracy)
+        self._sketch_timestamp = None
+        return values
+
+
+class SketchTimer(SketchMetric, Timer):
+    """A :class:`Timer` that summarises its values in a
+    :class:`QuantileSketch`.
+
+    Examples:
+
+    >>> mm = MetricManager('vumi.worker0.')
+    >>> my_timer = mm.register(SketchTimer('hard.work'))
+    >>> with my_timer.timeit():
+    >>>     process_data()
+    """
+
+
 class MetricsConsumer(Consumer):
     """Utility for consuming metrics published by :class:`MetricManager`s.
 
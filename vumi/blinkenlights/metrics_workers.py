@@ -13,7 +13,9 @@ from twisted.internet.protocol import DatagramProtocol
 
 from vumi.service import Consumer, Publisher, Worker
 from vumi.blinkenlights.metrics import (MetricsConsumer, MetricManager, Count,
-                                        Metric, Timer, Aggregator)
+                                        Metric, Timer, Aggregator,
+                                        QuantileSketch, SketchAccuracyError,
+                                        SketchNotSupportedError)
 from vumi.blinkenlights.message20110818 import MetricMessage
 
 
@@ -180,6 +182,11 @@ class MetricAggregator(Worker):
     lag : int, seconds, optional
         The number of seconds after a bucket's time ends to wait
         before processing the bucket. Default is 5s.
+
+    Metrics published as sketches (see
+    :class:`vumi.blinkenlights.metrics.SketchMetric`) are merged in
+    timestamp order, together with any plain values published for the same
+    metric, and aggregated from the merged sketch.
     """
 
     _time = time.time  # hook for faking time in tests
@@ -225,6 +232,10 @@ class MetricAggregator(Worker):
                 ts = ts_key * self.bucket_size
                 items = self.buckets[ts_key].iteritems()
                 for metric_name, (agg_set, values) in items:
+                    if any(QuantileSketch.is_sketch(v) for t, v in values):
+                        aggregates.extend(self.aggregate_sketches(
+                            metric_name, agg_set, values))
+                        continue
                     values = [v for t, v in sorted(values)]
                     for agg_name in agg_set:
                         agg_metric = "%s.%s" % (metric_name, agg_name)
@@ -238,6 +249,38 @@ class MetricAggregator(Worker):
                 del self.buckets[ts_key]
         self._last_ts_key = current_ts_key
 
+    def aggregate_sketches(self, metric_name, agg_set, values):
+        """Merge sketch and plain values and aggregate the merged sketch."""
+        values = sorted(values, key=lambda value: value[0])
+        accuracy = [v['relative_accuracy'] for t, v in values
+                    if QuantileSketch.is_sketch(v)][0]
+        sketch = QuantileSketch(accuracy)
+        try:
+            for _t, value in values:
+                if QuantileSketch.is_sketch(value):
+                    sketch.merge(QuantileSketch.from_dict(value))
+                else:
+                    sketch.add(value)
+        except SketchAccuracyError:
+            log.err(DiscardedMetricError(
+                "Throwing away sketches with mismatched accuracies for"
+                " metric %r" % (metric_name,)))
+            return []
+
+        aggregates = []
+        for agg_name in agg_set:
+            agg_metric = "%s.%s" % (metric_name, agg_name)
+            agg_func = Aggregator.from_name(agg_name)
+            try:
+                agg_value = agg_func.aggregate_sketch(sketch)
+            except SketchNotSupportedError:
+                log.err(DiscardedMetricError(
+                    "Throwing away sketches for metric %r: aggregator %r"
+                    " does not support sketches" % (agg_metric, agg_name)))
+                continue
+            aggregates.append((agg_metric, agg_value))
+        return aggregates
+
     def consume_metric(self, metric_name, aggregates, values):
         if not values:
             return
@@ -1,3 +1,4 @@
+import json
 import time
 
 from twisted.internet import reactor
@@ -307,11 +308,142 @@ class TestAggregators(VumiTestCase):
         self.assertEqual(metrics.LAST.name, "last")
         self.assertEqual(metrics.Aggregator.from_name("last"), metrics.LAST)
 
+    def test_p50(self):
+        self.assertEqual(metrics.P50([]), 0.0)
+        self.assertEqual(metrics.P50([1.0, 2.0]), 1.0)
+        self.assertEqual(metrics.P50([3.0, 1.0, 2.0]), 2.0)
+        self.assertEqual(metrics.P50.name, "p50")
+        self.assertEqual(metrics.Aggregator.from_name("p50"), metrics.P50)
+
+    def test_p95(self):
+        values = [float(i) for i in range(100, 0, -1)]
+        self.assertEqual(metrics.P95([]), 0.0)
+        self.assertEqual(metrics.P95(values), 95.0)
+        self.assertEqual(metrics.P95.name, "p95")
+        self.assertEqual(metrics.Aggregator.from_name("p95"), metrics.P95)
+
+    def test_p99(self):
+        values = [float(i) for i in range(100, 0, -1)]
+        self.assertEqual(metrics.P99([]), 0.0)
+        self.assertEqual(metrics.P99(values), 99.0)
+        self.assertEqual(metrics.P99.name, "p99")
+        self.assertEqual(metrics.Aggregator.from_name("p99"), metrics.P99)
+
+    def test_aggregate_sketch(self):
+        sketch = metrics.QuantileSketch()
+        for value in [2.0, 1.0, 3.0, 4.0]:
+            sketch.add(value)
+        self.assertEqual(metrics.SUM.aggregate_sketch(sketch), 10.0)
+        self.assertEqual(metrics.AVG.aggregate_sketch(sketch), 2.5)
+        self.assertEqual(metrics.MIN.aggregate_sketch(sketch), 1.0)
+        self.assertEqual(metrics.MAX.aggregate_sketch(sketch), 4.0)
+        self.assertEqual(metrics.LAST.aggregate_sketch(sketch), 4.0)
+        self.assertTrue(
+            abs(metrics.P50.aggregate_sketch(sketch) - 2.0) <= 0.02)
+        self.assertEqual(metrics.P99.aggregate_sketch(sketch), 4.0)
+
+    def test_aggregate_empty_sketch(self):
+        sketch = metrics.QuantileSketch()
+        for agg in [metrics.SUM, metrics.AVG, metrics.MIN, metrics.MAX,
+                    metrics.LAST, metrics.P50, metrics.P95, metrics.P99]:
+            self.assertEqual(agg.aggregate_sketch(sketch), 0.0)
+
+    def test_aggregate_sketch_unsupported(self):
+        self.patch(metrics.Aggregator, "REGISTRY", {})
+        agg = metrics.Aggregator("test-no-sketch", sum)
+        self.assertRaises(
+            metrics.SketchNotSupportedError,
+            agg.aggregate_sketch, metrics.QuantileSketch())
+
     def test_already_registered(self):
         self.assertRaises(metrics.AggregatorAlreadyDefinedError,
                           metrics.Aggregator, "sum", sum)
 
 
+class TestQuantileSketch(VumiTestCase):
+
+    def assert_within_accuracy(self, sketch, value, expected):
+        self.assertTrue(
+            abs(value - expected) <= sketch.relative_accuracy * abs(expected),
+            "%r not within %r of %r" % (
+                value, sketch.relative_accuracy, expected))
+
+    def test_empty(self):
+        sketch = metrics.QuantileSketch()
+        self.assertEqual(sketch.count, 0)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assertEqual(sketch.avg(), 0.0)
+
+    def test_invalid_accuracy(self):
+        self.assertRaises(ValueError, metrics.QuantileSketch, 0)
+        self.assertRaises(ValueError, metrics.QuantileSketch, 1)
+
+    def test_add(self):
+        sketch = metrics.QuantileSketch()
+        for value in [3.0, 1.0, 2.0]:
+            sketch.add(value)
+        self.assertEqual(sketch.count, 3)
+        self.assertEqual(sketch.sum, 6.0)
+        self.assertEqual(sketch.min, 1.0)
+        self.assertEqual(sketch.max, 3.0)
+        self.assertEqual(sketch.last, 2.0)
+        self.assertEqual(sketch.avg(), 2.0)
+
+    def test_quantiles(self):
+        sketch = metrics.QuantileSketch()
+        for i in range(1, 10001):
+            sketch.add(i / 100.0)
+        self.assertTrue(len(sketch.bins) < 1000)
+        self.assert_within_accuracy(sketch, sketch.quantile(0.5), 50.0)
+        self.assert_within_accuracy(sketch, sketch.quantile(0.95), 95.0)
+        self.assert_within_accuracy(sketch, sketch.quantile(0.99), 99.0)
+        self.assertEqual(sketch.quantile(0), 0.01)
+        self.assertEqual(sketch.quantile(1), 100.0)
+
+    def test_quantiles_negative_and_zero(self):
+        sketch = metrics.QuantileSketch()
+        for value in [-10.0, -5.0, 0.0, 0.0, 5.0, 10.0]:
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0), -10.0)
+        self.assert_within_accuracy(sketch, sketch.quantile(0.3), -5.0)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assert_within_accuracy(sketch, sketch.quantile(0.8), 5.0)
+        self.assertEqual(sketch.quantile(1), 10.0)
+
+    def test_merge(self):
+        sketch1 = metrics.QuantileSketch()
+        sketch2 = metrics.QuantileSketch()
+        combined = metrics.QuantileSketch()
+        for i in range(1, 101):
+            [sketch1, sketch2][i % 2].add(float(i))
+            combined.add(float(i))
+        sketch2.merge(sketch1)
+        self.assertEqual(sketch2.to_dict(), combined.to_dict())
+
+    def test_merge_empty(self):
+        sketch = metrics.QuantileSketch()
+        sketch.add(1.0)
+        sketch.merge(metrics.QuantileSketch())
+        self.assertEqual(sketch.count, 1)
+        self.assertEqual(sketch.last, 1.0)
+
+    def test_merge_mismatched_accuracy(self):
+        sketch = metrics.QuantileSketch(0.01)
+        self.assertRaises(metrics.SketchAccuracyError,
+                          sketch.merge, metrics.QuantileSketch(0.02))
+
+    def test_to_dict_from_dict(self):
+        sketch = metrics.QuantileSketch()
+        for value in [-1.0, 0.0, 1.0, 2.0, 2.0]:
+            sketch.add(value)
+        sketch_dict = json.loads(json.dumps(sketch.to_dict()))
+        self.assertTrue(metrics.QuantileSketch.is_sketch(sketch_dict))
+        self.assertFalse(metrics.QuantileSketch.is_sketch(1.0))
+        restored = metrics.QuantileSketch.from_dict(sketch_dict)
+        self.assertEqual(restored.to_dict(), sketch.to_dict())
+        self.assertEqual(restored.quantile(0.5), sketch.quantile(0.5))
+
+
 class CheckValuesMixin(object):
 
     def _check_poll_base(self, metric, n):
@@ -498,3 +630,39 @@ class TestMetricsConsumer(VumiTestCase):
         vumi_msg = Message.from_json(msg.to_json())
         consumer.consume_message(vumi_msg)
         self.assertEqual(datapoints, expected_datapoints)
+
+
+class TestSketchMetric(VumiTestCase, CheckValuesMixin):
+    def test_poll(self):
+        metric = metrics.SketchMetric("foo")
+        self.assertEqual(metric.aggs, ("avg", "p50", "p95", "p99"))
+        self.check_poll(metric, [])
+        for value in [1.0, 2.0, 3.0]:
+            metric.set(value)
+        [sketch_dict] = self._check_poll_base(metric, 1)
+        sketch = metrics.QuantileSketch.from_dict(sketch_dict)
+        self.assertEqual(sketch.count, 3)
+        self.assertEqual(sketch.sum, 6.0)
+        self.check_poll(metric, [])
+
+    def test_relative_accuracy(self):
+        metric = metrics.SketchMetric("foo", relative_accuracy=0.05)
+        metric.set(1.0)
+        [sketch_dict] = self._check_poll_base(metric, 1)
+        self.assertEqual(sketch_dict['relative_accuracy'], 0.05)
+
+
+class TestSketchTimer(VumiTestCase, CheckValuesMixin):
+
+    def test_timeit(self):
+        timer = metrics.SketchTimer("foo")
+        fake_time = [12345.0]
+        self.patch(time, 'time', lambda: fake_time[0])
+        for i in range(3):
+            with timer.timeit():
+                fake_time[0] += 0.1
+        [sketch_dict] = self._check_poll_base(timer, 1)
+        sketch = metrics.QuantileSketch.from_dict(sketch_dict)
+        self.assertEqual(sketch.count, 3)
+        self.assertTrue(0.09 < sketch.quantile(0.5) < 0.11)
+        self.check_poll(timer, [])
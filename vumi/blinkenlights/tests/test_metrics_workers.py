@@ -3,6 +3,7 @@ from twisted.internet.protocol import DatagramProtocol
 from twisted.internet import reactor
 
 from vumi.blinkenlights import metrics_workers
+from vumi.blinkenlights.metrics import Aggregator, QuantileSketch
 from vumi.blinkenlights.message20110818 import MetricMessage
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
@@ -152,6 +153,99 @@ class TestMetricAggregator(VumiTestCase):
         worker.check_buckets()
         self.assertEqual(recv(), expected)
 
+    def mk_sketch(self, values, relative_accuracy=0.01):
+        sketch = QuantileSketch(relative_accuracy)
+        for value in values:
+            sketch.add(value)
+        return sketch.to_dict()
+
+    @inlineCallbacks
+    def test_aggregating_sketches(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        aggs = ("avg", "last", "max", "p50", "p99")
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", aggs, [(1236, self.mk_sketch([4.0, 2.0]))]),
+        ])
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", aggs, [(1235, self.mk_sketch([1.0, 3.0]))]),
+            ("vumi.test.foo", aggs, [(1237, 5.0)]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        aggregates = {}
+        for datapoints in self.broker.recv_datapoints(
+                "vumi.metrics.aggregates", "vumi.metrics.aggregates"):
+            for name, _, values in datapoints:
+                aggregates[name] = values
+        self.assertEqual(sorted(aggregates.keys()), [
+            "vumi.test.foo.avg", "vumi.test.foo.last", "vumi.test.foo.max",
+            "vumi.test.foo.p50", "vumi.test.foo.p99"])
+        self.assertEqual(aggregates["vumi.test.foo.avg"], [[1235, 3.0]])
+        self.assertEqual(aggregates["vumi.test.foo.last"], [[1235, 5.0]])
+        self.assertEqual(aggregates["vumi.test.foo.max"], [[1235, 5.0]])
+        [[_, p50]] = aggregates["vumi.test.foo.p50"]
+        self.assertTrue(abs(p50 - 3.0) <= 0.03)
+        self.assertEqual(aggregates["vumi.test.foo.p99"], [[1235, 5.0]])
+
+    @inlineCallbacks
+    def test_aggregating_sketches_mismatched_accuracy(self):
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", ("avg",), [(1235, self.mk_sketch([1.0]))]),
+            ("vumi.test.foo", ("avg",), [(1236, self.mk_sketch([2.0], 0.1))]),
+            ("vumi.test.bar", ("avg",), [(1236, self.mk_sketch([2.0]))]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        [err] = self.flushLoggedErrors(metrics_workers.DiscardedMetricError)
+        self.assertEqual(self.broker.recv_datapoints(
+            "vumi.metrics.aggregates", "vumi.metrics.aggregates"),
+            [[["vumi.test.bar.avg", [], [[1235, 2.0]]]]])
+
+    @inlineCallbacks
+    def test_aggregating_sketches_unsupported_aggregator(self):
+        self.patch(Aggregator, "REGISTRY", Aggregator.REGISTRY.copy())
+        Aggregator("test-no-sketch", sum)
+        config = {'bucket': 3, 'bucket_size': 5}
+        worker = yield self.worker_helper.get_worker(
+            metrics_workers.MetricAggregator, config, start=False)
+        worker._time = self.fake_time
+        yield worker.startWorker()
+
+        self.broker.send_datapoints("vumi.metrics.buckets", "bucket.3", [
+            ("vumi.test.foo", ("test-no-sketch", "max"),
+             [(1235, self.mk_sketch([1.0]))]),
+            ("vumi.test.bar", ("avg",), [(1236, self.mk_sketch([2.0]))]),
+        ])
+        yield self.broker.kick_delivery()
+
+        self.now = 1246
+        worker.check_buckets()
+        [err] = self.flushLoggedErrors(metrics_workers.DiscardedMetricError)
+        aggregates = {}
+        for datapoints in self.broker.recv_datapoints(
+                "vumi.metrics.aggregates", "vumi.metrics.aggregates"):
+            for name, _, values in datapoints:
+                aggregates[name] = values
+        self.assertEqual(aggregates, {
+            "vumi.test.foo.max": [[1235, 1.0]],
+            "vumi.test.bar.avg": [[1235, 2.0]],
+        })
+
     @inlineCallbacks
     def test_aggregating_lag(self):
         config = {'bucket': 3, 'bucket_size': 5, 'lag': 1}
@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.components.tests.test_message_formatters -*-
 
+import json
 from csv import writer
 
 from zope.interface import Interface, implements
@@ -26,6 +27,12 @@ class IMessageFormatter(Interface):
         Write a :class:`TransportUserMessage` to the request.
         """
 
+    def write_continuation(request, continuation):
+        """
+        Write a continuation token that can be used to resume the export
+        after the rows written so far.
+        """
+
 
 class JsonFormatter(object):
     """ Formatter for writing messages to requests as JSON. """
@@ -44,6 +51,10 @@ class JsonFormatter(object):
         request.write(message.to_json())
         request.write('\n')
 
+    def write_continuation(self, request, continuation):
+        request.write(json.dumps({'continuation': continuation}))
+        request.write('\n')
+
 
 class CsvFormatter(object):
     """ Formatter for writing messages to requests as CSV. """
@@ -73,6 +84,9 @@ class CsvFormatter(object):
         writer(request).writerow([
             self._format_field(field, message) for field in self.FIELDS])
 
+    def write_continuation(self, request, continuation):
+        writer(request).writerow(['continuation', continuation])
+
     def _format_field(self, field, message):
         field_formatter = getattr(self, '_format_field_%s' % (field,), None)
         if field_formatter is not None:
@@ -10,7 +10,8 @@ from uuid import uuid4
 import itertools
 import warnings
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, gatherResults, DeferredSemaphore)
 
 from vumi.message import (
     TransportEvent, TransportUserMessage, parse_vumi_date, format_vumi_date)
@@ -18,7 +19,6 @@ from vumi.persist.model import Model, Manager
 from vumi.persist.fields import (
     VumiMessage, ForeignKey, ManyToMany, ListOf, Tag, Dynamic, Unicode)
 from vumi.persist.txriak_manager import TxRiakManager
-from vumi import log
 from vumi.components.message_store_cache import MessageStoreCache
 from vumi.components.message_store_migrators import (
     EventMigrator, InboundMessageMigrator, OutboundMessageMigrator)
@@ -263,77 +263,107 @@ class MessageStore(object):
         returnValue(False)
 
     @Manager.calls_manager
-    def reconcile_cache(self, batch_id, start_timestamp=None):
+    def reconcile_cache(self, batch_id, start_timestamp=None, **kw):
         """
         Rebuild the cache for the given batch.
 
-        The ``start_timestamp`` parameter is used for testing only.
+        The ``start_timestamp`` parameter is used for testing only. With a
+        :class:`TxRiakManager`, a :class:`CacheReconciler` is used and its
+        final state is returned. Other keyword parameters are passed to it.
+        Other managers rebuild the cache one key at a time and ignore them.
         """
-        if start_timestamp is None:
-            start_timestamp = format_vumi_date(datetime.utcnow())
+        if isinstance(self.manager, TxRiakManager):
+            reconciler = CacheReconciler(
+                self, batch_id, start_timestamp=start_timestamp, **kw)
+            state = yield reconciler.run()
+            returnValue(state)
         yield self.cache.clear_batch(batch_id)
         yield self.cache.batch_start(batch_id)
-        yield self.reconcile_outbound_cache(batch_id, start_timestamp)
-        yield self.reconcile_inbound_cache(batch_id, start_timestamp)
+        if start_timestamp is None:
+            # Messages newer than this are added to the rollups as they
+            # arrive, so we only start the clock once the cache is clear.
+            start_timestamp = format_vumi_date(datetime.utcnow())
+        yield self._reconcile_outbound_cache(batch_id, start_timestamp)
+        yield self._reconcile_inbound_cache(batch_id, start_timestamp)
 
-    @Manager.calls_manager
     def reconcile_inbound_cache(self, batch_id, start_timestamp):
         """
         Rebuild the inbound message cache.
         """
+        warnings.warn("reconcile_inbound_cache() is deprecated. Use "
+                      "reconcile_cache().", category=DeprecationWarning)
+        return self._reconcile_inbound_cache(batch_id, start_timestamp)
+
+    @Manager.calls_manager
+    def _reconcile_inbound_cache(self, batch_id, start_timestamp):
         key_manager = ReconKeyManager(
             start_timestamp, self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
         key_count = 0
 
         index_page = yield self.batch_inbound_keys_with_addresses(batch_id)
+        page = ''
         while index_page is not None:
+            addrs = set()
+            rollup_entries = []
             for key, timestamp, addr in index_page:
-                yield self.cache.add_from_addr(batch_id, addr)
+                addrs.add(addr)
+                if timestamp <= start_timestamp:
+                    rollup_entries.append((timestamp, addr))
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
+            yield self.cache.add_recon_page(
+                'inbound', batch_id, page, addrs, rollup_entries)
+            page = index_page.continuation
             index_page = yield index_page.next_page()
 
         yield self.cache.add_inbound_message_count(batch_id, key_count)
         for key, timestamp in key_manager:
-            try:
-                yield self.cache.add_inbound_message_key(
-                    batch_id, key, self.cache.get_timestamp(timestamp))
-            except:
-                log.err()
+            yield self.cache.add_inbound_message_key(
+                batch_id, key, self.cache.get_timestamp(timestamp))
 
-    @Manager.calls_manager
     def reconcile_outbound_cache(self, batch_id, start_timestamp):
         """
         Rebuild the outbound message cache.
         """
+        warnings.warn("reconcile_outbound_cache() is deprecated. Use "
+                      "reconcile_cache().", category=DeprecationWarning)
+        return self._reconcile_outbound_cache(batch_id, start_timestamp)
+
+    @Manager.calls_manager
+    def _reconcile_outbound_cache(self, batch_id, start_timestamp):
         key_manager = ReconKeyManager(
             start_timestamp, self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
         key_count = 0
         status_counts = defaultdict(int)
 
         index_page = yield self.batch_outbound_keys_with_addresses(batch_id)
+        page = ''
         while index_page is not None:
+            addrs = set()
+            rollup_entries = []
             for key, timestamp, addr in index_page:
-                yield self.cache.add_to_addr(batch_id, addr)
+                addrs.add(addr)
+                if timestamp <= start_timestamp:
+                    rollup_entries.append((timestamp, addr))
                 old_key = key_manager.add_key(key, timestamp)
                 if old_key is not None:
                     key_count += 1
                     sc = yield self.get_event_counts(old_key[0])
                     for status, count in sc.iteritems():
                         status_counts[status] += count
+            yield self.cache.add_recon_page(
+                'outbound', batch_id, page, addrs, rollup_entries)
+            page = index_page.continuation
             index_page = yield index_page.next_page()
 
         yield self.cache.add_outbound_message_count(batch_id, key_count)
         for status, count in status_counts.iteritems():
             yield self.cache.add_event_count(batch_id, status, count)
         for key, timestamp in key_manager:
-            try:
-                yield self.cache.add_outbound_message_key(
-                    batch_id, key, self.cache.get_timestamp(timestamp))
-                yield self.reconcile_event_cache(batch_id, key)
-            except:
-                log.err()
+            yield self.cache.add_outbound_message_key(
+                batch_id, key, self.cache.get_timestamp(timestamp))
+            yield self.reconcile_event_cache(batch_id, key)
 
     @Manager.calls_manager
     def get_event_counts(self, message_id):
@@ -362,7 +392,9 @@ class MessageStore(object):
         event_keys = yield self.message_event_keys(message_id)
         for event_key in event_keys:
             event = yield self.get_event(event_key)
-            yield self.cache.add_event(batch_id, event)
+            if event is not None:
+                # The index can outlive a deleted event.
+                yield self.cache.add_event(batch_id, event)
 
     @Manager.calls_manager
     def batch_start(self, tags=(), **metadata):
@@ -715,20 +747,21 @@ class MessageStore(object):
 
     @Manager.calls_manager
     def _query_batch_index(self, model_proxy, batch_id, index, max_results,
-                           start, end, formatter):
+                           start, end, formatter, continuation=None):
         if max_results is None:
             max_results = self.DEFAULT_MAX_RESULTS
         start_value, end_value = self._start_end_values(batch_id, start, end)
         results = yield model_proxy.index_keys_page(
             index, start_value, end_value, max_results=max_results,
-            return_terms=(formatter is not None))
+            return_terms=(formatter is not None), continuation=continuation)
         if formatter is not None:
             results = IndexPageWrapper(formatter, self, batch_id, results)
         returnValue(results)
 
     def batch_inbound_keys_with_timestamps(self, batch_id, max_results=None,
                                            start=None, end=None,
-                                           with_timestamps=True):
+                                           with_timestamps=True,
+                                           continuation=None):
         """
         Return all inbound message keys with (and ordered by) timestamps.
 
@@ -748,16 +781,20 @@ class MessageStore(object):
             If set to ``False``, only the keys will be returned. The results
             will still be ordered by timestamp, however.
 
+        :param str continuation:
+            Optional continuation token from a previous page of results.
+
         This method performs a Riak index query.
         """
         formatter = key_with_ts_only_formatter if with_timestamps else None
         return self._query_batch_index(
             self.inbound_messages, batch_id, 'batches_with_addresses',
-            max_results, start, end, formatter)
+            max_results, start, end, formatter, continuation)
 
     def batch_outbound_keys_with_timestamps(self, batch_id, max_results=None,
                                             start=None, end=None,
-                                            with_timestamps=True):
+                                            with_timestamps=True,
+                                            continuation=None):
         """
         Return all outbound message keys with (and ordered by) timestamps.
 
@@ -777,15 +814,19 @@ class MessageStore(object):
             If set to ``False``, only the keys will be returned. The results
             will still be ordered by timestamp, however.
 
+        :param str continuation:
+            Optional continuation token from a previous page of results.
+
         This method performs a Riak index query.
         """
         formatter = key_with_ts_only_formatter if with_timestamps else None
         return self._query_batch_index(
             self.outbound_messages, batch_id, 'batches_with_addresses',
-            max_results, start, end, formatter)
+            max_results, start, end, formatter, continuation)
 
     def batch_inbound_keys_with_addresses(self, batch_id, max_results=None,
-                                          start=None, end=None):
+                                          start=None, end=None,
+                                          continuation=None):
         """
         Return all inbound message keys with (and ordered by) timestamps and
         addresses.
@@ -802,14 +843,19 @@ class MessageStore(object):
         :param str end:
             Optional end timestamp string matching VUMI_DATE_FORMAT.
 
+        :param str continuation:
+            Optional continuation token from a previous page of results.
+
         This method performs a Riak index query.
         """
         return self._query_batch_index(
             self.inbound_messages, batch_id, 'batches_with_addresses',
-            max_results, start, end, key_with_ts_and_value_formatter)
+            max_results, start, end, key_with_ts_and_value_formatter,
+            continuation=continuation)
 
     def batch_outbound_keys_with_addresses(self, batch_id, max_results=None,
-                                           start=None, end=None):
+                                           start=None, end=None,
+                                           continuation=None):
         """
         Return all outbound message keys with (and ordered by) timestamps and
         addresses.
@@ -826,11 +872,15 @@ class MessageStore(object):
         :param str end:
             Optional end timestamp string matching VUMI_DATE_FORMAT.
 
+        :param str continuation:
+            Optional continuation token from a previous page of results.
+
         This method performs a Riak index query.
         """
         return self._query_batch_index(
             self.outbound_messages, batch_id, 'batches_with_addresses',
-            max_results, start, end, key_with_ts_and_value_formatter)
+            max_results, start, end, key_with_ts_and_value_formatter,
+            continuation=continuation)
 
     def batch_inbound_keys_with_addresses_reverse(self, batch_id,
                                                   max_results=None,
@@ -898,7 +948,8 @@ class MessageStore(object):
 
     def batch_event_keys_with_statuses_reverse(self, batch_id,
                                                max_results=None,
-                                               start=None, end=None):
+                                               start=None, end=None,
+                                               continuation=None):
         """
         Return all event keys with timestamps and statuses.
         Results are ordered from newest to oldest.
@@ -915,6 +966,9 @@ class MessageStore(object):
         :param str end:
             Optional end timestamp string matching VUMI_DATE_FORMAT.
 
+        :param str continuation:
+            Optional continuation token from a previous page of results.
+
         This method performs a Riak index query.
         """
         # We're using reverse timestamps, so swap start and end and convert to
@@ -926,7 +980,8 @@ class MessageStore(object):
         start, end = end, start
         return self._query_batch_index(
             self.events, batch_id, 'batches_with_statuses_reverse',
-            max_results, start, end, key_with_rts_and_value_formatter)
+            max_results, start, end, key_with_rts_and_value_formatter,
+            continuation)
 
     @Manager.calls_manager
     def message_event_keys_with_statuses(self, msg_id, max_results=None):
@@ -976,7 +1031,9 @@ class MessageStore(object):
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        This method performs multiple Riak index queries and reads every index
+        entry in the range. :meth:`batch_inbound_rollup_stats` is much cheaper
+        for large batches.
         """
         total = 0
         unique_addresses = set()
@@ -1025,7 +1082,9 @@ class MessageStore(object):
         :returns:
             ``dict`` containing 'total' and 'unique_addresses' entries.
 
-        This method performs multiple Riak index queries.
+        This method performs multiple Riak index queries and reads every index
+        entry in the range. :meth:`batch_outbound_rollup_stats` is much cheaper
+        for large batches.
         """
         total = 0
         unique_addresses = set()
@@ -1050,6 +1109,272 @@ class MessageStore(object):
             "unique_addresses": len(unique_addresses),
         })
 
+    def batch_inbound_rollup_stats(self, batch_id, start=None, end=None):
+        """
+        Return inbound message stats for the specified time range from the
+        rollups kept in the cache.
+
+        :param str batch_id:
+            The batch_id to fetch stats for.
+
+        :param str start:
+            Optional start timestamp string matching VUMI_DATE_FORMAT.
+
+        :param str end:
+            Optional end timestamp string matching VUMI_DATE_FORMAT.
+
+        :returns:
+            ``dict`` containing 'total' and 'unique_addresses' entries.
+
+        Unlike :meth:`batch_inbound_stats`, this doesn't read the Riak
+        indexes. The time range is widened to whole hours and the unique
+        address count is an estimate. See
+        :meth:`MessageStoreCache.get_rollup_stats` for details.
+        """
+        return self.cache.get_rollup_stats('inbound', batch_id, start, end)
+
+    def batch_outbound_rollup_stats(self, batch_id, start=None, end=None):
+        """
+        Return outbound message stats for the specified time range from the
+        rollups kept in the cache.
+
+        :param str batch_id:
+            The batch_id to fetch stats for.
+
+        :param str start:
+            Optional start timestamp string matching VUMI_DATE_FORMAT.
+
+        :param str end:
+            Optional end timestamp string matching VUMI_DATE_FORMAT.
+
+        :returns:
+            ``dict`` containing 'total' and 'unique_addresses' entries.
+
+        Unlike :meth:`batch_outbound_stats`, this doesn't read the Riak
+        indexes. The time range is widened to whole hours and the unique
+        address count is an estimate. See
+        :meth:`MessageStoreCache.get_rollup_stats` for details.
+        """
+        return self.cache.get_rollup_stats('outbound', batch_id, start, end)
+
+
+class CacheReconciler(object):
+    """
+    Rebuilds the cache for a batch from the indexes in Riak.
+
+    Index pages are read in order, and the next page is fetched while the
+    current one is being processed. The cache writes for each page are made
+    in a single Redis transaction, and the event lookups for each page are
+    made concurrently.
+
+    Progress is tracked in :attr:`state`, which is a JSON-serialisable dict
+    that is updated after each index page. Passing it back in as ``state``
+    resumes an interrupted reconciliation from the last completed page.
+
+    Rollups are only rebuilt from messages that are no newer than
+    ``start_timestamp``. Newer messages are added to them as they arrive,
+    so they aren't counted twice. Each page's rollup writes are recorded
+    with it, so a page that was interrupted after its rollups were written
+    isn't counted twice when it is processed again.
+
+    :param MessageStore message_store:
+        The message store to reconcile. It must use a
+        :class:`TxRiakManager`.
+    :param str batch_id:
+        The batch to reconcile.
+    :param str start_timestamp:
+        Messages newer than this are always added to the cache. Defaults to
+        the time the cache is cleared.
+    :param int concurrency:
+        The maximum number of cache writes and event lookups to have in
+        flight at once.
+    :param int page_size:
+        The number of keys to fetch in each index query.
+    :param dict state:
+        The :attr:`state` of a previous reconciler to resume from.
+    :param progress_callback:
+        A function that is called with :attr:`state` after each index page.
+    """
+
+    DEFAULT_CONCURRENCY = 10
+
+    def __init__(self, message_store, batch_id, start_timestamp=None,
+                 concurrency=None, page_size=None, state=None,
+                 progress_callback=None):
+        assert isinstance(message_store.manager, TxRiakManager), (
+            "manager is not an instance of TxRiakManager")
+        if concurrency is None:
+            concurrency = self.DEFAULT_CONCURRENCY
+        self.store = message_store
+        self.cache = message_store.cache
+        self.batch_id = batch_id
+        self.page_size = page_size
+        self.progress_callback = progress_callback
+        self._semaphore = DeferredSemaphore(concurrency)
+        if state is None:
+            state = {
+                'batch_id': batch_id,
+                'start_timestamp': start_timestamp,
+                'phase': None,
+                'processed': 0,
+            }
+        elif state['batch_id'] != batch_id:
+            raise ValueError(
+                "Can't resume reconciliation of batch %r for batch %r." % (
+                    state['batch_id'], batch_id))
+        self.state = state
+
+    def _start_phase(self, phase):
+        self.state.update({
+            'phase': phase,
+            'continuation': None,
+            'scanned': False,
+            'counted': False,
+            'key_count': 0,
+            'status_counts': {},
+            'cache_keys': [],
+            'new_keys': [],
+        })
+        self._report_progress()
+
+    def _report_progress(self):
+        if self.progress_callback is not None:
+            self.progress_callback(self.state)
+
+    def _counted(self):
+        # Adding message and event counts isn't idempotent, so we record
+        # that it's been done. The message keys are only counted when
+        # they're new to the cache, so adding them again is safe.
+        self.state['counted'] = True
+        self._report_progress()
+
+    def _key_manager(self):
+        key_manager = ReconKeyManager(
+            self.state['start_timestamp'],
+            self.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT)
+        # These lists are shared with our state so that it always reflects
+        # the key manager. Resumed state may have lists instead of tuples.
+        self.state['cache_keys'][:] = map(tuple, self.state['cache_keys'])
+        self.state['new_keys'][:] = map(tuple, self.state['new_keys'])
+        key_manager.cache_keys = self.state['cache_keys']
+        key_manager.new_keys = self.state['new_keys']
+        return key_manager
+
+    def _run_concurrently(self, calls):
+        """
+        Make the given ``(func, arg, ...)`` calls, limited by our concurrency.
+        """
+        d = gatherResults(
+            [self._semaphore.run(*call) for call in calls],
+            consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        return d
+
+    @inlineCallbacks
+    def run(self):
+        """
+        Reconcile the cache, returning a deferred that fires with the final
+        :attr:`state`.
+        """
+        if self.state['phase'] is None:
+            yield self.cache.clear_batch(self.batch_id)
+            yield self.cache.batch_start(self.batch_id)
+            if self.state['start_timestamp'] is None:
+                # Messages newer than this are added to the rollups as they
+                # arrive, so we only start the clock once the cache is clear.
+                self.state['start_timestamp'] = format_vumi_date(
+                    datetime.utcnow())
+            self._start_phase('outbound')
+        if self.state['phase'] == 'outbound':
+            key_manager = yield self._scan_keys(
+                'outbound', self.store.batch_outbound_keys_with_addresses,
+                count_events=True)
+            yield self._finish_outbound(key_manager)
+            self._start_phase('inbound')
+        if self.state['phase'] == 'inbound':
+            key_manager = yield self._scan_keys(
+                'inbound', self.store.batch_inbound_keys_with_addresses)
+            yield self._finish_inbound(key_manager)
+            self._start_phase('done')
+        returnValue(self.state)
+
+    @inlineCallbacks
+    def _scan_keys(self, direction, query, count_events=False):
+        key_manager = self._key_manager()
+        if self.state['scanned']:
+            returnValue(key_manager)
+
+        index_page = yield query(
+            self.batch_id, max_results=self.page_size,
+            continuation=self.state['continuation'])
+        while index_page is not None:
+            if index_page.has_next_page():
+                next_page_d = index_page.next_page()
+            else:
+                next_page_d = succeed(None)
+            page = self.state['continuation'] or ''
+            addrs = set()
+            rollup_entries = []
+            calls = []
+            for key, timestamp, addr in index_page:
+                self.state['processed'] += 1
+                addrs.add(addr)
+                if timestamp <= self.state['start_timestamp']:
+                    rollup_entries.append((timestamp, addr))
+                old_key = key_manager.add_key(key, timestamp)
+                if old_key is not None:
+                    self.state['key_count'] += 1
+                    if count_events:
+                        calls.append((self._count_events, old_key[0]))
+            calls.append((
+                self.cache.add_recon_page, direction, self.batch_id, page,
+                addrs, rollup_entries))
+            yield self._run_concurrently(calls)
+            self.state['continuation'] = index_page.continuation
+            self.state['scanned'] = not index_page.has_next_page()
+            self._report_progress()
+            index_page = yield next_page_d
+        returnValue(key_manager)
+
+    @inlineCallbacks
+    def _count_events(self, message_id):
+        status_counts = yield self.store.get_event_counts(message_id)
+        for status, count in status_counts.iteritems():
+            self.state['status_counts'][status] = (
+                self.state['status_counts'].get(status, 0) + count)
+
+    @inlineCallbacks
+    def _finish_outbound(self, key_manager):
+        if not self.state.get('counted'):
+            yield self.cache.add_outbound_message_count(
+                self.batch_id, self.state['key_count'])
+            for status, count in self.state['status_counts'].iteritems():
+                yield self.cache.add_event_count(self.batch_id, status, count)
+            self._counted()
+        yield self._run_concurrently(
+            (self._add_outbound_key, key, timestamp)
+            for key, timestamp in key_manager)
+
+    @inlineCallbacks
+    def _add_outbound_key(self, key, timestamp):
+        yield self.cache.add_outbound_message_key(
+            self.batch_id, key, self.cache.get_timestamp(timestamp))
+        yield self.store.reconcile_event_cache(self.batch_id, key)
+
+    @inlineCallbacks
+    def _finish_inbound(self, key_manager):
+        if not self.state.get('counted'):
+            yield self.cache.add_inbound_message_count(
+                self.batch_id, self.state['key_count'])
+            self._counted()
+        yield self._run_concurrently(
+            (self._add_inbound_key, key, timestamp)
+            for key, timestamp in key_manager)
+
+    def _add_inbound_key(self, key, timestamp):
+        return self.cache.add_inbound_message_key(
+            self.batch_id, key, self.cache.get_timestamp(timestamp))
+
 
 class IndexPageWrapper(object):
     """
@@ -1098,6 +1423,14 @@ class IndexPageWrapper(object):
         """
         return self._index_page.has_next_page()
 
+    @property
+    def continuation(self):
+        """
+        The continuation token for the next page of results, or ``None`` if
+        this is the last page.
+        """
+        return self._index_page.continuation
+
     def __iter__(self):
         return (self._formatter(self._batch_id, r) for r in self._index_page)
 
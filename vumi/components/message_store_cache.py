@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
+import calendar
 import hashlib
 import json
 import time
@@ -34,8 +35,17 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    ROLLUP_COUNT_KEY = 'rollup_count'
+    ROLLUP_ADDR_KEY = 'rollup_addr_hll'
+    ROLLUP_BUCKETS_KEY = 'rollup_buckets'
+    RECON_PAGE_KEY = 'recon_page'
     TRUNCATE_MESSAGE_KEY_COUNT_AT = 2000
 
+    # Rollup bucket sizes in seconds, largest first. Each size must be a
+    # multiple of the next one. The smallest size is the resolution of
+    # rollup stats.
+    ROLLUP_BUCKET_SIZES = (60 * 60 * 24, 60 * 60)
+
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
 
@@ -83,6 +93,20 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def rollup_count_key(self, direction, batch_id, bucket_size, bucket):
+        return self.batch_key(
+            self.ROLLUP_COUNT_KEY, direction, batch_id, bucket_size, bucket)
+
+    def rollup_addr_key(self, direction, batch_id, bucket_size, bucket):
+        return self.batch_key(
+            self.ROLLUP_ADDR_KEY, direction, batch_id, bucket_size, bucket)
+
+    def rollup_buckets_key(self, direction, batch_id):
+        return self.batch_key(self.ROLLUP_BUCKETS_KEY, direction, batch_id)
+
+    def recon_page_key(self, direction, batch_id):
+        return self.batch_key(self.RECON_PAGE_KEY, direction, batch_id)
+
     def uses_counters(self, batch_id):
         """
         Returns ``True`` if ``batch_id`` has moved to the new system
@@ -223,6 +247,10 @@ class MessageStoreCache(object):
         yield self.redis.delete(self.status_key(batch_id))
         yield self.redis.delete(self.to_addr_key(batch_id))
         yield self.redis.delete(self.from_addr_key(batch_id))
+        yield self.clear_rollups('inbound', batch_id)
+        yield self.clear_rollups('outbound', batch_id)
+        yield self.redis.delete(self.recon_page_key('inbound', batch_id))
+        yield self.redis.delete(self.recon_page_key('outbound', batch_id))
         yield self.redis.srem(self.batch_key(), batch_id)
 
     def get_timestamp(self, timestamp):
@@ -239,14 +267,18 @@ class MessageStoreCache(object):
         Add an outbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(
+        new_entry = yield self.add_outbound_message_key(
             batch_id, msg['message_id'], timestamp)
         yield self.add_to_addr(batch_id, msg['to_addr'])
+        if new_entry:
+            yield self.add_to_rollups(
+                'outbound', batch_id, [(msg['timestamp'], msg['to_addr'])])
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
         """
         Add a message key, weighted with the timestamp to the batch_id.
+        Returns ``True`` if the key wasn't already in the cache.
         """
         new_entry = yield self.redis.zadd(self.outbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -258,6 +290,7 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.outbound_count_key(batch_id))
                 yield self.truncate_outbound_message_keys(batch_id)
+        returnValue(bool(new_entry))
 
     @Manager.calls_manager
     def add_outbound_message_count(self, batch_id, count):
@@ -337,14 +370,18 @@ class MessageStoreCache(object):
         Add an inbound message to the cache for the given batch_id
         """
         timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(
+        new_entry = yield self.add_inbound_message_key(
             batch_id, msg['message_id'], timestamp)
         yield self.add_from_addr(batch_id, msg['from_addr'])
+        if new_entry:
+            yield self.add_to_rollups(
+                'inbound', batch_id, [(msg['timestamp'], msg['from_addr'])])
 
     @Manager.calls_manager
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
-        Add a message key, weighted with the timestamp to the batch_id
+        Add a message key, weighted with the timestamp to the batch_id.
+        Returns ``True`` if the key wasn't already in the cache.
         """
         new_entry = yield self.redis.zadd(self.inbound_key(batch_id), **{
             message_key.encode('utf-8'): timestamp,
@@ -355,6 +392,7 @@ class MessageStoreCache(object):
             if uses_counters:
                 yield self.redis.incr(self.inbound_count_key(batch_id))
                 yield self.truncate_inbound_message_keys(batch_id)
+        returnValue(bool(new_entry))
 
     @Manager.calls_manager
     def add_inbound_message_count(self, batch_id, count):
@@ -422,6 +460,202 @@ class MessageStoreCache(object):
         """
         return self.redis.pfcount(self.to_addr_key(batch_id))
 
+    def get_rollup_timestamp(self, timestamp):
+        """
+        Return a UTC timestamp in whole seconds for a datetime value or a
+        string in the Vumi date format.
+        """
+        if isinstance(timestamp, basestring):
+            timestamp = parse_vumi_date(timestamp)
+        return calendar.timegm(timestamp.timetuple())
+
+    def get_rollup_buckets(self, start, end):
+        """
+        Return the fewest rollup buckets that exactly cover the range from
+        ``start`` to ``end``, as a list of ``(bucket_size, bucket)`` tuples.
+
+        Both timestamps must be multiples of the smallest bucket size. Each
+        bucket is identified by the timestamp it starts at, and covers that
+        many seconds.
+        """
+        buckets = []
+        sizes = list(self.ROLLUP_BUCKET_SIZES)
+        edges = [(start, end)]
+        while sizes:
+            size = sizes.pop(0)
+            next_edges = []
+            for edge_start, edge_end in edges:
+                first = -(-edge_start // size) * size
+                last = edge_end // size * size
+                if first >= last:
+                    next_edges.append((edge_start, edge_end))
+                    continue
+                buckets.extend((size, b) for b in xrange(first, last, size))
+                next_edges.extend([(edge_start, first), (last, edge_end)])
+            edges = [(s, e) for s, e in next_edges if s < e]
+        return buckets
+
+    @Manager.calls_manager
+    def add_to_rollups(self, direction, batch_id, entries):
+        """
+        Add messages to the rollups for this batch_id.
+
+        :param str direction:
+            Either ``inbound`` or ``outbound``.
+        :param entries:
+            An iterable of ``(timestamp, addr)`` tuples, one for each message.
+            ``timestamp`` may be a datetime or a string in the Vumi date
+            format and ``addr`` is the address to count unique values of.
+
+        Each rollup bucket has a message counter and a HyperLogLog of
+        addresses. All the writes are made in a single transaction.
+        """
+        pipe = self.redis.pipeline()
+        if self._queue_rollups(pipe, direction, batch_id, entries):
+            yield pipe.execute()
+
+    def _queue_rollups(self, pipe, direction, batch_id, entries):
+        """
+        Queue the writes for :meth:`add_to_rollups` on a pipeline.
+
+        Returns ``False`` if there was nothing to write.
+        """
+        counts = {}
+        addrs = {}
+        for timestamp, addr in entries:
+            timestamp = self.get_rollup_timestamp(timestamp)
+            for size in self.ROLLUP_BUCKET_SIZES:
+                bucket = (size, timestamp - timestamp % size)
+                counts[bucket] = counts.get(bucket, 0) + 1
+                addrs.setdefault(bucket, set()).add(addr.encode('utf-8'))
+        if not counts:
+            return False
+
+        for (size, bucket), count in counts.iteritems():
+            pipe.incr(
+                self.rollup_count_key(direction, batch_id, size, bucket),
+                count)
+            pipe.pfadd(
+                self.rollup_addr_key(direction, batch_id, size, bucket),
+                *addrs[(size, bucket)])
+            pipe.zadd(self.rollup_buckets_key(direction, batch_id), **{
+                '%s:%s' % (size, bucket): bucket,
+            })
+        return True
+
+    @Manager.calls_manager
+    def add_recon_page(self, direction, batch_id, page, addrs,
+                       rollup_entries):
+        """
+        Add a page of messages found while reconciling this batch_id.
+
+        :param str direction:
+            Either ``inbound`` or ``outbound``.
+        :param str page:
+            Identifies the page within the reconciliation.
+        :param addrs:
+            An iterable of addresses to add to the batch's unique address
+            count.
+        :param rollup_entries:
+            An iterable of ``(timestamp, addr)`` tuples to add to the rollups,
+            as for :meth:`add_to_rollups`.
+
+        All the writes are made in a single transaction, which also records
+        ``page``. Adding a page's addresses again has no effect, but adding
+        its messages to the rollups again would count them twice. So the
+        rollups are left alone if ``page`` is the last page recorded for
+        this direction, which happens when a reconciliation is resumed
+        after an interruption.
+        """
+        page_key = self.recon_page_key(direction, batch_id)
+        last_page = yield self.redis.get(page_key)
+        if direction == 'inbound':
+            addr_key = self.from_addr_key(batch_id)
+        else:
+            addr_key = self.to_addr_key(batch_id)
+        addrs = set(addr.encode('utf-8') for addr in addrs)
+        pipe = self.redis.pipeline()
+        if addrs:
+            pipe.pfadd(addr_key, *addrs)
+        if last_page != page:
+            self._queue_rollups(pipe, direction, batch_id, rollup_entries)
+            pipe.set(page_key, page)
+        if len(pipe):
+            yield pipe.execute()
+
+    @Manager.calls_manager
+    def get_rollup_stats(self, direction, batch_id, start=None, end=None):
+        """
+        Return message stats for this batch_id from its rollups.
+
+        :param str direction:
+            Either ``inbound`` or ``outbound``.
+        :param start:
+            Optional start timestamp, as a datetime or a string in the Vumi
+            date format.
+        :param end:
+            Optional end timestamp, as a datetime or a string in the Vumi date
+            format.
+        :returns:
+            ``dict`` containing 'total' and 'unique_addresses' entries.
+
+        Rollups have the resolution of the smallest bucket size, so the
+        range is widened to whole buckets. The range is covered with as few
+        buckets as possible, so the work done depends on the number of days
+        in the range rather than the number of messages. Like
+        :meth:`count_from_addrs`, the unique address count is an estimate.
+        """
+        resolution = self.ROLLUP_BUCKET_SIZES[-1]
+        buckets_key = self.rollup_buckets_key(direction, batch_id)
+        if start is None:
+            first = yield self.redis.zrange(buckets_key, 0, 0, withscores=True)
+            start = int(first[0][1]) if first else None
+        else:
+            start = self.get_rollup_timestamp(start)
+        if end is None:
+            last = yield self.redis.zrange(
+                buckets_key, -1, -1, withscores=True)
+            end = int(last[0][1]) if last else None
+        else:
+            end = self.get_rollup_timestamp(end)
+
+        buckets = []
+        if start is not None and end is not None:
+            buckets = self.get_rollup_buckets(
+                start - start % resolution,
+                end - end % resolution + resolution)
+        if not buckets:
+            returnValue({"total": 0, "unique_addresses": 0})
+
+        pipe = self.redis.pipeline(transaction=False)
+        for size, bucket in buckets:
+            pipe.get(self.rollup_count_key(direction, batch_id, size, bucket))
+        pipe.pfcount(*[
+            self.rollup_addr_key(direction, batch_id, size, bucket)
+            for size, bucket in buckets])
+        results = yield pipe.execute()
+        returnValue({
+            "total": sum(int(count or 0) for count in results[:-1]),
+            "unique_addresses": results[-1],
+        })
+
+    @Manager.calls_manager
+    def clear_rollups(self, direction, batch_id):
+        """
+        Remove all the rollups for this batch_id.
+        """
+        buckets_key = self.rollup_buckets_key(direction, batch_id)
+        buckets = yield self.redis.zrange(buckets_key, 0, -1)
+        pipe = self.redis.pipeline(transaction=False)
+        for bucket in buckets:
+            size, bucket = bucket.split(':')
+            pipe.delete(
+                self.rollup_count_key(direction, batch_id, size, bucket))
+            pipe.delete(
+                self.rollup_addr_key(direction, batch_id, size, bucket))
+        pipe.delete(buckets_key)
+        yield pipe.execute()
+
     def get_inbound_message_keys(self, batch_id, start=0, stop=-1, asc=False,
                                  with_timestamp=False):
         """
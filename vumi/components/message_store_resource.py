@@ -3,10 +3,13 @@
 import iso8601
 
 from twisted.application.internet import StreamServerEndpointService
-from twisted.internet.defer import DeferredList, inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.interfaces import IPushProducer
 from twisted.web.resource import NoResource, Resource
 from twisted.web.server import NOT_DONE_YET
+from zope.interface import implements
 
+from vumi import log
 from vumi.components.message_store import MessageStore
 from vumi.components.message_formatters import (
     JsonFormatter, CsvFormatter, CsvEventFormatter)
@@ -21,14 +24,6 @@ from vumi.utils import build_web_site
 from vumi.worker import BaseWorker
 
 
-# NOTE: Thanks Ned http://stackoverflow.com/a/312464!
-def chunks(l, n):
-    """ Yield successive n-sized chunks from l.
-    """
-    for i in xrange(0, len(l), n):
-        yield l[i:i + n]
-
-
 class ParameterError(Exception):
     """
     Exception raised while trying to parse a parameter.
@@ -36,6 +31,46 @@ class ParameterError(Exception):
     pass
 
 
+class ResponseProducer(object):
+    """
+    Streaming producer that tells us when the transport can't keep up.
+
+    The transport pauses this producer when its write buffer is full and
+    resumes it once the buffer has drained. :meth:`wait` returns a deferred
+    that fires when writing may continue.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self):
+        self.paused = False
+        self.stopped = False
+        self._waiting = []
+
+    def wait(self):
+        if not self.paused or self.stopped:
+            return succeed(None)
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def _release_waiting(self):
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._release_waiting()
+
+    def stopProducing(self):
+        self.stopped = True
+        self._release_waiting()
+
+
 class MessageStoreProxyResource(Resource):
 
     isLeaf = True
@@ -61,6 +96,15 @@ class MessageStoreProxyResource(Resource):
             raise ParameterError(
                 "Invalid '%s' parameter: %s" % (argname, str(e)))
 
+    def _extract_continuation_arg(self, request):
+        if 'continuation' not in request.args:
+            return None
+        if len(request.args['continuation']) > 1:
+            raise ParameterError(
+                "Invalid 'continuation' parameter: Too many values")
+        [value] = request.args['continuation']
+        return value or None
+
     def render_GET(self, request):
         if 'concurrency' in request.args:
             concurrency = int(request.args['concurrency'][0])
@@ -70,28 +114,43 @@ class MessageStoreProxyResource(Resource):
         try:
             start = self._extract_date_arg(request, 'start')
             end = self._extract_date_arg(request, 'end')
+            continuation = self._extract_continuation_arg(request)
         except ParameterError as e:
             request.setResponseCode(400)
             return str(e)
 
         self.formatter.add_http_headers(request)
-        self.formatter.write_row_header(request)
+        if continuation is None:
+            self.formatter.write_row_header(request)
 
         if not (start or end):
-            d = self.get_keys_page(self.message_store, self.batch_id)
+            d = self.get_keys_page(
+                self.message_store, self.batch_id, continuation=continuation)
         else:
             d = self.get_keys_page_for_time(
-                self.message_store, self.batch_id, start, end)
+                self.message_store, self.batch_id, start, end,
+                continuation=continuation)
+        request.include_continuation = (
+            request.args.get('include_continuation', ['false'])[0].lower()
+            in ('true', '1'))
+        request.response_producer = ResponseProducer()
+        request.registerProducer(request.response_producer, True)
         request.connection_has_been_closed = False
-        request.notifyFinish().addBoth(
-            lambda _: setattr(request, 'connection_has_been_closed', True))
+        request.notifyFinish().addBoth(self.connection_closed_cb, request)
         d.addCallback(self.fetch_pages, concurrency, request)
+        d.addErrback(self.fetch_failed_eb, request)
         return NOT_DONE_YET
 
-    def get_keys_page(self, message_store, batch_id):
+    def connection_closed_cb(self, _result, request):
+        request.connection_has_been_closed = True
+        # Release anything waiting for the transport to drain.
+        request.response_producer.stopProducing()
+
+    def get_keys_page(self, message_store, batch_id, continuation=None):
         raise NotImplementedError('To be implemented by sub-class.')
 
-    def get_keys_page_for_time(self, message_store, batch_id, start, end):
+    def get_keys_page_for_time(self, message_store, batch_id, start, end,
+                               continuation=None):
         raise NotImplementedError('To be implemented by sub-class.')
 
     def get_message(self, message_store, message_id):
@@ -116,6 +175,7 @@ class MessageStoreProxyResource(Resource):
             # We fetch the next page before waiting for the current page to be
             # processed.
             next_page_d = keys_page.next_page()
+            d.addCallback(self.write_continuation_cb, keys_page, request)
             d.addCallback(lambda _: next_page_d)
             # Add this method as a callback to operate on the next page. It's
             # like recursion, but without worrying about stack size.
@@ -125,49 +185,82 @@ class MessageStoreProxyResource(Resource):
             d.addCallback(self.finish_request_cb, request)
         return d
 
+    def write_continuation_cb(self, _result, keys_page, request):
+        """
+        Write the continuation token for the rest of the results, if the
+        client asked for them.
+
+        Requesting the same resource with this token as the ``continuation``
+        parameter resumes the export after the last complete page.
+        """
+        if request.connection_has_been_closed:
+            return
+        if request.include_continuation and keys_page.continuation:
+            self.formatter.write_continuation(
+                request, keys_page.continuation.encode('utf-8'))
+
     def finish_request_cb(self, _result, request):
         if not request.connection_has_been_closed:
             # We need to check for this here in case we lose the connection
             # while delivering the last page.
+            request.unregisterProducer()
             return request.finish()
 
-    @inlineCallbacks
+    def fetch_failed_eb(self, failure, request):
+        log.err(failure, "Error fetching messages for batch %r." % (
+            self.batch_id,))
+        return self.finish_request_cb(None, request)
+
     def fetch_page(self, keys_page, concurrency, request):
         """
-        Process a page of keys in chunks of concurrently-fetched messages.
-        """
-        for keys in chunks(list(keys_page), concurrency):
-            if request.connection_has_been_closed:
-                # We're no longer connected, so stop doing work.
-                return
-            yield self.handle_chunk(keys, request)
+        Process a page of keys with up to ``concurrency`` concurrent fetches.
 
-    def handle_chunk(self, message_keys, request):
-        """
-        Concurrently fetch a chunk of messages and write each to the response.
+        Messages are written in key order, so a slow fetch only holds up the
+        writes behind it. We don't start new fetches while the transport's
+        write buffer is full, and we don't hold on to messages once they've
+        been written.
         """
-        return DeferredList([
-            self.handle_message(key, request) for key in message_keys])
+        return self.message_store.manager.call_concurrently(
+            self.handle_message, [(key, request) for key in keys_page],
+            concurrency,
+            result_callback=lambda msg: self.write_message_cb(msg, request),
+            collect_results=False)
 
     def handle_message(self, message_key, request):
+        if request.connection_has_been_closed:
+            # We're no longer connected, so stop doing work.
+            return succeed(None)
         d = self.get_message(self.message_store, message_key)
-        d.addCallback(self.write_message, request)
+        d.addErrback(self.handle_message_eb, message_key)
         return d
 
+    def handle_message_eb(self, failure, message_key):
+        log.err(failure, "Error fetching message %r." % (message_key,))
+
     def write_message(self, message, request):
         if not request.content.closed:
             self.formatter.write_row(request, message)
 
+    def write_message_cb(self, message, request):
+        if request.connection_has_been_closed:
+            return
+        if message is not None:
+            self.write_message(message, request)
+        return request.response_producer.wait()
+
 
 class InboundResource(MessageStoreProxyResource):
 
-    def get_keys_page(self, message_store, batch_id):
-        return message_store.batch_inbound_keys_page(batch_id)
+    def get_keys_page(self, message_store, batch_id, continuation=None):
+        return message_store.batch_inbound_keys_page(
+            batch_id, continuation=continuation)
 
-    def get_keys_page_for_time(self, message_store, batch_id, start, end):
+    def get_keys_page_for_time(self, message_store, batch_id, start, end,
+                               continuation=None):
         return message_store.batch_inbound_keys_with_timestamps(
             batch_id, max_results=message_store.DEFAULT_MAX_RESULTS,
-            start=start, end=end, with_timestamps=False)
+            start=start, end=end, with_timestamps=False,
+            continuation=continuation)
 
     def get_message(self, message_store, message_id):
         return message_store.get_inbound_message(message_id)
@@ -175,13 +268,16 @@ class InboundResource(MessageStoreProxyResource):
 
 class OutboundResource(MessageStoreProxyResource):
 
-    def get_keys_page(self, message_store, batch_id):
-        return message_store.batch_outbound_keys_page(batch_id)
+    def get_keys_page(self, message_store, batch_id, continuation=None):
+        return message_store.batch_outbound_keys_page(
+            batch_id, continuation=continuation)
 
-    def get_keys_page_for_time(self, message_store, batch_id, start, end):
+    def get_keys_page_for_time(self, message_store, batch_id, start, end,
+                               continuation=None):
         return message_store.batch_outbound_keys_with_timestamps(
             batch_id, max_results=message_store.DEFAULT_MAX_RESULTS,
-            start=start, end=end, with_timestamps=False)
+            start=start, end=end, with_timestamps=False,
+            continuation=continuation)
 
     def get_message(self, message_store, message_id):
         return message_store.get_outbound_message(message_id)
@@ -189,15 +285,16 @@ class OutboundResource(MessageStoreProxyResource):
 
 class EventResource(MessageStoreProxyResource):
 
-    def get_keys_page(self, message_store, batch_id):
+    def get_keys_page(self, message_store, batch_id, continuation=None):
         return message_store.batch_event_keys_with_statuses_reverse(
             batch_id, max_results=message_store.DEFAULT_MAX_RESULTS,
-            start=None, end=None)
+            start=None, end=None, continuation=continuation)
 
-    def get_keys_page_for_time(self, message_store, batch_id, start, end):
+    def get_keys_page_for_time(self, message_store, batch_id, start, end,
+                               continuation=None):
         return message_store.batch_event_keys_with_statuses_reverse(
             batch_id, max_results=message_store.DEFAULT_MAX_RESULTS,
-            start=start, end=end)
+            start=start, end=end, continuation=continuation)
 
     def get_message(self, message_store, event_index):
         event_id, _, _ = event_index
@@ -4,9 +4,47 @@
 
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
 from vumi import log
+from vumi.utils import LRUCache
+
+
+class ActiveSessionsPage(object):
+    """
+    A page of active sessions returned by
+    :meth:`SessionManager.iter_active_sessions`.
+
+    Iterating over the page yields ``(user_id, session)`` pairs. Redis ``SCAN``
+    semantics apply, so a session may appear on more than one page and
+    sessions created during the iteration may not appear at all.
+    """
+
+    def __init__(self, session_manager, cursor, sessions, page_size):
+        self._session_manager = session_manager
+        self._sessions = sessions
+        self._page_size = page_size
+        self.cursor = cursor
+
+    def __iter__(self):
+        return iter(self._sessions)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def has_next_page(self):
+        return self.cursor is not None
+
+    def next_page(self):
+        """
+        Fetch the next page of active sessions. Returns a deferred that fires
+        with a new :class:`ActiveSessionsPage` or ``None`` if this is the last
+        page.
+        """
+        if not self.has_next_page():
+            return succeed(None)
+        return self._session_manager.iter_active_sessions(
+            self._page_size, cursor=self.cursor)
 
 
 class SessionManager(object):
@@ -18,13 +56,28 @@ class SessionManager(object):
         Time before a session expires. Default is None (never expire).
     :param float gc_period:
         Deprecated and ignored.
+    :param float cache_ttl:
+        Number of seconds to keep sessions in a local read-through cache.
+        Default is None (no caching). Sessions written by other processes may
+        be stale for up to this long, so keep it short.
+    :param int cache_size:
+        Maximum number of sessions to keep in the local cache.
+    :param clock:
+        An ``IReactorTime`` provider to use for cache expiry. Defaults to the
+        global reactor.
     """
 
-    def __init__(self, redis, max_session_length=None, gc_period=None):
+    def __init__(self, redis, max_session_length=None, gc_period=None,
+                 cache_ttl=None, cache_size=1000, clock=None):
         self.max_session_length = max_session_length
         self.redis = redis
         if gc_period is not None:
             log.warning("SessionManager 'gc_period' parameter is deprecated.")
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self._cache = None
+        if cache_ttl is not None:
+            self._cache = LRUCache(cache_size, ttl=cache_ttl, clock=clock)
 
     @inlineCallbacks
     def stop(self, stop_redis=True):
@@ -33,36 +86,98 @@ class SessionManager(object):
 
     @classmethod
     def from_redis_config(cls, config, key_prefix=None,
-                          max_session_length=None, gc_period=None):
+                          max_session_length=None, gc_period=None,
+                          cache_ttl=None, cache_size=1000):
         """Create a `SessionManager` instance using `TxRedisManager`.
         """
         from vumi.persist.txredis_manager import TxRedisManager
         d = TxRedisManager.from_config(config)
         if key_prefix is not None:
             d.addCallback(lambda m: m.sub_manager(key_prefix))
-        return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
+        return d.addCallback(lambda m: cls(
+            m, max_session_length, gc_period, cache_ttl=cache_ttl,
+            cache_size=cache_size))
+
+    def _session_key(self, user_id):
+        return "%s:%s" % ('session', user_id)
+
+    def _cache_get(self, user_id):
+        if self._cache is None:
+            return None
+        session = self._cache.get(user_id)
+        if session is None:
+            return None
+        # Callers may modify the session they get, so we hand out copies.
+        return dict(session)
+
+    def _cache_set(self, user_id, session):
+        if self._cache is None:
+            return
+        if not session:
+            self._cache.pop(user_id)
+            return
+        self._cache.set(user_id, dict(session))
+
+    def _cache_invalidate(self, user_id):
+        if self._cache is not None:
+            self._cache.pop(user_id)
 
     @inlineCallbacks
     def active_sessions(self):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        This walks all the pages returned by :meth:`iter_active_sessions`, so
+        it still touches every session key in Redis. Prefer paging through
+        :meth:`iter_active_sessions` directly for large session populations.
         """
-        keys = yield self.redis.keys('session:*')
-        sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
+        sessions = {}
+        page = yield self.iter_active_sessions()
+        while page is not None:
+            for user_id, session in page:
+                sessions[user_id] = session
+            page = yield page.next_page()
+        returnValue(sessions.items())
 
-        returnValue(sessions)
+    @inlineCallbacks
+    def iter_active_sessions(self, page_size=100, cursor=None):
+        """Return a deferred that fires with an :class:`ActiveSessionsPage`.
+
+        Session keys are found with ``SCAN`` rather than ``KEYS`` so that Redis
+        isn't blocked for large session populations, and the sessions on each
+        page are fetched in a single pipelined round trip.
+
+        :param int page_size:
+            Hint for the number of keys to scan for each page.
+        :param cursor:
+            Cursor to resume from, as found on a previous page. Default is
+            None (start a new scan).
+        """
+        cursor, keys = yield self.redis.scan(
+            cursor, match='session:*', count=page_size)
+        user_ids = [key.split(':', 1)[1] for key in keys]
+        sessions = []
+        if user_ids:
+            pipe = self.redis.pipeline(transaction=False)
+            for user_id in user_ids:
+                pipe.hgetall(self._session_key(user_id))
+            results = yield pipe.execute()
+            # Sessions that expired after the scan come back empty.
+            sessions = [(user_id, session)
+                        for user_id, session in zip(user_ids, results)
+                        if session]
+        returnValue(ActiveSessionsPage(self, cursor, sessions, page_size))
 
+    @inlineCallbacks
     def load_session(self, user_id):
         """
-        Load session data from Redis
+        Load session data from Redis, or from the local cache if it is
+        enabled and holds a fresh copy.
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.hgetall(ukey)
+        session = self._cache_get(user_id)
+        if session is None:
+            session = yield self.redis.hgetall(self._session_key(user_id))
+            self._cache_set(user_id, session)
+        returnValue(session)
 
     def schedule_session_expiry(self, user_id, timeout):
         """
@@ -75,34 +190,43 @@ class SessionManager(object):
         timeout : int
             The number of seconds after which this session should expire
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.expire(ukey, timeout)
+        return self.redis.expire(self._session_key(user_id), timeout)
 
     @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
+
+        The old session is cleared and the new session's fields and expiry
+        are written in a single transaction.
         """
-        yield self.clear_session(user_id)
+        ukey = self._session_key(user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        pipe = self.redis.pipeline()
+        pipe.delete(ukey)
+        pipe.hmset(ukey, defaults)
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            pipe.expire(ukey, int(self.max_session_length))
+        pipe.hgetall(ukey)
+        results = yield pipe.execute()
+        session = results[-1]
+        self._cache_set(user_id, session)
+        returnValue(session)
 
     def clear_session(self, user_id):
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.delete(ukey)
+        self._cache_invalidate(user_id)
+        return self.redis.delete(self._session_key(user_id))
 
     @inlineCallbacks
     def save_session(self, user_id, session):
         """
         Save a session
 
+        All fields are written in a single round trip.
+
         Parameters
         ----------
         user_id : str
@@ -112,7 +236,17 @@ class SessionManager(object):
             values that are dictionaries are converted to strings by Redis.
 
         """
-        ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+        if not session:
+            returnValue(session)
+        ukey = self._session_key(user_id)
+        if self.cache_ttl is None:
+            yield self.redis.hmset(ukey, session)
+        else:
+            # Fetch the whole session back so the cache doesn't need to guess
+            # what the other fields are or how Redis encoded the values.
+            pipe = self.redis.pipeline()
+            pipe.hmset(ukey, session)
+            pipe.hgetall(ukey)
+            results = yield pipe.execute()
+            self._cache_set(user_id, results[-1])
         returnValue(session)
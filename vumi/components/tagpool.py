@@ -9,16 +9,245 @@ import time
 from twisted.internet.defer import returnValue
 
 from vumi.errors import VumiError
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisScript
 
 
 class TagpoolError(VumiError):
     """An error occurred during an operation on a tag pool."""
 
 
+# The free list may hold stale entries for tags that were acquired
+# specifically (which leaves them in the list to avoid an O(n) LREM). These
+# are skipped when popped and the list is compacted when the stale entries
+# outnumber the free tags by more than this.
+FREE_LIST_SLACK = 100
+
+
+# Encode a UTF-8 string as a JSON string the same way Python's json.dumps()
+# does, so that owner tag list entries built by scripts match the ones
+# built in Python. Lua processes backslash escapes in string literals too,
+# so the JSON escapes below need doubled backslashes.
+_JSON_STRING_LUA = r"""
+local function json_string(s)
+    local out = {'"'}
+    local i = 1
+    while i <= #s do
+        local c = s:byte(i)
+        local cp, len
+        if c < 0x80 then
+            cp, len = c, 1
+        elseif c < 0xE0 then
+            cp, len = (c % 0x20) * 0x40 + s:byte(i + 1) % 0x40, 2
+        elseif c < 0xF0 then
+            cp, len = ((c % 0x10) * 0x1000 + (s:byte(i + 1) % 0x40) * 0x40 +
+                       s:byte(i + 2) % 0x40), 3
+        else
+            cp, len = ((c % 0x08) * 0x40000 + (s:byte(i + 1) % 0x40) * 0x1000 +
+                       (s:byte(i + 2) % 0x40) * 0x40 + s:byte(i + 3) % 0x40), 4
+        end
+        i = i + len
+        if cp == 34 then
+            out[#out + 1] = '\\"'
+        elseif cp == 92 then
+            out[#out + 1] = '\\\\'
+        elseif cp == 8 then
+            out[#out + 1] = '\\b'
+        elseif cp == 9 then
+            out[#out + 1] = '\\t'
+        elseif cp == 10 then
+            out[#out + 1] = '\\n'
+        elseif cp == 12 then
+            out[#out + 1] = '\\f'
+        elseif cp == 13 then
+            out[#out + 1] = '\\r'
+        elseif cp >= 32 and cp < 127 then
+            out[#out + 1] = string.char(cp)
+        elseif cp < 0x10000 then
+            out[#out + 1] = string.format('\\u%04x', cp)
+        else
+            cp = cp - 0x10000
+            out[#out + 1] = string.format(
+                '\\u%04x\\u%04x', 0xD800 + math.floor(cp / 0x400),
+                0xDC00 + cp % 0x400)
+        end
+    end
+    out[#out + 1] = '"'
+    return table.concat(out)
+end
+"""
+
+
+def _owner_tag_entry(pool_json, local_tag):
+    return "[%s, %s]" % (pool_json, json.dumps(local_tag.decode("utf-8")))
+
+
+def _fake_acquire_tags(redis, keys, args):
+    free_list_key, free_set_key, inuse_set_key, reason_key, owner_key = keys
+    count, reason_json, pool_json = args
+    acquired = []
+    while len(acquired) < int(count):
+        tag = redis.lpop(free_list_key)
+        if tag is None:
+            break
+        if redis.smove(free_set_key, inuse_set_key, tag):
+            redis.hset(reason_key, tag, reason_json)
+            redis.sadd(owner_key, _owner_tag_entry(pool_json, tag))
+            acquired.append(tag)
+    return acquired
+
+
+# Pop up to a number of tags off the free list, skipping stale entries, and
+# mark them as in use with the given reason.
+#
+# KEYS: free list, free set, in-use set, reason hash, owner tag set
+# ARGV: number of tags, reason JSON, pool JSON
+ACQUIRE_TAGS_SCRIPT = RedisScript(_JSON_STRING_LUA + """
+local count = tonumber(ARGV[1])
+local acquired = {}
+while #acquired < count do
+    local tag = redis.call('LPOP', KEYS[1])
+    if not tag then
+        break
+    end
+    if redis.call('SMOVE', KEYS[2], KEYS[3], tag) == 1 then
+        redis.call('HSET', KEYS[4], tag, ARGV[2])
+        redis.call('SADD', KEYS[5],
+                   '[' .. ARGV[3] .. ', ' .. json_string(tag) .. ']')
+        acquired[#acquired + 1] = tag
+    end
+end
+return acquired
+""", _fake_acquire_tags)
+
+
+def _fake_acquire_specific_tag(redis, keys, args):
+    free_set_key, inuse_set_key, reason_key, owner_key = keys
+    tag, reason_json, owner_entry = args
+    if not redis.smove(free_set_key, inuse_set_key, tag):
+        return 0
+    redis.hset(reason_key, tag, reason_json)
+    redis.sadd(owner_key, owner_entry)
+    return 1
+
+
+# Mark a specific free tag as in use. Its free list entry is left behind and
+# skipped when it is popped.
+#
+# KEYS: free set, in-use set, reason hash, owner tag set
+# ARGV: tag, reason JSON, owner tag set entry
+ACQUIRE_SPECIFIC_TAG_SCRIPT = RedisScript("""
+if redis.call('SMOVE', KEYS[1], KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+redis.call('SADD', KEYS[4], ARGV[3])
+return 1
+""", _fake_acquire_specific_tag)
+
+
+def _fake_release_tag(redis, keys, args):
+    free_list_key, free_set_key, inuse_set_key, reason_key, owner_key = keys
+    tag, owner_entry, expected_reason = args
+    reason = redis.hget(reason_key, tag)
+    if (reason or '') != expected_reason:
+        return -1
+    if not redis.smove(inuse_set_key, free_set_key, tag):
+        return 0
+    redis.rpush(free_list_key, tag)
+    if reason is not None:
+        redis.srem(owner_key, owner_entry)
+    free_count = redis.scard(free_set_key)
+    if redis.llen(free_list_key) > 2 * free_count + FREE_LIST_SLACK:
+        kept = []
+        for entry in redis.lrange(free_list_key, 0, -1):
+            if entry not in kept and redis.sismember(free_set_key, entry):
+                kept.append(entry)
+        redis.delete(free_list_key)
+        for entry in kept:
+            redis.rpush(free_list_key, entry)
+    return 1
+
+
+# Return an in-use tag to the free list, compacting the free list if it has
+# too many stale entries. Returns -1 without doing anything if the tag's
+# reason isn't the expected one, since the owner tag set to remove the tag
+# from depends on it.
+#
+# KEYS: free list, free set, in-use set, reason hash, owner tag set
+# ARGV: tag, owner tag set entry, expected reason JSON (empty for none)
+RELEASE_TAG_SCRIPT = RedisScript("""
+local reason = redis.call('HGET', KEYS[4], ARGV[1])
+if (reason or '') ~= ARGV[3] then
+    return -1
+end
+if redis.call('SMOVE', KEYS[3], KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+if reason then
+    redis.call('SREM', KEYS[5], ARGV[2])
+end
+local free_count = redis.call('SCARD', KEYS[2])
+if redis.call('LLEN', KEYS[1]) > 2 * free_count + %d then
+    local seen = {}
+    local kept = {}
+    for _, entry in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+        if not seen[entry] and
+                redis.call('SISMEMBER', KEYS[2], entry) == 1 then
+            seen[entry] = true
+            kept[#kept + 1] = entry
+        end
+    end
+    redis.call('DEL', KEYS[1])
+    for i = 1, #kept, 1000 do
+        redis.call('RPUSH', KEYS[1], unpack(kept, i, math.min(i + 999, #kept)))
+    end
+end
+return 1
+""" % (FREE_LIST_SLACK,), _fake_release_tag)
+
+
+def _fake_declare_tags(redis, keys, args):
+    free_list_key, free_set_key, inuse_set_key, pool_list_key = keys
+    pool, local_tags = args[0], args[1:]
+    redis.sadd(pool_list_key, pool)
+    added = 0
+    for tag in local_tags:
+        if not (redis.sismember(free_set_key, tag) or
+                redis.sismember(inuse_set_key, tag)):
+            redis.sadd(free_set_key, tag)
+            redis.rpush(free_list_key, tag)
+            added += 1
+    return added
+
+
+# Register a pool and add any tags that aren't already in it to the free
+# list.
+#
+# KEYS: free list, free set, in-use set, pool list
+# ARGV: pool, tags...
+DECLARE_TAGS_SCRIPT = RedisScript("""
+redis.call('SADD', KEYS[4], ARGV[1])
+local added = 0
+for i = 2, #ARGV do
+    local tag = ARGV[i]
+    if redis.call('SISMEMBER', KEYS[2], tag) == 0 and
+            redis.call('SISMEMBER', KEYS[3], tag) == 0 then
+        redis.call('SADD', KEYS[2], tag)
+        redis.call('RPUSH', KEYS[1], tag)
+        added = added + 1
+    end
+end
+return added
+""", _fake_declare_tags)
+
+
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
+    Acquiring, releasing and declaring tags are each done atomically by a
+    single script on the Redis server.
+
     :param redis:
         An instance of :class:`vumi.persist.redis_base.Manager`.
     """
@@ -38,8 +267,18 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def acquire_tag(self, pool, owner=None, reason=None):
-        local_tag = yield self._acquire_tag(pool, owner, reason)
-        returnValue((pool, local_tag) if local_tag is not None else None)
+        local_tags = yield self._acquire_tags(pool, 1, owner, reason)
+        returnValue((pool, local_tags[0]) if local_tags else None)
+
+    @Manager.calls_manager
+    def acquire_tags(self, pool, count, owner=None, reason=None):
+        """Acquire up to ``count`` tags from a pool.
+
+        Returns a list of the tags acquired, which is shorter than ``count``
+        if there aren't enough free tags.
+        """
+        local_tags = yield self._acquire_tags(pool, count, owner, reason)
+        returnValue([(pool, local_tag) for local_tag in local_tags])
 
     @Manager.calls_manager
     def acquire_specific_tag(self, tag, owner=None, reason=None):
@@ -61,7 +300,6 @@ class TagpoolManager(object):
         for pool, local_tag in tags:
             pools.setdefault(pool, []).append(local_tag)
         for pool, local_tags in pools.items():
-            yield self._register_pool(pool)
             yield self._declare_tags(pool, local_tags)
 
     @Manager.calls_manager
@@ -161,43 +399,59 @@ class TagpoolManager(object):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
+    def _reason_json(self, owner, reason):
+        reason = dict(reason or {})
+        reason['timestamp'] = time.time()
+        reason['owner'] = owner
+        return json.dumps(reason)
+
     @Manager.calls_manager
-    def _acquire_tag(self, pool, owner, reason):
+    def _acquire_tags(self, pool, count, owner, reason):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+        local_tags = yield self.redis.run_script(ACQUIRE_TAGS_SCRIPT, [
+            free_list_key, free_set_key, inuse_set_key,
+            self._tag_pool_reason_key(pool), self._owner_tag_list_key(owner),
+        ], [count, self._reason_json(owner, reason), json.dumps(pool)])
+        returnValue([self._decode(local_tag) for local_tag in local_tags])
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
+        owner_entry = json.dumps([pool, local_tag])
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
-        if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
-            yield self._store_reason(pool, local_tag, owner, reason)
-        returnValue(moved)
+        _free_list, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        acquired = yield self.redis.run_script(ACQUIRE_SPECIFIC_TAG_SCRIPT, [
+            free_set_key, inuse_set_key, self._tag_pool_reason_key(pool),
+            self._owner_tag_list_key(owner),
+        ], [local_tag, self._reason_json(owner, reason), owner_entry])
+        returnValue(acquired)
 
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
+        owner_entry = json.dumps([pool, local_tag])
         local_tag = self._encode(local_tag)
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
-        if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
-            yield self._remove_reason(pool, local_tag)
+        reason_hash_key = self._tag_pool_reason_key(pool)
+        while True:
+            # The owner tag set depends on the reason, so we read it first
+            # and the script checks that it hasn't changed in the meantime.
+            raw_reason = yield self.redis.hget(reason_hash_key, local_tag)
+            owner = None
+            if raw_reason is not None:
+                owner = json.loads(raw_reason).get('owner')
+            released = yield self.redis.run_script(RELEASE_TAG_SCRIPT, [
+                free_list_key, free_set_key, inuse_set_key, reason_hash_key,
+                self._owner_tag_list_key(owner),
+            ], [local_tag, owner_entry, raw_reason or ''])
+            if released != -1:
+                break
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
         new_tags = set(self._encode(tag) for tag in local_tags)
-        old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
-        old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        yield self.redis.run_script(DECLARE_TAGS_SCRIPT, [
+            free_list_key, free_set_key, inuse_set_key, self._pool_list_key(),
+        ], [self._encode(pool)] + sorted(new_tags))
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
@@ -208,26 +462,3 @@ class TagpoolManager(object):
             return ":".join(["tagpools", "unowned", "tags"])
         owner = self._encode(owner)
         return ":".join(["tagpools", "owners", owner, "tags"])
-
-    @Manager.calls_manager
-    def _store_reason(self, pool, local_tag, owner, reason):
-        if reason is None:
-            reason = {}
-        reason['timestamp'] = time.time()
-        reason['owner'] = owner
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
-        owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
-
-    @Manager.calls_manager
-    def _remove_reason(self, pool, local_tag):
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        reason = yield self.redis.hget(reason_hash_key, local_tag)
-        if reason is not None:
-            reason = json.loads(reason)
-            owner = reason.get('owner')
-            owner_tag_list_key = self._owner_tag_list_key(owner)
-            self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
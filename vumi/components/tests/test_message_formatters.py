@@ -34,6 +34,12 @@ class TestJsonFormatter(VumiTestCase):
             msg.to_json(), "\n",
         ])
 
+    def test_write_continuation(self):
+        self.formatter.write_continuation(self.request, "token")
+        self.assertEqual(self.request.written, [
+            '{"continuation": "token"}', "\n",
+        ])
+
 
 class TestCsvFormatter(VumiTestCase):
     def setUp(self):
@@ -70,6 +76,10 @@ class TestCsvFormatter(VumiTestCase):
             self.request.written,
             "%(ts)s,%(id)s,9292,+41791234567,,,foo,\r\n", msg)
 
+    def test_write_continuation(self):
+        self.formatter.write_continuation(self.request, "token")
+        self.assertEqual(self.request.written, ["continuation,token\r\n"])
+
     def test_write_row_with_in_reply_to(self):
         msg = self.msg_helper.make_inbound("foo", in_reply_to="msg-2")
         self.formatter.write_row(self.request, msg)
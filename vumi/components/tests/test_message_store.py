@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 """Tests for vumi.components.message_store."""
+import json
 import time
 from datetime import datetime, timedelta
 
@@ -12,8 +13,8 @@ from vumi.tests.helpers import (
 
 try:
     from vumi.components.message_store import (
-        MessageStore, to_reverse_timestamp, from_reverse_timestamp,
-        add_batches_to_event)
+        MessageStore, CacheReconciler, to_reverse_timestamp,
+        from_reverse_timestamp, add_batches_to_event)
 except ImportError, e:
     import_skip(e, 'riak')
 
@@ -1552,6 +1553,58 @@ class TestMessageStore(TestMessageStoreBase):
 
         self.assertEqual(outbound_stats_2, {"total": 2, "unique_addresses": 2})
 
+    @inlineCallbacks
+    def test_batch_inbound_rollup_stats(self):
+        """
+        batch_inbound_rollup_stats returns total and unique address counts
+        from the cached rollups.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+
+        now = datetime.now()
+        start_3 = now - timedelta(5)
+        start_2 = now - timedelta(35)
+        yield self.create_inbound_messages(
+            batch_id, 5, start_timestamp=now, from_addr=u'00005')
+        yield self.create_inbound_messages(
+            batch_id, 3, start_timestamp=start_3, from_addr=u'00003')
+        yield self.create_inbound_messages(
+            batch_id, 2, start_timestamp=start_2, from_addr=u'00002')
+
+        inbound_stats = yield self.store.batch_inbound_rollup_stats(batch_id)
+        self.assertEqual(inbound_stats, {"total": 10, "unique_addresses": 3})
+
+        inbound_stats = yield self.store.batch_inbound_rollup_stats(
+            batch_id, start=format_vumi_date(now - timedelta(22)),
+            end=format_vumi_date(now - timedelta(12)))
+        self.assertEqual(inbound_stats, {"total": 2, "unique_addresses": 2})
+
+    @inlineCallbacks
+    def test_batch_outbound_rollup_stats(self):
+        """
+        batch_outbound_rollup_stats returns total and unique address counts
+        from the cached rollups.
+        """
+        batch_id = yield self.store.batch_start([('pool', 'tag')])
+
+        now = datetime.now()
+        start_3 = now - timedelta(5)
+        start_2 = now - timedelta(35)
+        yield self.create_outbound_messages(
+            batch_id, 5, start_timestamp=now, to_addr=u'00005')
+        yield self.create_outbound_messages(
+            batch_id, 3, start_timestamp=start_3, to_addr=u'00003')
+        yield self.create_outbound_messages(
+            batch_id, 2, start_timestamp=start_2, to_addr=u'00002')
+
+        outbound_stats = yield self.store.batch_outbound_rollup_stats(
+            batch_id)
+        self.assertEqual(outbound_stats, {"total": 10, "unique_addresses": 3})
+
+        outbound_stats = yield self.store.batch_outbound_rollup_stats(
+            batch_id, start=format_vumi_date(now - timedelta(12)))
+        self.assertEqual(outbound_stats, {"total": 3, "unique_addresses": 2})
+
 
 class TestMessageStoreCache(TestMessageStoreBase):
 
@@ -1670,6 +1723,26 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status['ack'], 10)
         self.assertEqual(batch_status['sent'], 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_rebuilds_rollups(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, 2, from_addr='from1')
+        yield self.create_inbound_messages(batch_id, 3, from_addr='from2')
+        yield self.create_outbound_messages(batch_id, 4, to_addr='to1')
+
+        yield self.clear_cache(self.store)
+        self.assertEqual(
+            (yield self.store.batch_inbound_rollup_stats(batch_id)),
+            {"total": 0, "unique_addresses": 0})
+        yield self.store.reconcile_cache(batch_id, page_size=2)
+
+        self.assertEqual(
+            (yield self.store.batch_inbound_rollup_stats(batch_id)),
+            {"total": 5, "unique_addresses": 2})
+        self.assertEqual(
+            (yield self.store.batch_outbound_rollup_stats(batch_id)),
+            {"total": 4, "unique_addresses": 1})
+
     @inlineCallbacks
     def test_reconcile_cache_with_old_and_new_messages(self):
         """
@@ -1785,6 +1858,138 @@ class TestMessageStoreCache(TestMessageStoreBase):
         events_zcard = yield cache.redis.zcard(cache.event_key(batch_id))
         self.assertEqual(events_zcard, 10)
 
+    @inlineCallbacks
+    def create_recon_batch(self):
+        self.store.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT = 3
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, 2, from_addr='from1')
+        yield self.create_inbound_messages(batch_id, 3, from_addr='from2')
+        outbound_messages = yield self.create_outbound_messages(
+            batch_id, 6, to_addr='to1')
+        for msg in outbound_messages:
+            ack = self.msg_helper.make_ack(msg)
+            yield self.store.add_event(ack)
+        yield self.clear_cache(self.store)
+        returnValue(batch_id)
+
+    @inlineCallbacks
+    def assert_recon_batch(self, batch_id):
+        cache = self.store.cache
+        inbound_count = yield cache.count_inbound_message_keys(batch_id)
+        self.assertEqual(inbound_count, 5)
+        outbound_count = yield cache.count_outbound_message_keys(batch_id)
+        self.assertEqual(outbound_count, 6)
+        self.assertEqual((yield cache.count_from_addrs(batch_id)), 2)
+        self.assertEqual((yield cache.count_to_addrs(batch_id)), 1)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 6)
+        self.assertEqual(batch_status['sent'], 6)
+
+    @inlineCallbacks
+    def test_reconcile_cache_small_pages(self):
+        batch_id = yield self.create_recon_batch()
+        progress = []
+        yield self.store.reconcile_cache(
+            batch_id, page_size=2, concurrency=2,
+            progress_callback=lambda state: progress.append(
+                (state['phase'], state['processed'])))
+        yield self.assert_recon_batch(batch_id)
+        self.assertEqual(progress[0], ('outbound', 0))
+        self.assertTrue(('outbound', 2) in progress)
+        self.assertTrue(('inbound', 6) in progress)
+        self.assertTrue(('inbound', 8) in progress)
+        self.assertEqual(progress[-1], ('done', 11))
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume(self):
+        batch_id = yield self.create_recon_batch()
+        saved = []
+
+        def interrupt(state):
+            # Save the state as JSON, like the recon script does.
+            saved.append(json.loads(json.dumps(state)))
+            if state['phase'] == 'outbound' and state['processed'] == 4:
+                raise Exception("Interrupted")
+
+        reconciler = CacheReconciler(
+            self.store, batch_id, page_size=2, progress_callback=interrupt)
+        yield self.assertFailure(reconciler.run(), Exception)
+
+        reconciler = CacheReconciler(
+            self.store, batch_id, page_size=2, state=saved[-1])
+        state = yield reconciler.run()
+        self.assertEqual(state['phase'], 'done')
+        self.assertEqual(state['processed'], 11)
+        yield self.assert_recon_batch(batch_id)
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume_rollups(self):
+        batch_id = yield self.create_recon_batch()
+        saved = []
+
+        def interrupt(state):
+            saved.append(json.loads(json.dumps(state)))
+            if state['phase'] == 'inbound' and state['processed'] == 10:
+                raise Exception("Interrupted")
+
+        reconciler = CacheReconciler(
+            self.store, batch_id, page_size=2, progress_callback=interrupt)
+        yield self.assertFailure(reconciler.run(), Exception)
+
+        # Resume from before the last page, as if we'd been interrupted
+        # after writing it but before saving our state.
+        reconciler = CacheReconciler(
+            self.store, batch_id, page_size=2, state=saved[-2])
+        yield reconciler.run()
+        self.assertEqual(
+            (yield self.store.batch_inbound_rollup_stats(batch_id)),
+            {"total": 5, "unique_addresses": 2})
+
+    @inlineCallbacks
+    def test_reconcile_cache_skips_newer_messages_in_rollups(self):
+        batch_id = yield self.create_recon_batch()
+        start_timestamp = format_vumi_date(datetime.utcnow())
+        # Messages newer than the start of the recon are added to the
+        # rollups as they're cached, so the recon leaves them out.
+        yield self.create_inbound_messages(
+            batch_id, 1, start_timestamp=datetime.utcnow() + timedelta(1),
+            from_addr='from3')
+        yield self.store.reconcile_cache(batch_id, start_timestamp)
+        self.assertEqual(
+            (yield self.store.batch_inbound_rollup_stats(batch_id)),
+            {"total": 5, "unique_addresses": 2})
+
+    @inlineCallbacks
+    def test_reconcile_cache_resume_after_key_failure(self):
+        batch_id = yield self.create_recon_batch()
+        saved = []
+        cache = self.store.cache
+        orig_add_key = cache.add_inbound_message_key
+
+        def fail_add_key(*args):
+            cache.add_inbound_message_key = orig_add_key
+            raise Exception("Redis is down")
+
+        cache.add_inbound_message_key = fail_add_key
+        reconciler = CacheReconciler(
+            self.store, batch_id, page_size=2,
+            progress_callback=lambda state: saved.append(
+                json.loads(json.dumps(state))))
+        # The failure isn't swallowed, and the saved state lets us pick up
+        # where we left off without counting messages twice.
+        yield self.assertFailure(reconciler.run(), Exception)
+        self.assertEqual(saved[-1]['phase'], 'inbound')
+
+        reconciler = CacheReconciler(
+            self.store, batch_id, page_size=2, state=saved[-1])
+        yield reconciler.run()
+        yield self.assert_recon_batch(batch_id)
+
+    def test_reconciler_resume_wrong_batch(self):
+        state = CacheReconciler(self.store, "batch-1").state
+        self.assertRaises(
+            ValueError, CacheReconciler, self.store, "batch-2", state=state)
+
     @inlineCallbacks
     def test_find_inbound_keys_matching(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
@@ -1870,6 +2075,54 @@ class TestMessageStoreCache(TestMessageStoreBase):
             self.assertAlmostEqual(found, expected)
 
 
+class TestMessageStoreCacheSync(TestMessageStoreBase):
+
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True, is_sync=True))
+        self.redis = self.persistence_helper.get_redis_manager()
+        self.manager = self.persistence_helper.get_riak_manager()
+        self.add_cleanup(self.manager.close_manager)
+        self.store = MessageStore(self.manager, self.redis)
+        self.msg_helper = self.add_helper(MessageHelper())
+
+    def create_batch(self):
+        self.store.cache.TRUNCATE_MESSAGE_KEY_COUNT_AT = 3
+        batch_id = self.store.batch_start([("pool", "tag")])
+        self.create_inbound_messages(batch_id, 2, from_addr='from1')
+        self.create_inbound_messages(batch_id, 3, from_addr='from2')
+        self.create_outbound_messages(batch_id, 6, to_addr='to1')
+        self.redis._purge_all()
+        return batch_id
+
+    def assert_batch(self, batch_id):
+        cache = self.store.cache
+        self.assertEqual(cache.count_inbound_message_keys(batch_id), 5)
+        self.assertEqual(cache.count_outbound_message_keys(batch_id), 6)
+        self.assertEqual(cache.count_from_addrs(batch_id), 2)
+        self.assertEqual(cache.count_to_addrs(batch_id), 1)
+        self.assertEqual(self.store.batch_status(batch_id)['sent'], 6)
+        self.assertEqual(
+            self.store.batch_inbound_rollup_stats(batch_id),
+            {"total": 5, "unique_addresses": 2})
+
+    def test_reconcile_cache(self):
+        batch_id = self.create_batch()
+        self.store.reconcile_cache(batch_id)
+        self.assert_batch(batch_id)
+
+    def test_reconcile_per_direction_deprecated(self):
+        batch_id = self.create_batch()
+        start_timestamp = format_vumi_date(datetime.utcnow())
+        self.store.cache.batch_start(batch_id)
+        self.store.reconcile_outbound_cache(batch_id, start_timestamp)
+        self.store.reconcile_inbound_cache(batch_id, start_timestamp)
+        self.assert_batch(batch_id)
+        warnings = self.flushWarnings()
+        self.assertEqual(
+            [w['category'] for w in warnings], [DeprecationWarning] * 2)
+
+
 class TestMigrationFunctions(TestMessageStoreBase):
 
     @inlineCallbacks
@@ -514,3 +514,226 @@ class TestMessageStoreCacheWithCounters(MessageStoreCacheTestCase):
         self.assertEqual(
             set(cached_message_keys),
             set([m['message_id'] for m in received_messages[-truncate_at:]]))
+
+
+class TestMessageStoreCacheRollups(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        from vumi.components.message_store_cache import MessageStoreCache
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.cache = MessageStoreCache(self.redis)
+        self.batch_id = 'a-batch-id'
+        yield self.cache.batch_start(self.batch_id)
+        self.msg_helper = self.add_helper(MessageHelper())
+
+    def add_inbound(self, timestamp, from_addr):
+        msg = self.msg_helper.make_inbound(
+            "inbound", from_addr=from_addr, timestamp=timestamp)
+        return self.cache.add_inbound_message(self.batch_id, msg)
+
+    def add_outbound(self, timestamp, to_addr):
+        msg = self.msg_helper.make_outbound(
+            "outbound", to_addr=to_addr, timestamp=timestamp)
+        return self.cache.add_outbound_message(self.batch_id, msg)
+
+    def assert_stats(self, stats, total, unique_addresses):
+        self.assertEqual(stats, {
+            "total": total,
+            "unique_addresses": unique_addresses,
+        })
+
+    def test_get_rollup_timestamp(self):
+        self.assertEqual(
+            self.cache.get_rollup_timestamp(datetime(1970, 1, 2, 1, 0, 5)),
+            90005)
+        self.assertEqual(
+            self.cache.get_rollup_timestamp("1970-01-02 01:00:05.000123"),
+            90005)
+
+    def test_get_rollup_buckets(self):
+        hour = 60 * 60
+        day = 24 * hour
+        self.assertEqual(self.cache.get_rollup_buckets(0, 0), [])
+        self.assertEqual(
+            self.cache.get_rollup_buckets(hour, 3 * hour),
+            [(hour, hour), (hour, 2 * hour)])
+        self.assertEqual(
+            self.cache.get_rollup_buckets(0, 2 * day),
+            [(day, 0), (day, day)])
+        self.assertEqual(
+            self.cache.get_rollup_buckets(day - hour, 3 * day + 2 * hour),
+            [(day, day), (day, 2 * day),
+             (hour, day - hour), (hour, 3 * day), (hour, 3 * day + hour)])
+
+    @inlineCallbacks
+    def test_no_rollups(self):
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('inbound', self.batch_id)),
+            0, 0)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats(
+                'inbound', self.batch_id, start=datetime(2014, 1, 1),
+                end=datetime(2014, 2, 1))),
+            0, 0)
+
+    @inlineCallbacks
+    def test_inbound_rollups(self):
+        yield self.add_inbound(datetime(2014, 1, 1, 10, 15), 'addr1')
+        yield self.add_inbound(datetime(2014, 1, 1, 10, 45), 'addr2')
+        yield self.add_inbound(datetime(2014, 1, 1, 12, 0), 'addr1')
+        yield self.add_inbound(datetime(2014, 1, 3, 9, 30), 'addr3')
+        yield self.add_inbound(datetime(2014, 1, 5, 23, 59), 'addr1')
+
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('inbound', self.batch_id)),
+            5, 3)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats(
+                'inbound', self.batch_id, start=datetime(2014, 1, 1, 11),
+                end=datetime(2014, 1, 4))),
+            2, 2)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats(
+                'inbound', self.batch_id, end="2014-01-01 10:20:00.000000")),
+            2, 2)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats(
+                'inbound', self.batch_id, start=datetime(2014, 1, 2))),
+            2, 2)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('outbound', self.batch_id)),
+            0, 0)
+
+    @inlineCallbacks
+    def test_outbound_rollups(self):
+        yield self.add_outbound(datetime(2014, 1, 1, 10, 15), 'addr1')
+        yield self.add_outbound(datetime(2014, 1, 2, 10, 15), 'addr2')
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('outbound', self.batch_id)),
+            2, 2)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats(
+                'outbound', self.batch_id, start=datetime(2014, 1, 2))),
+            1, 1)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('inbound', self.batch_id)),
+            0, 0)
+
+    @inlineCallbacks
+    def test_duplicate_messages_not_counted(self):
+        msg = self.msg_helper.make_inbound(
+            "inbound", timestamp=datetime(2014, 1, 1))
+        yield self.cache.add_inbound_message(self.batch_id, msg)
+        yield self.cache.add_inbound_message(self.batch_id, msg)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('inbound', self.batch_id)),
+            1, 1)
+
+    @inlineCallbacks
+    def test_add_to_rollups(self):
+        yield self.cache.add_to_rollups('inbound', self.batch_id, [
+            ("2014-01-01 10:00:00.000000", u'addr1'),
+            ("2014-01-01 10:30:00.000000", u'addr2'),
+            ("2014-01-01 11:00:00.000000", u'addr1'),
+        ])
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats(
+                'inbound', self.batch_id, start=datetime(2014, 1, 1, 10),
+                end=datetime(2014, 1, 1, 10, 59))),
+            2, 2)
+
+    @inlineCallbacks
+    def test_clear_batch_clears_rollups(self):
+        yield self.add_inbound(datetime(2014, 1, 1, 10, 15), 'addr1')
+        yield self.add_outbound(datetime(2014, 1, 1, 10, 15), 'addr1')
+        self.assertNotEqual((yield self.redis.keys('*rollup*')), [])
+        yield self.cache.clear_batch(self.batch_id)
+        self.assertEqual((yield self.redis.keys('*rollup*')), [])
+
+    @inlineCallbacks
+    def test_add_to_rollups_no_entries(self):
+        yield self.cache.add_to_rollups('inbound', self.batch_id, [])
+        self.assertEqual((yield self.redis.keys('*rollup*')), [])
+
+    @inlineCallbacks
+    def test_get_rollup_stats_across_days(self):
+        yield self.cache.add_to_rollups('outbound', self.batch_id, [
+            (datetime(2014, 1, 1, 23, 30), u'addr1'),
+            (datetime(2014, 1, 2, 12, 0), u'addr2'),
+            (datetime(2014, 1, 3, 0, 30), u'addr1'),
+            (datetime(2014, 1, 4, 0, 30), u'addr3'),
+        ])
+        # This range is covered by one day bucket and an hour bucket at
+        # each end.
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats(
+                'outbound', self.batch_id, start=datetime(2014, 1, 1, 23),
+                end=datetime(2014, 1, 3, 0, 10))),
+            3, 2)
+
+    @inlineCallbacks
+    def test_clear_rollups(self):
+        yield self.cache.add_to_rollups('inbound', self.batch_id, [
+            (datetime(2014, 1, 1, 10), u'addr1'),
+            (datetime(2014, 1, 2, 10), u'addr2'),
+        ])
+        yield self.cache.add_to_rollups('outbound', self.batch_id, [
+            (datetime(2014, 1, 1, 10), u'addr1'),
+        ])
+        yield self.cache.clear_rollups('inbound', self.batch_id)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('inbound', self.batch_id)),
+            0, 0)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('outbound', self.batch_id)),
+            1, 1)
+        keys = yield self.redis.keys('*rollup*inbound*')
+        self.assertEqual(keys, [])
+
+    @inlineCallbacks
+    def test_add_recon_page(self):
+        yield self.cache.add_recon_page(
+            'outbound', self.batch_id, '', [u'addr1', u'addr2', u'addr3'], [
+                (datetime(2014, 1, 1, 10), u'addr1'),
+                (datetime(2014, 1, 1, 10, 30), u'addr2'),
+                (datetime(2014, 1, 1, 11), u'addr1'),
+            ])
+        self.assertEqual((yield self.cache.count_to_addrs(self.batch_id)), 3)
+        self.assertEqual(
+            (yield self.cache.count_from_addrs(self.batch_id)), 0)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('outbound', self.batch_id)),
+            3, 2)
+
+    @inlineCallbacks
+    def test_add_recon_page_again(self):
+        entries = [(datetime(2014, 1, 1, 10), u'addr1')]
+        yield self.cache.add_recon_page(
+            'inbound', self.batch_id, '', [u'addr1'], entries)
+        yield self.cache.add_recon_page(
+            'inbound', self.batch_id, 'page2', [u'addr2'], entries)
+        # Adding the last page again doesn't count its messages twice.
+        yield self.cache.add_recon_page(
+            'inbound', self.batch_id, 'page2', [u'addr2'], entries)
+        self.assert_stats(
+            (yield self.cache.get_rollup_stats('inbound', self.batch_id)),
+            2, 1)
+        self.assertEqual(
+            (yield self.cache.count_from_addrs(self.batch_id)), 2)
+
+    @inlineCallbacks
+    def test_add_recon_page_no_entries(self):
+        yield self.cache.add_recon_page('inbound', self.batch_id, '', [], [])
+        self.assertEqual(
+            (yield self.cache.count_from_addrs(self.batch_id)), 0)
+        self.assertEqual((yield self.redis.keys('*rollup*')), [])
+
+    @inlineCallbacks
+    def test_clear_batch_clears_recon_pages(self):
+        yield self.cache.add_recon_page(
+            'inbound', self.batch_id, 'page2', [u'addr1'],
+            [(datetime(2014, 1, 1, 10), u'addr1')])
+        yield self.cache.clear_batch(self.batch_id)
+        self.assertEqual((yield self.redis.keys('*recon_page*')), [])
@@ -3,6 +3,7 @@
 import time
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 
 from vumi.components.session import SessionManager
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
@@ -70,3 +71,155 @@ class TestSessionManager(VumiTestCase):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_save_session_empty(self):
+        yield self.sm.create_session("u1")
+        session = yield self.sm.save_session("u1", {})
+        self.assertEqual(session, {})
+        loaded = yield self.sm.load_session("u1")
+        self.assertEqual(loaded.keys(), ['created_at'])
+
+    @inlineCallbacks
+    def test_create_session_with_expiry(self):
+        self.sm.max_session_length = 60.0
+        yield self.sm.create_session("u1", foo="bar")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertTrue(0 < ttl <= 60)
+
+    @inlineCallbacks
+    def test_clear_session(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_iter_active_sessions(self):
+        for i in range(25):
+            yield self.sm.create_session("u%s" % (i,), n=i)
+        yield self.manager.set("not-a-session", "foo")
+
+        seen = {}
+        pages = 0
+        page = yield self.sm.iter_active_sessions(page_size=10)
+        while page is not None:
+            pages += 1
+            for user_id, session in page:
+                seen[user_id] = session
+            page = yield page.next_page()
+
+        self.assertTrue(pages > 1)
+        self.assertEqual(
+            sorted(seen.keys()), sorted("u%s" % (i,) for i in range(25)))
+        self.assertEqual(seen["u7"]["n"], "7")
+
+    @inlineCallbacks
+    def test_iter_active_sessions_empty(self):
+        page = yield self.sm.iter_active_sessions()
+        self.assertEqual(list(page), [])
+        self.assertFalse(page.has_next_page())
+        self.assertEqual((yield page.next_page()), None)
+
+    @inlineCallbacks
+    def test_iter_active_sessions_resume_from_cursor(self):
+        for i in range(25):
+            yield self.sm.create_session("u%s" % (i,))
+        first = yield self.sm.iter_active_sessions(page_size=10)
+        self.assertTrue(first.has_next_page())
+        resumed = yield self.sm.iter_active_sessions(
+            page_size=10, cursor=first.cursor)
+        following = yield first.next_page()
+        self.assertEqual(list(resumed), list(following))
+
+
+class TestSessionManagerCache(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(PersistenceHelper())
+        self.manager = yield self.persistence_helper.get_redis_manager()
+        yield self.manager._purge_all()  # Just in case
+        self.clock = Clock()
+        self.sm = SessionManager(
+            self.manager, cache_ttl=5, cache_size=3, clock=self.clock)
+        self.add_cleanup(self.sm.stop)
+
+    @inlineCallbacks
+    def test_load_session_reads_through_cache(self):
+        session = yield self.sm.create_session("u1", foo="bar")
+        # Change the session behind the manager's back.
+        yield self.manager.hset("session:u1", "foo", "baz")
+        self.assertEqual((yield self.sm.load_session("u1")), session)
+
+    @inlineCallbacks
+    def test_cache_expires(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.manager.hset("session:u1", "foo", "baz")
+        self.clock.advance(5)
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session["foo"], "baz")
+
+    @inlineCallbacks
+    def test_save_session_updates_cache(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.save_session("u1", {"foo": 1, "bar": "baz"})
+        yield self.manager.delete("session:u1")
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session["foo"], "1")
+        self.assertEqual(session["bar"], "baz")
+        self.assertTrue("created_at" in session)
+
+    @inlineCallbacks
+    def test_clear_session_invalidates_cache(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_cached_session_is_a_copy(self):
+        session = yield self.sm.create_session("u1", foo="bar")
+        session["foo"] = "changed"
+        loaded = yield self.sm.load_session("u1")
+        self.assertEqual(loaded["foo"], "bar")
+
+    @inlineCallbacks
+    def test_empty_sessions_not_cached(self):
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+        yield self.manager.hset("session:u1", "foo", "bar")
+        self.assertEqual((yield self.sm.load_session("u1")), {"foo": "bar"})
+
+    @inlineCallbacks
+    def test_cache_size_limit(self):
+        for i in range(5):
+            yield self.sm.create_session("u%s" % (i,))
+        self.assertEqual(
+            [u for u in ["u0", "u1", "u2", "u3", "u4"] if u in self.sm._cache],
+            ["u2", "u3", "u4"])
+
+    @inlineCallbacks
+    def test_cache_evicts_least_recently_used(self):
+        for i in range(3):
+            yield self.sm.create_session("u%s" % (i,))
+        yield self.sm.load_session("u0")
+        yield self.sm.create_session("u3")
+        self.assertTrue("u0" in self.sm._cache)
+        self.assertFalse("u1" in self.sm._cache)
+
+    @inlineCallbacks
+    def test_expired_entries_evicted(self):
+        yield self.sm.create_session("u1")
+        self.clock.advance(10)
+        yield self.sm.create_session("u2")
+        self.assertFalse("u1" in self.sm._cache)
+        self.assertTrue("u2" in self.sm._cache)
+        self.assertEqual(len(self.sm._cache), 1)
+
+    def test_no_cache_without_ttl(self):
+        sm = SessionManager(self.manager)
+        self.assertEqual(sm._cache, None)
+
+    @inlineCallbacks
+    def test_from_redis_config_with_cache(self):
+        sm = yield SessionManager.from_redis_config(
+            {'FAKE_REDIS': self.manager}, cache_ttl=5, cache_size=10)
+        self.assertEqual(sm._cache.ttl, 5)
+        self.assertEqual(sm._cache.max_size, 10)
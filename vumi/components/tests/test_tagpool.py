@@ -112,15 +112,112 @@ class TestTxTagpoolManager(VumiTestCase):
         self.assertEqual((yield self.tpm.acquire_specific_tag(tag5)), tag5)
         self.assertEqual((yield self.tpm.acquire_specific_tag(tag5)), None)
         free_local_tags = [t[1] for t in tags]
-        free_local_tags.remove("tag5")
         redis = self.redis
+        # The free list entry is left behind and skipped when popped.
         self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
                          free_local_tags)
+        free_local_tags.remove("tag5")
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(free_local_tags))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag5"]))
 
+    @inlineCallbacks
+    def test_acquire_skips_specifically_acquired_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2, tag3 = [("poolA", "tag%d" % i) for i in (1, 2, 3)]
+        yield self.tpm.declare_tags([tag1, tag2, tag3])
+        self.assertEqual((yield self.tpm.acquire_specific_tag(tag1)), tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag3)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+        self.assertEqual(
+            (yield self.redis.lrange(tkey("free:list"), 0, -1)), [])
+
+    @inlineCallbacks
+    def test_acquire_specific_tag_and_release(self):
+        tag1, tag2 = [("poolA", "tag%d" % i) for i in (1, 2)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        self.assertEqual((yield self.tpm.acquire_specific_tag(tag1)), tag1)
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        # The second free list entry for tag1 is skipped since it's in use.
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
+    @inlineCallbacks
+    def test_release_compacts_free_list(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = [("poolA", "tag%d" % i) for i in (1, 2)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        for i in range(102):
+            yield self.tpm.acquire_specific_tag(tag1)
+            yield self.tpm.release_tag(tag1)
+        free_list = yield self.redis.lrange(tkey("free:list"), 0, -1)
+        self.assertTrue(len(free_list) <= 2 * 2 + 100)
+        self.assertEqual(sorted(set(free_list)), ["tag1", "tag2"])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3)),
+                         [tag1, tag2])
+
+    @inlineCallbacks
+    def test_acquire_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tags = [("poolA", "tag%d" % i) for i in range(5)]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual(
+            (yield self.tpm.acquire_tags("poolA", 3, "me", {"foo": "bar"})),
+            tags[:3])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3)), tags[3:])
+        self.assertEqual((yield self.tpm.acquire_tags("poolA", 3)), [])
+        self.assertEqual((yield self.redis.smembers(tkey("inuse:set"))),
+                         set(t[1] for t in tags))
+        self.assertEqual(sorted((yield self.tpm.owned_tags("me"))),
+                         [list(t) for t in tags[:3]])
+        owner, reason = yield self.tpm.acquired_by(tags[1])
+        self._check_reason("me", owner, reason, {"foo": "bar"})
+
+    @inlineCallbacks
+    def test_acquire_unicode_tags_and_release(self):
+        tags = [(u"poöl", u"tág\"1\u2603"), (u"poöl", u"tág\U0001f600")]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual(
+            sorted((yield self.tpm.acquire_tags(u"poöl", 2, u"mé"))),
+            sorted(tags))
+        self.assertEqual(sorted((yield self.tpm.owned_tags(u"mé"))),
+                         sorted([list(t) for t in tags]))
+        for tag in tags:
+            yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [])
+
+    @inlineCallbacks
+    def test_acquire_tags_escaped_owner_entries(self):
+        tags = [(u"poöl", u"tág"), (u"poöl", u'a"b\\c\t\x01')]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_tags(u"poöl", 2, u"mé")
+        # The entries built by the acquire script must match the ones
+        # built in Python when the tags are released.
+        owner_key = self.tpm._owner_tag_list_key(u"mé")
+        self.assertEqual(
+            (yield self.redis.smembers(owner_key)),
+            set(json.dumps(list(tag)) for tag in tags))
+        for tag in tags:
+            yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.redis.smembers(owner_key)), set())
+        self.assertEqual((yield self.tpm.owned_tags(u"mé")), [])
+
+    @inlineCallbacks
+    def test_release_removes_owned_tag(self):
+        tag1, tag2 = [("poolA", "tag%d" % i) for i in (1, 2)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        yield self.tpm.acquire_tag("poolA", "me")
+        yield self.tpm.acquire_specific_tag(tag2, "me")
+        self.assertEqual(sorted((yield self.tpm.owned_tags("me"))),
+                         [list(tag1), list(tag2)])
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.tpm.owned_tags("me")), [list(tag2)])
+        yield self.tpm.release_tag(tag2)
+        self.assertEqual((yield self.tpm.owned_tags("me")), [])
+
     @inlineCallbacks
     def test_acquire_specific_unicode_tag(self):
         tag = (u"poöl", u"tág")
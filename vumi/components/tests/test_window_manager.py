@@ -1,4 +1,4 @@
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 from twisted.internet.task import Clock
 
 from vumi.components.window_manager import WindowManager, WindowException
@@ -103,6 +103,89 @@ class TestWindowManager(VumiTestCase):
             (yield self.wm.get_internal_id(self.window_id, "external_id")),
             None)
 
+    @inlineCallbacks
+    def test_add_many(self):
+        keys = yield self.wm.add_many(
+            self.window_id, ['a', 'b', 'c'], keys=['key1'])
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(keys[0], 'key1')
+        self.assertEqual((yield self.wm.count_waiting(self.window_id)), 3)
+        for key, data in zip(keys, ['a', 'b', 'c']):
+            self.assertEqual(
+                (yield self.wm.get_data(self.window_id, key)), data)
+        # Keys come out in the order they went in.
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), keys)
+
+    @inlineCallbacks
+    def test_get_next_keys(self):
+        keys = yield self.wm.add_many(self.window_id, range(15))
+        claimed = yield self.wm.get_next_keys(self.window_id, 4)
+        self.assertEqual(claimed, keys[:4])
+        # Only the remaining room in the window is claimed.
+        claimed = yield self.wm.get_next_keys(self.window_id)
+        self.assertEqual(claimed, keys[4:10])
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+        self.assertEqual((yield self.wm.count_in_flight(self.window_id)), 10)
+        self.assertEqual((yield self.wm.count_waiting(self.window_id)), 5)
+        stats = yield self.redis.zrange(
+            self.wm.stats_key(self.window_id), 0, -1)
+        self.assertEqual(sorted(stats), sorted(keys[:10]))
+
+    @inlineCallbacks
+    def test_get_next_keys_empty_window(self):
+        self.assertEqual((yield self.wm.get_next_keys(self.window_id)), [])
+        self.assertEqual((yield self.wm.get_next_key(self.window_id)), None)
+
+    @inlineCallbacks
+    def test_remove_keys(self):
+        keys = yield self.wm.add_many(self.window_id, range(3))
+        yield self.wm.get_next_keys(self.window_id)
+        yield self.wm.set_external_id(self.window_id, keys[0], "external_id")
+        yield self.wm.remove_keys(self.window_id, keys[:2])
+        self.assertEqual((yield self.wm.count_in_flight(self.window_id)), 1)
+        self.assertFalse(
+            (yield self.redis.exists(self.wm.window_key(
+                self.window_id, keys[0]))))
+        self.assertEqual(
+            (yield self.wm.get_data(self.window_id, keys[2])), 2)
+        self.assertEqual(
+            (yield self.wm.get_external_id(self.window_id, keys[0])), None)
+        self.assertEqual(
+            (yield self.wm.get_internal_id(self.window_id, "external_id")),
+            None)
+        stats = yield self.redis.zrange(
+            self.wm.stats_key(self.window_id), 0, -1)
+        self.assertEqual(stats, [keys[2]])
+
+    @inlineCallbacks
+    def test_monitor_windows_dispatches_concurrently(self):
+        yield self.wm.add_many(self.window_id, range(3))
+        pending = []
+
+        def callback(window_id, key):
+            d = Deferred()
+            pending.append(d)
+            # None of the callbacks finish until all of them have been
+            # called, so this would never complete if they weren't
+            # dispatched concurrently.
+            if len(pending) == 3:
+                for pending_d in pending:
+                    pending_d.callback(None)
+            return d
+
+        yield self.wm._monitor_windows(callback, False)
+        self.assertEqual(len(pending), 3)
+
+    @inlineCallbacks
+    def test_monitor_windows_callback_failure(self):
+        yield self.wm.add_many(self.window_id, range(3))
+
+        def callback(window_id, key):
+            raise WindowException("oops")
+
+        yield self.assertFailure(
+            self.wm._monitor_windows(callback, False), WindowException)
+
     @inlineCallbacks
     def assert_count_waiting(self, window_id, amount):
         self.assertEqual((yield self.wm.count_waiting(window_id)), amount)
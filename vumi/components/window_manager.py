@@ -3,16 +3,58 @@ import json
 import uuid
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred)
 from twisted.internet.task import LoopingCall
 
 from vumi import log
+from vumi.persist.redis_base import RedisScript
 
 
 class WindowException(Exception):
     pass
 
 
+def _fake_claim_keys(redis, keys, args):
+    window_key, inflight_key, stats_key = keys
+    window_size, limit, timestamp = args
+    room = int(window_size) - redis.llen(inflight_key)
+    if 0 <= int(limit) < room:
+        room = int(limit)
+    claimed = []
+    for _ in range(room):
+        key = redis.rpoplpush(window_key, inflight_key)
+        if not key:
+            break
+        redis.zadd(stats_key, **{key: float(timestamp)})
+        claimed.append(key)
+    return claimed
+
+
+# Move as many keys as there is room for (up to an optional limit) from the
+# waiting list to the in-flight list and timestamp them, atomically.
+#
+# KEYS: waiting list, in-flight list, in-flight timestamps
+# ARGV: window size, limit (negative for no limit), timestamp
+CLAIM_KEYS_SCRIPT = RedisScript("""
+local room = tonumber(ARGV[1]) - redis.call('LLEN', KEYS[2])
+local limit = tonumber(ARGV[2])
+if limit >= 0 and limit < room then
+    room = limit
+end
+local claimed = {}
+for i = 1, room do
+    local key = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+    if not key then
+        break
+    end
+    redis.call('ZADD', KEYS[3], ARGV[3], key)
+    claimed[#claimed + 1] = key
+end
+return claimed
+""", _fake_claim_keys)
+
+
 class WindowManager(object):
 
     WINDOW_KEY = 'windows'
@@ -88,35 +130,60 @@ class WindowManager(object):
 
     @inlineCallbacks
     def add(self, window_id, data, key=None):
-        key = key or uuid.uuid4().get_hex()
-        # The redis.set() has to complete before redis.lpush(),
-        # otherwise the key can be popped from the window before the
-        # data is available.
-        yield self.redis.set(self.window_key(window_id, key),
-                             json.dumps(data))
-        yield self.redis.lpush(self.window_key(window_id), key)
+        [key] = yield self.add_many(window_id, [data], keys=[key])
         returnValue(key)
 
     @inlineCallbacks
-    def get_next_key(self, window_id):
-
-        window_key = self.window_key(window_id)
-        inflight_key = self.flight_key(window_id)
-
-        waiting_list = yield self.count_waiting(window_id)
-        if waiting_list == 0:
-            return
+    def add_many(self, window_id, data_list, keys=None):
+        """
+        Add several items to a window in a single round trip.
+
+        Returns the list of keys, which are generated for any that are
+        ``None`` or missing.
+        """
+        if keys is None:
+            keys = []
+        keys = list(keys) + [None] * (len(data_list) - len(keys))
+        keys = [key or uuid.uuid4().get_hex() for key in keys]
+        # The data has to be set before the key is pushed, otherwise the key
+        # can be popped from the window before the data is available. The
+        # transaction guarantees this.
+        pipe = self.redis.pipeline()
+        for key, data in zip(keys, data_list):
+            pipe.set(self.window_key(window_id, key), json.dumps(data))
+        for key in keys:
+            pipe.lpush(self.window_key(window_id), key)
+        yield pipe.execute()
+        returnValue(keys)
 
-        flight_size = yield self.count_in_flight(window_id)
-        room_available = self.window_size - flight_size
+    @inlineCallbacks
+    def get_next_key(self, window_id):
+        keys = yield self.get_next_keys(window_id, 1)
+        if keys:
+            returnValue(keys[0])
 
-        if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
-            next_key = yield self.redis.rpoplpush(window_key, inflight_key)
-            if next_key:
-                yield self._set_timestamp(window_id, next_key)
-                returnValue(next_key)
+    @inlineCallbacks
+    def get_next_keys(self, window_id, limit=None):
+        """
+        Claim as many waiting keys as there is room for in the window, up to
+        ``limit`` if it is given.
+
+        This is done atomically on the Redis server, so concurrent window
+        managers never overfill a window.
+        """
+        keys = yield self.redis.run_script(CLAIM_KEYS_SCRIPT, [
+            self.window_key(window_id),
+            self.flight_key(window_id),
+            self.stats_key(window_id),
+        ], [
+            self.window_size,
+            -1 if limit is None else limit,
+            repr(self.get_clocktime()),
+        ])
+        if keys:
+            log.debug('Claimed %s keys from window %s' % (
+                len(keys), self.window_key(window_id)))
+        returnValue(keys)
 
     def _set_timestamp(self, window_id, flight_key):
         return self.redis.zadd(self.stats_key(window_id), **{
@@ -143,28 +210,48 @@ class WindowManager(object):
         windows = yield self.get_windows()
         for window_id in windows:
             expired_keys = yield self.get_expired_flight_keys(window_id)
-            for key in expired_keys:
-                yield self.redis.lrem(self.flight_key(window_id), key, 1)
+            if expired_keys:
+                pipe = self.redis.pipeline(transaction=False)
+                for key in expired_keys:
+                    pipe.lrem(self.flight_key(window_id), key, 1)
+                yield pipe.execute()
 
     @inlineCallbacks
     def get_data(self, window_id, key):
         json_data = yield self.redis.get(self.window_key(window_id, key))
         returnValue(json.loads(json_data))
 
-    @inlineCallbacks
     def remove_key(self, window_id, key):
-        yield self.redis.lrem(self.flight_key(window_id), key, 1)
-        yield self.redis.delete(self.window_key(window_id, key))
-        yield self.redis.delete(self.stats_key(window_id, key))
-        yield self.clear_external_id(window_id, key)
-        yield self._clear_timestamp(window_id, key)
+        return self.remove_keys(window_id, [key])
 
     @inlineCallbacks
+    def remove_keys(self, window_id, keys):
+        """
+        Remove several keys and their data from a window in two round trips.
+        """
+        if not keys:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(self.map_key(window_id, 'external', key))
+        external_ids = yield pipe.execute()
+
+        pipe = self.redis.pipeline()
+        for key, external_id in zip(keys, external_ids):
+            pipe.lrem(self.flight_key(window_id), key, 1)
+            pipe.delete(self.window_key(window_id, key))
+            pipe.delete(self.stats_key(window_id, key))
+            if external_id:
+                pipe.delete(self.map_key(window_id, 'external', key))
+                pipe.delete(self.map_key(window_id, 'internal', external_id))
+            pipe.zrem(self.stats_key(window_id), key)
+        yield pipe.execute()
+
     def set_external_id(self, window_id, flight_key, external_id):
-        yield self.redis.set(self.map_key(window_id, 'internal', external_id),
-            flight_key)
-        yield self.redis.set(self.map_key(window_id, 'external', flight_key),
-            external_id)
+        pipe = self.redis.pipeline()
+        pipe.set(self.map_key(window_id, 'internal', external_id), flight_key)
+        pipe.set(self.map_key(window_id, 'external', flight_key), external_id)
+        return pipe.execute()
 
     def get_internal_id(self, window_id, external_id):
         return self.redis.get(self.map_key(window_id, 'internal', external_id))
@@ -197,10 +284,15 @@ class WindowManager(object):
                          cleanup_callback=None):
         windows = yield self.get_windows()
         for window_id in windows:
-            key = (yield self.get_next_key(window_id))
-            while key:
-                yield key_callback(window_id, key)
-                key = (yield self.get_next_key(window_id))
+            keys = yield self.get_next_keys(window_id)
+            while keys:
+                # The keys we've claimed are handled concurrently.
+                d = gatherResults([
+                    maybeDeferred(key_callback, window_id, key)
+                    for key in keys], consumeErrors=True)
+                d.addErrback(lambda f: f.value.subFailure)
+                yield d
+                keys = yield self.get_next_keys(window_id)
 
             # Remove empty windows if required
             if cleanup and not ((yield self.count_waiting(window_id)) or
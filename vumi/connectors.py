@@ -18,7 +18,8 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, publisher_options=None,
+                 consumer_options=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -26,6 +27,10 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
+        self._publisher_options = (publisher_options
+                                   if publisher_options is not None else {})
+        self._consumer_options = (consumer_options
+                                  if consumer_options is not None else {})
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
 
@@ -37,9 +42,17 @@ class BaseConnector(object):
 
     def teardown(self):
         d = gatherResults([c.stop() for c in self._consumers.values()])
+        d.addCallback(lambda r: self.flush())
         d.addCallback(lambda r: self._middlewares.teardown())
         return d
 
+    def flush(self):
+        """
+        Publish any messages buffered by this connector's publishers.
+        """
+        return gatherResults([
+            publisher.flush() for publisher in self._publishers.itervalues()])
+
     @property
     def paused(self):
         return all(consumer.paused
@@ -56,7 +69,8 @@ class BaseConnector(object):
 
     @inlineCallbacks
     def _setup_publisher(self, mtype):
-        publisher = yield self.worker.publish_to(self._rkey(mtype))
+        publisher = yield self.worker.publish_to(
+            self._rkey(mtype), **self._publisher_options)
         self._publishers[mtype] = publisher
         returnValue(publisher)
 
@@ -67,7 +81,7 @@ class BaseConnector(object):
 
         consumer = yield self.worker.consume(
             self._rkey(mtype), handler, message_class=msg_class, paused=True,
-            prefetch_count=self._prefetch_count)
+            prefetch_count=self._prefetch_count, **self._consumer_options)
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         returnValue(consumer)
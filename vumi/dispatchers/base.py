@@ -3,9 +3,11 @@
 """Basic tools for building dispatchers."""
 
 import re
+import json
 import functools
 
 from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
+from twisted.internet.task import LoopingCall
 
 from vumi.service import Worker
 from vumi.errors import ConfigError, DispatcherError
@@ -431,6 +433,56 @@ class UserGroupingRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_message(app, msg)
 
 
+class KeywordRoutingIndex(object):
+    """Routing rules for :class:`ContentKeywordRouter`, compiled for lookup.
+
+    Rules are indexed by keyword and then by `to_addr`. Each of these holds
+    a trie of `from_addr` prefixes, so looking up the applications for a
+    message only touches the rules that can match it.
+
+    :param list rules:
+        A list of routing rules, as described for
+        :class:`ContentKeywordRouter`. Keywords must already be lowercase.
+    """
+
+    # Key for rules matching any to_addr. Rules with an explicit `to_addr`
+    # of `None` only match messages with a `to_addr` of `None`.
+    ANY_TO_ADDR = object()
+
+    def __init__(self, rules):
+        self.rules = rules
+        self._index = {}
+        for position, rule in enumerate(rules):
+            to_addrs = self._index.setdefault(rule['keyword'], {})
+            node = to_addrs.setdefault(
+                rule.get('to_addr', self.ANY_TO_ADDR), {})
+            for char in rule.get('prefix', ''):
+                node = node.setdefault(char, {})
+            # Trie nodes are keyed by character, so None is free to hold the
+            # rules ending at a node.
+            node.setdefault(None, []).append((position, rule['app']))
+
+    def _match_prefixes(self, node, from_addr, matches):
+        matches.extend(node.get(None, ()))
+        for char in from_addr or '':
+            node = node.get(char)
+            if node is None:
+                break
+            matches.extend(node.get(None, ()))
+
+    def match(self, keyword, to_addr, from_addr):
+        """Return the applications matching a message, in rule order."""
+        to_addrs = self._index.get(keyword)
+        if to_addrs is None:
+            return []
+        matches = []
+        for key in (self.ANY_TO_ADDR, to_addr):
+            node = to_addrs.get(key)
+            if node is not None:
+                self._match_prefixes(node, from_addr, matches)
+        return [app for position, app in sorted(matches)]
+
+
 class ContentKeywordRouter(SimpleDispatchRouter):
     """Router that dispatches based on the first word of the message
     content. In the context of SMSes the first word is sometimes called
@@ -470,26 +522,28 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
         message. Default is seven days.
+
+    :param float rules_reload_interval:
+        If set, how often (in seconds) to check Redis for a new set of
+        routing rules. The rules are stored under the ``routing_rules`` key
+        as a JSON object with optional `rules` and `keyword_mappings` keys
+        like the options above and replace the configured rules entirely.
+        Invalid rules are logged and ignored. Default is not to check.
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
+    RULES_KEY = 'routing_rules'
 
     def setup_routing(self):
         self.r_config = self.config.get('redis_manager', {})
         self.r_prefix = self.config['dispatcher_name']
 
-        self.rules = []
-        for rule in self.config.get('rules', []):
-            if 'keyword' not in rule or 'app' not in rule:
-                raise ConfigError("Rule definition %r must contain values for"
-                                  " both 'app' and 'keyword'" % rule)
-            rule = rule.copy()
-            rule['keyword'] = rule['keyword'].lower()
-            self.rules.append(rule)
-        keyword_mappings = self.config.get('keyword_mappings', {})
-        for transport_name, keyword in keyword_mappings.items():
-            self.rules.append({'app': transport_name,
-                               'keyword': keyword.lower()})
+        self.set_rules(self.config.get('rules', []),
+                       self.config.get('keyword_mappings', {}))
+        self._rules_json = None
+        self.rules_reload_interval = float(
+            self.config.get('rules_reload_interval', 0))
+        self._rules_reloader = None
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
@@ -504,6 +558,67 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.redis = redis
         self.session_manager = SessionManager(
             self.redis, self.expire_routing_timeout)
+        if self.rules_reload_interval > 0:
+            self._rules_reloader = LoopingCall(self.reload_rules)
+            d = self._rules_reloader.start(self.rules_reload_interval)
+            d.addErrback(lambda f: log.err(
+                f, "ContentKeywordRouter rule reloading task died"))
+
+    def teardown_routing(self):
+        if self._rules_reloader is not None:
+            if self._rules_reloader.running:
+                self._rules_reloader.stop()
+            self._rules_reloader = None
+
+    def compile_rules(self, rules, keyword_mappings):
+        """Validate routing rules and compile them into a
+        :class:`KeywordRoutingIndex`.
+        """
+        compiled_rules = []
+        for rule in rules:
+            if 'keyword' not in rule or 'app' not in rule:
+                raise ConfigError("Rule definition %r must contain values for"
+                                  " both 'app' and 'keyword'" % rule)
+            rule = rule.copy()
+            rule['keyword'] = rule['keyword'].lower()
+            compiled_rules.append(rule)
+        for transport_name, keyword in keyword_mappings.items():
+            compiled_rules.append({'app': transport_name,
+                                   'keyword': keyword.lower()})
+        return KeywordRoutingIndex(compiled_rules)
+
+    def set_rules(self, rules, keyword_mappings=None):
+        """Replace the routing rules.
+
+        The new rules are compiled before any are replaced, so messages are
+        always routed using either the old or the new set.
+        """
+        self.rule_index = self.compile_rules(rules, keyword_mappings or {})
+        self.rules = self.rule_index.rules
+
+    @inlineCallbacks
+    def reload_rules(self):
+        """Load routing rules from Redis if they have changed."""
+        yield self._redis_d  # Horrible hack to ensure we have it setup.
+        rules_json = yield self.redis.get(self.RULES_KEY)
+        if rules_json is None or rules_json == self._rules_json:
+            return
+        # Remember the rules even if they're invalid so that we only complain
+        # about them once.
+        self._rules_json = rules_json
+        try:
+            rule_set = json.loads(rules_json)
+            if not isinstance(rule_set, dict):
+                raise ConfigError(
+                    "Routing rules must be a JSON object, not %r" % (
+                        rule_set,))
+            self.set_rules(rule_set.get('rules', []),
+                           rule_set.get('keyword_mappings', {}))
+        except (ValueError, ConfigError), e:
+            log.error(DispatcherError(
+                "Ignoring invalid routing rules %r: %s" % (rules_json, e)))
+            return
+        log.msg("Loaded %d routing rules." % (len(self.rules),))
 
     def get_message_key(self, message):
         return 'message:%s' % (message,)
@@ -517,28 +632,21 @@ class ContentKeywordRouter(SimpleDispatchRouter):
     def publish_exposed_event(self, name, msg):
         self.dispatcher.publish_inbound_event(name, msg)
 
-    def is_msg_matching_routing_rules(self, keyword, msg, rule):
-        return all([keyword == rule['keyword'],
-                    (not 'to_addr' in rule) or
-                    (msg['to_addr'] == rule['to_addr']),
-                    (not 'prefix' in rule) or
-                    (msg['from_addr'].startswith(rule['prefix']))])
-
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
-        matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
-        if not matched:
-            if self.fallback_application is not None:
-                self.publish_exposed_inbound(self.fallback_application, msg)
-            else:
-                log.error(DispatcherError(
-                    'Message could not be routed: %r' % (msg,)))
+        apps = self.rule_index.match(keyword, msg['to_addr'], msg['from_addr'])
+        for app in apps[:-1]:
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(app, msg.copy())
+        if apps:
+            # The last application can have the original.
+            self.publish_exposed_inbound(apps[-1], msg)
+        elif self.fallback_application is not None:
+            self.publish_exposed_inbound(self.fallback_application, msg)
+        else:
+            log.error(DispatcherError(
+                'Message could not be routed: %r' % (msg,)))
 
     @inlineCallbacks
     def dispatch_inbound_event(self, msg):
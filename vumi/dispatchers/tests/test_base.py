@@ -1,9 +1,12 @@
+import json
+
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter,
+    KeywordRoutingIndex)
 from vumi.dispatchers.tests.helpers import DispatcherHelper, DummyDispatcher
-from vumi.errors import DispatcherError
+from vumi.errors import ConfigError, DispatcherError
 from vumi.tests.utils import LogCatcher
 from vumi.tests.helpers import VumiTestCase, MessageHelper
 
@@ -534,6 +537,75 @@ class TestContentKeywordRouter(VumiTestCase):
             'keyword1 rest of msg', to_addr='8181', from_addr='+256788601462')
         self.assert_dispatched('app1', [msg])
 
+    @inlineCallbacks
+    def test_inbound_message_routing_to_addr_and_prefix(self):
+        msg1 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8182', from_addr='+256788601462')
+        msg2 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+255788601462')
+        msg3 = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+256')
+        self.assert_dispatched('app1', [msg3])
+        self.assert_dispatched('app3', [msg1, msg2, msg3])
+        self.assert_dispatched('fallback_app', [])
+
+    @inlineCallbacks
+    def test_inbound_message_routing_unknown_keyword(self):
+        msg = yield self.send_inbound(
+            'KEYWORD4 rest of msg', to_addr='8181', from_addr='+256788601462')
+        self.assert_dispatched('app1', [])
+        self.assert_dispatched('app2', [])
+        self.assert_dispatched('app3', [])
+        self.assert_dispatched('fallback_app', [msg])
+
+    @inlineCallbacks
+    def test_set_rules(self):
+        self.router.set_rules([{'app': 'app2', 'keyword': 'keyword1'}])
+        msg = yield self.send_inbound(
+            'KEYWORD1 rest of msg', to_addr='8181', from_addr='+256788601462')
+        self.assert_dispatched('app1', [])
+        self.assert_dispatched('app2', [msg])
+        self.assert_dispatched('app3', [])
+
+    def test_set_rules_invalid(self):
+        self.assertRaises(
+            ConfigError, self.router.set_rules, [{'app': 'app2'}])
+        self.assertEqual(len(self.router.rules), 4)
+
+    @inlineCallbacks
+    def test_reload_rules(self):
+        yield self.router.reload_rules()
+        self.assertEqual(len(self.router.rules), 4)
+
+        yield self.redis.set('routing_rules', json.dumps({
+            'rules': [{'app': 'app1', 'keyword': 'KEYWORD5'}],
+            'keyword_mappings': {'app2': 'KEYWORD6'},
+        }))
+        yield self.router.reload_rules()
+        self.assertEqual(self.router.rules, [
+            {'app': 'app1', 'keyword': 'keyword5'},
+            {'app': 'app2', 'keyword': 'keyword6'},
+        ])
+        msg1 = yield self.send_inbound('KEYWORD5 rest of msg')
+        msg2 = yield self.send_inbound('KEYWORD6 rest of msg')
+        msg3 = yield self.send_inbound('KEYWORD1 rest of msg')
+        self.assert_dispatched('app1', [msg1])
+        self.assert_dispatched('app2', [msg2])
+        self.assert_dispatched('fallback_app', [msg3])
+
+    @inlineCallbacks
+    def test_reload_rules_invalid(self):
+        for rules_json in ['not json', '[]', '{"rules": [{"app": "app1"}]}']:
+            yield self.redis.set('routing_rules', rules_json)
+            yield self.router.reload_rules()
+            [err] = self.flushLoggedErrors(DispatcherError)
+            self.assertTrue(str(err.value).startswith(
+                'Ignoring invalid routing rules'))
+            self.assertEqual(len(self.router.rules), 4)
+        # Rules that we've already complained about aren't reloaded.
+        yield self.router.reload_rules()
+        self.assertEqual(self.flushLoggedErrors(DispatcherError), [])
+
     @inlineCallbacks
     def test_inbound_event_routing_ok(self):
         yield self.router.session_manager.create_session(
@@ -577,6 +649,75 @@ class TestContentKeywordRouter(VumiTestCase):
         self.assertEqual(session['name'], 'app2')
 
 
+class TestContentKeywordRouterReloading(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.disp_helper = self.add_helper(
+            DispatcherHelper(BaseDispatchWorker))
+        self.dispatcher = yield self.disp_helper.get_dispatcher({
+            'dispatcher_name': 'keyword_dispatcher',
+            'router_class': 'vumi.dispatchers.base.ContentKeywordRouter',
+            'transport_names': ['transport1'],
+            'transport_mappings': {},
+            'exposed_names': ['app1'],
+            'rules_reload_interval': 60,
+        })
+        self.router = self.dispatcher._router
+        yield self.router._redis_d
+        self.add_cleanup(self.router.session_manager.stop)
+
+    def test_reloader_started(self):
+        self.assertTrue(self.router._rules_reloader.running)
+        self.assertEqual(self.router._rules_reloader.interval, 60)
+
+    @inlineCallbacks
+    def test_reloader_stopped(self):
+        reloader = self.router._rules_reloader
+        yield self.dispatcher.stopWorker()
+        self.assertFalse(reloader.running)
+        self.assertEqual(self.router._rules_reloader, None)
+
+
+class TestKeywordRoutingIndex(VumiTestCase):
+
+    def test_match(self):
+        index = KeywordRoutingIndex([
+            {'app': 'app1', 'keyword': 'foo'},
+            {'app': 'app2', 'keyword': 'foo', 'to_addr': '123'},
+            {'app': 'app3', 'keyword': 'foo', 'prefix': '+27'},
+            {'app': 'app4', 'keyword': 'foo', 'to_addr': '123',
+             'prefix': '+2782'},
+            {'app': 'app5', 'keyword': 'bar'},
+            {'app': 'app6', 'keyword': 'foo', 'prefix': '+2'},
+        ])
+        self.assertEqual(index.match('foo', '123', '+27821234567'),
+                         ['app1', 'app2', 'app3', 'app4', 'app6'])
+        self.assertEqual(index.match('foo', '123', '+26821234567'),
+                         ['app1', 'app2', 'app6'])
+        self.assertEqual(index.match('foo', '456', '+27821234567'),
+                         ['app1', 'app3', 'app6'])
+        self.assertEqual(index.match('bar', '456', '+27821234567'),
+                         ['app5'])
+        self.assertEqual(index.match('baz', '456', '+27821234567'), [])
+
+    def test_match_none_addresses(self):
+        index = KeywordRoutingIndex([
+            {'app': 'app1', 'keyword': 'foo', 'to_addr': None},
+            {'app': 'app2', 'keyword': 'foo', 'prefix': '+27'},
+            {'app': 'app3', 'keyword': 'foo', 'prefix': ''},
+        ])
+        self.assertEqual(index.match('foo', None, None), ['app1', 'app3'])
+        self.assertEqual(index.match('foo', '123', '+27'), ['app2', 'app3'])
+
+    def test_match_same_app(self):
+        index = KeywordRoutingIndex([
+            {'app': 'app1', 'keyword': 'foo'},
+            {'app': 'app1', 'keyword': 'foo', 'prefix': '+27'},
+        ])
+        self.assertEqual(index.match('foo', '123', '+27'), ['app1', 'app1'])
+
+
 class TestRedirectOutboundRouterForSMPP(VumiTestCase):
     """
     This is a test to cover our use case when using SMPP 3.4 with
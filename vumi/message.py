@@ -71,6 +71,159 @@ def to_json(obj):
     return json.dumps(obj, cls=JSONMessageEncoder)
 
 
+def decode_datetime_fields(payload, fields):
+    """Parse the given fields of a payload as Vumi dates.
+
+    Unlike :func:`date_time_decoder`, this only looks at the named fields and
+    leaves everything else alone, so it's cheap enough for the message
+    decoding hot path.
+
+    :param dict payload:
+        The decoded message payload. It is modified in place.
+    :param fields:
+        The names of the fields to parse. Fields in nested dicts may be
+        named with a dotted path, e.g. ``message.timestamp``.
+    :return dict:
+        The payload.
+    """
+    for field in fields:
+        container = payload
+        path = field.split('.')
+        for key in path[:-1]:
+            container = container.get(key)
+            if not isinstance(container, dict):
+                break
+        else:
+            value = container.get(path[-1])
+            if isinstance(value, basestring):
+                try:
+                    container[path[-1]] = parse_vumi_date(value)
+                except ValueError:
+                    pass
+    return payload
+
+
+def decode_datetimes(value):
+    """Parse every string in a payload that looks like a Vumi date.
+
+    This has the same effect as decoding the payload with
+    :func:`date_time_decoder` as the JSON ``object_hook``, but also works for
+    payloads decoded by other serializers.
+
+    :param value:
+        The decoded payload. Dicts are modified in place.
+    :return:
+        The payload.
+    """
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, basestring):
+                try:
+                    value[key] = parse_vumi_date(item)
+                except ValueError:
+                    pass
+            else:
+                decode_datetimes(item)
+    elif isinstance(value, list):
+        for item in value:
+            decode_datetimes(item)
+    return value
+
+
+def copy_payload(value):
+    """Copy a message payload structure without serialising it.
+
+    Dicts and lists (and tuples, which become lists as they would in a JSON
+    round trip) are copied recursively. Everything else is treated as
+    immutable and shared.
+    """
+    if isinstance(value, dict):
+        return dict((k, copy_payload(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [copy_payload(v) for v in value]
+    return value
+
+
+def _encode_default(obj):
+    if isinstance(obj, datetime):
+        return format_vumi_date(obj)
+    raise TypeError("%r is not serializable" % (obj,))
+
+
+class JSONMessageSerializer(object):
+    """Serialize message payloads as JSON.
+
+    :param json_module:
+        A module that provides ``dumps`` and ``loads`` with the same
+        signatures as the standard library ``json`` module. This allows a
+        faster implementation (``simplejson``, for example) to be used.
+    """
+
+    content_type = 'application/json'
+
+    def __init__(self, json_module=json):
+        self.json = json_module
+
+    def serialize(self, payload):
+        return self.json.dumps(payload, default=_encode_default)
+
+    def deserialize(self, data):
+        return self.json.loads(data)
+
+
+class MsgpackMessageSerializer(object):
+    """Serialize message payloads using msgpack.
+
+    This requires the optional ``msgpack`` package.
+    """
+
+    content_type = 'application/x-msgpack'
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def serialize(self, payload):
+        return self.msgpack.packb(
+            payload, default=_encode_default, use_bin_type=True)
+
+    def deserialize(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+DEFAULT_CONTENT_TYPE = JSONMessageSerializer.content_type
+_SERIALIZERS = {}
+
+
+def register_message_serializer(serializer):
+    """Register a serializer for its content type.
+
+    Serializers are looked up by the AMQP ``content type`` property of the
+    messages we consume, so any registered content type can be consumed.
+    """
+    _SERIALIZERS[serializer.content_type] = serializer
+
+
+def get_message_serializer(content_type=None):
+    """Return the serializer for a content type.
+
+    If ``content_type`` is ``None``, the default JSON serializer is returned.
+    Serializers for content types that haven't been registered yet are
+    created on demand if we know how to build them.
+    """
+    if content_type is None:
+        content_type = DEFAULT_CONTENT_TYPE
+    if content_type not in _SERIALIZERS:
+        if content_type != MsgpackMessageSerializer.content_type:
+            raise ValueError(
+                "Unsupported message content type: %r" % (content_type,))
+        register_message_serializer(MsgpackMessageSerializer())
+    return _SERIALIZERS[content_type]
+
+
+register_message_serializer(JSONMessageSerializer())
+
+
 class Message(object):
     """
     A unified message object used by Vumi when transmitting messages over AMQP
@@ -84,6 +237,9 @@ class Message(object):
     # name of the special attribute that isn't stored by the message store
     _CACHE_ATTRIBUTE = "__cache__"
 
+    # fields that are decoded as datetimes when deserializing
+    DATETIME_FIELDS = ('timestamp',)
+
     def __init__(self, _process_fields=True, **kwargs):
         if _process_fields:
             kwargs = self.process_fields(kwargs)
@@ -113,6 +269,32 @@ class Message(object):
     def from_json(cls, json_string):
         return cls(_process_fields=False, **to_kwargs(from_json(json_string)))
 
+    def serialize(self, content_type=None):
+        """Serialize this message for the given content type."""
+        return get_message_serializer(content_type).serialize(self.payload)
+
+    @classmethod
+    def deserialize(cls, data, content_type=None, datetime_fields_only=False):
+        """Build a message from data serialized with the given content type.
+
+        As with :meth:`from_json`, every string that looks like a Vumi date
+        is parsed as a datetime. If ``datetime_fields_only`` is set, only the
+        fields listed in :attr:`DATETIME_FIELDS` are parsed, which is much
+        cheaper, and nested datetimes come back as strings.
+        """
+        payload = get_message_serializer(content_type).deserialize(data)
+        return cls.from_payload(
+            payload, datetime_fields_only=datetime_fields_only)
+
+    @classmethod
+    def from_payload(cls, payload, datetime_fields_only=False):
+        """Build a message from a freshly deserialized payload."""
+        if datetime_fields_only:
+            decode_datetime_fields(payload, cls.DATETIME_FIELDS)
+        else:
+            decode_datetimes(payload)
+        return cls(_process_fields=False, **to_kwargs(payload))
+
     def __str__(self):
         return u"<Message payload=\"%s\">" % repr(self.payload)
 
@@ -140,7 +322,8 @@ class Message(object):
         return self.payload.items()
 
     def copy(self):
-        return self.from_json(self.to_json())
+        return self.__class__(
+            _process_fields=False, **to_kwargs(copy_payload(self.payload)))
 
     @property
     def cache(self):
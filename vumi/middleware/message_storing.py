@@ -1,15 +1,20 @@
 # -*- test-case-name: vumi.middleware.tests.test_message_storing -*-
 
-from confmodel.fields import ConfigBool, ConfigDict, ConfigText
+from confmodel.fields import (
+    ConfigBool, ConfigDict, ConfigFloat, ConfigInt, ConfigText)
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, DeferredList, DeferredLock)
 
+from vumi import log
 from vumi.middleware.base import BaseMiddleware, BaseMiddlewareConfig
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.components.message_store import MessageStore
 from vumi.config import ConfigRiak
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi.utils import LRUCache
 
 
 class StoringMiddlewareConfig(BaseMiddlewareConfig):
@@ -28,6 +33,28 @@ class StoringMiddlewareConfig(BaseMiddlewareConfig):
         "``True`` to store consumed messages as well as published ones, "
         "``False`` to store only published messages.", default=True,
         static=True)
+    write_behind = ConfigBool(
+        "``True`` to buffer messages and events and store them in bulk "
+        "instead of storing each one before passing it on.", default=False,
+        static=True)
+    write_behind_batch_size = ConfigInt(
+        "The number of buffered messages and events that triggers a flush "
+        "in write-behind mode.", default=100, static=True)
+    write_behind_interval = ConfigFloat(
+        "The maximum number of seconds a message or event is buffered for "
+        "in write-behind mode.", default=1.0, static=True)
+    write_behind_max_buffer = ConfigInt(
+        "The maximum number of unstored messages and events in write-behind "
+        "mode. Once this is reached, message processing waits for the "
+        "store to catch up.", default=1000, static=True)
+    tag_cache_size = ConfigInt(
+        "The maximum number of tag to batch mappings to cache in "
+        "write-behind mode.", default=1000, static=True)
+    tag_cache_ttl = ConfigFloat(
+        "The number of seconds a cached tag to batch mapping is used for in "
+        "write-behind mode. Messages sent on a tag shortly after a new "
+        "batch is started for it may be stored in the previous batch.",
+        default=60.0, static=True)
 
 
 class StoringMiddleware(BaseMiddleware):
@@ -59,10 +86,29 @@ class StoringMiddleware(BaseMiddleware):
         ``True`` to store consumed messages as well as published ones,
         ``False`` to store only published messages.
         Default is ``True``.
+    :param bool write_behind:
+        ``True`` to buffer messages and events and store them in bulk.
+        Messages are passed on without waiting for them to be stored.
+        Default is ``False``.
+    :param int write_behind_batch_size:
+        Number of buffered messages and events that triggers a flush.
+        Default is 100.
+    :param float write_behind_interval:
+        Maximum number of seconds to buffer for. Default is 1.0.
+    :param int write_behind_max_buffer:
+        Maximum number of unstored messages and events before message
+        processing waits for the store. Default is 1000.
+    :param int tag_cache_size:
+        Maximum number of tag to batch mappings to cache. Default is 1000.
+    :param float tag_cache_ttl:
+        Number of seconds to cache tag to batch mappings for.
+        Default is 60.0.
     """
 
     CONFIG_CLASS = StoringMiddlewareConfig
 
+    clock = reactor
+
     @inlineCallbacks
     def setup_middleware(self):
         store_prefix = self.config.store_prefix
@@ -72,12 +118,106 @@ class StoringMiddleware(BaseMiddleware):
         self.store = MessageStore(
             self.manager, self.redis.sub_manager(store_prefix))
         self.store_on_consume = self.config.store_on_consume
+        self.write_behind = self.config.write_behind
+        self._write_buffer = []
+        self._unstored = 0
+        self._flush_call = None
+        self._flush_lock = DeferredLock()
+        self._tag_cache = LRUCache(
+            self.config.tag_cache_size, ttl=self.config.tag_cache_ttl,
+            clock=self.clock)
 
     @inlineCallbacks
     def teardown_middleware(self):
+        yield self.flush()
         yield self.redis.close_manager()
         yield self.manager.close_manager()
 
+    def _buffer_write(self, handler, message, tag=None):
+        # We store a copy so that changes made further along the pipeline
+        # don't affect what gets stored.
+        self._write_buffer.append((handler, message.copy(), tag))
+        self._unstored += 1
+        d = None
+        if len(self._write_buffer) >= self.config.write_behind_batch_size:
+            d = self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.config.write_behind_interval, self.flush)
+        if self._unstored >= self.config.write_behind_max_buffer:
+            # Too much is waiting to be stored, so we make the caller wait
+            # for the store to catch up.
+            return d if d is not None else self.flush()
+        return succeed(None)
+
+    def flush(self):
+        """
+        Store all buffered messages and events.
+
+        Returns a deferred that fires once everything buffered so far has
+        been stored. Flushes are serialised so that events are never stored
+        before the messages they refer to.
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        batch, self._write_buffer = self._write_buffer, []
+        return self._flush_lock.run(self._store_batch, batch)
+
+    @inlineCallbacks
+    def _store_batch(self, batch):
+        try:
+            tags = list(set(tag for _, _, tag in batch if tag is not None))
+            batch_ids = yield self._call_all(
+                (self._get_batch_id_for_tag, tag) for tag in tags)
+            tag_batch_ids = dict(zip(tags, batch_ids))
+            # Events look up batches from their outbound messages, so all
+            # the messages in this batch must be stored first.
+            yield self._call_all(
+                (self._add_message, handler, message, tag_batch_ids.get(tag))
+                for handler, message, tag in batch if handler != 'event')
+            yield self._call_all(
+                (self.store.add_event, event)
+                for handler, event, _ in batch if handler == 'event')
+        finally:
+            self._unstored -= len(batch)
+
+    def _call_all(self, calls):
+        """
+        Make the given ``(func, arg, ...)`` calls in parallel.
+
+        Returns a deferred that fires with a list of results. Failures are
+        logged and have a result of ``None``.
+        """
+        d = DeferredList(
+            [call[0](*call[1:]) for call in calls], consumeErrors=True)
+
+        def check_results(results):
+            values = []
+            for success, result in results:
+                if not success:
+                    log.err(result, "Error in message store write-behind")
+                    result = None
+                values.append(result)
+            return values
+
+        return d.addCallback(check_results)
+
+    def _add_message(self, handler, message, batch_id):
+        if handler == 'inbound':
+            return self.store.add_inbound_message(message, batch_id=batch_id)
+        return self.store.add_outbound_message(message, batch_id=batch_id)
+
+    @inlineCallbacks
+    def _get_batch_id_for_tag(self, tag):
+        if tag in self._tag_cache:
+            returnValue(self._tag_cache.get(tag))
+        tag_info = yield self.store.get_tag_info(tag)
+        batch_id = tag_info.current_batch.key
+        self._tag_cache.set(tag, batch_id)
+        returnValue(batch_id)
+
     def handle_consume_inbound(self, message, connector_name):
         if not self.store_on_consume:
             return message
@@ -86,7 +226,10 @@ class StoringMiddleware(BaseMiddleware):
     @inlineCallbacks
     def handle_inbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
+        if self.write_behind:
+            yield self._buffer_write('inbound', message, tag)
+        else:
+            yield self.store.add_inbound_message(message, tag=tag)
         returnValue(message)
 
     def handle_consume_outbound(self, message, connector_name):
@@ -97,7 +240,10 @@ class StoringMiddleware(BaseMiddleware):
     @inlineCallbacks
     def handle_outbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
+        if self.write_behind:
+            yield self._buffer_write('outbound', message, tag)
+        else:
+            yield self.store.add_outbound_message(message, tag=tag)
         returnValue(message)
 
     def handle_consume_event(self, event, connector_name):
@@ -115,5 +261,8 @@ class StoringMiddleware(BaseMiddleware):
             date = transport_metadata['date']
             if not isinstance(date, basestring):
                 transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
+        if self.write_behind:
+            yield self._buffer_write('event', event)
+        else:
+            yield self.store.add_event(event)
         returnValue(event)
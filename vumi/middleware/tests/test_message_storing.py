@@ -1,6 +1,7 @@
 """Tests for vumi.middleware.message_storing."""
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.message import TransportUserMessage, TransportEvent
@@ -19,7 +20,7 @@ class TestStoringMiddleware(VumiTestCase):
         self.add_cleanup(manager.close_manager)
 
     @inlineCallbacks
-    def setup_middleware(self, config={}):
+    def setup_middleware(self, config={}, clock=None):
         # We've already skipped the test by now if we don't have riakasaurus,
         # so it's safe to import stuff that pulls it in without guards.
         from vumi.middleware.message_storing import StoringMiddleware
@@ -27,6 +28,8 @@ class TestStoringMiddleware(VumiTestCase):
         config = self.persistence_helper.mk_config(config)
         dummy_worker = object()
         mw = StoringMiddleware("dummy_storer", config, dummy_worker)
+        if clock is not None:
+            mw.clock = clock
         self.add_cleanup(mw.teardown_middleware)
         yield mw.setup_middleware()
         self.store = mw.store
@@ -201,3 +204,97 @@ class TestStoringMiddleware(VumiTestCase):
         resp2 = yield mw.handle_publish_event(ack2, "dummy_connector")
         self.assertEqual(resp2, ack2)
         yield self.assert_outbound_stored(msg, events=[event_id2])
+
+    @inlineCallbacks
+    def test_write_behind_flush_on_batch_size(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True,
+            'write_behind_batch_size': 2,
+        })
+        msg1 = self.mk_msg()
+        resp1 = yield mw.handle_outbound(msg1, "dummy_connector")
+        self.assertEqual(resp1, msg1)
+        yield self.assert_outbound_not_stored(msg1)
+
+        msg2 = self.mk_msg()
+        resp2 = yield mw.handle_inbound(msg2, "dummy_connector")
+        self.assertEqual(resp2, msg2)
+        # The flush was started by the second message, so we wait for it.
+        yield mw._flush_lock.run(lambda: None)
+        yield self.assert_outbound_stored(msg1)
+        yield self.assert_inbound_stored(msg2)
+
+    @inlineCallbacks
+    def test_write_behind_flush_on_interval(self):
+        clock = Clock()
+        mw = yield self.setup_middleware({
+            'write_behind': True,
+            'write_behind_interval': 5,
+        }, clock=clock)
+        msg = self.mk_msg()
+        yield mw.handle_outbound(msg, "dummy_connector")
+        clock.advance(4)
+        yield self.assert_outbound_not_stored(msg)
+        clock.advance(1)
+        yield mw._flush_lock.run(lambda: None)
+        yield self.assert_outbound_stored(msg)
+
+    @inlineCallbacks
+    def test_write_behind_stores_copy(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        msg = self.mk_msg()
+        yield mw.handle_outbound(msg, "dummy_connector")
+        stored_msg = msg.copy()
+        msg['content'] = 'changed'
+        yield mw.flush()
+        yield self.assert_outbound_stored(stored_msg)
+
+    @inlineCallbacks
+    def test_write_behind_flush_on_teardown(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        msg = self.mk_msg()
+        yield mw.handle_inbound(msg, "dummy_connector")
+        yield self.assert_inbound_not_stored(msg)
+        yield mw.teardown_middleware()
+        yield self.assert_inbound_stored(msg)
+
+    @inlineCallbacks
+    def test_write_behind_max_buffer(self):
+        mw = yield self.setup_middleware({
+            'write_behind': True,
+            'write_behind_max_buffer': 2,
+        })
+        msg1 = self.mk_msg()
+        yield mw.handle_outbound(msg1, "dummy_connector")
+        yield self.assert_outbound_not_stored(msg1)
+        msg2 = self.mk_msg()
+        # The buffer is full, so we wait for everything to be stored.
+        yield mw.handle_outbound(msg2, "dummy_connector")
+        yield self.assert_outbound_stored(msg1)
+        yield self.assert_outbound_stored(msg2)
+
+    @inlineCallbacks
+    def test_write_behind_with_tag_and_event(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        msg = self.mk_msg()
+        TaggingMiddleware.add_tag_to_msg(msg, ["pool", "tag"])
+        yield mw.handle_outbound(msg, "dummy_connector")
+        ack = self.mk_ack(user_message_id=msg['message_id'])
+        yield mw.handle_event(ack, "dummy_connector")
+        yield mw.flush()
+        yield self.assert_outbound_stored(
+            msg, batch_id, events=[ack['event_id']])
+        event_record = yield self.store.events.load(ack['event_id'])
+        self.assertEqual(event_record.batches.keys(), [batch_id])
+
+    @inlineCallbacks
+    def test_write_behind_tag_cache(self):
+        mw = yield self.setup_middleware({'write_behind': True})
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        batch_id1 = yield mw._get_batch_id_for_tag(("pool", "tag"))
+        self.assertEqual(batch_id1, batch_id)
+        yield self.store.batch_done(batch_id)
+        batch_id2 = yield mw._get_batch_id_for_tag(("pool", "tag"))
+        self.assertEqual(batch_id2, batch_id)
+        self.assertEqual(mw._tag_cache.hits, 1)
@@ -27,6 +27,22 @@ def call_to_deferred(deferred, func, *args, **kw):
     execute(func, *args, **kw).chainDeferred(deferred)
 
 
+class SyncFakeRedis(object):
+    """
+    A synchronous view of a :class:`FakeRedis`, even an async one.
+
+    This is given to the Python implementations of Redis scripts, which run
+    "on the server" and so can't wait for deferreds.
+    """
+
+    def __init__(self, fake_redis):
+        self._fake_redis = fake_redis
+
+    def __getattr__(self, name):
+        func = getattr(type(self._fake_redis), name).sync
+        return lambda *args, **kw: func(self._fake_redis, *args, **kw)
+
+
 class ResponseError(Exception):
     """
     Exception class for things we throw to match the real Redis client
@@ -524,6 +540,32 @@ class FakeRedis(object):
             return 1
         return 0
 
+    # Pipelines and scripting
+
+    @maybe_async
+    def execute_pipeline(self, commands, transaction=True):
+        """
+        Run a list of ``(command, args, kwargs)`` tuples and return a list of
+        their results. Like the real client, every command is run and the
+        first error (if any) is raised afterwards.
+        """
+        results = []
+        error = None
+        for call, args, kw in commands:
+            try:
+                results.append(getattr(self, call).sync(self, *args, **kw))
+            except ResponseError as e:
+                results.append(e)
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    @maybe_async
+    def run_script(self, script, keys, args):
+        return script.fake_func(SyncFakeRedis(self), keys, args)
+
     # HyperLogLog operations
 
     @maybe_async
@@ -535,8 +577,11 @@ class FakeRedis(object):
         return hll.card() != old_card
 
     @maybe_async
-    def pfcount(self, key):
-        hll = self._data.get(key, HyperLogLog(0.01))
+    def pfcount(self, key, *keys):
+        hll = HyperLogLog(0.01)
+        hlls = [self._data[k] for k in (key,) + keys if k in self._data]
+        if hlls:
+            hll.update(*hlls)
         return len(hll)
 
 
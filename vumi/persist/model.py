@@ -5,7 +5,10 @@
 from functools import wraps
 import urllib
 
+from twisted.internet.defer import returnValue
+
 from vumi.errors import VumiError
+from vumi.utils import LRUCache
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
 
@@ -296,9 +299,14 @@ class Model(object):
     def load(cls, manager, key, result=None):
         """Load an object from Riak.
 
+        If the manager has a model cache or an identity map, they are
+        consulted before Riak.
+
         :returns:
             A deferred that fires with the new model object.
         """
+        if result is None:
+            return manager.load_cached(cls, key)
         return manager.load(cls, key, result=result)
 
     @classmethod
@@ -310,6 +318,37 @@ class Model(object):
         """
         return manager.load_all_bunches(cls, keys)
 
+    @classmethod
+    def load_many(cls, manager, keys, concurrency=None,
+                  result_callback=None):
+        """Load objects for the given list of keys.
+
+        See :meth:`Manager.load_many`.
+
+        :returns:
+            A (possibly deferred) list of model instances.
+        """
+        return manager.load_many(
+            cls, keys, concurrency=concurrency,
+            result_callback=result_callback)
+
+    @classmethod
+    def index_pages_loader(cls, manager, field_name, value, end_value=None,
+                           max_results=None, continuation=None,
+                           concurrency=None):
+        """Load objects page by page from an index query.
+
+        The arguments are the same as for :meth:`index_keys_page`, except for
+        ``concurrency``, which limits the number of objects loaded at once.
+
+        :returns:
+            A :class:`ModelPageLoader` for the query.
+        """
+        index_page = cls.index_keys_page(
+            manager, field_name, value, end_value, max_results=max_results,
+            continuation=continuation)
+        return ModelPageLoader(manager, cls, index_page, concurrency)
+
     @classmethod
     def all_keys(cls, manager):
         """Return all keys in this model's bucket.
@@ -665,6 +704,119 @@ class VumiMapReduce(object):
             self._riak_mapreduce_obj, self._results_to_keys)
 
 
+class ModelPageLoader(object):
+    """Load the model instances for each page of keys from an index query.
+
+    Each call to :meth:`next_page` loads the model instances for the next
+    page of keys. The following index page is fetched while the instances
+    for the current one are being loaded.
+
+    :param manager:
+        A :class:`Manager` object.
+    :param modelcls:
+        The model class to load.
+    :param index_page:
+        The first page of keys (a :class:`VumiIndexPage` or
+        :class:`VumiTxIndexPage` object, or a deferred that fires with one).
+        The index query must not return terms.
+    :param int concurrency:
+        The maximum number of model instances to load at once. See
+        :meth:`Manager.load_many`.
+    """
+
+    def __init__(self, manager, modelcls, index_page, concurrency=None):
+        self.manager = manager
+        self.modelcls = modelcls
+        self.concurrency = concurrency
+        self.continuation = None
+        self.done = False
+        self._index_page = index_page
+
+    def next_page(self):
+        """Load the model instances for the next page of keys.
+
+        Keys that don't have objects in Riak are skipped. Once the instances
+        are loaded, :attr:`continuation` holds the continuation token for the
+        rest of the query (or ``None`` if this was the last page).
+
+        :returns:
+            A (possibly deferred) list of model instances, or ``None`` if
+            there are no more pages.
+        """
+        return self.manager.call_decorator(self._next_page)()
+
+    def _next_page(self):
+        if self.done:
+            returnValue(None)
+        index_page = yield self._index_page
+        self._index_page = None
+        if index_page is None:
+            self.done = True
+            returnValue(None)
+        if index_page.has_next_page():
+            # Fetch the next page of keys while we load this one.
+            self._index_page = index_page.next_page()
+        modelobjs = yield self.manager.load_many(
+            self.modelcls, list(index_page), concurrency=self.concurrency)
+        self.continuation = index_page.continuation
+        self.done = self._index_page is None
+        returnValue(modelobjs)
+
+
+class ModelCache(LRUCache):
+    """A least-recently-used cache of loaded model data.
+
+    Entries hold the encoded data and metadata of a model's Riak object rather
+    than the model instance itself, so every cache hit builds a new instance
+    that the caller is free to modify.
+
+    Each key being loaded from Riak has a generation number that is bumped
+    whenever the key is invalidated, so that a load that raced with a store
+    or delete doesn't put stale data in the cache. Generations are only
+    tracked while loads are in flight.
+
+    See :class:`vumi.utils.LRUCache` for the parameters.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=None):
+        super(ModelCache, self).__init__(max_size, ttl=ttl, clock=clock)
+        # Maps keys being loaded to [generation, number of loads in flight].
+        self._generations = {}
+
+    def begin_load(self, key):
+        """Note that a load of ``key`` has started and return the key's
+        current generation.
+        """
+        generation = self._generations.setdefault(key, [0, 0])
+        generation[1] += 1
+        return generation[0]
+
+    def end_load(self, key, generation, data):
+        """Cache ``data`` for a load started by :meth:`begin_load`, unless the
+        key has been invalidated since then.
+
+        ``data`` may be ``None`` if the load failed or there was nothing to
+        cache.
+        """
+        current = self._generations[key]
+        current[1] -= 1
+        if not current[1]:
+            del self._generations[key]
+        if data is not None and current[0] == generation:
+            self.set(key, data)
+
+    def invalidate(self, key):
+        """Remove ``key`` and stop any loads in flight from caching it."""
+        self.pop(key)
+        if key in self._generations:
+            self._generations[key][0] += 1
+
+    def stats(self):
+        stats = super(ModelCache, self).stats()
+        stats["max_size"] = self.max_size
+        return stats
+
+
 class Manager(object):
     """A wrapper around a Riak client."""
 
@@ -675,7 +827,8 @@ class Manager(object):
     USE_MAPREDUCE_BUNCH_LOADING = False
 
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None, store_versions=None, parent=None):
+                 mapreduce_timeout=None, store_versions=None, parent=None,
+                 cache_size=None, cache_ttl=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
@@ -684,6 +837,12 @@ class Manager(object):
         self._bucket_cache = {}
         self.store_versions = store_versions or {}
         self._parent = parent
+        self.model_cache = None
+        if cache_size:
+            self.model_cache = ModelCache(cache_size, ttl=cache_ttl)
+        elif parent is not None:
+            self.model_cache = parent.model_cache
+        self._identity_map = None
 
     def proxy(self, modelcls):
         return ModelProxy(self, modelcls)
@@ -692,6 +851,30 @@ class Manager(object):
         return self.__class__(
             self.client, self.bucket_prefix + sub_prefix, parent=self)
 
+    def identity_scope(self):
+        """Return a manager with an identity map.
+
+        The new manager shares this manager's client, bucket prefix and model
+        cache. Loading the same key more than once through it returns the same
+        model instance, so it should only be used for the duration of a single
+        request or unit of work.
+        """
+        manager = self.sub_manager('')
+        manager.load_bunch_size = self.load_bunch_size
+        manager.mapreduce_timeout = self.mapreduce_timeout
+        manager.store_versions = self.store_versions
+        manager._identity_map = {}
+        return manager
+
+    def cache_stats(self):
+        """Return hit, miss and size metrics for the model cache.
+
+        Returns ``None`` if there is no model cache.
+        """
+        if self.model_cache is None:
+            return None
+        return self.model_cache.stats()
+
     def bucket_name(self, modelcls_or_obj):
         return self.bucket_prefix + modelcls_or_obj.bucket
 
@@ -765,6 +948,110 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " .load(...)")
 
+    def load_cached(self, modelcls, key):
+        """Load a model instance, consulting the identity map and model cache
+        (if there are any) before Riak.
+        """
+        if self.model_cache is None and self._identity_map is None:
+            return self.load(modelcls, key)
+        return self.call_decorator(self._load_cached)(modelcls, key)
+
+    def _load_cached(self, modelcls, key):
+        cache_key = (self.bucket_name(modelcls), key)
+        if self._identity_map is not None:
+            modelobj = self._identity_map.get(cache_key)
+            if isinstance(modelobj, modelcls):
+                returnValue(modelobj)
+
+        cached = None
+        if self.model_cache is not None:
+            cached = self.model_cache.get(cache_key)
+        if cached is not None:
+            modelobj = self._load_from_cache(modelcls, key, cached)
+        elif self.model_cache is None:
+            modelobj = yield self.load(modelcls, key)
+        else:
+            generation = self.model_cache.begin_load(cache_key)
+            data = None
+            try:
+                modelobj = yield self.load(modelcls, key)
+                # Migrated objects aren't cached so that the caller that loads
+                # them from Riak gets a chance to notice and store them.
+                if modelobj is not None and not modelobj.was_migrated:
+                    data = self._cache_data(modelobj)
+            finally:
+                self.model_cache.end_load(cache_key, generation, data)
+
+        if modelobj is not None and self._identity_map is not None:
+            self._identity_map[cache_key] = modelobj
+        returnValue(modelobj)
+
+    def _cache_data(self, modelobj):
+        riak_object = modelobj._riak_object
+        return {
+            'content_type': riak_object.get_content_type(),
+            'encoded_data': riak_object.get_encoded_data(),
+            'indexes': list(riak_object.get_indexes()),
+            'usermeta': dict(riak_object.get_user_metadata()),
+            'vclock': riak_object.get_vclock(),
+        }
+
+    def _load_from_cache(self, modelcls, key, cached):
+        riak_object = self.riak_object(modelcls, key)
+        riak_object.set_content_type(cached['content_type'])
+        riak_object.set_encoded_data(cached['encoded_data'])
+        riak_object.set_indexes(list(cached['indexes']))
+        riak_object.set_user_metadata(dict(cached['usermeta']))
+        riak_object.set_vclock(cached['vclock'])
+        return self._migrate_riak_object(modelcls, key, riak_object)
+
+    def _update_cache(self, modelobj, deleted=False):
+        """Invalidate cached data for a model instance that is being stored or
+        deleted.
+
+        NOTE: This should only be called by subclasses.
+        """
+        cache_key = (self.bucket_name(modelobj), modelobj.key)
+        if self.model_cache is not None:
+            self.model_cache.invalidate(cache_key)
+        if self._identity_map is not None:
+            if deleted:
+                self._identity_map.pop(cache_key, None)
+            else:
+                self._identity_map[cache_key] = modelobj
+
+    def load_many(self, modelcls, keys, concurrency=None,
+                  result_callback=None):
+        """Load the model instances for a list of keys.
+
+        If a key doesn't exist, no object will be returned for it.
+
+        :param int concurrency:
+            The maximum number of objects to load at once. Defaults to the
+            manager's ``load_bunch_size``.
+        :param result_callback:
+            A function that is called with each model instance as soon as it
+            is loaded. If it returns a deferred, further loads wait for it.
+
+        :returns:
+            A (possibly deferred) list of model instances in key order.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .load_many(...)")
+
+    def store_many(self, modelobjs, concurrency=None):
+        """Store a list of model instances in Riak.
+
+        :param int concurrency:
+            The maximum number of objects to store at once. Defaults to the
+            manager's ``load_bunch_size``.
+
+        :returns:
+            A (possibly deferred) list of the stored model instances.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .store_many(...)")
+
     def _migrate_riak_object(self, modelcls, key, riak_object):
         """
         Migrate a loaded riak_object to the latest schema version.
@@ -851,10 +1138,8 @@ class Manager(object):
         :returns:
             An iterator over (possibly deferred) lists of model instances.
         """
-        while keys:
-            batch_keys = keys[:self.load_bunch_size]
-            keys = keys[self.load_bunch_size:]
-            yield self._load_bunch(model, batch_keys)
+        for i in xrange(0, len(keys), self.load_bunch_size):
+            yield self._load_bunch(model, keys[i:i + self.load_bunch_size])
 
     def riak_map_reduce(self):
         """Construct a RiakMapReduce object for this client."""
@@ -952,6 +1237,19 @@ class ModelProxy(object):
     def load_all_bunches(self, *args, **kw):
         return self._modelcls.load_all_bunches(self._manager, *args, **kw)
 
+    def load_many(self, keys, concurrency=None, result_callback=None):
+        return self._modelcls.load_many(
+            self._manager, keys, concurrency=concurrency,
+            result_callback=result_callback)
+
+    def index_pages_loader(self, field_name, value, end_value=None,
+                           max_results=None, continuation=None,
+                           concurrency=None):
+        return self._modelcls.index_pages_loader(
+            self._manager, field_name, value, end_value,
+            max_results=max_results, continuation=continuation,
+            concurrency=concurrency)
+
     def all_keys(self):
         return self._modelcls.all_keys(self._manager)
 
@@ -2,6 +2,7 @@
 
 import os
 from functools import wraps
+from hashlib import sha1
 
 from vumi.persist.ast_magic import make_function
 from vumi.persist.fake_redis import FakeRedis
@@ -55,6 +56,29 @@ class CallMakerMetaclass(type):
         return type.__new__(meta, classname, bases, new_class_dict)
 
 
+class RedisScript(object):
+    """
+    A Lua script to run atomically on the Redis server.
+
+    Scripts are run with ``EVALSHA`` so that the script body is only sent to
+    the server if it isn't already in the server's script cache.
+
+    :param str lua:
+        The Lua source of the script. It can use ``KEYS`` and ``ARGV`` as
+        usual. Keys are prefixed by the manager before the script is run.
+    :param fake_func:
+        A Python implementation of the script for
+        :class:`~vumi.persist.fake_redis.FakeRedis`, which can't run Lua. It
+        is called with a synchronous view of the fake, a list of keys and a
+        list of args, and must return the same values the Lua script does.
+    """
+
+    def __init__(self, lua, fake_func):
+        self.lua = lua
+        self.sha = sha1(lua).hexdigest()
+        self.fake_func = fake_func
+
+
 class ClientProxy(object):
     def __init__(self, client):
         self.client = client
@@ -102,6 +126,23 @@ class Manager(object):
             sub_man._close = self._client.teardown
         return sub_man
 
+    def pipeline(self, transaction=True):
+        """
+        Return a :class:`Pipeline` for sending several commands at once.
+
+        :param bool transaction:
+            If ``True``, the commands are wrapped in ``MULTI``/``EXEC`` and
+            run atomically.
+        """
+        return Pipeline(self, transaction)
+
+    def run_script(self, script, keys=(), args=()):
+        """
+        Run a :class:`RedisScript` with the given keys and args.
+        """
+        keys = [self._key(key) for key in keys]
+        return self._make_redis_call('run_script', script, keys, list(args))
+
     @staticmethod
     def calls_manager(manager_attr):
         """Decorate a method that calls a manager.
@@ -310,4 +351,53 @@ class Manager(object):
     # HyperLogLog operations
 
     pfadd = RedisCall(['key'], vararg='values')
-    pfcount = RedisCall(['key'])
+    pfcount = RedisCall(['key'], vararg='keys', key_args=['key', 'keys'])
+
+
+class Pipeline(Manager):
+    """
+    A batch of Redis commands that are sent to the server together.
+
+    Commands are queued by calling the usual manager methods on the pipeline
+    and sent by calling :meth:`execute`, which returns a list of results (or
+    a deferred that fires with one, for async managers). Key prefixes and
+    result filters are handled the same way as they are by the manager.
+    """
+
+    def __init__(self, manager, transaction=True):
+        super(Pipeline, self).__init__(
+            None, manager._config, manager._key_prefix,
+            key_separator=manager._key_separator,
+            client_proxy=manager._client_proxy)
+        self._manager = manager
+        self._transaction = transaction
+        self._commands = []
+        self._filters = []
+
+    def __len__(self):
+        return len(self._commands)
+
+    def pipeline(self, transaction=True):
+        raise NotImplementedError("Pipelines can't be nested.")
+
+    def execute(self):
+        """
+        Send all queued commands and return their results.
+        """
+        commands, self._commands = self._commands, []
+        filters, self._filters = self._filters, []
+        results = self._client.execute_pipeline(commands, self._transaction)
+
+        def filter_results(results):
+            return [r if f is None else f(r) for f, r in zip(filters, results)]
+
+        return self._manager._filter_redis_results(filter_results, results)
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._commands.append((call, args, kw))
+        self._filters.append(None)
+        return self
+
+    def _filter_redis_results(self, func, results):
+        self._filters[-1] = func
+        return results
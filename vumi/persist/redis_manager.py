@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_manager -*-
 
 import redis
+import redis.client
 import redis.exceptions
 
 from vumi.persist.redis_base import Manager
@@ -47,6 +48,49 @@ class VumiRedis(redis.Redis):
             cursor = None
         return (cursor, keys)
 
+    def pipeline(self, transaction=True, shard_hint=None):
+        return VumiPipeline(
+            self.connection_pool, self.response_callbacks, transaction,
+            shard_hint)
+
+    def execute_pipeline(self, commands, transaction=True):
+        """
+        Run a list of ``(command, args, kwargs)`` tuples in a single round
+        trip and return a list of their results.
+        """
+        pipe = self.pipeline(transaction=transaction)
+        for call, args, kw in commands:
+            getattr(pipe, call)(*args, **kw)
+        return pipe.execute()
+
+    def run_script(self, script, keys, args):
+        """
+        Run a :class:`~vumi.persist.redis_base.RedisScript`, sending the
+        script body only if the server hasn't seen it before.
+        """
+        try:
+            return self.execute_command(
+                'EVALSHA', script.sha, len(keys), *(keys + args))
+        except redis.exceptions.NoScriptError:
+            return self.execute_command(
+                'EVAL', script.lua, len(keys), *(keys + args))
+
+
+class VumiPipeline(redis.client.BasePipeline, VumiRedis):
+    """
+    Pipeline that uses our custom client's command signatures.
+
+    .. note::
+
+       :meth:`scan` can't be used in a pipeline.
+    """
+
+    def run_script(self, script, keys, args):
+        # We can't find out whether the server has the script until the
+        # pipeline is executed, so we send the whole thing.
+        return self.execute_command(
+            'EVAL', script.lua, len(keys), *(keys + args))
+
 
 class RedisManager(Manager):
 
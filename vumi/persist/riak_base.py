@@ -177,6 +177,9 @@ class VumiRiakObjectBase(object):
     def set_data(self, data):
         self._riak_obj.data = data
 
+    def get_encoded_data(self):
+        return self._riak_obj.encoded_data
+
     def set_encoded_data(self, encoded_data):
         self._riak_obj.encoded_data = encoded_data
 
@@ -204,6 +207,12 @@ class VumiRiakObjectBase(object):
     def set_user_metadata(self, usermeta):
         self._riak_obj.usermeta = usermeta
 
+    def get_vclock(self):
+        return self._riak_obj.vclock
+
+    def set_vclock(self, vclock):
+        self._riak_obj.vclock = vclock
+
     def get_bucket(self):
         raise NotImplementedError("Subclasses must implement this.")
 
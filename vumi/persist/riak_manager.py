@@ -100,6 +100,8 @@ class RiakManager(Manager):
             'mapreduce_timeout', cls.DEFAULT_MAPREDUCE_TIMEOUT)
         transport_type = config.pop('transport_type', 'http')
         store_versions = config.pop('store_versions', None)
+        cache_size = config.pop('cache_size', None)
+        cache_ttl = config.pop('cache_ttl', None)
 
         host = config.get('host', '127.0.0.1')
         port = config.get('port')
@@ -119,7 +121,8 @@ class RiakManager(Manager):
         client = VumiRiakClient(**client_args)
         return cls(
             client, bucket_prefix, load_bunch_size=load_bunch_size,
-            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions)
+            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions,
+            cache_size=cache_size, cache_ttl=cache_ttl)
 
     def close_manager(self):
         if self._parent is None:
@@ -164,10 +167,12 @@ class RiakManager(Manager):
     def store(self, modelobj):
         riak_object = self._reverse_migrate_riak_object(modelobj)
         riak_object.store()
+        self._update_cache(modelobj)
         return modelobj
 
     def delete(self, modelobj):
         modelobj._riak_object.delete()
+        self._update_cache(modelobj, deleted=True)
 
     def load(self, modelcls, key, result=None):
         riak_object = self.riak_object(modelcls, key, result)
@@ -179,6 +184,21 @@ class RiakManager(Manager):
         objs = (self.load(modelcls, key) for key in keys)
         return [obj for obj in objs if obj is not None]
 
+    def load_many(self, modelcls, keys, concurrency=None,
+                  result_callback=None):
+        # Loads are synchronous, so there's no concurrency to limit.
+        modelobjs = []
+        for key in keys:
+            modelobj = self.load_cached(modelcls, key)
+            if modelobj is not None:
+                modelobjs.append(modelobj)
+                if result_callback is not None:
+                    result_callback(modelobj)
+        return modelobjs
+
+    def store_many(self, modelobjs, concurrency=None):
+        return [self.store(modelobj) for modelobj in modelobjs]
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
@@ -549,6 +549,18 @@ class FakeRedisTestMixin(object):
         yield self.assert_redis_op(redis, 0, 'pfadd', 'hll2', 'a', 'b')
         yield self.assert_redis_op(redis, 2, 'pfcount', 'hll2')
 
+    @inlineCallbacks
+    def test_pfcount_multiple_keys(self):
+        redis = yield self.get_redis()
+        yield redis.pfadd('hll1', 'a', 'b')
+        yield redis.pfadd('hll2', 'b', 'c')
+        yield self.assert_redis_op(redis, 3, 'pfcount', 'hll1', 'hll2')
+        yield self.assert_redis_op(
+            redis, 2, 'pfcount', 'hll1', 'missing')
+        yield self.assert_redis_op(redis, 0, 'pfcount', 'missing')
+        # Counting a union doesn't change the keys.
+        yield self.assert_redis_op(redis, 2, 'pfcount', 'hll1')
+
 
 class FakeRedisUnverifiedTestMixin(object):
     """
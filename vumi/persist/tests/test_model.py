@@ -2,10 +2,13 @@
 
 """Tests for vumi.persist.model."""
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, Deferred)
+from twisted.internet.task import Clock
 
 from vumi.persist.model import (
-    Model, Manager, ModelMigrator, ModelMigrationError, VumiRiakError)
+    Model, Manager, ModelCache, ModelMigrator, ModelMigrationError,
+    ModelPageLoader, VumiRiakError)
 from vumi.persist import fields
 from vumi.persist.fields import (
     ValidationError, Integer, Unicode, Dynamic, Field, FieldDescriptor)
@@ -416,6 +419,83 @@ class ModelTestMixin(object):
             objs.extend((yield obj_bunch))
         self.assertEqual(["one", "two"], sorted(obj.key for obj in objs))
 
+    @Manager.calls_manager
+    def test_load_all_bunches_small_bunches(self):
+        self.manager.load_bunch_size = 2
+        simple_model = self.manager.proxy(SimpleModel)
+        keys = ["k%d" % i for i in range(5)]
+        for key in keys:
+            yield simple_model(key, a=1, b=u'abc').save()
+
+        bunches = []
+        for obj_bunch in simple_model.load_all_bunches(keys):
+            bunches.append(sorted(obj.key for obj in (yield obj_bunch)))
+        self.assertEqual(bunches, [["k0", "k1"], ["k2", "k3"], ["k4"]])
+
+    @Manager.calls_manager
+    def test_load_many(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("one", a=1, b=u'abc').save()
+        yield simple_model("two", a=2, b=u'def').save()
+        yield simple_model("three", a=2, b=u'ghi').save()
+
+        loaded = []
+        objs = yield simple_model.load_many(
+            ['three', 'bad', 'one'], concurrency=2,
+            result_callback=loaded.append)
+        self.assertEqual([obj.key for obj in objs], ["three", "one"])
+        self.assertEqual([obj.a for obj in objs], [2, 1])
+        self.assertEqual(sorted(obj.key for obj in loaded), ["one", "three"])
+
+    @Manager.calls_manager
+    def test_load_many_no_keys(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        objs = yield simple_model.load_many([])
+        self.assertEqual(objs, [])
+
+    @Manager.calls_manager
+    def test_store_many(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        objs = [simple_model("k%d" % i, a=i, b=u'abc') for i in range(5)]
+        stored = yield self.manager.store_many(objs, concurrency=2)
+        self.assertEqual(stored, objs)
+        loaded = yield simple_model.load_many(["k%d" % i for i in range(5)])
+        self.assertEqual([obj.a for obj in loaded], range(5))
+
+    @Manager.calls_manager
+    def test_index_pages_loader(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        for key in ["k1", "k2", "k3"]:
+            yield indexed_model(key, a=1, b=u"one").save()
+        yield indexed_model("other", a=2, b=u"two").save()
+
+        loader = indexed_model.index_pages_loader('a', 1, max_results=2)
+        page1 = yield loader.next_page()
+        self.assertEqual(sorted(obj.key for obj in page1), ["k1", "k2"])
+        self.assertNotEqual(loader.continuation, None)
+        self.assertFalse(loader.done)
+        page2 = yield loader.next_page()
+        self.assertEqual([obj.key for obj in page2], ["k3"])
+        self.assertEqual(loader.continuation, None)
+        self.assertTrue(loader.done)
+        page3 = yield loader.next_page()
+        self.assertEqual(page3, None)
+
+    @Manager.calls_manager
+    def test_index_pages_loader_resume(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        for key in ["k1", "k2", "k3"]:
+            yield indexed_model(key, a=1, b=u"one").save()
+
+        loader = indexed_model.index_pages_loader('a', 1, max_results=2)
+        page1 = yield loader.next_page()
+        resumed = indexed_model.index_pages_loader(
+            'a', 1, max_results=2, continuation=loader.continuation)
+        page2 = yield resumed.next_page()
+        self.assertEqual(
+            sorted(obj.key for obj in page1 + page2), ["k1", "k2", "k3"])
+        self.assertTrue(resumed.done)
+
     @Manager.calls_manager
     def test_load_all_bunches_skips_tombstones(self):
         self.assertFalse(self.manager.USE_MAPREDUCE_BUNCH_LOADING)
@@ -1154,6 +1234,350 @@ class ModelTestMixin(object):
         dcf.a = "aval2"
         self.assertEqual(mfc_called_fields, [("b", "a"), ("b", "a")])
 
+    @Manager.calls_manager
+    def test_load_without_model_cache(self):
+        self.assertEqual(self.manager.model_cache, None)
+        self.assertEqual(self.manager.cache_stats(), None)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo", a=5, b=u'3').save()
+        s = yield simple_model.load("foo")
+        self.assertEqual((s.a, s.b), (5, u'3'))
+
+    @Manager.calls_manager
+    def test_load_uses_model_cache(self):
+        self.manager.model_cache = ModelCache(10)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo", a=5, b=u'3').save()
+
+        s1 = yield simple_model.load("foo")
+        self.assertEqual(self.manager.cache_stats()["misses"], 1)
+        self.assertEqual(self.manager.cache_stats()["hits"], 0)
+        s2 = yield simple_model.load("foo")
+        self.assertEqual(self.manager.cache_stats()["hits"], 1)
+        self.assertEqual(s2.get_data(), s1.get_data())
+        self.assertEqual(s2._riak_object.get_indexes(),
+                         s1._riak_object.get_indexes())
+        self.assertNotIdentical(s2, s1)
+
+        # Cache hits are independent instances.
+        s2.a = 6
+        s3 = yield simple_model.load("foo")
+        self.assertEqual(s3.a, 5)
+
+    @Manager.calls_manager
+    def test_load_missing_with_model_cache(self):
+        self.manager.model_cache = ModelCache(10)
+        simple_model = self.manager.proxy(SimpleModel)
+        s = yield simple_model.load("foo")
+        self.assertEqual(s, None)
+        self.assertEqual(self.manager.cache_stats()["size"], 0)
+
+    @Manager.calls_manager
+    def test_save_invalidates_model_cache(self):
+        self.manager.model_cache = ModelCache(10)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo", a=5, b=u'3').save()
+        s1 = yield simple_model.load("foo")
+        s1.a = 6
+        yield s1.save()
+        self.assertEqual(self.manager.cache_stats()["size"], 0)
+        s2 = yield simple_model.load("foo")
+        self.assertEqual(s2.a, 6)
+
+    @Manager.calls_manager
+    def test_delete_invalidates_model_cache(self):
+        self.manager.model_cache = ModelCache(10)
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo", a=5, b=u'3').save()
+        s1 = yield simple_model.load("foo")
+        yield s1.delete()
+        s2 = yield simple_model.load("foo")
+        self.assertEqual(s2, None)
+
+    @Manager.calls_manager
+    def test_sub_manager_shares_model_cache(self):
+        self.manager.model_cache = ModelCache(10)
+        sub_manager = self.manager.sub_manager("sub.")
+        self.assertIdentical(sub_manager.model_cache, self.manager.model_cache)
+        yield self.manager.proxy(SimpleModel)("foo", a=5, b=u'3').save()
+        # The bucket prefix is part of the cache key, so the sub-manager
+        # doesn't see objects in the parent manager's buckets.
+        s = yield sub_manager.proxy(SimpleModel).load("foo")
+        self.assertEqual(s, None)
+
+    @Manager.calls_manager
+    def test_identity_scope(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo", a=5, b=u'3').save()
+        scope = self.manager.identity_scope()
+        self.assertEqual(scope.bucket_prefix, self.manager.bucket_prefix)
+        scoped_model = scope.proxy(SimpleModel)
+        s1 = yield scoped_model.load("foo")
+        s2 = yield scoped_model.load("foo")
+        self.assertIdentical(s2, s1)
+        # Loads outside the scope still get their own instances.
+        s3 = yield simple_model.load("foo")
+        self.assertNotIdentical(s3, s1)
+
+    @Manager.calls_manager
+    def test_identity_scope_store_and_delete(self):
+        scope = self.manager.identity_scope()
+        scoped_model = scope.proxy(SimpleModel)
+        s1 = yield scoped_model("foo", a=5, b=u'3').save()
+        s2 = yield scoped_model.load("foo")
+        self.assertIdentical(s2, s1)
+        yield s1.delete()
+        s3 = yield scoped_model.load("foo")
+        self.assertEqual(s3, None)
+
+
+class FakeIndexPage(object):
+    def __init__(self, pages, index=0):
+        self.pages = pages
+        self.index = index
+        self.continuation = (
+            "page-%d" % (index + 1,) if index + 1 < len(pages) else None)
+        self.next_page_calls = 0
+
+    def __iter__(self):
+        return iter(self.pages[self.index])
+
+    def has_next_page(self):
+        return self.continuation is not None
+
+    def next_page(self):
+        self.next_page_calls += 1
+        return succeed(FakeIndexPage(self.pages, self.index + 1))
+
+
+class FakeLoadManager(object):
+    call_decorator = staticmethod(inlineCallbacks)
+
+    def __init__(self):
+        self.loads = []
+
+    def load_many(self, modelcls, keys, concurrency=None):
+        d = Deferred()
+        self.loads.append((keys, concurrency, d))
+        return d
+
+
+class FakeCacheModel(object):
+    bucket = SimpleModel.bucket
+    was_migrated = False
+
+    def __init__(self, key, data):
+        self.key = key
+        self.data = data
+
+
+class FakeCacheManager(Manager):
+    call_decorator = staticmethod(inlineCallbacks)
+
+    def __init__(self):
+        super(FakeCacheManager, self).__init__(None, "test.", cache_size=10)
+        self.loads = []
+
+    def load(self, modelcls, key, result=None):
+        d = Deferred()
+        self.loads.append(d)
+        return d
+
+    def _cache_data(self, modelobj):
+        return modelobj.data
+
+    def _load_from_cache(self, modelcls, key, cached):
+        return FakeCacheModel(key, cached)
+
+
+class TestManagerLoadCached(VumiTestCase):
+
+    def test_load_cached(self):
+        manager = FakeCacheManager()
+        d = manager.load_cached(SimpleModel, "foo")
+        [load_d] = manager.loads
+        load_d.callback(FakeCacheModel("foo", "data"))
+        self.assertEqual(self.successResultOf(d).data, "data")
+        self.assertEqual(
+            manager.model_cache.get(("test.simplemodel", "foo")), "data")
+        self.assertEqual(manager.model_cache._generations, {})
+
+    def test_load_cached_racing_store(self):
+        manager = FakeCacheManager()
+        d = manager.load_cached(SimpleModel, "foo")
+        [load_d] = manager.loads
+        # A store finishes while the load is in flight, so the loaded data
+        # may be stale and mustn't be cached.
+        manager._update_cache(FakeCacheModel("foo", "new"))
+        load_d.callback(FakeCacheModel("foo", "old"))
+        self.assertEqual(self.successResultOf(d).data, "old")
+        self.assertEqual(len(manager.model_cache), 0)
+        self.assertEqual(manager.model_cache._generations, {})
+
+        d = manager.load_cached(SimpleModel, "foo")
+        manager.loads[-1].callback(FakeCacheModel("foo", "new"))
+        self.assertEqual(
+            manager.model_cache.get(("test.simplemodel", "foo")), "new")
+
+    def test_load_cached_failure(self):
+        manager = FakeCacheManager()
+        d = manager.load_cached(SimpleModel, "foo")
+        [load_d] = manager.loads
+        load_d.errback(VumiRiakError("oops"))
+        self.failureResultOf(d, VumiRiakError)
+        self.assertEqual(len(manager.model_cache), 0)
+        self.assertEqual(manager.model_cache._generations, {})
+
+
+class TestModelPageLoader(VumiTestCase):
+
+    def test_next_page(self):
+        manager = FakeLoadManager()
+        first_page = FakeIndexPage([["a", "b"], ["c"]])
+        loader = ModelPageLoader(manager, SimpleModel, first_page, 5)
+
+        d = loader.next_page()
+        [(keys, concurrency, load_d)] = manager.loads
+        self.assertEqual((keys, concurrency), (["a", "b"], 5))
+        # The next index page is requested before the models are loaded.
+        self.assertEqual(first_page.next_page_calls, 1)
+        self.assertEqual(loader.continuation, None)
+        load_d.callback(["obj-a"])
+        self.assertEqual(self.successResultOf(d), ["obj-a"])
+        self.assertEqual(loader.continuation, "page-1")
+        self.assertFalse(loader.done)
+
+        d = loader.next_page()
+        manager.loads[1][2].callback(["obj-c"])
+        self.assertEqual(manager.loads[1][0], ["c"])
+        self.assertEqual(self.successResultOf(d), ["obj-c"])
+        self.assertEqual(loader.continuation, None)
+        self.assertTrue(loader.done)
+
+        self.assertEqual(self.successResultOf(loader.next_page()), None)
+        self.assertEqual(len(manager.loads), 2)
+
+    def test_next_page_deferred_first_page(self):
+        manager = FakeLoadManager()
+        page_d = Deferred()
+        loader = ModelPageLoader(manager, SimpleModel, page_d)
+        d = loader.next_page()
+        self.assertEqual(manager.loads, [])
+        page_d.callback(FakeIndexPage([["a"]]))
+        manager.loads[0][2].callback(["obj-a"])
+        self.assertEqual(self.successResultOf(d), ["obj-a"])
+        self.assertTrue(loader.done)
+
+    def test_next_page_no_results(self):
+        loader = ModelPageLoader(FakeLoadManager(), SimpleModel, None)
+        self.assertEqual(self.successResultOf(loader.next_page()), None)
+        self.assertTrue(loader.done)
+
+
+class TestModelCache(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def make_cache(self, max_size=3, ttl=None):
+        return ModelCache(max_size, ttl=ttl, clock=self.clock)
+
+    def test_get_missing(self):
+        cache = self.make_cache()
+        self.assertEqual(cache.get(("bucket", "foo")), None)
+        self.assertEqual(cache.stats(), {
+            "size": 0,
+            "max_size": 3,
+            "hits": 0,
+            "misses": 1,
+            "evictions": 0,
+            "hit_rate": 0.0,
+        })
+
+    def test_set_and_get(self):
+        cache = self.make_cache()
+        cache.set(("bucket", "foo"), {"data": 1})
+        self.assertEqual(cache.get(("bucket", "foo")), {"data": 1})
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = self.make_cache()
+        for key in ["a", "b", "c"]:
+            cache.set(("bucket", key), key)
+        # Using "a" makes "b" the least recently used entry.
+        cache.get(("bucket", "a"))
+        cache.set(("bucket", "d"), "d")
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get(("bucket", "b")), None)
+        self.assertEqual(cache.get(("bucket", "a")), "a")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        cache = self.make_cache(ttl=10)
+        cache.set(("bucket", "foo"), "foo")
+        self.clock.advance(9)
+        self.assertEqual(cache.get(("bucket", "foo")), "foo")
+        self.clock.advance(1)
+        self.assertEqual(cache.get(("bucket", "foo")), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_set_replaces_entry(self):
+        cache = self.make_cache(ttl=10)
+        cache.set(("bucket", "foo"), "old")
+        self.clock.advance(5)
+        cache.set(("bucket", "foo"), "new")
+        self.clock.advance(9)
+        self.assertEqual(cache.get(("bucket", "foo")), "new")
+        self.assertEqual(len(cache), 1)
+
+    def test_load_caches_data(self):
+        cache = self.make_cache()
+        generation = cache.begin_load(("bucket", "foo"))
+        cache.end_load(("bucket", "foo"), generation, "foo")
+        self.assertEqual(cache.get(("bucket", "foo")), "foo")
+        self.assertEqual(cache._generations, {})
+
+    def test_invalidate_during_load(self):
+        cache = self.make_cache()
+        cache.set(("bucket", "foo"), "old")
+        generation = cache.begin_load(("bucket", "foo"))
+        cache.invalidate(("bucket", "foo"))
+        self.assertEqual(cache.get(("bucket", "foo")), None)
+        cache.end_load(("bucket", "foo"), generation, "stale")
+        self.assertEqual(cache.get(("bucket", "foo")), None)
+        self.assertEqual(cache._generations, {})
+
+    def test_invalidate_during_overlapping_loads(self):
+        cache = self.make_cache()
+        first = cache.begin_load(("bucket", "foo"))
+        cache.invalidate(("bucket", "foo"))
+        second = cache.begin_load(("bucket", "foo"))
+        cache.end_load(("bucket", "foo"), first, "stale")
+        self.assertEqual(cache.get(("bucket", "foo")), None)
+        cache.end_load(("bucket", "foo"), second, "fresh")
+        self.assertEqual(cache.get(("bucket", "foo")), "fresh")
+        self.assertEqual(cache._generations, {})
+
+    def test_end_load_without_data(self):
+        cache = self.make_cache()
+        generation = cache.begin_load(("bucket", "foo"))
+        cache.end_load(("bucket", "foo"), generation, None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache._generations, {})
+
+    def test_pop_and_clear(self):
+        cache = self.make_cache()
+        cache.set(("bucket", "foo"), "foo")
+        cache.set(("bucket", "bar"), "bar")
+        cache.pop(("bucket", "foo"))
+        cache.pop(("bucket", "missing"))
+        self.assertEqual(cache.get(("bucket", "foo")), None)
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
 
 class TestModelOnTxRiak(VumiTestCase, ModelTestMixin):
 
@@ -72,3 +72,32 @@ class TestRedisManager(VumiTestCase):
         self.manager.setex("key-ttl", 30, "value")
         ttl = self.manager.ttl("key-ttl")
         self.assertTrue(10 <= ttl <= 30)
+
+    def test_pipeline(self):
+        self.manager.set('foo', '1')
+        pipe = self.manager.pipeline()
+        pipe.get('foo')
+        pipe.incr('foo')
+        pipe.keys()
+        self.assertEqual(pipe.execute(), ['1', 2, ['foo']])
+        self.assertEqual(self.manager.get('foo'), '2')
+
+    def test_pipeline_sub_manager(self):
+        sub_manager = self.manager.sub_manager('sub')
+        pipe = sub_manager.pipeline(transaction=False)
+        pipe.set('foo', '1').keys()
+        self.assertEqual(pipe.execute(), [True, ['foo']])
+        self.assertEqual(self.manager.keys(), ['sub:foo'])
+
+    def test_run_script(self):
+        from vumi.persist.redis_base import RedisScript
+
+        def fake_incr_twice(redis, keys, args):
+            redis.incr(keys[0])
+            return redis.incr(keys[0])
+
+        script = RedisScript(
+            "redis.call('INCR', KEYS[1])\n"
+            "return redis.call('INCR', KEYS[1])", fake_incr_twice)
+        self.assertEqual(self.manager.run_script(script, ['foo']), 2)
+        self.assertEqual(self.manager.get('foo'), '2')
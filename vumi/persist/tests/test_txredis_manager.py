@@ -5,9 +5,11 @@ from functools import wraps
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import SkipTest
 
-from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.redis_base import RedisScript
+from vumi.persist.txredis_manager import TxRedisManager, VumiRedis
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -29,6 +31,20 @@ def skip_fake_redis(func):
     return wrapper
 
 
+def fake_getset(redis, keys, args):
+    [key], [value] = keys, args
+    old_value = redis.get(key)
+    redis.set(key, value)
+    return old_value
+
+
+GETSET_SCRIPT = RedisScript("""
+local old_value = redis.call('GET', KEYS[1])
+redis.call('SET', KEYS[1], ARGV[1])
+return old_value
+""", fake_getset)
+
+
 class TestTxRedisManager(VumiTestCase):
     @inlineCallbacks
     def get_manager(self):
@@ -133,3 +149,125 @@ class TestTxRedisManager(VumiTestCase):
         f2 = yield sub_manager.get("foo")
         f3 = yield sub_sub_manager.get("foo")
         self.assertEqual([f1, f2, f3], ["1", "2", "3"])
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        manager = yield self.get_manager()
+        yield manager.set("foo", "1")
+        pipe = manager.pipeline()
+        pipe.get("foo")
+        pipe.incr("foo")
+        pipe.hset("bar", "baz", "quux")
+        pipe.keys()
+        self.assertEqual(len(pipe), 4)
+        results = yield pipe.execute()
+        self.assertEqual(results[:3], ["1", 2, 1])
+        self.assertEqual(sorted(results[3]), ["bar", "foo"])
+        self.assertEqual((yield manager.hgetall("bar")), {"baz": "quux"})
+        self.assertEqual(len(pipe), 0)
+
+    @inlineCallbacks
+    def test_pipeline_no_transaction(self):
+        manager = yield self.get_manager()
+        pipe = manager.pipeline(transaction=False)
+        pipe.set("foo", "1").incr("foo", 2)
+        self.assertEqual((yield pipe.execute()), [True, 3])
+
+    @inlineCallbacks
+    def test_pipeline_sub_manager(self):
+        manager = yield self.get_manager()
+        sub_manager = manager.sub_manager("sub")
+        pipe = sub_manager.pipeline()
+        pipe.set("foo", "1")
+        pipe.keys()
+        self.assertEqual((yield pipe.execute()), [True, ["foo"]])
+        self.assertEqual((yield manager.keys()), ["sub:foo"])
+
+    @inlineCallbacks
+    def test_pipeline_error(self):
+        manager = yield self.get_manager()
+        yield manager.set("foo", "bar")
+        pipe = manager.pipeline()
+        pipe.hincrby("foo", "field")
+        pipe.set("baz", "1")
+        yield self.assertFailure(pipe.execute(), manager.RESPONSE_ERROR)
+        # The other commands still run.
+        self.assertEqual((yield manager.get("baz")), "1")
+
+    @inlineCallbacks
+    def test_run_script(self):
+        manager = yield self.get_manager()
+        yield manager.set("foo", "1")
+        old_value = yield manager.run_script(GETSET_SCRIPT, ["foo"], ["2"])
+        self.assertEqual(old_value, "1")
+        self.assertEqual((yield manager.get("foo")), "2")
+
+    @inlineCallbacks
+    def test_run_script_in_pipeline(self):
+        manager = yield self.get_manager()
+        pipe = manager.pipeline()
+        pipe.set("foo", "1")
+        pipe.run_script(GETSET_SCRIPT, ["foo"], ["2"])
+        self.assertEqual((yield pipe.execute()), [True, "1"])
+        self.assertEqual((yield manager.get("foo")), "2")
+
+
+class TestVumiRedisPipelining(VumiTestCase):
+    """
+    Tests for pipelining in our txredis client, using canned responses.
+    """
+
+    def setUp(self):
+        self.transport = StringTransport()
+        self.client = VumiRedis()
+        self.client.makeConnection(self.transport)
+
+    def respond(self, *responses):
+        self.client.dataReceived("".join(responses))
+
+    def test_pipeline(self):
+        d = self.client.execute_pipeline([
+            ("get", ("foo",), {}),
+            ("incr", ("bar",), {}),
+        ], transaction=False)
+        self.assertEqual(self.transport.value(), "".join([
+            "*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n",
+            "*2\r\n$4\r\nINCR\r\n$3\r\nbar\r\n",
+        ]))
+        self.respond("$1\r\nx\r\n", ":5\r\n")
+        self.assertEqual(self.successResultOf(d), ["x", 5])
+
+    def test_transaction(self):
+        d = self.client.execute_pipeline([
+            ("hgetall", ("foo",), {}),
+            ("zadd", ("bar",), {"a": 1}),
+            ("ttl", ("baz",), {}),
+        ])
+        self.assertEqual(self.transport.value(), "".join([
+            "*1\r\n$5\r\nMULTI\r\n",
+            "*2\r\n$7\r\nHGETALL\r\n$3\r\nfoo\r\n",
+            "*4\r\n$4\r\nZADD\r\n$3\r\nbar\r\n$1\r\n1\r\n$1\r\na\r\n",
+            "*2\r\n$3\r\nTTL\r\n$3\r\nbaz\r\n",
+            "*1\r\n$4\r\nEXEC\r\n",
+        ]))
+        self.assertNoResult(d)
+        self.respond("+OK\r\n", "+QUEUED\r\n" * 3)
+        self.assertNoResult(d)
+        # The responses from EXEC get the same processing they would outside
+        # a transaction.
+        self.respond(
+            "*3\r\n", "*2\r\n$1\r\nf\r\n$1\r\nv\r\n", ":1\r\n", ":-1\r\n")
+        self.assertEqual(self.successResultOf(d), [{"f": "v"}, 1, None])
+
+    def test_run_script(self):
+        d = self.client.run_script(GETSET_SCRIPT, ["foo"], ["1"])
+        self.assertEqual(self.transport.value(), "".join([
+            "*5\r\n$7\r\nEVALSHA\r\n$40\r\n%s\r\n" % (GETSET_SCRIPT.sha,),
+            "$1\r\n1\r\n$3\r\nfoo\r\n$1\r\n1\r\n",
+        ]))
+        self.transport.clear()
+        self.respond("-NOSCRIPT No matching script.\r\n")
+        self.assertTrue(self.transport.value().startswith(
+            "*5\r\n$4\r\nEVAL\r\n"))
+        self.respond("$1\r\n0\r\n")
+        self.assertEqual(self.successResultOf(d), "0")
@@ -1,6 +1,8 @@
 """Tests for vumi.persist.txriak_manager."""
 
-from twisted.internet.defer import inlineCallbacks
+import threading
+
+from twisted.internet.defer import inlineCallbacks, gatherResults, Deferred
 
 from vumi.persist.model import Manager, VumiRiakError
 from vumi.tests.helpers import VumiTestCase, import_skip
@@ -405,3 +407,286 @@ class TestTxRiakManager(CommonRiakManagerTests, VumiTestCase):
             'bucket_prefix': 'test.',
             })
         self.assertEqual(manager.client.protocol, 'http')
+
+    def test_from_config_with_concurrency_limit(self):
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({
+            'bucket_prefix': 'test.',
+            'concurrency_limit': 3,
+            'io_pool_name': 'test-riak-io',
+            })
+        self.assertEqual(manager.client.io_pool.size, 3)
+        self.assertEqual(manager.client.io_pool.name, 'test-riak-io')
+
+    def test_from_config_default_concurrency_limit(self):
+        manager_class = type(self.manager)
+        manager = manager_class.from_config({
+            'bucket_prefix': 'test.',
+            })
+        io_pool = manager.client.io_pool
+        self.assertEqual(io_pool.size, io_pool.DEFAULT_SIZE)
+        self.assertEqual(io_pool.name, io_pool.DEFAULT_NAME)
+
+    def test_sub_manager_shares_io_pool(self):
+        sub_manager = self.manager.sub_manager('foo.')
+        self.assertEqual(
+            sub_manager.client.io_pool, self.manager.client.io_pool)
+
+    @inlineCallbacks
+    def test_io_stats(self):
+        dummy = self.mkdummy("foo", {"a": 1})
+        yield self.manager.store(dummy)
+        yield self.manager.load(DummyModel, "foo")
+        stats = self.manager.io_stats()
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertTrue(stats["calls"] >= 2)
+        self.assertTrue(1 <= stats["connections"] <= stats["size"])
+
+    @inlineCallbacks
+    def test_close_manager_stops_io_pool(self):
+        manager = self.create_txriak_manager()
+        yield manager.load(DummyModel, "foo")
+        self.assertTrue(manager.client.io_pool.running)
+        yield manager.close_manager()
+        self.assertFalse(manager.client.io_pool.running)
+        self.assertEqual(manager.io_stats()["connections"], 0)
+
+
+class TestTxRiakManagerBulkOperations(VumiTestCase):
+    """
+    Tests for TxRiakManager's bulk operations that don't need Riak.
+    """
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import TxRiakManager
+        except ImportError, e:
+            import_skip(e, 'riak', 'riak')
+        self.manager = TxRiakManager(None, 'test.')
+        self.manager.load_cached = self.load_cached
+        self.manager.store = self.store
+        self.requests = []
+
+    def load_cached(self, modelcls, key):
+        d = Deferred()
+        self.requests.append((key, d))
+        return d
+
+    def store(self, modelobj):
+        d = Deferred()
+        self.requests.append((modelobj, d))
+        d.addCallback(lambda _: modelobj)
+        return d
+
+    def fire(self, index, result=None):
+        self.requests[index][1].callback(result)
+
+    def test_load_many_limits_concurrency(self):
+        loaded = []
+        d = self.manager.load_many(
+            DummyModel, ["a", "b", "c", "d"], concurrency=2,
+            result_callback=loaded.append)
+        self.assertEqual([key for key, _ in self.requests], ["a", "b"])
+        # Results are streamed as they arrive and a new load is started for
+        # each one that finishes.
+        self.fire(1, "obj-b")
+        self.assertEqual(loaded, ["obj-b"])
+        self.assertEqual([key for key, _ in self.requests], ["a", "b", "c"])
+        self.fire(0, None)
+        self.fire(2, "obj-c")
+        self.assertNoResult(d)
+        self.fire(3, "obj-d")
+        self.assertEqual(loaded, ["obj-b", "obj-c", "obj-d"])
+        # Missing objects are skipped and the rest are in key order.
+        self.assertEqual(self.successResultOf(d), ["obj-b", "obj-c", "obj-d"])
+
+    def test_load_many_default_concurrency(self):
+        self.manager.load_bunch_size = 3
+        self.manager.load_many(DummyModel, ["a", "b", "c", "d"])
+        self.assertEqual(len(self.requests), 3)
+
+    def test_load_many_no_keys(self):
+        d = self.manager.load_many(DummyModel, [])
+        self.assertEqual(self.successResultOf(d), [])
+
+    def test_load_many_error(self):
+        d = self.manager.load_many(DummyModel, ["a", "b"], concurrency=2)
+        self.requests[0][1].errback(ValueError("bad"))
+        self.fire(1, "obj-b")
+        self.failureResultOf(d, ValueError)
+
+    def test_load_many_waits_for_result_callback(self):
+        callback_d = Deferred()
+        d = self.manager.load_many(
+            DummyModel, ["a", "b"], concurrency=1,
+            result_callback=lambda obj: callback_d)
+        self.fire(0, "obj-a")
+        self.assertEqual(len(self.requests), 1)
+        callback_d.callback(None)
+        self.assertEqual(len(self.requests), 2)
+        self.fire(1, "obj-b")
+        self.assertEqual(self.successResultOf(d), ["obj-a", "obj-b"])
+
+    def test_call_concurrently_result_callback_in_order(self):
+        handled = []
+        d = self.manager.call_concurrently(
+            self.load_cached, [(DummyModel, key) for key in ["a", "b", "c"]],
+            concurrency=2, result_callback=handled.append)
+        self.fire(1, "obj-b")
+        # The result for "b" waits for the one for "a", which holds up the
+        # next call.
+        self.assertEqual(handled, [])
+        self.assertEqual([key for key, _ in self.requests], ["a", "b"])
+        self.fire(0, "obj-a")
+        self.assertEqual(handled, ["obj-a", "obj-b"])
+        self.assertEqual([key for key, _ in self.requests], ["a", "b", "c"])
+        self.fire(2, "obj-c")
+        self.assertEqual(handled, ["obj-a", "obj-b", "obj-c"])
+        self.assertEqual(
+            self.successResultOf(d), ["obj-a", "obj-b", "obj-c"])
+
+    def test_call_concurrently_waits_for_result_callback(self):
+        callback_d = Deferred()
+        d = self.manager.call_concurrently(
+            self.load_cached, [(DummyModel, "a"), (DummyModel, "b")],
+            concurrency=1, result_callback=lambda result: callback_d)
+        self.fire(0, "obj-a")
+        self.assertEqual(len(self.requests), 1)
+        callback_d.callback(None)
+        self.assertEqual(len(self.requests), 2)
+        self.fire(1, "obj-b")
+        self.assertEqual(self.successResultOf(d), ["obj-a", "obj-b"])
+
+    def test_call_concurrently_without_collecting_results(self):
+        handled = []
+        d = self.manager.call_concurrently(
+            self.load_cached, [(DummyModel, key) for key in "ab"],
+            concurrency=2, result_callback=handled.append,
+            collect_results=False)
+        self.fire(1, "obj-b")
+        self.fire(0, "obj-a")
+        self.assertEqual(handled, ["obj-a", "obj-b"])
+        self.assertEqual(self.successResultOf(d), None)
+
+    def test_call_concurrently_error_stops_calls(self):
+        d = self.manager.call_concurrently(
+            self.load_cached, [(DummyModel, key) for key in "abcd"],
+            concurrency=2)
+        self.requests[0][1].errback(ValueError("bad"))
+        self.failureResultOf(d, ValueError)
+        self.fire(1, "obj-b")
+        self.assertEqual([key for key, _ in self.requests], ["a", "b"])
+
+    def test_call_concurrently_error_releases_waiting_results(self):
+        handled = []
+        d = self.manager.call_concurrently(
+            self.load_cached, [(DummyModel, key) for key in "abc"],
+            concurrency=2, result_callback=handled.append)
+        # The result for "b" waits for the one for "a", which fails.
+        self.fire(1, "obj-b")
+        self.requests[0][1].errback(ValueError("bad"))
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(handled, [])
+        self.assertEqual([key for key, _ in self.requests], ["a", "b"])
+
+    def test_call_concurrently_result_callback_error(self):
+        handled = []
+
+        def result_callback(result):
+            if result == "obj-a":
+                raise ValueError("bad")
+            handled.append(result)
+
+        d = self.manager.call_concurrently(
+            self.load_cached, [(DummyModel, key) for key in "abcd"],
+            concurrency=2, result_callback=result_callback)
+        self.fire(1, "obj-b")
+        self.fire(0, "obj-a")
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(handled, [])
+        self.assertEqual([key for key, _ in self.requests], ["a", "b"])
+
+    def test_store_many(self):
+        d = self.manager.store_many(["x", "y", "z"], concurrency=2)
+        self.assertEqual(len(self.requests), 2)
+        for i in [1, 0, 2]:
+            self.fire(i)
+        self.assertEqual(self.successResultOf(d), ["x", "y", "z"])
+
+
+class TestRiakIOPool(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.persist.txriak_manager import RiakIOPool
+        except ImportError, e:
+            import_skip(e, 'riak', 'riak')
+        self.io_pool = RiakIOPool(size=2, name="test-riak-io")
+        self.add_cleanup(self.io_pool.stop)
+
+    def block(self, started, release):
+        started.set()
+        release.wait(5)
+        return "unblocked"
+
+    def test_defaults(self):
+        io_pool = type(self.io_pool)()
+        self.assertEqual(io_pool.size, io_pool.DEFAULT_SIZE)
+        self.assertEqual(io_pool.name, io_pool.DEFAULT_NAME)
+        self.assertFalse(io_pool.running)
+
+    @inlineCallbacks
+    def test_run(self):
+        self.assertFalse(self.io_pool.running)
+        result = yield self.io_pool.run(lambda a, b=0: a + b, 1, b=2)
+        self.assertEqual(result, 3)
+        self.assertTrue(self.io_pool.running)
+        self.assertEqual(self.io_pool.stats()["calls"], 1)
+
+    @inlineCallbacks
+    def test_run_error(self):
+        def fail():
+            raise ValueError("bad")
+        d = self.io_pool.run(fail)
+        yield self.assertFailure(d, ValueError)
+        self.assertEqual(self.io_pool.stats()["in_flight"], 0)
+
+    @inlineCallbacks
+    def test_run_in_named_thread(self):
+        name = yield self.io_pool.run(
+            lambda: threading.current_thread().name)
+        self.assertTrue("test-riak-io" in name)
+
+    @inlineCallbacks
+    def test_concurrency_limit(self):
+        release = threading.Event()
+        started = [threading.Event() for _ in range(3)]
+        ds = [self.io_pool.run(self.block, s, release) for s in started]
+        started[0].wait(5)
+        started[1].wait(5)
+        stats = self.io_pool.stats()
+        self.assertEqual(stats["in_flight"], 2)
+        self.assertEqual(stats["queued"], 1)
+        # The first calls may start before the last one is queued.
+        self.assertTrue(1 <= stats["max_queued"] <= 3)
+        self.assertFalse(started[2].is_set())
+        release.set()
+        results = yield gatherResults(ds)
+        self.assertEqual(results, ["unblocked"] * 3)
+        stats = self.io_pool.stats()
+        self.assertEqual(stats["in_flight"], 0)
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["calls"], 3)
+        self.assertTrue(stats["max_wait"] > 0)
+        self.assertTrue(stats["total_wait"] >= stats["max_wait"])
+        self.assertEqual(stats["mean_wait"], stats["total_wait"] / 3)
+
+    @inlineCallbacks
+    def test_stop_and_restart(self):
+        yield self.io_pool.run(lambda: None)
+        self.io_pool.stop()
+        self.assertFalse(self.io_pool.running)
+        result = yield self.io_pool.run(lambda: "again")
+        self.assertEqual(result, "again")
+        self.assertTrue(self.io_pool.running)
@@ -13,7 +13,8 @@ except ImportError:
 import txredis.exceptions
 
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, succeed, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, succeed, Deferred, gatherResults)
 
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import (
@@ -37,6 +38,9 @@ class VumiRedis(txr.Redis):
         self.connected_d = Deferred()
         self._disconnected_d = Deferred()
         self._client_shutdown_called = False
+        # While we're queuing commands in a transaction, this holds the
+        # deferreds for their real responses.
+        self._queued_responses = None
 
     def connectionMade(self):
         d = super(VumiRedis, self).connectionMade()
@@ -63,6 +67,73 @@ class VumiRedis(txr.Redis):
             d.addCallback(lambda _: self.quit())
         return d.addCallback(lambda _: self._disconnected_d)
 
+    def getResponse(self):
+        d = super(VumiRedis, self).getResponse()
+        if self._queued_responses is None:
+            return d
+        # Inside a transaction the server only tells us that the command has
+        # been queued. The real response is part of the EXEC response, so we
+        # give the caller a deferred that we fire when we get that.
+        d.addErrback(lambda f: None)
+        response_d = Deferred()
+        self._queued_responses.append(response_d)
+        return response_d
+
+    def execute_pipeline(self, commands, transaction=True):
+        """
+        Run a list of ``(command, args, kwargs)`` tuples and return a
+        deferred that fires with a list of their results.
+
+        All the commands are written to the connection before any responses
+        are read, so they only cost one round trip. Since nothing else can
+        write to the connection while we do this, a transaction can safely
+        share the connection with other callers.
+        """
+        if not transaction:
+            ds = [getattr(self, call)(*args, **kw)
+                  for call, args, kw in commands]
+            return self._gather_pipeline_results(ds)
+
+        multi_d = self.multi()
+        self._queued_responses = []
+        try:
+            ds = [getattr(self, call)(*args, **kw)
+                  for call, args, kw in commands]
+        finally:
+            response_ds, self._queued_responses = self._queued_responses, None
+        exec_d = self.execute()
+
+        def fire_responses(responses):
+            for response_d, response in zip(response_ds, responses):
+                if isinstance(response, Exception):
+                    response_d.errback(response)
+                else:
+                    response_d.callback(response)
+            return self._gather_pipeline_results(ds)
+
+        d = self._gather_pipeline_results([multi_d, exec_d])
+        return d.addCallback(lambda results: fire_responses(results[1]))
+
+    def _gather_pipeline_results(self, ds):
+        d = gatherResults(ds, consumeErrors=True)
+        return d.addErrback(lambda f: f.value.subFailure)
+
+    def run_script(self, script, keys, args):
+        """
+        Run a :class:`~vumi.persist.redis_base.RedisScript`, sending the
+        script body only if the server hasn't seen it before.
+        """
+        if self._queued_responses is not None:
+            # We can't retry inside a transaction, so send the whole thing.
+            return self.eval(script.lua, keys, args)
+        d = self.evalsha(script.sha, keys, args)
+
+        def load_script(f):
+            f.trap(txredis.exceptions.NoScript)
+            return self.eval(script.lua, keys, args)
+
+        return d.addErrback(load_script)
+
     def _ok_to_true(self, r):
         """
         Some commands return 'OK', but we expect True.
@@ -122,17 +193,15 @@ class VumiRedis(txr.Redis):
                                  "values and scores")
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
-        orig_zadd = super(VumiRedis, self).zadd
-        d = succeed(0)
-
-        def do_zadd(s, key, member, score):
-            d = orig_zadd(key, member, score)
-            d.addCallback(lambda r: r + s)
-            return d
-
+        if not pieces:
+            return succeed(0)
+        # We send a single ZADD for all the members so that this is one
+        # command in a pipeline or transaction.
+        score_members = []
         for member, score in pieces:
-            d.addCallback(do_zadd, key, member, score)
-        return d
+            score_members.extend([score, member])
+        self._send('ZADD', key, *score_members)
+        return self.getResponse()
 
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
@@ -208,15 +277,17 @@ class VumiRedis(txr.Redis):
         return self.getResponse()
 
     # txredis doesn't implement this.
-    def pfcount(self, key):
+    def pfcount(self, key, *keys):
         """
         Return the approximate cardinality of the HyperLogLog at the given key.
+        If more than one key is given, the cardinality of the union of their
+        HyperLogLogs is returned.
 
         .. note::
 
            Requires redis server 2.8.9 or later.
         """
-        self._send('PFCOUNT', key)
+        self._send('PFCOUNT', key, *keys)
         return self.getResponse()
 
 
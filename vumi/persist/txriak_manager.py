@@ -2,10 +2,17 @@
 
 """An async manager implementation on top of the riak Python package."""
 
+import threading
+import time
+
 from riak import RiakObject, RiakMapReduce, RiakError
-from twisted.internet.threads import deferToThread
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, gatherResults, maybeDeferred, succeed)
+    Deferred, inlineCallbacks, returnValue, gatherResults, maybeDeferred,
+    succeed)
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
 
 from vumi.persist.model import Manager, VumiRiakError
 from vumi.persist.riak_base import (
@@ -13,16 +20,164 @@ from vumi.persist.riak_base import (
     VumiRiakObjectBase)
 
 
+def _daemon_thread(*args, **kw):
+    thread = threading.Thread(*args, **kw)
+    thread.daemon = True
+    return thread
+
+
 def riakErrorHandler(failure):
     e = failure.trap(RiakError)
     raise VumiRiakError(e)
 
 
+class RiakIOPool(object):
+    """
+    A dedicated thread pool for blocking Riak client calls.
+
+    Riak calls used to share the reactor's thread pool with everything else
+    that uses :func:`deferToThread`. This pool is sized separately and keeps
+    track of how many calls are waiting for a thread and how long they wait.
+
+    The riak client keeps one connection per thread that is making a request,
+    so the size of this pool also limits the number of HTTP or protocol
+    buffer connections the client opens.
+
+    The threads are started when the first call is made and stopped by
+    :meth:`stop` or when the reactor shuts down. A stopped pool starts new
+    threads if it is used again. The threads are daemon threads so that a
+    manager that is never closed doesn't keep the process alive.
+
+    :param int size:
+        The maximum number of concurrent Riak calls.
+    :param str name:
+        The name of the thread pool, used for naming its threads.
+    """
+
+    DEFAULT_SIZE = 10
+    DEFAULT_NAME = "riak-io"
+
+    reactor = reactor
+
+    def __init__(self, size=None, name=None):
+        self.size = size or self.DEFAULT_SIZE
+        self.name = name or self.DEFAULT_NAME
+        self._threadpool = None
+        self._shutdown_trigger = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queued = 0
+        self.calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def running(self):
+        return self._threadpool is not None
+
+    def _start(self):
+        self._threadpool = ThreadPool(
+            minthreads=0, maxthreads=self.size, name=self.name)
+        self._threadpool.threadFactory = _daemon_thread
+        self._threadpool.start()
+        self._shutdown_trigger = self.reactor.addSystemEventTrigger(
+            'during', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Stop the threads in this pool.
+        """
+        if self._threadpool is None:
+            return
+        threadpool, self._threadpool = self._threadpool, None
+        self.reactor.removeSystemEventTrigger(self._shutdown_trigger)
+        self._shutdown_trigger = None
+        threadpool.stop()
+
+    def _call_in_thread(self, queued_at, func, args, kw):
+        wait = time.time() - queued_at
+        with self._lock:
+            self.queued -= 1
+            self.in_flight += 1
+            self.calls += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        try:
+            return func(*args, **kw)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def run(self, func, *args, **kw):
+        """
+        Call a blocking function in this pool.
+
+        :returns:
+            A deferred that fires with the function's result.
+        """
+        if self._threadpool is None:
+            self._start()
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        return deferToThreadPool(
+            self.reactor, self._threadpool, self._call_in_thread,
+            time.time(), func, args, kw)
+
+    def stats(self):
+        """
+        Return a dictionary of queue depth and wait time metrics.
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": self.size,
+                "queued": self.queued,
+                "in_flight": self.in_flight,
+                "max_queued": self.max_queued,
+                "calls": self.calls,
+                "total_wait": self.total_wait,
+                "max_wait": self.max_wait,
+                "mean_wait": (
+                    self.total_wait / self.calls if self.calls else 0.0),
+            }
+
+
 class VumiTxRiakClient(VumiRiakClientBase):
     """
     Wrapper around a RiakClient to manage resources better.
+
+    Blocking calls are made in :attr:`io_pool`, a :class:`RiakIOPool` of at
+    most ``concurrency_limit`` threads.
     """
 
+    def __init__(self, concurrency_limit=None, io_pool_name=None,
+                 **client_args):
+        super(VumiTxRiakClient, self).__init__(**client_args)
+        self.io_pool = RiakIOPool(concurrency_limit, io_pool_name)
+
+    def connection_count(self):
+        """
+        Return the number of open connections in the client's connection
+        pools.
+        """
+        if self._closed:
+            return 0
+        return sum(
+            len(pool.resources) for pool in [
+                self._raw_client._http_pool, self._raw_client._tcp_pool]
+            if pool is not None)
+
+    def io_stats(self):
+        """
+        Return the I/O pool's metrics along with the number of open
+        connections.
+        """
+        stats = self.io_pool.stats()
+        stats["connections"] = self.connection_count()
+        return stats
+
 
 class VumiTxIndexPage(VumiIndexPageBase):
     """
@@ -31,6 +186,10 @@ class VumiTxIndexPage(VumiIndexPageBase):
     Iterating over this object will return the results for the current page.
     """
 
+    def __init__(self, index_page, io_pool):
+        super(VumiTxIndexPage, self).__init__(index_page)
+        self._io_pool = io_pool
+
     # Methods that touch the network.
 
     def next_page(self):
@@ -43,8 +202,8 @@ class VumiTxIndexPage(VumiIndexPageBase):
         """
         if not self.has_next_page():
             return succeed(None)
-        d = deferToThread(self._index_page.next_page)
-        d.addCallback(type(self))
+        d = self._io_pool.run(self._index_page.next_page)
+        d.addCallback(type(self), self._io_pool)
         d.addErrback(riakErrorHandler)
         return d
 
@@ -54,6 +213,10 @@ class VumiTxRiakBucket(VumiRiakBucketBase):
     Wrapper around a RiakBucket to manage network access better.
     """
 
+    def __init__(self, riak_bucket, io_pool):
+        super(VumiTxRiakBucket, self).__init__(riak_bucket)
+        self._io_pool = io_pool
+
     # Methods that touch the network.
 
     def get_index(self, index_name, start_value, end_value=None,
@@ -65,11 +228,11 @@ class VumiTxRiakBucket(VumiRiakBucketBase):
 
     def get_index_page(self, index_name, start_value, end_value=None,
                        return_terms=None, max_results=None, continuation=None):
-        d = deferToThread(
+        d = self._io_pool.run(
             self._riak_bucket.get_index, index_name, start_value, end_value,
             return_terms=return_terms, max_results=max_results,
             continuation=continuation)
-        d.addCallback(VumiTxIndexPage)
+        d.addCallback(VumiTxIndexPage, self._io_pool)
         d.addErrback(riakErrorHandler)
         return d
 
@@ -79,8 +242,12 @@ class VumiTxRiakObject(VumiRiakObjectBase):
     Wrapper around a RiakObject to manage network access better.
     """
 
+    def __init__(self, riak_obj, io_pool):
+        super(VumiTxRiakObject, self).__init__(riak_obj)
+        self._io_pool = io_pool
+
     def get_bucket(self):
-        return VumiTxRiakBucket(self._riak_obj.bucket)
+        return VumiTxRiakBucket(self._riak_obj.bucket, self._io_pool)
 
     # Methods that touch the network.
 
@@ -89,8 +256,8 @@ class VumiTxRiakObject(VumiRiakObjectBase):
         Call a function that touches the network and wrap the result in this
         class.
         """
-        d = deferToThread(func)
-        d.addCallback(type(self))
+        d = self._io_pool.run(func)
+        d.addCallback(type(self), self._io_pool)
         return d
 
 
@@ -109,6 +276,10 @@ class TxRiakManager(Manager):
             'mapreduce_timeout', cls.DEFAULT_MAPREDUCE_TIMEOUT)
         transport_type = config.pop('transport_type', 'http')
         store_versions = config.pop('store_versions', None)
+        cache_size = config.pop('cache_size', None)
+        cache_ttl = config.pop('cache_ttl', None)
+        concurrency_limit = config.pop('concurrency_limit', None)
+        io_pool_name = config.pop('io_pool_name', None)
 
         host = config.get('host', '127.0.0.1')
         port = config.get('port')
@@ -125,17 +296,42 @@ class TxRiakManager(Manager):
         if port is not None:
             client_args['port'] = port
 
-        client = VumiTxRiakClient(**client_args)
+        client = VumiTxRiakClient(
+            concurrency_limit=concurrency_limit, io_pool_name=io_pool_name,
+            **client_args)
         return cls(
             client, bucket_prefix, load_bunch_size=load_bunch_size,
-            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions)
+            mapreduce_timeout=mapreduce_timeout, store_versions=store_versions,
+            cache_size=cache_size, cache_ttl=cache_ttl)
 
     def close_manager(self):
         if self._parent is None:
             # Only top-level managers may close the client.
-            return deferToThread(self.client.close)
+            io_pool = self.client.io_pool
+            d = io_pool.run(self.client.close)
+
+            def stop_io_pool(r):
+                io_pool.stop()
+                return r
+
+            return d.addBoth(stop_io_pool)
         return succeed(None)
 
+    def io_stats(self):
+        """
+        Return metrics for the client's I/O pool.
+
+        The dictionary contains the pool's ``size``, the number of ``queued``
+        and ``in_flight`` calls, the highest queue depth seen
+        (``max_queued``), the number of ``calls`` made, their ``total_wait``,
+        ``max_wait`` and ``mean_wait`` times in seconds and the number of
+        open ``connections``.
+        """
+        return self.client.io_stats()
+
+    def _run_in_io_pool(self, func, *args, **kw):
+        return self.client.io_pool.run(func, *args, **kw)
+
     def _is_unclosed(self):
         # This returns `True` if the manager needs to be explicitly closed and
         # hasn't been closed yet. It should only be used in tests that ensure
@@ -147,12 +343,13 @@ class TxRiakManager(Manager):
     def riak_bucket(self, bucket_name):
         bucket = self.client.bucket(bucket_name)
         if bucket is not None:
-            bucket = VumiTxRiakBucket(bucket)
+            bucket = VumiTxRiakBucket(bucket, self.client.io_pool)
         return bucket
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)._riak_bucket
-        riak_object = VumiTxRiakObject(RiakObject(self.client, bucket, key))
+        riak_object = VumiTxRiakObject(
+            RiakObject(self.client, bucket, key), self.client.io_pool)
         if result:
             metadata = result['metadata']
             indexes = metadata['index']
@@ -173,13 +370,18 @@ class TxRiakManager(Manager):
 
     def store(self, modelobj):
         riak_object = self._reverse_migrate_riak_object(modelobj)
+        self._update_cache(modelobj)
         d = riak_object.store()
+        # Invalidate again in case a load started and finished while we were
+        # storing.
+        d.addCallback(lambda _: self._update_cache(modelobj))
         d.addCallback(lambda _: modelobj)
         return d
 
     def delete(self, modelobj):
+        self._update_cache(modelobj, deleted=True)
         d = modelobj._riak_object.delete()
-        d.addCallback(lambda _: None)
+        d.addCallback(lambda _: self._update_cache(modelobj, deleted=True))
         return d
 
     @inlineCallbacks
@@ -190,19 +392,109 @@ class TxRiakManager(Manager):
         returnValue(self._migrate_riak_object(modelcls, key, riak_object))
 
     def _load_multiple(self, modelcls, keys):
-        d = gatherResults([self.load(modelcls, key) for key in keys])
+        return self.load_many(modelcls, keys, concurrency=len(keys))
+
+    def call_concurrently(self, func, args_list, concurrency=None,
+                          result_callback=None, collect_results=True):
+        """
+        Call ``func`` with each tuple of arguments in ``args_list``, with at
+        most ``concurrency`` calls in flight at once.
+
+        :param int concurrency:
+            The maximum number of calls in flight at once. Defaults to the
+            manager's ``load_bunch_size``.
+        :param result_callback:
+            A function that is called with each result in the same order as
+            ``args_list``. A call that finishes early waits for the results
+            before it to be handled first. If ``result_callback`` returns a
+            deferred, no new call is started until it fires.
+        :param bool collect_results:
+            Whether to keep the results to return at the end. Set this to
+            ``False`` if ``result_callback`` consumes them, so that each
+            result can be freed once it has been handled.
+
+        :returns:
+            A deferred that fires with a list of results in the same order as
+            ``args_list`` (or ``None`` if ``collect_results`` is ``False``).
+            If a call (or ``result_callback``) fails, no new calls are started
+            and the deferred fails with the first error.
+        """
+        results = [None] * len(args_list) if collect_results else None
+        pending = iter(enumerate(args_list))
+        # Set when a call fails, so that the workers stop.
+        stopped = [False]
+        handled = []
+        if result_callback is not None:
+            # handled[i] fires once every result before the i-th has been
+            # passed to result_callback.
+            handled = [succeed(None)] + [Deferred() for _ in args_list]
+
+        def stop(failure):
+            stopped[0] = True
+            # Workers waiting for earlier results to be handled would wait
+            # forever, so we fail them too.
+            for d in handled:
+                if not d.called:
+                    d.errback(failure)
+                    # Nothing may be waiting for this one.
+                    d.addErrback(lambda _: None)
+
+        @inlineCallbacks
+        def worker():
+            # Workers share the iterator, so each call is made exactly once.
+            try:
+                for i, args in pending:
+                    result = yield func(*args)
+                    if stopped[0]:
+                        return
+                    if collect_results:
+                        results[i] = result
+                    if result_callback is not None:
+                        yield handled[i]
+                        yield result_callback(result)
+                        if stopped[0]:
+                            return
+                        handled[i + 1].callback(None)
+            except Exception:
+                if not stopped[0]:
+                    stop(Failure())
+                raise
+
+        workers = min(concurrency or self.load_bunch_size, len(args_list))
+        d = gatherResults([worker() for _ in xrange(workers)],
+                          consumeErrors=True)
+        d.addErrback(lambda f: f.value.subFailure)
+        d.addCallback(lambda _: results)
+        return d
+
+    def load_many(self, modelcls, keys, concurrency=None,
+                  result_callback=None):
+        @inlineCallbacks
+        def load(key):
+            modelobj = yield self.load_cached(modelcls, key)
+            if modelobj is not None and result_callback is not None:
+                yield result_callback(modelobj)
+            returnValue(modelobj)
+
+        d = self.call_concurrently(
+            load, [(key,) for key in keys], concurrency)
         d.addCallback(lambda objs: [obj for obj in objs if obj is not None])
         return d
 
+    def store_many(self, modelobjs, concurrency=None):
+        return self.call_concurrently(
+            self.store, [(modelobj,) for modelobj in modelobjs], concurrency)
+
     def riak_map_reduce(self):
         mapreduce = RiakMapReduce(self.client)
         # Hack: We replace the two methods that hit the network with
-        #       deferToThread wrappers to prevent accidental sync calls in
-        #       other code.
+        #       wrappers that call them in the I/O pool to prevent accidental
+        #       sync calls in other code.
         run = mapreduce.run
         stream = mapreduce.stream
-        mapreduce.run = lambda *a, **kw: deferToThread(run, *a, **kw)
-        mapreduce.stream = lambda *a, **kw: deferToThread(stream, *a, **kw)
+        mapreduce.run = lambda *a, **kw: self._run_in_io_pool(run, *a, **kw)
+        mapreduce.stream = (
+            lambda *a, **kw: self._run_in_io_pool(stream, *a, **kw))
         return mapreduce
 
     def run_map_reduce(self, mapreduce, mapper_func=None, reducer_func=None):
@@ -220,7 +512,8 @@ class TxRiakManager(Manager):
         return mapreduce_done
 
     def _search_iteration(self, bucket, query, rows, start):
-        d = deferToThread(bucket.search, query, rows=rows, start=start)
+        d = self._run_in_io_pool(
+            bucket.search, query, rows=rows, start=start)
         d.addCallback(lambda r: [doc["id"] for doc in r["docs"]])
         return d
 
@@ -243,15 +536,15 @@ class TxRiakManager(Manager):
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
-        return deferToThread(bucket.enable_search)
+        return self._run_in_io_pool(bucket.enable_search)
 
     def riak_search_enabled(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
-        return deferToThread(bucket.search_enabled)
+        return self._run_in_io_pool(bucket.search_enabled)
 
     def should_quote_index_values(self):
         return False
 
     def purge_all(self):
-        return deferToThread(self.client._purge_all, self.bucket_prefix)
+        return self._run_in_io_pool(self.client._purge_all, self.bucket_prefix)
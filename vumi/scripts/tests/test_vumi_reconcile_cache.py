@@ -0,0 +1,174 @@
+"""Tests for vumi.scripts.vumi_reconcile_cache."""
+
+import json
+import os
+import sys
+from uuid import uuid4
+from StringIO import StringIO
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import usage
+
+from vumi.components.message_store import MessageStore
+from vumi.scripts.vumi_reconcile_cache import (
+    CacheReconcilerRunner, Options, main)
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper, MessageHelper
+
+
+class StubbedCacheReconcilerRunner(CacheReconcilerRunner):
+    def __init__(self, testcase, *args, **kwargs):
+        self.testcase = testcase
+        self.output = []
+        super(StubbedCacheReconcilerRunner, self).__init__(*args, **kwargs)
+
+    def emit(self, s):
+        self.output.append(s)
+
+    def get_riak_manager(self, riak_config):
+        return self.testcase.get_riak_manager(riak_config)
+
+    def get_redis_manager(self, redis_config):
+        return self.testcase.get_redis_manager(redis_config)
+
+
+class TestCacheReconcilerRunner(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = self.add_helper(
+            PersistenceHelper(use_riak=True, is_sync=False))
+        self.msg_helper = self.add_helper(MessageHelper())
+        self.expected_bucket_prefix = "bucket-%s" % (uuid4().hex,)
+        self.riak_manager = self.persistence_helper.get_riak_manager({
+            "bucket_prefix": self.expected_bucket_prefix,
+        })
+        self.add_cleanup(self.riak_manager.close_manager)
+        self.redis_manager = yield self.persistence_helper.get_redis_manager()
+        self.mdb = MessageStore(
+            self.riak_manager, self.redis_manager.sub_manager("message_store"))
+        self.default_args = [
+            "-b", self.expected_bucket_prefix,
+        ]
+
+    def make_runner(self, args=None, batch=None, index_page_size=None,
+                    state_file=None):
+        if args is None:
+            args = self.default_args
+        if batch is not None:
+            args.extend(["--batch", batch])
+        if index_page_size is not None:
+            args.extend(["--index-page-size", str(index_page_size)])
+        if state_file is not None:
+            args.extend(["--state-file", state_file])
+        options = Options()
+        options.parseOptions(args)
+        return StubbedCacheReconcilerRunner(self, options)
+
+    def get_riak_manager(self, config):
+        self.assertEqual(config["bucket_prefix"], self.expected_bucket_prefix)
+        return self.persistence_helper.get_riak_manager(config)
+
+    def get_redis_manager(self, config):
+        self.assertEqual(config, {})
+        # We use the test Redis config so the runner sees our data.
+        return self.persistence_helper.get_redis_manager()
+
+    @inlineCallbacks
+    def make_batch(self, inbound=0, outbound=0):
+        batch_id = yield self.mdb.batch_start()
+        for i in range(inbound):
+            msg = self.msg_helper.make_inbound(None, from_addr="1234%d" % i)
+            yield self.mdb.add_inbound_message(msg, batch_id=batch_id)
+        for i in range(outbound):
+            msg = self.msg_helper.make_outbound(None, to_addr="1234%d" % i)
+            yield self.mdb.add_outbound_message(msg, batch_id=batch_id)
+        yield self.mdb.cache.clear_batch(batch_id)
+        returnValue(batch_id)
+
+    def test_batch_required(self):
+        self.assertRaises(usage.UsageError, self.make_runner, [
+            "-b", self.expected_bucket_prefix,
+        ])
+
+    def test_bucket_required(self):
+        self.assertRaises(usage.UsageError, self.make_runner, [
+            "--batch", "gingercookies",
+        ])
+
+    def test_redis_config_must_be_json(self):
+        self.assertRaises(usage.UsageError, self.make_runner, [
+            "--batch", "gingercookies",
+            "-b", self.expected_bucket_prefix,
+            "--redis-config", "{nope",
+        ])
+
+    @inlineCallbacks
+    def test_main(self):
+        """
+        The reconciler runs via `main()`.
+        """
+        self.patch(
+            CacheReconcilerRunner, "get_redis_manager",
+            lambda _self, config: self.get_redis_manager(config))
+        batch_id = yield self.make_batch(inbound=2)
+        self.patch(sys, "stdout", StringIO())
+        yield main(
+            None, "name",
+            "--batch", batch_id,
+            "-b", self.riak_manager.bucket_prefix)
+        self.assertEqual(
+            sys.stdout.getvalue().splitlines()[-1], "Done, 2 keys processed.")
+        inbound_count = yield self.mdb.cache.count_inbound_message_keys(
+            batch_id)
+        self.assertEqual(inbound_count, 2)
+
+    @inlineCallbacks
+    def test_reconcile(self):
+        batch_id = yield self.make_batch(inbound=3, outbound=4)
+        runner = self.make_runner(batch=batch_id, index_page_size=2)
+        yield runner.run()
+        self.assertEqual(runner.output[-1], "Done, 7 keys processed.")
+        inbound_count = yield self.mdb.cache.count_inbound_message_keys(
+            batch_id)
+        self.assertEqual(inbound_count, 3)
+        outbound_count = yield self.mdb.cache.count_outbound_message_keys(
+            batch_id)
+        self.assertEqual(outbound_count, 4)
+
+    @inlineCallbacks
+    def test_reconcile_with_state_file(self):
+        batch_id = yield self.make_batch(inbound=3)
+        state_file = self.mktemp()
+        runner = self.make_runner(
+            batch=batch_id, index_page_size=2, state_file=state_file)
+        saved = []
+        save_state = runner.save_state
+
+        def record_state(state):
+            save_state(state)
+            with open(state_file) as f:
+                saved.append(json.load(f))
+
+        runner.save_state = record_state
+        yield runner.run()
+        self.assertEqual(saved[-1]["phase"], "done")
+        self.assertFalse(os.path.exists(state_file))
+
+    @inlineCallbacks
+    def test_resume_from_state_file(self):
+        batch_id = yield self.make_batch(inbound=3)
+        state_file = self.mktemp()
+        with open(state_file, "w") as f:
+            json.dump({
+                "batch_id": batch_id,
+                "start_timestamp": "2100-01-01 00:00:00.000000",
+                "phase": "done",
+                "processed": 3,
+            }, f)
+        runner = self.make_runner(batch=batch_id, state_file=state_file)
+        yield runner.run()
+        self.assertEqual(runner.output, [
+            "Resuming from 3 keys processed.",
+            "Done, 3 keys processed.",
+        ])
+        self.assertFalse(os.path.exists(state_file))
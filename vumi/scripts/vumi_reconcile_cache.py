@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- test-case-name: vumi.scripts.tests.test_vumi_reconcile_cache -*-
+
+import json
+import os
+import sys
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import react
+from twisted.python import usage
+
+from vumi.components.message_store import MessageStore, CacheReconciler
+from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.txriak_manager import TxRiakManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["batch", None, None,
+         "Batch identifier to reconcile the cache for."],
+        ["bucket-prefix", "b", None,
+         "The bucket prefix for the Riak manager."],
+        ["redis-config", None, "{}",
+         "JSON-encoded Redis configuration parameters."],
+        ["store-prefix", None, "message_store",
+         "Prefix for message store keys in Redis."],
+        ["concurrency", None, "10",
+         "The maximum number of Riak and Redis requests to have in flight."],
+        ["index-page-size", None, "1000",
+         "The number of keys to fetch in each index query."],
+        ["state-file", None, None,
+         "File to save progress in. If this file exists, reconciliation"
+         " resumes from the progress saved in it."],
+    ]
+
+    longdesc = """
+    Message store cache reconciler. This rebuilds the Redis cache for a batch
+    from the Riak indexes. Interrupted reconciliations can be resumed if a
+    state file is used.
+    """
+
+    def postOptions(self):
+        if self["batch"] is None:
+            raise usage.UsageError("Please specify a batch.")
+        if self["bucket-prefix"] is None:
+            raise usage.UsageError("Please specify a bucket prefix.")
+        try:
+            self["redis-config"] = json.loads(self["redis-config"])
+        except ValueError:
+            raise usage.UsageError("Redis config must be valid JSON.")
+        self["concurrency"] = int(self["concurrency"])
+        self["index-page-size"] = int(self["index-page-size"])
+
+
+class CacheReconcilerRunner(object):
+    def __init__(self, options):
+        self.options = options
+        riak_config = {
+            'bucket_prefix': options['bucket-prefix'],
+        }
+        self.manager = self.get_riak_manager(riak_config)
+        self.redis = None
+
+    @inlineCallbacks
+    def cleanup(self):
+        yield self.manager.close_manager()
+        if self.redis is not None:
+            yield self.redis.close_manager()
+
+    def get_riak_manager(self, riak_config):
+        return TxRiakManager.from_config(riak_config)
+
+    def get_redis_manager(self, redis_config):
+        return TxRedisManager.from_config(redis_config)
+
+    def emit(self, s):
+        print s
+
+    def load_state(self):
+        state_file = self.options["state-file"]
+        if state_file is None or not os.path.exists(state_file):
+            return None
+        with open(state_file) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        state_file = self.options["state-file"]
+        if state_file is None:
+            return
+        # Write to a temporary file first so that an interruption can't leave
+        # us with a partially written state file.
+        tmp_file = state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.rename(tmp_file, state_file)
+
+    def report_progress(self, state):
+        self.save_state(state)
+        if state["phase"] != "done":
+            self.emit("%s keys processed, reconciling %s messages ..." % (
+                state["processed"], state["phase"]))
+
+    @inlineCallbacks
+    def _run(self):
+        self.redis = yield self.get_redis_manager(
+            self.options["redis-config"])
+        store = MessageStore(
+            self.manager, self.redis.sub_manager(self.options["store-prefix"]))
+        state = self.load_state()
+        if state is not None:
+            self.emit("Resuming from %s keys processed." % (
+                state["processed"],))
+        reconciler = CacheReconciler(
+            store, self.options["batch"], state=state,
+            concurrency=self.options["concurrency"],
+            page_size=self.options["index-page-size"],
+            progress_callback=self.report_progress)
+        state = yield reconciler.run()
+        if self.options["state-file"] is not None:
+            os.remove(self.options["state-file"])
+        self.emit("Done, %s keys processed." % (state["processed"],))
+
+    @inlineCallbacks
+    def run(self):
+        try:
+            yield self._run()
+        finally:
+            yield self.cleanup()
+
+
+def main(_reactor, name, *args):
+    try:
+        options = Options()
+        options.parseOptions(args)
+    except usage.UsageError, errortext:
+        print '%s: %s' % (name, errortext)
+        print '%s: Try --help for usage details.' % (name,)
+        sys.exit(1)
+
+    runner = CacheReconcilerRunner(options)
+    return runner.run()
+
+
+if __name__ == '__main__':
+    react(main, sys.argv)
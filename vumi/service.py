@@ -5,10 +5,11 @@ import warnings
 from copy import deepcopy
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, succeed)
+    inlineCallbacks, returnValue, Deferred, DeferredLock, succeed, fail)
 from twisted.internet import protocol, reactor
 import txamqp
 from txamqp.client import TwistedDelegate
@@ -199,7 +200,8 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False, prefetch_count=None):
+                message_class=None, paused=False, prefetch_count=None,
+                concurrency=1, ordering=None, datetime_fields_only=False):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -213,6 +215,9 @@ class Worker(MultiService, object):
             'durable': durable,
             'start_paused': paused,
             'prefetch_count': prefetch_count,
+            'concurrency': concurrency,
+            'ordering': ordering,
+            'datetime_fields_only': datetime_fields_only,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
@@ -224,10 +229,34 @@ class Worker(MultiService, object):
         return self._amqp_client.start_consumer(consumer_class, *args, **kw)
 
     @inlineCallbacks
-    def publish_to(self, routing_key):
+    def publish_to(self, routing_key, content_type=None, batch_size=None,
+                   batch_interval=None, confirm=False):
+        """
+        Return a publisher for the given routing key.
+
+        Messages are serialised for ``content_type``, which defaults to JSON.
+        If ``batch_size`` or ``confirm`` is set, a :class:`BatchingPublisher`
+        is returned instead of a :class:`DynamicPublisher`.
+
+        :param int batch_size:
+            The maximum number of messages to buffer before flushing.
+        :param float batch_interval:
+            The maximum number of seconds a message may wait in the buffer.
+        :param bool confirm:
+            If ``True``, each batch is published in an AMQP transaction and
+            the publish deferreds only fire once the broker has committed it.
+        """
         channel = yield self._amqp_client.get_channel()
-        publisher = DynamicPublisher(channel, routing_key)
+        if batch_size is None and not confirm:
+            publisher = DynamicPublisher(
+                channel, routing_key, content_type=content_type)
+        else:
+            publisher = BatchingPublisher(
+                channel, routing_key, content_type=content_type,
+                batch_size=batch_size, batch_interval=batch_interval,
+                confirm=confirm)
         yield self._amqp_client._declare_exchange(publisher, channel)
+        yield publisher.start()
         # return the publisher
         returnValue(publisher)
 
@@ -245,6 +274,21 @@ class QueueCloseMarker(object):
 
 
 class Consumer(object):
+    """
+    An AMQP queue consumer.
+
+    By default, messages are processed one at a time. If :attr:`concurrency`
+    is greater than one, up to that many messages are processed at the same
+    time. :attr:`ordering` may be set to ``'from_addr'`` or ``'session'`` to
+    keep messages that share an address (or a pair of addresses) in order
+    while messages for different addresses are processed concurrently.
+    Messages without the relevant addresses (events, for example) are never
+    held back.
+
+    If :attr:`datetime_fields_only` is set, only the message's
+    ``DATETIME_FIELDS`` are parsed as datetimes when decoding, instead of
+    every string that looks like a date.
+    """
 
     exchange_name = "vumi"
     exchange_type = "direct"
@@ -256,6 +300,11 @@ class Consumer(object):
     message_class = Message
     start_paused = False
     prefetch_count = None
+    concurrency = 1
+    ordering = None
+    datetime_fields_only = False
+
+    ORDERINGS = (None, 'from_addr', 'session')
 
     def __init__(self, channel):
         self.channel = channel
@@ -267,7 +316,13 @@ class Consumer(object):
 
     @inlineCallbacks
     def start(self):
+        if self.ordering not in self.ORDERINGS:
+            raise ValueError("Unknown consumer ordering: %r" % (
+                self.ordering,))
         self._in_progress = 0
+        self._in_flight = 0
+        self._slot_d = None
+        self._ordering_chains = {}
         self.keep_consuming = True
         self.paused = self.start_paused
         self._unpause_d = None
@@ -286,7 +341,11 @@ class Consumer(object):
                     break
                 if self.paused:
                     yield self._unpause_d
-                yield self.consume(message)
+                if self.concurrency > 1:
+                    yield self._wait_for_slot()
+                    self._consume_concurrently(message)
+                else:
+                    yield self.consume(message)
         except txamqp.queue.Closed as e:
             log.err("Queue has closed", e)
         except Exception:
@@ -326,16 +385,94 @@ class Consumer(object):
         return d
 
     def _check_notify(self):
-        if self.paused and not self._in_progress:
+        if self.paused and not (self._in_progress or self._in_flight):
             while self._notify_paused_and_quiet:
                 self._notify_paused_and_quiet.pop(0).callback(None)
 
+    def _wait_for_slot(self):
+        """
+        Return a deferred that fires when fewer than :attr:`concurrency`
+        messages are in flight.
+        """
+        if self._in_flight < self.concurrency:
+            return succeed(None)
+        if self._slot_d is None:
+            self._slot_d = Deferred()
+        return self._slot_d
+
+    def decode_message(self, message):
+        """
+        Decode an AMQP message using the serializer for its content type.
+        """
+        properties = message.content.properties or {}
+        return self.message_class.deserialize(
+            message.content.body, properties.get('content type'),
+            datetime_fields_only=self.datetime_fields_only)
+
+    def get_ordering_key(self, msg):
+        """
+        Return the key used to keep related messages in order, or ``None`` if
+        this message may be processed in any order.
+        """
+        if self.ordering == 'from_addr':
+            return msg.get('from_addr')
+        if self.ordering == 'session':
+            addrs = (msg.get('from_addr'), msg.get('to_addr'))
+            if None in addrs:
+                return None
+            return (msg.get('transport_name'),) + tuple(sorted(addrs))
+        return None
+
+    def _consume_concurrently(self, message):
+        self._in_flight += 1
+        try:
+            msg = self.decode_message(message)
+            key = self.get_ordering_key(msg)
+        except Exception:
+            d = fail()
+            key = None
+            if self._fake_channel is not None:
+                self._fake_channel.message_processed()
+        else:
+            if key is None:
+                d = self.consume(message, msg)
+            else:
+                # Messages with the same key are chained onto a single
+                # deferred so that each one waits for the previous one.
+                chain = self._ordering_chains.get(key)
+                if chain is None:
+                    chain = self._ordering_chains[key] = [succeed(None), 0]
+                chain[1] += 1
+                d = chain[0]
+                d.addCallback(lambda _: self.consume(message, msg))
+        d.addErrback(self._consume_failed, message)
+        d.addCallback(self._consume_concurrently_done, key)
+
+    def _consume_failed(self, failure, message):
+        # Unlike the serial path, a failure here doesn't stop us from reading
+        # further messages. The failed message is left unacknowledged.
+        log.err(failure, "Error consuming message: %r" % (
+            message.content.body,))
+
+    def _consume_concurrently_done(self, _result, key):
+        if key is not None:
+            chain = self._ordering_chains[key]
+            chain[1] -= 1
+            if chain[1] == 0:
+                del self._ordering_chains[key]
+        self._in_flight -= 1
+        d, self._slot_d = self._slot_d, None
+        if d is not None:
+            d.callback(None)
+        self._check_notify()
+
     @inlineCallbacks
-    def consume(self, message):
+    def consume(self, message, vumi_message=None):
         self._in_progress += 1
         try:
-            result = yield self.consume_message(
-                self.message_class.from_json(message.content.body))
+            if vumi_message is None:
+                vumi_message = self.decode_message(message)
+            result = yield self.consume_message(vumi_message)
         finally:
             # If we get an exception here the consumer's already pretty much
             # broken, but we still decrement the _in_progress counter so we
@@ -445,22 +582,40 @@ class DynamicPublisher(_Publisher):
 
     durable = True
 
-    def __init__(self, channel, routing_key):
+    def __init__(self, channel, routing_key, content_type=None):
         self.channel = channel
         self.check_routing_key(routing_key)
         self.routing_key = routing_key
+        self.content_type = content_type
+
+    def start(self):
+        return succeed(None)
+
+    def flush(self):
+        """
+        Publish any buffered messages.
+
+        Messages are never buffered here, so there's nothing to do.
+        """
+        return succeed(None)
 
     def publish_message(self, message):
-        self.publish_raw(message.to_json())
+        self.publish_raw(message.serialize(self.content_type),
+                         content_type=self.content_type)
         return succeed(message)
 
     def publish_json(self, data):
         self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
 
-    def publish_raw(self, data):
+    def publish_raw(self, data, content_type=None):
+        self._publish(self._mk_content(data, content_type))
+
+    def _mk_content(self, data, content_type):
         amq_message = Content(data)
         amq_message['delivery mode'] = self.delivery_mode
-        self._publish(amq_message)
+        if content_type is not None:
+            amq_message['content type'] = content_type
+        return amq_message
 
     def _publish(self, message):
         return self.channel.basic_publish(
@@ -468,6 +623,96 @@ class DynamicPublisher(_Publisher):
             routing_key=self.routing_key)
 
 
+class BatchingPublisher(DynamicPublisher):
+    """
+    A single-routing-key publisher that buffers messages and publishes them
+    in batches.
+
+    A batch is flushed when it reaches ``batch_size`` messages or when its
+    oldest message has waited ``batch_interval`` seconds, whichever happens
+    first. If ``confirm`` is set, the channel is put into transactional mode
+    and each batch is committed before its publish deferreds fire. This gives
+    us an acknowledgement from the broker without needing the publisher
+    confirms extension, which isn't part of the AMQP 0-8 spec we use.
+    """
+
+    clock = reactor
+
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_BATCH_INTERVAL = 0.01
+
+    def __init__(self, channel, routing_key, content_type=None,
+                 batch_size=None, batch_interval=None, confirm=False):
+        super(BatchingPublisher, self).__init__(
+            channel, routing_key, content_type=content_type)
+        if batch_size is None:
+            batch_size = self.DEFAULT_BATCH_SIZE
+        if batch_interval is None:
+            batch_interval = self.DEFAULT_BATCH_INTERVAL
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.confirm = confirm
+        self._pending = []
+        self._flush_call = None
+        self._flush_lock = DeferredLock()
+
+    @inlineCallbacks
+    def start(self):
+        if self.confirm:
+            yield self.channel.tx_select()
+
+    def publish_message(self, message):
+        d = self.publish_raw(message.serialize(self.content_type),
+                             content_type=self.content_type)
+        d.addCallback(lambda _: message)
+        return d
+
+    def publish_json(self, data):
+        return self.publish_raw(json.dumps(data, cls=json.JSONEncoder))
+
+    def publish_raw(self, data, content_type=None):
+        d = Deferred()
+        self._pending.append((self._mk_content(data, content_type), d))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.batch_interval, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Publish all buffered messages.
+
+        Returns a deferred that fires when the batch has been written (and
+        committed, if ``confirm`` is set). Flushes are serialised so that
+        transaction boundaries on the channel are never interleaved.
+        """
+        if self._flush_call is not None:
+            if self._flush_call.active():
+                self._flush_call.cancel()
+            self._flush_call = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return succeed(None)
+        return self._flush_lock.run(self._publish_batch, batch)
+
+    @inlineCallbacks
+    def _publish_batch(self, batch):
+        try:
+            for amq_message, _ in batch:
+                self._publish(amq_message)
+            if self.confirm:
+                yield self.channel.tx_commit()
+        except Exception:
+            failure = Failure()
+            for _, d in batch:
+                d.errback(failure)
+        else:
+            for _, d in batch:
+                d.callback(None)
+
+
 class WorkerCreator(object):
     """
     Creates workers
@@ -67,23 +67,23 @@ def mkContent(body, children=None, properties=None):
                  properties=properties)
 
 
-def mk_deliver(body, exchange, routing_key, ctag, dtag):
+def mk_deliver(body, exchange, routing_key, ctag, dtag, properties=None):
     return Message(mkMethod('deliver', 60), [
             ('consumer_tag', ctag),
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
-def mk_get_ok(body, exchange, routing_key, dtag):
+def mk_get_ok(body, exchange, routing_key, dtag, properties=None):
     return Message(mkMethod('get-ok', 71), [
             ('delivery_tag', dtag),
             ('redelivered', False),
             ('exchange', exchange),
             ('routing_key', routing_key),
-            ], mkContent(body))
+            ], mkContent(body, properties=properties))
 
 
 class FakeAMQPBroker(object):
@@ -186,7 +186,8 @@ class FakeAMQPBroker(object):
                 if dtag is None:
                     break
                 dmsg = mk_deliver(msg['content'], msg['exchange'],
-                                  msg['routing_key'], ctag, dtag)
+                                  msg['routing_key'], ctag, dtag,
+                                  msg['properties'])
                 self._delivering['count'] += 1
                 channel.deliver_message(dmsg, ctag)
                 delivered = True
@@ -264,8 +265,11 @@ class FakeAMQPBroker(object):
 
     def get_messages(self, exchange, rkey):
         contents = self.get_dispatched(exchange, rkey)
-        messages = [VumiMessage.from_json(content.body)
-                    for content in contents]
+        messages = []
+        for content in contents:
+            properties = getattr(content, 'properties', None) or {}
+            messages.append(VumiMessage.deserialize(
+                content.body, properties.get('content type')))
         return messages
 
     def publish_message(self, exchange, routing_key, message):
@@ -295,6 +299,8 @@ class FakeAMQPChannel(object):
         self.delegate = client.delegate
         self.unacked = []
         self._consumer_prefetch = {}
+        self.tx_mode = False
+        self.tx_pending = []
 
     def __repr__(self):
         return '<FakeAMQPChannel: id=%s>' % (self.channel_id,)
@@ -342,8 +348,27 @@ class FakeAMQPChannel(object):
         return Message(mkMethod("cancel-ok", 31))
 
     def basic_publish(self, exchange, routing_key, content):
+        if self.tx_mode:
+            self.tx_pending.append((exchange, routing_key, content))
+            return None
         return self.broker.basic_publish(exchange, routing_key, content)
 
+    def tx_select(self):
+        self.tx_mode = True
+        return Message(mkMethod("select-ok", 11))
+
+    def tx_commit(self):
+        assert self.tx_mode
+        pending, self.tx_pending = self.tx_pending, []
+        for exchange, routing_key, content in pending:
+            self.broker.basic_publish(exchange, routing_key, content)
+        return Message(mkMethod("commit-ok", 21))
+
+    def tx_rollback(self):
+        assert self.tx_mode
+        self.tx_pending = []
+        return Message(mkMethod("rollback-ok", 31))
+
     def basic_ack(self, delivery_tag, multiple):
         assert delivery_tag in [dtag for dtag, _ctag, _queue in self.unacked]
         for dtag, ctag, queue in self.unacked[:]:
@@ -376,7 +401,7 @@ class FakeAMQPChannel(object):
         if msg:
             self.unacked.append((dtag, None, queue))
             return mk_get_ok(msg['content'], msg['exchange'],
-                             msg['routing_key'], dtag)
+                             msg['routing_key'], dtag, msg['properties'])
         return Message(mkMethod("get-empty", 72))
 
     def message_processed(self):
@@ -463,6 +488,7 @@ class FakeAMQPQueue(object):
                 'exchange': exchange,
                 'routing_key': routing_key,
                 'content': content.body,
+                'properties': getattr(content, 'properties', None),
                 })
 
     def ack(self, delivery_tag):
@@ -549,6 +575,15 @@ class FakeAMQPChannelWrapper(object):
     def basic_publish(self, exchange, routing_key, content):
         return self._fake_channel.basic_publish(exchange, routing_key, content)
 
+    def tx_select(self):
+        return self._fake_channel.tx_select()
+
+    def tx_commit(self):
+        return self._fake_channel.tx_commit()
+
+    def tx_rollback(self):
+        return self._fake_channel.tx_rollback()
+
     def basic_ack(self, delivery_tag, multiple):
         return self._fake_channel.basic_ack(delivery_tag, multiple)
 
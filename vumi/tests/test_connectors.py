@@ -3,6 +3,7 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from vumi.connectors import (
     BaseConnector, ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector, IgnoreMessage)
+from vumi.service import BatchingPublisher
 from vumi.tests.utils import LogCatcher
 from vumi.worker import BaseWorker
 from vumi.message import TransportUserMessage
@@ -31,14 +32,17 @@ class BaseConnectorTestCase(VumiTestCase):
 
     @inlineCallbacks
     def mk_connector(self, worker=None, connector_name=None,
-                     prefetch_count=None, middlewares=None, setup=False):
+                     prefetch_count=None, middlewares=None, setup=False,
+                     publisher_options=None, consumer_options=None):
         if worker is None:
             worker = yield self.worker_helper.get_worker(DummyWorker, {})
         if connector_name is None:
             connector_name = "dummy_connector"
         connector = self.connector_class(worker, connector_name,
                                          prefetch_count=prefetch_count,
-                                         middlewares=middlewares)
+                                         middlewares=middlewares,
+                                         publisher_options=publisher_options,
+                                         consumer_options=consumer_options)
         if setup:
             yield connector.setup()
         returnValue(connector)
@@ -102,6 +106,13 @@ class TestBaseConnector(BaseConnectorTestCase):
         fake_channel = consumer.channel._fake_channel
         self.assertEqual(fake_channel.qos_prefetch_count, 10)
 
+    @inlineCallbacks
+    def test_consumer_options(self):
+        conn, consumer = yield self.mk_consumer(
+            consumer_options={'concurrency': 5, 'ordering': 'from_addr'})
+        self.assertEqual(consumer.concurrency, 5)
+        self.assertEqual(consumer.ordering, 'from_addr')
+
     @inlineCallbacks
     def test_setup_raises(self):
         conn = yield self.mk_connector()
@@ -144,6 +155,38 @@ class TestBaseConnector(BaseConnectorTestCase):
         publisher = yield conn._setup_publisher('outbound')
         self.assertEqual(publisher.routing_key, 'foo.outbound')
 
+    @inlineCallbacks
+    def test_setup_publisher_with_options(self):
+        conn = yield self.mk_connector(
+            connector_name='foo', publisher_options={'batch_size': 10})
+        publisher = yield conn._setup_publisher('outbound')
+        self.assertTrue(isinstance(publisher, BatchingPublisher))
+        self.assertEqual(publisher.batch_size, 10)
+
+    @inlineCallbacks
+    def test_flush(self):
+        conn = yield self.mk_connector(
+            connector_name='foo', publisher_options={'batch_size': 10})
+        yield conn._setup_publisher('outbound')
+        msg = self.msg_helper.make_outbound("outbound")
+        d = conn._publish_message('outbound', msg, None)
+        self.assertEqual(self.worker_helper.get_dispatched_outbound('foo'), [])
+        yield conn.flush()
+        self.assertEqual((yield d), msg)
+        self.assertEqual(
+            self.worker_helper.get_dispatched_outbound('foo'), [msg])
+
+    @inlineCallbacks
+    def test_teardown_flushes_publishers(self):
+        conn = yield self.mk_connector(
+            connector_name='foo', publisher_options={'batch_size': 10})
+        yield conn._setup_publisher('outbound')
+        msg = self.msg_helper.make_outbound("outbound")
+        conn._publish_message('outbound', msg, None)
+        yield conn.teardown()
+        self.assertEqual(
+            self.worker_helper.get_dispatched_outbound('foo'), [msg])
+
     @inlineCallbacks
     def test_setup_consumer(self):
         conn, consumer = yield self.mk_consumer(connector_name='foo')
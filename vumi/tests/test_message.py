@@ -2,11 +2,15 @@ from datetime import datetime
 import json
 
 from vumi.tests.utils import RegexMatcher, UTCNearNow
+from vumi import message as message_module
 from vumi.message import (
     Message, TransportMessage, TransportEvent, TransportUserMessage,
     TransportStatus, MissingMessageField, InvalidMessageField,
-    format_vumi_date, parse_vumi_date, from_json, to_json)
-from vumi.tests.helpers import VumiTestCase
+    format_vumi_date, parse_vumi_date, from_json, to_json,
+    decode_datetime_fields, copy_payload, JSONMessageSerializer,
+    MsgpackMessageSerializer, get_message_serializer,
+    register_message_serializer)
+from vumi.tests.helpers import VumiTestCase, import_skip
 
 
 class ModuleUtilityTest(VumiTestCase):
@@ -72,6 +76,137 @@ class ModuleUtilityTest(VumiTestCase):
             'foo': timestamp,
         })
 
+    def test_decode_datetime_fields(self):
+        payload = {
+            'timestamp': '2015-01-02 12:01:02.134002',
+            'other': '2015-01-02 12:01:02.134002',
+        }
+        self.assertEqual(decode_datetime_fields(payload, ['timestamp']), {
+            'timestamp': datetime(2015, 1, 2, 12, 1, 2, microsecond=134002),
+            'other': '2015-01-02 12:01:02.134002',
+        })
+
+    def test_decode_datetime_fields_nested(self):
+        payload = {
+            'message': {'timestamp': '2015-01-02 12:01:02'},
+            'other': None,
+        }
+        decode_datetime_fields(
+            payload, ['message.timestamp', 'other.timestamp', 'missing.foo'])
+        self.assertEqual(payload, {
+            'message': {'timestamp': datetime(2015, 1, 2, 12, 1, 2)},
+            'other': None,
+        })
+
+    def test_decode_datetime_fields_ignores_non_dates(self):
+        payload = {'timestamp': 'not a date', 'number': 5}
+        decode_datetime_fields(payload, ['timestamp', 'number', 'missing'])
+        self.assertEqual(payload, {'timestamp': 'not a date', 'number': 5})
+
+    def test_copy_payload(self):
+        timestamp = datetime(2015, 1, 2, 12, 1, 2)
+        payload = {
+            'timestamp': timestamp,
+            'nested': {'list': [1, {'a': 'b'}], 'tuple': (1, 2)},
+        }
+        copied = copy_payload(payload)
+        self.assertEqual(copied, {
+            'timestamp': timestamp,
+            'nested': {'list': [1, {'a': 'b'}], 'tuple': [1, 2]},
+        })
+        copied['nested']['list'][1]['a'] = 'c'
+        self.assertEqual(payload['nested']['list'][1], {'a': 'b'})
+
+
+class JSONMessageSerializerTest(VumiTestCase):
+
+    def test_content_type(self):
+        self.assertEqual(
+            JSONMessageSerializer.content_type, 'application/json')
+
+    def test_round_trip(self):
+        serializer = JSONMessageSerializer()
+        timestamp = datetime(2015, 1, 2, 12, 1, 2, microsecond=134002)
+        data = serializer.serialize({'timestamp': timestamp, 'a': [1]})
+        self.assertEqual(json.loads(data), {
+            'timestamp': '2015-01-02 12:01:02.134002',
+            'a': [1],
+        })
+        self.assertEqual(serializer.deserialize(data), {
+            'timestamp': '2015-01-02 12:01:02.134002',
+            'a': [1],
+        })
+
+    def test_custom_json_module(self):
+        calls = []
+
+        class RecordingJSON(object):
+            def dumps(self, obj, **kw):
+                calls.append('dumps')
+                return json.dumps(obj, **kw)
+
+            def loads(self, data):
+                calls.append('loads')
+                return json.loads(data)
+
+        serializer = JSONMessageSerializer(RecordingJSON())
+        serializer.deserialize(serializer.serialize({'a': 1}))
+        self.assertEqual(calls, ['dumps', 'loads'])
+
+
+class MsgpackMessageSerializerTest(VumiTestCase):
+
+    def setUp(self):
+        try:
+            import msgpack
+            msgpack  # To keep pyflakes happy.
+        except ImportError, e:
+            import_skip(e, 'msgpack')
+
+    def test_round_trip(self):
+        serializer = MsgpackMessageSerializer()
+        timestamp = datetime(2015, 1, 2, 12, 1, 2, microsecond=134002)
+        data = serializer.serialize({
+            'timestamp': timestamp, 'content': u'hi \u1234', 'a': [1]})
+        self.assertEqual(serializer.deserialize(data), {
+            'timestamp': '2015-01-02 12:01:02.134002',
+            'content': u'hi \u1234',
+            'a': [1],
+        })
+
+    def test_message_round_trip(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345',
+            transport_name='sphex', transport_type='sms', content=u'hi')
+        data = msg.serialize('application/x-msgpack')
+        self.assertEqual(
+            TransportUserMessage.deserialize(data, 'application/x-msgpack'),
+            msg)
+
+
+class GetMessageSerializerTest(VumiTestCase):
+
+    def setUp(self):
+        self.patch(message_module, '_SERIALIZERS',
+                   message_module._SERIALIZERS.copy())
+
+    def test_default(self):
+        serializer = get_message_serializer()
+        self.assertTrue(isinstance(serializer, JSONMessageSerializer))
+        self.assertEqual(get_message_serializer('application/json'),
+                         serializer)
+
+    def test_unknown_content_type(self):
+        self.assertRaises(ValueError, get_message_serializer, 'text/foo')
+
+    def test_register_message_serializer(self):
+        class FooSerializer(object):
+            content_type = 'text/foo'
+
+        serializer = FooSerializer()
+        register_message_serializer(serializer)
+        self.assertEqual(get_message_serializer('text/foo'), serializer)
+
 
 class MessageTest(VumiTestCase):
 
@@ -85,6 +220,65 @@ class MessageTest(VumiTestCase):
         self.assertTrue('a' in Message(a=5))
         self.assertFalse('a' in Message(b=5))
 
+    def test_from_json_decodes_nested_datetimes(self):
+        timestamp = datetime(2015, 1, 2, 12, 1, 2, microsecond=134002)
+        msg = Message.from_json(json.dumps({
+            'timestamp': '2015-01-02 12:01:02.134002',
+            'content': '2015-01-02 12:01:02.134002',
+            'metadata': {'timestamp': '2015-01-02 12:01:02.134002'},
+        }))
+        self.assertEqual(msg.payload, {
+            'timestamp': timestamp,
+            'content': timestamp,
+            'metadata': {'timestamp': timestamp},
+        })
+
+    def test_deserialize_decodes_nested_datetimes(self):
+        timestamp = datetime(2015, 1, 2, 12, 1, 2, microsecond=134002)
+        msg = Message.deserialize(json.dumps({
+            'timestamp': '2015-01-02 12:01:02.134002',
+            'metadata': {'times': [{'at': '2015-01-02 12:01:02.134002'}]},
+        }))
+        self.assertEqual(msg.payload, {
+            'timestamp': timestamp,
+            'metadata': {'times': [{'at': timestamp}]},
+        })
+
+    def test_deserialize_datetime_fields_only(self):
+        msg = Message.deserialize(json.dumps({
+            'timestamp': '2015-01-02 12:01:02.134002',
+            'content': '2015-01-02 12:01:02.134002',
+            'metadata': {'timestamp': '2015-01-02 12:01:02.134002'},
+        }), datetime_fields_only=True)
+        self.assertEqual(msg.payload, {
+            'timestamp': datetime(2015, 1, 2, 12, 1, 2, microsecond=134002),
+            'content': '2015-01-02 12:01:02.134002',
+            'metadata': {'timestamp': '2015-01-02 12:01:02.134002'},
+        })
+
+    def test_serialize_round_trip(self):
+        msg = Message(a=5, timestamp=datetime(2015, 1, 2, 12, 1, 2))
+        self.assertEqual(json.loads(msg.serialize()), {
+            'a': 5, 'timestamp': '2015-01-02 12:01:02.000000'})
+        self.assertEqual(Message.deserialize(msg.serialize()), msg)
+
+    def test_copy(self):
+        msg = Message(a={'b': [1, 2]}, nested_time=datetime(2015, 1, 2))
+        copied = msg.copy()
+        self.assertEqual(copied, msg)
+        copied['a']['b'].append(3)
+        self.assertEqual(msg['a'], {'b': [1, 2]})
+        # Unlike a JSON round trip, nested datetimes are kept as they are.
+        self.assertEqual(copied['nested_time'], datetime(2015, 1, 2))
+
+    def test_copy_keeps_class(self):
+        msg = TransportUserMessage(
+            to_addr='+27831234567', from_addr='12345',
+            transport_name='sphex', transport_type='sms')
+        copied = msg.copy()
+        self.assertTrue(isinstance(copied, TransportUserMessage))
+        self.assertEqual(copied, msg)
+
     def test_message_cache(self):
         msg = Message(a=5)
         self.assertEqual(msg.cache, {})
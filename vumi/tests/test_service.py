@@ -1,10 +1,16 @@
 import json
 from collections import namedtuple
+from datetime import datetime
 
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet import reactor
+from twisted.internet.task import Clock
 
-from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
+from vumi import message as message_module
+from vumi.message import (
+    Message, JSONMessageSerializer, register_message_serializer)
+from vumi.service import (
+    Worker, WorkerCreator, DynamicPublisher, BatchingPublisher)
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
 
@@ -15,6 +21,16 @@ def fake_amq_message(dictionary, delivery_tag='delivery_tag'):
                       content=Content(body=json.dumps(dictionary)))
 
 
+class ReversedJSONSerializer(JSONMessageSerializer):
+    content_type = 'application/x-reversed-json'
+
+    def serialize(self, payload):
+        return super(ReversedJSONSerializer, self).serialize(payload)[::-1]
+
+    def deserialize(self, data):
+        return super(ReversedJSONSerializer, self).deserialize(data[::-1])
+
+
 class TestService(VumiTestCase):
     def setUp(self):
         self.worker_helper = self.add_helper(WorkerHelper())
@@ -91,6 +107,141 @@ class TestService(VumiTestCase):
         [failure] = self.flushLoggedErrors()
         self.assertEqual(failure.getErrorMessage(), "oops")
 
+    @inlineCallbacks
+    def start_blocking_consumer(self, **kw):
+        """
+        Start a consumer whose callback blocks until released.
+
+        Returns the consumer and a dict mapping message keys to the deferreds
+        that release them.
+        """
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        blocked = {}
+
+        def consume_func(msg):
+            d = blocked[msg['key']] = Deferred()
+            return d
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, **kw)
+        returnValue((consumer, blocked))
+
+    def publish_msgs(self, *msgs):
+        for msg in msgs:
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key', fake_amq_message(msg).content)
+        # We can't wait for delivery because the consumers block, so we just
+        # wait for the delivery run to happen.
+        d = Deferred()
+        reactor.callLater(0, d.callback, None)
+        return d
+
+    @inlineCallbacks
+    def test_consume_serial_by_default(self):
+        consumer, blocked = yield self.start_blocking_consumer()
+        yield self.publish_msgs({"key": "a"}, {"key": "b"})
+        self.assertEqual(blocked.keys(), ["a"])
+        blocked["a"].callback(None)
+        self.assertEqual(sorted(blocked.keys()), ["a", "b"])
+        blocked["b"].callback(None)
+        yield self.worker_helper.kick_delivery()
+
+    @inlineCallbacks
+    def test_consume_concurrently(self):
+        consumer, blocked = yield self.start_blocking_consumer(concurrency=3)
+        yield self.publish_msgs(*[{"key": k} for k in "abcde"])
+        self.assertEqual(sorted(blocked.keys()), ["a", "b", "c"])
+        self.assertEqual(consumer._in_progress, 3)
+        blocked["b"].callback(None)
+        self.assertEqual(sorted(blocked.keys()), ["a", "b", "c", "d"])
+        for k in "acd":
+            blocked[k].callback(None)
+        self.assertEqual(sorted(blocked.keys()), list("abcde"))
+        blocked["e"].callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(consumer._in_progress, 0)
+        self.assertEqual(consumer._in_flight, 0)
+
+    @inlineCallbacks
+    def test_consume_concurrently_ordering_from_addr(self):
+        consumer, blocked = yield self.start_blocking_consumer(
+            concurrency=5, ordering='from_addr')
+        yield self.publish_msgs(
+            {"key": "a1", "from_addr": "a"},
+            {"key": "b1", "from_addr": "b"},
+            {"key": "a2", "from_addr": "a"},
+            {"key": "x"})
+        self.assertEqual(sorted(blocked.keys()), ["a1", "b1", "x"])
+        self.assertEqual(consumer._in_flight, 4)
+        blocked["a1"].callback(None)
+        self.assertEqual(sorted(blocked.keys()), ["a1", "a2", "b1", "x"])
+        for k in ["a2", "b1", "x"]:
+            blocked[k].callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertEqual(consumer._ordering_chains, {})
+        self.assertEqual(consumer._in_flight, 0)
+
+    @inlineCallbacks
+    def test_consume_concurrently_ordering_session(self):
+        consumer, blocked = yield self.start_blocking_consumer(
+            concurrency=5, ordering='session')
+        yield self.publish_msgs(
+            {"key": "in", "from_addr": "+27831", "to_addr": "*120#"},
+            {"key": "out", "from_addr": "*120#", "to_addr": "+27831"},
+            {"key": "other", "from_addr": "+27832", "to_addr": "*120#"})
+        self.assertEqual(sorted(blocked.keys()), ["in", "other"])
+        blocked["in"].callback(None)
+        self.assertEqual(sorted(blocked.keys()), ["in", "other", "out"])
+        for k in ["out", "other"]:
+            blocked[k].callback(None)
+        yield self.worker_helper.kick_delivery()
+
+    @inlineCallbacks
+    def test_consume_unknown_ordering(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        yield self.assertFailure(
+            worker.consume('test.routing.key', lambda msg: None,
+                           concurrency=2, ordering='foo'),
+            ValueError)
+
+    @inlineCallbacks
+    def test_consume_concurrently_pause_waits_for_in_flight(self):
+        consumer, blocked = yield self.start_blocking_consumer(
+            concurrency=5, ordering='from_addr')
+        yield self.publish_msgs(
+            {"key": "a1", "from_addr": "a"},
+            {"key": "a2", "from_addr": "a"})
+        pause_d = consumer.pause()
+        blocked["a1"].callback(None)
+        # a2 has been delivered to us, so we wait for it too.
+        self.assertFalse(pause_d.called)
+        blocked["a2"].callback(None)
+        yield pause_d
+        self.assertEqual(consumer._in_flight, 0)
+
+    @inlineCallbacks
+    def test_consume_concurrently_broken_consume(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+
+        def consume_func(msg):
+            if msg['key'] == 'bad':
+                raise Exception("oops")
+            log.append(msg['key'])
+
+        consumer = yield worker.consume(
+            'test.routing.key', consume_func, concurrency=2)
+        for key in ["bad", "good"]:
+            self.worker_helper.broker.basic_publish(
+                'vumi', 'test.routing.key',
+                fake_amq_message({"key": key}).content)
+        yield self.worker_helper.kick_delivery()
+        # The failure doesn't stop the consumer.
+        self.assertEqual(log, ["good"])
+        self.assertEqual(consumer._in_flight, 0)
+        [failure] = self.flushLoggedErrors()
+        self.assertEqual(failure.getErrorMessage(), "oops")
+
     @inlineCallbacks
     def test_start_publisher(self):
         """The publisher should publish"""
@@ -104,6 +255,185 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publish_with_content_type(self):
+        self.patch(message_module, '_SERIALIZERS',
+                   message_module._SERIALIZERS.copy())
+        register_message_serializer(ReversedJSONSerializer())
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', content_type='application/x-reversed-json')
+        publisher.publish_message(Message(key="value"))
+        [published_msg] = self.worker_helper.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEquals(published_msg.body, '}"eulav" :"yek"{')
+        self.assertEquals(published_msg.properties, {
+            'delivery mode': 2,
+            'content type': 'application/x-reversed-json',
+        })
+
+    @inlineCallbacks
+    def test_consume_with_content_type(self):
+        self.patch(message_module, '_SERIALIZERS',
+                   message_module._SERIALIZERS.copy())
+        register_message_serializer(ReversedJSONSerializer())
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        publisher = yield worker.publish_to(
+            'test.routing.key', content_type='application/x-reversed-json')
+        publisher.publish_message(Message(key="value"))
+        publisher = yield worker.publish_to('test.routing.key')
+        publisher.publish_message(Message(key="json"))
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEquals(log, [Message(key="value"), Message(key="json")])
+
+    @inlineCallbacks
+    def test_consume_datetime_fields_only(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        log = []
+        yield worker.consume('test.routing.key', log.append)
+        yield worker.consume(
+            'test.routing.key', log.append, queue_name='fields.only',
+            datetime_fields_only=True)
+        publisher = yield worker.publish_to('test.routing.key')
+        timestamp = datetime(2015, 1, 2, 12, 1, 2)
+        publisher.publish_message(Message(nested={'at': timestamp}))
+        yield self.worker_helper.broker.wait_delivery()
+        self.assertEquals(set(msg['nested']['at'] for msg in log), set([
+            '2015-01-02 12:01:02.000000', timestamp]))
+
+    @inlineCallbacks
+    def test_publish_to_unbatched(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to('test.routing.key')
+        self.assertEqual(type(publisher), DynamicPublisher)
+
+    @inlineCallbacks
+    def test_publish_to_batched(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to(
+            'test.routing.key', batch_size=5, batch_interval=0.5)
+        self.assertEqual(type(publisher), BatchingPublisher)
+        self.assertEqual(publisher.batch_size, 5)
+        self.assertEqual(publisher.batch_interval, 0.5)
+        self.assertEqual(publisher.confirm, False)
+
+    @inlineCallbacks
+    def test_publish_to_confirm(self):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        publisher = yield worker.publish_to('test.routing.key', confirm=True)
+        self.assertEqual(type(publisher), BatchingPublisher)
+        self.assertEqual(
+            publisher.batch_size, BatchingPublisher.DEFAULT_BATCH_SIZE)
+        self.assertEqual(publisher.confirm, True)
+        self.assertEqual(publisher.channel._fake_channel.tx_mode, True)
+
+
+class TestBatchingPublisher(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = self.add_helper(WorkerHelper())
+        self.clock = Clock()
+        self.patch(BatchingPublisher, 'clock', self.clock)
+
+    @inlineCallbacks
+    def get_publisher(self, **kw):
+        worker = yield self.worker_helper.get_worker(Worker, {}, start=False)
+        kw.setdefault('batch_size', 3)
+        kw.setdefault('batch_interval', 1)
+        publisher = yield worker.publish_to('test.routing.key', **kw)
+        self.add_cleanup(publisher.flush)
+        returnValue(publisher)
+
+    def get_dispatched(self):
+        return [Message.from_json(content.body) for content in
+                self.worker_helper.broker.get_dispatched(
+                    'vumi', 'test.routing.key')]
+
+    @inlineCallbacks
+    def test_flush_on_batch_size(self):
+        publisher = yield self.get_publisher()
+        msgs = [Message(key=str(i)) for i in range(3)]
+        d1 = publisher.publish_message(msgs[0])
+        d2 = publisher.publish_message(msgs[1])
+        self.assertEqual(self.get_dispatched(), [])
+        self.assertFalse(d1.called)
+        self.assertFalse(d2.called)
+        d3 = publisher.publish_message(msgs[2])
+        self.assertEqual(self.get_dispatched(), msgs)
+        self.assertEqual((yield d1), msgs[0])
+        self.assertEqual((yield d2), msgs[1])
+        self.assertEqual((yield d3), msgs[2])
+
+    @inlineCallbacks
+    def test_flush_on_batch_interval(self):
+        publisher = yield self.get_publisher()
+        msg = Message(key="value")
+        d = publisher.publish_message(msg)
+        self.clock.advance(0.9)
+        self.assertEqual(self.get_dispatched(), [])
+        self.assertFalse(d.called)
+        self.clock.advance(0.1)
+        self.assertEqual(self.get_dispatched(), [msg])
+        self.assertEqual((yield d), msg)
+
+    @inlineCallbacks
+    def test_flush_cancels_timer(self):
+        publisher = yield self.get_publisher()
+        publisher.publish_message(Message(key="value"))
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        yield publisher.flush()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.get_dispatched()), 1)
+
+    @inlineCallbacks
+    def test_flush_empty(self):
+        publisher = yield self.get_publisher()
+        yield publisher.flush()
+        self.assertEqual(self.get_dispatched(), [])
+
+    @inlineCallbacks
+    def test_publish_json(self):
+        publisher = yield self.get_publisher()
+        d = publisher.publish_json({"key": "value"})
+        yield publisher.flush()
+        yield d
+        self.assertEqual(self.get_dispatched(), [Message(key="value")])
+
+    @inlineCallbacks
+    def test_confirm_commits_batch(self):
+        publisher = yield self.get_publisher(confirm=True)
+        fake_channel = publisher.channel._fake_channel
+        commits = []
+        orig_tx_commit = fake_channel.tx_commit
+
+        def tx_commit():
+            commits.append(len(fake_channel.tx_pending))
+            return orig_tx_commit()
+
+        self.patch(fake_channel, 'tx_commit', tx_commit)
+        msgs = [Message(key=str(i)) for i in range(2)]
+        ds = [publisher.publish_message(msg) for msg in msgs]
+        yield publisher.flush()
+        self.assertEqual(commits, [2])
+        self.assertEqual(self.get_dispatched(), msgs)
+        self.assertEqual([d.result for d in ds], msgs)
+
+    @inlineCallbacks
+    def test_confirm_commit_failure(self):
+        publisher = yield self.get_publisher(confirm=True)
+        fake_channel = publisher.channel._fake_channel
+
+        def tx_commit():
+            raise Exception("broker restarted")
+
+        self.patch(fake_channel, 'tx_commit', tx_commit)
+        d = publisher.publish_message(Message(key="value"))
+        yield publisher.flush()
+        failure = yield self.assertFailure(d, Exception)
+        self.assertEqual(str(failure), "broker restarted")
+        self.assertEqual(self.get_dispatched(), [])
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
@@ -14,7 +14,7 @@ from vumi.utils import (
     normalize_msisdn, vumi_resource_path, cleanup_msisdn, get_operator_name,
     http_request, http_request_full, get_first_word, redis_from_config,
     build_web_site, LogFilterSite, PkgResources, HttpTimeoutError,
-    StatusEdgeDetector)
+    StatusEdgeDetector, LRUCache, TokenBucket)
 from vumi.message import TransportStatus
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.fake_connection import (
@@ -527,3 +527,107 @@ class TestStatusEdgeDetector(VumiTestCase):
             'type': 'baz',
             'message': 'test'}
         self.assertEqual(sed.check_status(**status2), status2)
+
+
+class TestLRUCache(VumiTestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(cache.get('foo', 'default'), 'default')
+        cache.set('foo', 'bar')
+        self.assertEqual(cache.get('foo'), 'bar')
+        self.assertTrue('foo' in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LRUCache(10, ttl=5, clock=clock)
+        cache.set('foo', 'bar')
+        clock.advance(4)
+        self.assertEqual(cache.get('foo'), 'bar')
+        clock.advance(1)
+        self.assertEqual(cache.get('foo'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'gone'), 'gone')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_stats(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.stats()['hit_rate'], 0.0)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache.stats(), {
+            'size': 1,
+            'hits': 3,
+            'misses': 1,
+            'evictions': 0,
+            'hit_rate': 0.75,
+        })
+
+
+class TestTokenBucket(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_starts_full(self):
+        bucket = TokenBucket(5, clock=self.clock)
+        self.assertEqual(bucket.tokens, 5)
+        bucket = TokenBucket(5, capacity=2, clock=self.clock)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_take_and_refill(self):
+        bucket = TokenBucket(2, clock=self.clock)
+        bucket.take()
+        bucket.take()
+        self.assertEqual(bucket.tokens, 0)
+        self.clock.advance(0.25)
+        self.assertEqual(bucket.tokens, 0.5)
+        self.clock.advance(10)
+        # Never more than the capacity.
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_take_into_debt(self):
+        bucket = TokenBucket(2, clock=self.clock)
+        bucket.take(3)
+        self.assertEqual(bucket.tokens, -1)
+        self.assertEqual(bucket.delay(), 1.0)
+        self.clock.advance(1)
+        self.assertEqual(bucket.tokens, 1)
+
+    def test_try_take(self):
+        bucket = TokenBucket(1, clock=self.clock)
+        self.assertTrue(bucket.try_take())
+        self.assertFalse(bucket.try_take())
+        self.assertEqual(bucket.tokens, 0)
+        self.clock.advance(1)
+        self.assertTrue(bucket.try_take())
+
+    def test_delay(self):
+        bucket = TokenBucket(4, clock=self.clock)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.take(4)
+        self.assertEqual(bucket.delay(), 0.25)
+        self.assertEqual(bucket.delay(2), 0.5)
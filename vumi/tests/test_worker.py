@@ -52,6 +52,20 @@ class TestBaseConfig(VumiTestCase):
         config = BaseConfig({'amqp_prefetch_count': 10})
         self.assertEqual(config.amqp_prefetch_count, 10)
 
+    def test_amqp_publish_defaults(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_publish_batch_size, None)
+        self.assertEqual(config.amqp_publish_batch_interval, 0.01)
+        self.assertEqual(config.amqp_publish_confirm, False)
+        self.assertEqual(config.amqp_connector_publish_options, {})
+
+    def test_amqp_consume_defaults(self):
+        config = BaseConfig({})
+        self.assertEqual(config.amqp_consume_concurrency, 1)
+        self.assertEqual(config.amqp_consume_ordering, None)
+        self.assertEqual(config.amqp_consume_datetime_fields_only, False)
+        self.assertEqual(config.amqp_connector_consume_options, {})
+
 
 class TestBaseWorker(VumiTestCase):
 
@@ -154,6 +168,46 @@ class TestBaseWorker(VumiTestCase):
         cfg = yield self.worker.get_config(msg)
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_cached(self):
+        msg = self.msg_helper.make_inbound("inbound")
+        cfg1 = yield self.worker.get_config(msg)
+        cfg2 = yield self.worker.get_config(msg)
+        self.assertIdentical(cfg1, cfg2)
+        stats = self.worker.get_config_cache_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_get_cached_config(self):
+        calls = []
+
+        def get_config_data():
+            calls.append('called')
+            return {'amqp_prefetch_count': 5}
+
+        cfg1 = self.worker.get_cached_config('foo', get_config_data)
+        cfg2 = self.worker.get_cached_config('foo', get_config_data)
+        cfg3 = self.worker.get_cached_config('bar')
+        self.assertIdentical(cfg1, cfg2)
+        self.assertEqual(calls, ['called'])
+        self.assertEqual(cfg1.amqp_prefetch_count, 5)
+        self.assertEqual(cfg3.amqp_prefetch_count, 20)
+
+    @inlineCallbacks
+    def test_get_cached_config_size(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {'config_cache_size': 1}, False)
+        worker.get_cached_config('foo')
+        worker.get_cached_config('bar')
+        worker.get_cached_config('foo')
+        self.assertEqual(worker.get_config_cache_stats(), {
+            'size': 1,
+            'hits': 0,
+            'misses': 3,
+            'evictions': 2,
+            'hit_rate': 0.0,
+        })
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
@@ -175,6 +229,82 @@ class TestBaseWorker(VumiTestCase):
         # test setup happened
         self.assertTrue(connector._consumers['inbound'].keep_consuming)
 
+    def test_get_publisher_options(self):
+        self.assertEqual(self.worker.get_publisher_options('foo'), {
+            'content_type': None,
+            'batch_size': None,
+            'batch_interval': 0.01,
+            'confirm': False,
+        })
+
+    def test_get_publisher_options_per_connector(self):
+        worker = self.worker_helper.get_worker_raw(DummyWorker, {
+            'amqp_publish_batch_size': 50,
+            'amqp_connector_publish_options': {
+                'foo': {'batch_size': 10, 'confirm': True},
+            },
+        })
+        self.assertEqual(worker.get_publisher_options('foo'), {
+            'content_type': None,
+            'batch_size': 10,
+            'batch_interval': 0.01,
+            'confirm': True,
+        })
+        self.assertEqual(worker.get_publisher_options('bar'), {
+            'content_type': None,
+            'batch_size': 50,
+            'batch_interval': 0.01,
+            'confirm': False,
+        })
+
+    def test_get_consumer_options(self):
+        self.assertEqual(self.worker.get_consumer_options('foo'), {
+            'concurrency': 1,
+            'ordering': None,
+            'datetime_fields_only': False,
+        })
+
+    def test_get_consumer_options_per_connector(self):
+        worker = self.worker_helper.get_worker_raw(DummyWorker, {
+            'amqp_consume_concurrency': 10,
+            'amqp_consume_datetime_fields_only': True,
+            'amqp_connector_consume_options': {
+                'foo': {'concurrency': 5, 'ordering': 'session',
+                        'datetime_fields_only': False},
+            },
+        })
+        self.assertEqual(worker.get_consumer_options('foo'), {
+            'concurrency': 5,
+            'ordering': 'session',
+            'datetime_fields_only': False,
+        })
+        self.assertEqual(worker.get_consumer_options('bar'), {
+            'concurrency': 10,
+            'ordering': None,
+            'datetime_fields_only': True,
+        })
+
+    @inlineCallbacks
+    def test_setup_connector_consumer_options(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'amqp_connector_consume_options': {
+                'foo': {'concurrency': 5, 'ordering': 'from_addr'},
+            },
+        }, False)
+        connector = yield worker.setup_ri_connector('foo')
+        consumer = connector._consumers['inbound']
+        self.assertEqual(consumer.concurrency, 5)
+        self.assertEqual(consumer.ordering, 'from_addr')
+
+    @inlineCallbacks
+    def test_setup_connector_publisher_options(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'amqp_connector_publish_options': {'foo': {'batch_size': 10}},
+        }, False)
+        connector = yield worker.setup_ri_connector('foo')
+        self.assertEqual(
+            connector._publishers['outbound'].batch_size, 10)
+
     @inlineCallbacks
     def test_teardown_connector(self):
         connector = yield self.worker.setup_connector(ReceiveInboundConnector,
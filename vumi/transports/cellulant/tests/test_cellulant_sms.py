@@ -74,7 +74,22 @@ class TestCellulantSmsTransport(VumiTestCase):
     def test_health(self):
         result = yield http_request(
             self.transport_url + "health", "", method='GET')
-        self.assertEqual(json.loads(result), {'pending_requests': 0})
+        self.assertEqual(json.loads(result), {
+            'pending_requests': 0,
+            'timed_out_requests': 0,
+            'response_times': {
+                'count': 0,
+                'sum': 0.0,
+                'max': None,
+                'p50': None,
+                'p95': None,
+                'p99': None,
+                'buckets': {
+                    '0.1': 0, '0.25': 0, '0.5': 0, '1': 0, '2.5': 0,
+                    '5': 0, '10': 0, '30': 0, '60': 0, '+Inf': 0,
+                },
+            },
+        })
 
     @inlineCallbacks
     def test_inbound(self):
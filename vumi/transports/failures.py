@@ -14,6 +14,7 @@ from vumi.persist.txredis_manager import TxRedisManager
 
 class FailureMessage(TransportMessage):
     MESSAGE_TYPE = 'failure_message'
+    DATETIME_FIELDS = ('timestamp', 'message.timestamp')
 
     FC_UNSPECIFIED, FC_PERMANENT, FC_TEMPORARY = (None, 'permanent',
                                                   'temporary')
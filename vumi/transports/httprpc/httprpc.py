@@ -1,9 +1,11 @@
 # -*- test-case-name: vumi.transports.httprpc.tests.test_httprpc -*-
 
+import heapq
 import json
+from bisect import bisect_left
 
 from twisted.cred.portal import Portal
-from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.web import http
@@ -12,7 +14,7 @@ from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from vumi.config import (
-    ConfigText, ConfigInt, ConfigBool, ConfigError, ConfigFloat)
+    ConfigText, ConfigInt, ConfigBool, ConfigError, ConfigFloat, ConfigList)
 from vumi.message import TransportStatus
 from vumi.transports.base import Transport
 from vumi.transports.httprpc.auth import HttpRpcRealm, StaticAuthChecker
@@ -79,12 +81,88 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
         "The maximum time allowed for a response before the service is "
         "considered `degraded`",
         default=1.0, static=True)
+    response_time_buckets = ConfigList(
+        "The upper bounds (in seconds) of the response time histogram buckets"
+        " reported by the health resource. Slower responses are counted in a"
+        " final `+Inf` bucket.",
+        default=[0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0],
+        static=True)
+    reply_routing = ConfigBool(
+        "If `True`, inbound messages are stamped with a reply route naming"
+        " this transport instance and replies are delivered to the instance"
+        " holding the HTTP request. Replies consumed from the shared outbound"
+        " queue by another instance are forwarded to the"
+        " `<transport_name>.<instance_id>.outbound` queue of the instance"
+        " they belong to. This allows several workers to share a transport"
+        " name behind a load balancer.",
+        default=False, static=True)
+    instance_id = ConfigText(
+        "The identifier for this transport instance used when"
+        " `reply_routing` is enabled. It must be unique among the workers"
+        " sharing a transport name and stay the same across restarts, since"
+        " it names a durable queue. Required if `reply_routing` is enabled.",
+        default=None, static=True)
 
     def post_validate(self):
         auth_supplied = (self.web_username is None, self.web_password is None)
         if any(auth_supplied) and not all(auth_supplied):
             raise ConfigError("If either web_username or web_password is"
                               " specified, both must be specified")
+        if self.reply_routing and not self.instance_id:
+            raise ConfigError(
+                "instance_id must be specified if reply_routing is enabled")
+
+
+class ResponseTimeHistogram(object):
+    """
+    Count response times in fixed buckets.
+
+    :param list bounds:
+        The upper bounds of the buckets, in seconds. Each response time is
+        counted in the first bucket whose bound it doesn't exceed, or in a
+        final unbounded bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = sorted(float(bound) for bound in bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def observe(self, response_time):
+        self.counts[bisect_left(self.bounds, response_time)] += 1
+        self.count += 1
+        self.total += response_time
+        self.max = max(self.max, response_time)
+
+    def percentile(self, percent):
+        """
+        Return the upper bound of the bucket containing the given percentile,
+        or ``None`` if there are no responses or it's in the unbounded
+        bucket.
+        """
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        labels = ['%g' % (bound,) for bound in self.bounds] + ['+Inf']
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'buckets': dict(zip(labels, self.counts)),
+        }
 
 
 class HttpRpcHealthResource(Resource):
@@ -129,9 +207,16 @@ class HttpRpcTransport(Transport):
 
     Because a reply from an application worker is needed before the HTTP
     response can be completed, a reply needs to be returned to the same
-    transport worker that generated the inbound message. This means that
-    currently there many only be one transport worker for each instance
-    of this transport of a given name.
+    transport worker that generated the inbound message. Unless
+    ``reply_routing`` is enabled, this means that there may only be one
+    transport worker for each instance of this transport of a given name.
+
+    With ``reply_routing`` enabled, each worker stamps the inbound messages
+    it publishes with a ``reply_route`` in their ``transport_metadata``
+    (which is copied to replies) and also consumes from its own
+    ``<transport_name>.<instance_id>.outbound`` queue. A reply consumed from
+    the shared outbound queue by a worker it doesn't belong to is forwarded
+    to the queue of the worker that does.
     """
     content_type = 'text/plain'
 
@@ -158,10 +243,58 @@ class HttpRpcTransport(Transport):
         self._validation_mode = config.validation_mode
         self.response_time_down = config.response_time_down
         self.response_time_degraded = config.response_time_degraded
+        self.response_time_buckets = config.response_time_buckets
+        self.reply_routing = config.reply_routing
+        self.instance_id = None
+        if self.reply_routing:
+            self.instance_id = config.instance_id
         if self._validation_mode not in self.KNOWN_VALIDATION_MODES:
             raise ConfigError('Invalid validation mode: %s' % (
                 self._validation_mode,))
 
+    @property
+    def reply_connector_name(self):
+        return "%s.%s" % (self.transport_name, self.instance_id)
+
+    @inlineCallbacks
+    def setup_connectors(self):
+        yield super(HttpRpcTransport, self).setup_connectors()
+        if self.reply_routing:
+            self._reply_publishers = {}
+            self.add_outbound_handler(self.route_outbound_message)
+            # Messages on our reply queue have already been through the
+            # middleware on the shared connector of the worker that
+            # forwarded them.
+            reply_connector = yield self.setup_ro_connector(
+                self.reply_connector_name, middleware=False)
+            self.add_outbound_handler(
+                self.handle_outbound_message, connector=reply_connector)
+
+    def get_reply_route(self, message):
+        return message['transport_metadata'].get('reply_route')
+
+    def route_outbound_message(self, message):
+        """
+        Handle an outbound message consumed from the shared queue, forwarding
+        it to the worker holding the request it replies to if that isn't us.
+        """
+        reply_route = self.get_reply_route(message)
+        if reply_route is None or reply_route == self.instance_id:
+            return self.handle_outbound_message(message)
+        return self.forward_outbound_message(reply_route, message)
+
+    @inlineCallbacks
+    def forward_outbound_message(self, reply_route, message):
+        self.emit("HttpRpcTransport forwarding %s to %s" % (
+            message['message_id'], reply_route))
+        publisher = self._reply_publishers.get(reply_route)
+        if publisher is None:
+            publisher = yield self.publish_to(
+                "%s.%s.outbound" % (self.transport_name, reply_route))
+            self._reply_publishers[reply_route] = publisher
+        msg = yield publisher.publish_message(message)
+        returnValue(msg)
+
     def get_transport_url(self, suffix=''):
         """
         Get the URL for the HTTP resource. Requires the worker to be started.
@@ -189,6 +322,13 @@ class HttpRpcTransport(Transport):
     @inlineCallbacks
     def setup_transport(self):
         self._requests = {}
+        # Pending requests ordered by when they arrived, so we only have to
+        # look at the ones that have timed out. Entries for requests that
+        # have already finished are skipped when they reach the front.
+        self._request_expiry = []
+        self.response_times = ResponseTimeHistogram(
+            self.response_time_buckets)
+        self.timed_out_requests = 0
         self.request_gc = LoopingCall(self.manually_close_requests)
         self.clock = self.get_clock()
         self.request_gc.clock = self.clock
@@ -250,12 +390,20 @@ class HttpRpcTransport(Transport):
         return missing_fields
 
     def manually_close_requests(self):
-        for request_id, request_data in self._requests.items():
-            timestamp = request_data['timestamp']
-            response_time = self.clock.seconds() - timestamp
-            if response_time > self.request_timeout:
-                self.on_timeout(request_id, response_time)
-                self.close_request(request_id)
+        now = self.clock.seconds()
+        while self._request_expiry:
+            timestamp, request_id = self._request_expiry[0]
+            response_time = now - timestamp
+            if response_time <= self.request_timeout:
+                break
+            heapq.heappop(self._request_expiry)
+            request_data = self._requests.get(request_id)
+            if request_data is None or request_data['timestamp'] != timestamp:
+                # This request has already been finished (or replaced).
+                continue
+            self.timed_out_requests += 1
+            self.on_timeout(request_id, response_time)
+            self.close_request(request_id)
 
     def close_request(self, request_id):
         self.log.warning('Timing out %s' % (self.get_request_to_addr(request_id),))
@@ -264,7 +412,9 @@ class HttpRpcTransport(Transport):
 
     def get_health_response(self):
         return json.dumps({
-            'pending_requests': len(self._requests)
+            'pending_requests': len(self._requests),
+            'timed_out_requests': self.timed_out_requests,
+            'response_times': self.response_times.to_dict(),
         })
 
     def set_request(self, request_id, request_object, timestamp=None):
@@ -274,6 +424,7 @@ class HttpRpcTransport(Transport):
             'timestamp': timestamp,
             'request': request_object,
         }
+        heapq.heappush(self._request_expiry, (timestamp, request_id))
 
     def get_request(self, request_id):
         if request_id in self._requests:
@@ -335,6 +486,10 @@ class HttpRpcTransport(Transport):
     #       in a consistent manner.
     def publish_message(self, **kwargs):
         self.set_request_to_addr(kwargs['message_id'], kwargs['to_addr'])
+        if self.reply_routing:
+            kwargs['transport_metadata'] = dict(
+                kwargs.get('transport_metadata') or {},
+                reply_route=self.instance_id)
         return super(HttpRpcTransport, self).publish_message(**kwargs)
 
     def get_request_to_addr(self, request_id):
@@ -358,6 +513,7 @@ class HttpRpcTransport(Transport):
         request = self._requests.get(message_id, None)
         if request is not None:
             response_time = self.clock.seconds() - request['timestamp']
+            self.response_times.observe(response_time)
             if response_time > self.response_time_down:
                 return self.on_down_response_time(message_id, response_time)
             elif response_time > self.response_time_degraded:
@@ -3,10 +3,12 @@ import json
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import Clock
 
+from vumi.config import ConfigError
 from vumi.utils import http_request, http_request_full, basic_auth_string
 from vumi.tests.helpers import VumiTestCase
 from vumi.tests.utils import LogCatcher
 from vumi.transports.httprpc import HttpRpcTransport
+from vumi.transports.httprpc.httprpc import ResponseTimeHistogram
 from vumi.message import TransportUserMessage
 from vumi.transports.tests.helpers import TransportHelper
 
@@ -50,9 +52,39 @@ class TestTransport(VumiTestCase):
         result = yield http_request(self.transport_url + "health", "",
                                     method='GET')
         self.assertEqual(json.loads(result), {
-            'pending_requests': 0
+            'pending_requests': 0,
+            'timed_out_requests': 0,
+            'response_times': {
+                'count': 0,
+                'sum': 0.0,
+                'max': None,
+                'p50': None,
+                'p95': None,
+                'p99': None,
+                'buckets': {
+                    '0.1': 0, '0.25': 0, '0.5': 0, '1': 0, '2.5': 0,
+                    '5': 0, '10': 0, '30': 0, '60': 0, '+Inf': 0,
+                },
+            },
         })
 
+    @inlineCallbacks
+    def test_health_response_times(self):
+        d = http_request(self.transport_url + "foo", '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.clock.advance(0.3)
+        yield self.tx_helper.make_dispatch_reply(msg, "OK")
+        yield d
+        result = yield http_request(self.transport_url + "health", "",
+                                    method='GET')
+        health = json.loads(result)
+        self.assertEqual(health['pending_requests'], 0)
+        response_times = health['response_times']
+        self.assertEqual(response_times['count'], 1)
+        self.assertEqual(response_times['buckets']['0.5'], 1)
+        self.assertEqual(response_times['p50'], 0.5)
+        self.assertAlmostEqual(response_times['max'], 0.3)
+
     @inlineCallbacks
     def test_inbound(self):
         d = http_request(self.transport_url + "foo", '', method='GET')
@@ -83,6 +115,36 @@ class TestTransport(VumiTestCase):
             self.assertEqual(warning, 'Timing out to_addr')
         self.assertEqual(response.delivered_body, 'I am a teapot')
         self.assertEqual(response.code, 418)
+        self.assertEqual(self.transport.timed_out_requests, 1)
+
+    @inlineCallbacks
+    def test_timeout_only_expired_requests(self):
+        d1 = http_request_full(self.transport_url + "foo", '', method='GET')
+        [msg1] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.clock.advance(3)
+        d2 = http_request_full(self.transport_url + "foo", '', method='GET')
+        [_, msg2] = yield self.tx_helper.wait_for_dispatched_inbound(2)
+        self.clock.advance(3)
+        d3 = http_request_full(self.transport_url + "foo", '', method='GET')
+        [_, _, msg3] = yield self.tx_helper.wait_for_dispatched_inbound(3)
+        # The first request is finished, so only its expiry entry remains.
+        yield self.tx_helper.make_dispatch_reply(msg1, "OK")
+        yield d1
+
+        self.clock.advance(4.1)
+        self.assertEqual(self.transport.timed_out_requests, 0)
+        self.clock.advance(5)
+        response2 = yield d2
+        self.assertEqual(response2.code, 418)
+        self.assertEqual(self.transport.timed_out_requests, 1)
+        self.assertEqual(self.transport.get_request(msg2['message_id']), None)
+        self.assertNotEqual(
+            self.transport.get_request(msg3['message_id']), None)
+        self.assertEqual(len(self.transport._request_expiry), 1)
+
+        yield self.tx_helper.make_dispatch_reply(msg3, "OK")
+        response3 = yield d3
+        self.assertEqual(response3.code, 200)
 
     @inlineCallbacks
     def test_publish_health_status_repeated(self):
@@ -113,6 +175,32 @@ class TestTransport(VumiTestCase):
         self.assertEqual(status['status'], 'degraded')
 
 
+class TestResponseTimeHistogram(VumiTestCase):
+
+    def test_observe(self):
+        histogram = ResponseTimeHistogram([1, 0.5])
+        for response_time in [0.1, 0.5, 0.7, 3]:
+            histogram.observe(response_time)
+        self.assertEqual(histogram.to_dict(), {
+            'count': 4,
+            'sum': 4.3,
+            'max': 3,
+            'p50': 0.5,
+            'p95': None,
+            'p99': None,
+            'buckets': {'0.5': 2, '1': 1, '+Inf': 1},
+        })
+
+    def test_percentiles(self):
+        histogram = ResponseTimeHistogram([1, 2, 3])
+        self.assertEqual(histogram.percentile(50), None)
+        for i in range(100):
+            histogram.observe(0.5 if i < 90 else 2.5)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(90), 1)
+        self.assertEqual(histogram.percentile(95), 3)
+
+
 class TestTransportWithAuthentication(VumiTestCase):
 
     @inlineCallbacks
@@ -137,9 +225,7 @@ class TestTransportWithAuthentication(VumiTestCase):
     def test_health_doesnt_require_auth(self):
         result = yield http_request(self.transport_url + "health", "",
                                     method='GET')
-        self.assertEqual(json.loads(result), {
-            'pending_requests': 0
-        })
+        self.assertEqual(json.loads(result)['pending_requests'], 0)
 
     @inlineCallbacks
     def test_inbound_with_successful_auth(self):
@@ -173,6 +259,113 @@ class TestTransportWithAuthentication(VumiTestCase):
         self.assertEqual(response, 'Unauthorized')
 
 
+class TestTransportReplyRouting(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.tx_helper = self.add_helper(TransportHelper(OkTransport))
+        self.transport_a = yield self.get_transport('a')
+        self.transport_b = yield self.get_transport('b')
+
+    def get_transport(self, instance_id):
+        return self.tx_helper.get_transport({
+            'web_path': "foo",
+            'web_port': 0,
+            'reply_routing': True,
+            'instance_id': instance_id,
+        })
+
+    def test_instance_id_required(self):
+        """
+        The per-instance reply queue is durable, so its name must not change
+        when the worker restarts. We don't generate a random one.
+        """
+        self.assertRaises(ConfigError, OkTransport.CONFIG_CLASS, {
+            'transport_name': 'sphex',
+            'web_path': 'foo',
+            'web_port': 0,
+            'reply_routing': True,
+        }, static=True)
+
+    @inlineCallbacks
+    def test_instance_id_without_reply_routing(self):
+        transport = yield self.tx_helper.get_transport({
+            'web_path': 'foo',
+            'web_port': 0,
+            'instance_id': 'a',
+        })
+        self.assertEqual(transport.instance_id, None)
+        self.assertEqual(
+            sorted(transport.connectors.keys()), ['sphex', 'sphex.status'])
+
+    def test_reply_connector(self):
+        self.assertTrue('sphex.a' in self.transport_a.connectors)
+        self.assertTrue('sphex.b' in self.transport_b.connectors)
+
+    @inlineCallbacks
+    def test_inbound_stamped_with_reply_route(self):
+        url = self.transport_b.get_transport_url("foo")
+        d = http_request(url, '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['transport_metadata'], {'reply_route': 'b'})
+        yield self.transport_b.handle_outbound_message(msg.reply("OK"))
+        yield d
+
+    @inlineCallbacks
+    def test_reply_handled_locally(self):
+        url = self.transport_a.get_transport_url("foo")
+        d = http_request(url, '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield self.transport_a.route_outbound_message(msg.reply("OK"))
+        response = yield d
+        self.assertEqual(response, "OK")
+        self.assertEqual(
+            self.tx_helper.get_dispatched_outbound('sphex.a'), [])
+
+    @inlineCallbacks
+    def test_reply_forwarded(self):
+        url = self.transport_b.get_transport_url("foo")
+        d = http_request(url, '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = msg.reply("OK")
+        yield self.transport_a.route_outbound_message(reply)
+        self.assertEqual(
+            self.tx_helper.get_dispatched_outbound('sphex.b'), [reply])
+
+        response = yield d
+        self.assertEqual(response, "OK")
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.assertEqual(ack['user_message_id'], reply['message_id'])
+
+    @inlineCallbacks
+    def test_reply_via_shared_queue(self):
+        url = self.transport_b.get_transport_url("foo")
+        d = http_request(url, '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        # Whichever worker consumes the reply, it ends up at the one holding
+        # the request.
+        yield self.tx_helper.make_dispatch_reply(msg, "OK")
+        response = yield d
+        self.assertEqual(response, "OK")
+        self.assertEqual(self.transport_b.get_request(msg['message_id']), None)
+
+    @inlineCallbacks
+    def test_outbound_without_reply_route(self):
+        url = self.transport_a.get_transport_url("foo")
+        d = http_request(url, '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = self.tx_helper.make_outbound(
+            "OK", in_reply_to=msg['message_id'])
+        yield self.transport_a.route_outbound_message(reply)
+        response = yield d
+        self.assertEqual(response, "OK")
+        self.assertEqual(
+            self.tx_helper.get_dispatched_outbound('sphex.a'), [])
+        self.assertEqual(
+            self.tx_helper.get_dispatched_outbound('sphex.b'), [])
+
+
 class JSONTransport(HttpRpcTransport):
 
     def handle_raw_inbound_message(self, msgid, request):
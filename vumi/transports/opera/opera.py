@@ -9,6 +9,7 @@ from twisted.web import xmlrpc, http
 from twisted.web.resource import Resource
 from twisted.internet.defer import inlineCallbacks
 
+from vumi.message import parse_vumi_date
 from vumi.utils import normalize_msisdn
 from vumi.transports import Transport
 from vumi.transports.failures import TemporaryFailure, PermanentFailure
@@ -240,13 +241,25 @@ class OperaTransport(Transport):
         addr = self.web_resource.getHost()
         return "http://%s:%s/%s" % (addr.host, addr.port, suffix.lstrip('/'))
 
+    def _metadata_datetime(self, metadata, key):
+        # Consumers may be configured to only decode the message timestamp,
+        # in which case datetimes in the transport metadata are strings.
+        value = metadata.get(key)
+        if isinstance(value, basestring):
+            value = parse_vumi_date(value)
+        return value
+
     @inlineCallbacks
     def handle_outbound_message(self, message):
         xmlrpc_payload = self.default_values.copy()
         metadata = message["transport_metadata"]
 
-        delivery = metadata.get('deliver_at', datetime.utcnow())
-        expiry = metadata.get('expire_at', (delivery + timedelta(days=1)))
+        delivery = self._metadata_datetime(metadata, 'deliver_at')
+        if delivery is None:
+            delivery = datetime.utcnow()
+        expiry = self._metadata_datetime(metadata, 'expire_at')
+        if expiry is None:
+            expiry = delivery + timedelta(days=1)
         priority = metadata.get('priority', 'standard')
         receipt = metadata.get('receipt', 'Y')
 
@@ -1,6 +1,7 @@
 from vumi.config import (
     ConfigText, ConfigInt, ConfigBool, ConfigClientEndpoint, ConfigDict,
-    ConfigFloat, ConfigClassName, ClientEndpointFallback)
+    ConfigFloat, ConfigClassName, ConfigList, ClientEndpointFallback,
+    ConfigError)
 from vumi.transports.smpp.iprocessors import (
     IDeliveryReportProcessor, IDeliverShortMessageProcessor,
     ISubmitShortMessageProcessor)
@@ -136,6 +137,21 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
         'Defaults to 0 which means no throttling is applied. '
         '(NOTE: 1 Vumi message may result in multiple PDUs)',
         default=0, static=True, required=False)
+    submit_sm_window = ConfigInt(
+        'The maximum number of `submit_sm` PDUs awaiting a `submit_sm_resp` '
+        'on each bind. Further messages wait until a response arrives. '
+        'Defaults to 0 which means no limit.', default=0, static=True)
+    submit_sm_resp_timeout = ConfigInt(
+        'How long (in seconds) to wait for a `submit_sm_resp` before giving '
+        'up on it and freeing its slot in the `submit_sm_window`. '
+        'Defaults to 60 seconds.', default=60, static=True)
+    bind_pool = ConfigList(
+        "A list of bind types (`TX`, `RX` or `TRX`) to open concurrently to "
+        "the SMSC, e.g. `['TRX', 'TRX', 'RX']`. Outbound messages are "
+        "balanced across the bound transmitting binds and each bind is "
+        "throttled separately (`mt_tps` applies per bind). Defaults to a "
+        "single bind of the transport's own bind type.",
+        default=[], static=True)
 
     # TODO: Deprecate these fields when confmodel#5 is done.
     host = ConfigText(
@@ -144,3 +160,9 @@ class SmppTransportConfig(Transport.CONFIG_CLASS):
     port = ConfigInt(
         "*DEPRECATED* 'host' and 'port' fields may be used in place of the"
         " 'twisted_endpoint' field.", static=True)
+
+    def post_validate(self):
+        for bind_type in self.bind_pool:
+            if bind_type not in ('TX', 'RX', 'TRX'):
+                raise ConfigError(
+                    "Invalid bind type in bind_pool: %r" % (bind_type,))
@@ -1,7 +1,4 @@
-import json
-
-from smpp.pdu_inspector import (
-    detect_multipart, multipart_key, MultipartMessage)
+from smpp.pdu_inspector import detect_multipart, multipart_key
 from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 from zope.interface import implements
 
@@ -9,12 +6,74 @@ from vumi.config import (
     Config, ConfigDict, ConfigRegex, ConfigText, ConfigInt, ConfigBool)
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage
+from vumi.persist.redis_base import RedisScript
 from vumi.transports.smpp.iprocessors import (
     IDeliveryReportProcessor, IDeliverShortMessageProcessor,
     ISubmitShortMessageProcessor)
 from vumi.transports.smpp.smpp_utils import unpacked_pdu_opts, detect_ussd
 
 
+MULTIPART_PENDING_KEY = 'multipart_pending'
+
+
+def multipart_parts_key(key):
+    return 'multipart_parts:%s' % (key,)
+
+
+def _fake_add_multipart_part(redis, keys, args):
+    parts_key, pending_key = keys
+    part_number, part_message, total, expiry, now = args
+    expiry = int(expiry)
+    stale = redis.zrangebyscore(
+        pending_key, '-inf', float(now) - expiry)
+    for member in stale:
+        redis.zrem(pending_key, member)
+    added = redis.hsetnx(parts_key, part_number, part_message)
+    if added and redis.hlen(parts_key) == 1:
+        redis.expire(parts_key, expiry)
+        redis.zadd(pending_key, **{parts_key: float(now)})
+    if redis.hlen(parts_key) < int(total):
+        return [added, len(stale)]
+    parts = redis.hgetall(parts_key)
+    redis.delete(parts_key)
+    redis.zrem(pending_key, parts_key)
+    result = [added, len(stale)]
+    for item in parts.items():
+        result.extend(item)
+    return result
+
+
+# Store one part of a multipart message and return all the parts if it's
+# complete, atomically. Incomplete messages expire, and the pending set
+# (which tracks when each message's first part arrived) lets us count how
+# many expired.
+#
+# KEYS: parts hash, pending set
+# ARGV: part number, part message, total parts, expiry, timestamp
+# Returns: {added, expired, [part number, part message, ...]}
+ADD_MULTIPART_PART_SCRIPT = RedisScript("""
+local expiry = tonumber(ARGV[4])
+local expired = redis.call(
+    'ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[5]) - expiry)
+local added = redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2])
+if added == 1 and redis.call('HLEN', KEYS[1]) == 1 then
+    redis.call('EXPIRE', KEYS[1], expiry)
+    redis.call('ZADD', KEYS[2], ARGV[5], KEYS[1])
+end
+if redis.call('HLEN', KEYS[1]) < tonumber(ARGV[3]) then
+    return {added, expired}
+end
+local parts = redis.call('HGETALL', KEYS[1])
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], KEYS[1])
+local result = {added, expired}
+for i = 1, #parts do
+    result[#result + 1] = parts[i]
+end
+return result
+""", _fake_add_multipart_part)
+
+
 class DeliveryReportProcessorConfig(Config):
 
     DELIVERY_REPORT_REGEX = (
@@ -219,6 +278,11 @@ class DeliverShortMessageProcessorConfig(Config):
         "If False, reject empty messages as invalid.",
         default=False, static=True)
 
+    multipart_expiry = ConfigInt(
+        "How long (in seconds) to keep the parts of an incomplete multipart "
+        "message after its first part arrives. Defaults to 1 hour.",
+        default=(60 * 60), static=True)
+
 
 class DeliverShortMessageProcessor(object):
     """
@@ -280,6 +344,12 @@ class DeliverShortMessageProcessor(object):
                 "{}".format(e.message))
 
         self.allow_empty_messages = self.config.allow_empty_messages
+        self.multipart_stats = {
+            'parts': 0,
+            'duplicates': 0,
+            'completed': 0,
+            'expired': 0,
+        }
 
     def dcs_decode(self, obj, data_coding):
         codec_name = self.data_coding_map.get(data_coding, None)
@@ -354,25 +424,49 @@ class DeliverShortMessageProcessor(object):
 
     @inlineCallbacks
     def handle_deliver_sm_multipart(self, pdu, pdu_params):
-        redis_key = "multi_%s" % (multipart_key(detect_multipart(pdu)),)
+        part = detect_multipart(pdu)
+        redis_key = multipart_parts_key(multipart_key(part))
         self.log.debug("Redis multipart key: %s" % (redis_key))
-        multi = yield self.load_multipart_message(redis_key)
-        multi.add_pdu(pdu)
-        completed = multi.get_completed()
-        if completed:
-            yield self.redis.delete(redis_key)
-            self.log.msg("Reassembled Message: %s" % (completed['message']))
-            # We assume that all parts have the same data_coding here, because
-            # otherwise there's nothing sensible we can do.
-            decoded_msg = self.dcs_decode(completed['message'],
-                                          pdu_params['data_coding'])
-            # and we can finally pass the whole message on
-            yield self.handle_short_message_content(
-                source_addr=completed['from_msisdn'],
-                destination_addr=completed['to_msisdn'],
-                short_message=decoded_msg)
-        else:
-            yield self.save_multipart_message(redis_key, multi)
+        result = yield self.redis.run_script(
+            ADD_MULTIPART_PART_SCRIPT,
+            [redis_key, MULTIPART_PENDING_KEY], [
+                part['part_number'],
+                part['part_message'] or '',
+                part['total_number'],
+                self.config.multipart_expiry,
+                repr(self.transport.clock.seconds()),
+            ])
+        added, expired, parts = result[0], result[1], result[2:]
+        self.update_multipart_stats(redis_key, added, expired)
+        if not parts:
+            return
+
+        self.multipart_stats['completed'] += 1
+        parts = sorted(
+            (int(number), message)
+            for number, message in zip(parts[::2], parts[1::2]))
+        message = ''.join(message for _number, message in parts)
+        self.log.msg("Reassembled Message: %s" % (message,))
+        # We assume that all parts have the same data_coding here, because
+        # otherwise there's nothing sensible we can do.
+        decoded_msg = self.dcs_decode(message, pdu_params['data_coding'])
+        # and we can finally pass the whole message on
+        yield self.handle_short_message_content(
+            source_addr=part['from_msisdn'],
+            destination_addr=part['to_msisdn'],
+            short_message=decoded_msg)
+
+    def update_multipart_stats(self, redis_key, added, expired):
+        self.multipart_stats['parts'] += 1
+        if not added:
+            self.multipart_stats['duplicates'] += 1
+            self.log.warning(
+                "Duplicate multipart message part ignored: %s" % (
+                    redis_key,))
+        if expired:
+            self.multipart_stats['expired'] += expired
+            self.log.warning(
+                "%s incomplete multipart messages expired." % (expired,))
 
     def handle_ussd_pdu(self, pdu):
         pdu_params = pdu['body']['mandatory_parameters']
@@ -428,27 +522,6 @@ class DeliverShortMessageProcessor(object):
             session_event=session_event,
             session_info=session_info)
 
-    def _hex_for_redis(self, data_dict):
-        for index, part in data_dict.items():
-            part['part_message'] = part['part_message'].encode('hex')
-        return data_dict
-
-    def _unhex_from_redis(self, data_dict):
-        for index, part in data_dict.items():
-            part['part_message'] = part['part_message'].decode('hex')
-        return data_dict
-
-    @inlineCallbacks
-    def load_multipart_message(self, redis_key):
-        value = yield self.redis.get(redis_key)
-        value = json.loads(value) if value else {}
-        self.log.debug("Retrieved value: %s" % (repr(value)))
-        returnValue(MultipartMessage(self._unhex_from_redis(value)))
-
-    def save_multipart_message(self, redis_key, multipart_message):
-        data_dict = self._hex_for_redis(multipart_message.get_array())
-        return self.redis.set(redis_key, json.dumps(data_dict))
-
 
 class SubmitShortMessageProcessorConfig(Config):
     submit_sm_encoding = ConfigText(
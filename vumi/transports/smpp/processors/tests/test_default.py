@@ -1,11 +1,16 @@
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
 from twisted.internet.task import Clock
 from twisted.trial.unittest import FailTest
 
+from smpp.pdu import unpack_pdu
+from smpp.pdu_builder import DeliverSM
+
 from vumi.errors import ConfigError
 from vumi.tests.helpers import VumiTestCase
 from vumi.transports.tests.helpers import TransportHelper
 from vumi.transports.smpp.pdu_utils import unpacked_pdu_opts
+from vumi.transports.smpp.processors.default import (
+    multipart_parts_key, MULTIPART_PENDING_KEY)
 from vumi.transports.smpp.smpp_transport import SmppTransceiverTransport
 from vumi.transports.smpp.tests.fake_smsc import FakeSMSC
 
@@ -100,3 +105,99 @@ class DefaultProcessorTestCase(VumiTestCase):
 
         msg_refs = [unpacked_pdu_opts(p)['sar_msg_ref_num'] for p in pdus]
         self.assertEqual(msg_refs, [1, 1])
+
+
+class DeliverShortMessageProcessorMultipartTestCase(VumiTestCase):
+    def setUp(self):
+        self.fake_smsc = FakeSMSC()
+        self.tx_helper = self.add_helper(
+            TransportHelper(SmppTransceiverTransport))
+        self.clock = Clock()
+
+    @inlineCallbacks
+    def get_processor(self, processor_config={}):
+        config = {
+            'system_id': 'foo',
+            'password': 'bar',
+            'twisted_endpoint': self.fake_smsc.endpoint,
+            'deliver_short_message_processor_config': processor_config,
+        }
+        transport = yield self.tx_helper.get_transport(config, start=False)
+        transport.clock = self.clock
+        yield transport.startWorker()
+        returnValue(transport.deliver_sm_processor)
+
+    def make_part(self, ref_num, total, part_num, text, source_addr='123'):
+        udh = '\x05\x00\x03%s%s%s' % (chr(ref_num), chr(total), chr(part_num))
+        pdu = DeliverSM(
+            sequence_number=part_num, short_message=udh + text,
+            source_addr=source_addr, destination_addr='456')
+        return unpack_pdu(pdu.get_bin())
+
+    def parts_key(self, ref_num, total, source_addr='123'):
+        return multipart_parts_key(
+            '%s_456_%s_%s' % (source_addr, ref_num, total))
+
+    @inlineCallbacks
+    def test_parts_stored_in_hash(self):
+        processor = yield self.get_processor({'multipart_expiry': 100})
+        handled = yield processor.handle_multipart_pdu(
+            self.make_part(1, 2, 1, 'back'))
+        self.assertTrue(handled)
+        key = self.parts_key(1, 2)
+        self.assertEqual((yield processor.redis.hgetall(key)), {'1': 'back'})
+        ttl = yield processor.redis.ttl(key)
+        self.assertTrue(0 < ttl <= 100)
+        pending = yield processor.redis.zrange(MULTIPART_PENDING_KEY, 0, -1)
+        self.assertEqual(pending, [processor.redis._key(key)])
+
+        yield processor.handle_multipart_pdu(self.make_part(1, 2, 2, ' at'))
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], u'back at')
+        self.assertEqual(msg['from_addr'], '123')
+        self.assertEqual(msg['to_addr'], '456')
+        self.assertEqual((yield processor.redis.exists(key)), False)
+        pending = yield processor.redis.zrange(MULTIPART_PENDING_KEY, 0, -1)
+        self.assertEqual(pending, [])
+
+    @inlineCallbacks
+    def test_concurrent_parts(self):
+        processor = yield self.get_processor()
+        yield gatherResults([
+            processor.handle_multipart_pdu(self.make_part(1, 3, 3, ' you')),
+            processor.handle_multipart_pdu(self.make_part(1, 3, 1, 'back')),
+            processor.handle_multipart_pdu(self.make_part(1, 3, 2, ' at')),
+        ])
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], u'back at you')
+        self.assertEqual(processor.multipart_stats['completed'], 1)
+
+    @inlineCallbacks
+    def test_duplicate_part(self):
+        processor = yield self.get_processor()
+        yield processor.handle_multipart_pdu(self.make_part(1, 2, 1, 'back'))
+        yield processor.handle_multipart_pdu(self.make_part(1, 2, 1, 'bak'))
+        self.assertEqual(self.tx_helper.get_dispatched_inbound(), [])
+        yield processor.handle_multipart_pdu(self.make_part(1, 2, 2, ' at'))
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(msg['content'], u'back at')
+        self.assertEqual(processor.multipart_stats, {
+            'parts': 3,
+            'duplicates': 1,
+            'completed': 1,
+            'expired': 0,
+        })
+
+    @inlineCallbacks
+    def test_expired_parts_counted(self):
+        processor = yield self.get_processor({'multipart_expiry': 10})
+        yield processor.handle_multipart_pdu(self.make_part(1, 2, 1, 'back'))
+        yield processor.handle_multipart_pdu(self.make_part(2, 2, 1, 'back'))
+        self.clock.advance(5)
+        yield processor.handle_multipart_pdu(self.make_part(3, 2, 1, 'back'))
+        self.assertEqual(processor.multipart_stats['expired'], 0)
+        self.clock.advance(5)
+        yield processor.handle_multipart_pdu(self.make_part(4, 2, 1, 'back'))
+        self.assertEqual(processor.multipart_stats['expired'], 2)
+        pending = yield processor.redis.zrange(MULTIPART_PENDING_KEY, 0, -1)
+        self.assertEqual(len(pending), 2)
@@ -1,11 +1,13 @@
 # -*- test-case-name: vumi.transports.smpp.tests.test_protocol -*-
 
+from collections import deque
 from functools import wraps
 
 from twisted.internet.protocol import Protocol, ClientFactory
 from twisted.internet.task import LoopingCall
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, maybeDeferred, DeferredQueue, succeed)
+    inlineCallbacks, returnValue, maybeDeferred, DeferredQueue, succeed,
+    Deferred)
 
 from smpp.pdu import unpack_pdu
 from smpp.pdu_builder import (
@@ -32,6 +34,129 @@ class EsmeProtocolError(Exception):
     pass
 
 
+class SubmitSmWindow(object):
+    """
+    Limit the number of ``submit_sm`` PDUs awaiting a ``submit_sm_resp``.
+
+    Senders call :meth:`acquire` before sending a PDU and wait for the
+    returned deferred if the window is full. Slots are released when the
+    response arrives or, if it never does, after ``resp_timeout`` seconds.
+    The time taken for each response is also tracked.
+
+    :param int size:
+        The maximum number of unacknowledged PDUs, or ``0`` for no limit.
+    :param int resp_timeout:
+        The number of seconds after which we give up on a response.
+    """
+
+    LATENCY_SMOOTHING = 0.1
+
+    def __init__(self, size, resp_timeout, clock, log):
+        self.size = size
+        self.resp_timeout = resp_timeout
+        self.clock = clock
+        self.log = log
+        self.slots_used = 0
+        self._waiters = deque()
+        self._in_flight = {}
+        self.resp_count = 0
+        self.timeout_count = 0
+        self.latency_avg = None
+        self.latency_max = None
+
+    def is_full(self):
+        return self.size > 0 and self.slots_used >= self.size
+
+    def acquire(self):
+        """
+        Reserve a slot in the window. Returns a deferred that fires once the
+        slot is ours.
+        """
+        if not self.is_full():
+            self.slots_used += 1
+            return succeed(None)
+        d = Deferred()
+        self._waiters.append(d)
+        return d
+
+    def release(self):
+        """
+        Give up a slot, passing it on to the next waiting sender if there is
+        one.
+        """
+        if self._waiters:
+            self._waiters.popleft().callback(None)
+        elif self.slots_used > 0:
+            self.slots_used -= 1
+
+    def sent(self, sequence_number):
+        """
+        Record that the PDU for a slot we hold has been sent.
+        """
+        timeout_call = self.clock.callLater(
+            self.resp_timeout, self._timed_out, sequence_number)
+        self._in_flight[sequence_number] = (
+            self.clock.seconds(), timeout_call)
+
+    def responded(self, sequence_number):
+        """
+        Record a response, freeing the slot held by the PDU it's for.
+        """
+        entry = self._in_flight.pop(sequence_number, None)
+        if entry is None:
+            # This PDU was sent on an earlier connection or already timed
+            # out, so it doesn't hold a slot.
+            return
+        sent_at, timeout_call = entry
+        timeout_call.cancel()
+        self._record_latency(self.clock.seconds() - sent_at)
+        self.release()
+
+    def _record_latency(self, latency):
+        self.resp_count += 1
+        if self.latency_avg is None:
+            self.latency_avg = latency
+        else:
+            self.latency_avg += (
+                self.LATENCY_SMOOTHING * (latency - self.latency_avg))
+        self.latency_max = max(self.latency_max, latency)
+
+    def _timed_out(self, sequence_number):
+        if self._in_flight.pop(sequence_number, None) is None:
+            return
+        self.timeout_count += 1
+        self.log.warning(
+            "No submit_sm_resp for sequence number %s after %s seconds,"
+            " releasing its window slot." % (
+                sequence_number, self.resp_timeout))
+        self.release()
+
+    def close(self):
+        """
+        Forget everything in flight and fail all waiting senders. Called when
+        the connection is lost.
+        """
+        for _sent_at, timeout_call in self._in_flight.values():
+            timeout_call.cancel()
+        self._in_flight.clear()
+        self.slots_used = 0
+        waiters, self._waiters = self._waiters, deque()
+        for d in waiters:
+            d.errback(EsmeProtocolError(
+                'Connection lost while waiting to submit_sm.'))
+
+    def stats(self):
+        return {
+            'window_size': self.size,
+            'in_flight': len(self._in_flight),
+            'queued': len(self._waiters),
+            'resp_count': self.resp_count,
+            'timeout_count': self.timeout_count,
+            'latency_avg': self.latency_avg,
+            'latency_max': self.latency_max,
+        }
+
+
 class EsmeProtocol(Protocol):
 
     noisy = True
@@ -78,6 +203,9 @@ class EsmeProtocol(Protocol):
         self.idle_timeout = self.config.smpp_enquire_link_interval * 2
         self.disconnect_call = None
         self.unbind_resp_queue = DeferredQueue()
+        self.submit_sm_window = SubmitSmWindow(
+            self.config.submit_sm_window, self.config.submit_sm_resp_timeout,
+            self.clock, self.log)
 
     def emit(self, msg):
         if self.noisy:
@@ -184,6 +312,7 @@ class EsmeProtocol(Protocol):
             ``ConnectionDone``
         """
         self.state = self.CLOSED_STATE
+        self.submit_sm_window.close()
         if self.enquire_link_call.running:
             self.enquire_link_call.stop()
         if self.drop_link_call is not None and self.drop_link_call.active():
@@ -301,6 +430,7 @@ class EsmeProtocol(Protocol):
         return self.send_pdu(UnbindResp(seq_no(pdu)))
 
     def handle_submit_sm_resp(self, pdu):
+        self.submit_sm_window.responded(seq_no(pdu))
         return self.on_submit_sm_resp(
             seq_no(pdu), message_id(pdu), command_status(pdu))
 
@@ -527,9 +657,21 @@ class EsmeProtocol(Protocol):
 
     @inlineCallbacks
     def send_submit_sm(self, vumi_message_id, pdu):
-        yield self.service.message_stash.cache_pdu(vumi_message_id, pdu)
-        yield self.service.message_stash.set_sequence_number_message_id(
-            seq_no(pdu.obj), vumi_message_id)
+        # If too many PDUs are waiting for responses, we wait here for a slot
+        # in the window.
+        yield self.submit_sm_window.acquire()
+        if not self.is_bound():
+            # We lost the bind while waiting.
+            self.submit_sm_window.release()
+            raise EsmeProtocolError('submit_sm called in unbound state.')
+        try:
+            yield self.service.message_stash.cache_pdu(vumi_message_id, pdu)
+            yield self.service.message_stash.set_sequence_number_message_id(
+                seq_no(pdu.obj), vumi_message_id)
+        except Exception:
+            self.submit_sm_window.release()
+            raise
+        self.submit_sm_window.sent(seq_no(pdu.obj))
         self.send_pdu(pdu)
 
     @require_bind
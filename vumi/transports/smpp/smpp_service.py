@@ -1,10 +1,10 @@
 from twisted.internet.defer import inlineCallbacks, returnValue, succeed
-from twisted.internet.task import LoopingCall
 
 from vumi.reconnecting_client import ReconnectingClientService
 from vumi.transports.smpp.protocol import (
     EsmeProtocol, EsmeProtocolFactory, EsmeProtocolError)
 from vumi.transports.smpp.sequence import RedisSequence
+from vumi.utils import TokenBucket
 
 
 GSM_MAX_SMS_BYTES = 140
@@ -17,6 +17,7 @@ class SmppService(ReconnectingClientService):
 
     def __init__(self, endpoint, bind_type, transport):
         self.transport = transport
+        self.bind_type = bind_type
         self.transport_name = transport.transport_name
         self.log = transport.log
         self.message_stash = self.transport.message_stash
@@ -29,12 +30,11 @@ class SmppService(ReconnectingClientService):
         self._throttled_pdus = []
         self._unthrottle_delayedCall = None
 
-        self.tps_counter = 0
+        # The token bucket is created when we start so that it uses the
+        # right clock.
         self.tps_limit = self.get_config().mt_tps
-        if self.tps_limit > 0:
-            self.mt_tps_lc = LoopingCall(self.reset_mt_tps)
-        else:
-            self.mt_tps_lc = None
+        self.tps_bucket = None
+        self._tps_delayedCall = None
 
         # Connection setup.
         factory = EsmeProtocolFactory(self, bind_type)
@@ -53,15 +53,25 @@ class SmppService(ReconnectingClientService):
             return self._protocol.is_bound()
         return False
 
+    def get_window_stats(self):
+        """
+        Return the ``submit_sm`` window statistics for the current connection,
+        or ``None`` if we aren't connected.
+        """
+        if self._protocol is None:
+            return None
+        return self._protocol.submit_sm_window.stats()
+
     def startService(self):
-        if self.mt_tps_lc is not None:
-            self.mt_tps_lc.clock = self.clock
-            self.mt_tps_lc.start(1, now=True)
+        if self.tps_limit > 0:
+            self.tps_bucket = TokenBucket(self.tps_limit, clock=self.clock)
         return ReconnectingClientService.startService(self)
 
     def stopService(self):
-        if self.mt_tps_lc and self.mt_tps_lc.running:
-            self.mt_tps_lc.stop()
+        if self._tps_delayedCall is not None:
+            if self._tps_delayedCall.active():
+                self._tps_delayedCall.cancel()
+            self._tps_delayedCall = None
         d = succeed(None)
         if self._protocol is not None:
             d.addCallback(lambda _: self._protocol.disconnect())
@@ -71,33 +81,48 @@ class SmppService(ReconnectingClientService):
     def get_config(self):
         return self.transport.get_static_config()
 
-    @inlineCallbacks
-    def reset_mt_tps(self):
-        if self.throttled and self.need_mt_throttling():
-            if not self.is_bound():
-                # We don't have a bound SMPP connection, so try again later.
-                self.log.msg(
-                    "Can't stop throttling while unbound, trying later.")
-                return
-            self.reset_mt_throttle_counter()
-            yield self.stop_throttling()
-
-    def reset_mt_throttle_counter(self):
-        self.tps_counter = 0
-
-    def incr_mt_throttle_counter(self):
-        self.tps_counter += 1
-
-    def need_mt_throttling(self):
-        return self.tps_counter >= self.tps_limit
-
     def check_mt_throttling(self):
-        if self.get_config().mt_tps > 0:
-            self.incr_mt_throttle_counter()
-            if self.need_mt_throttling():
-                # We can't yield here, because we need the current message to
-                # finish sending before it will return.
-                self.start_throttling()
+        if self.tps_bucket is None:
+            return
+        self.tps_bucket.take()
+        if self.tps_bucket.delay() > 0:
+            # We can't yield here, because we need the current message to
+            # finish sending before it will return.
+            self.start_throttling()
+            self.check_stop_tps_throttling()
+
+    def check_stop_tps_throttling(self, delay=None):
+        if self._tps_delayedCall is not None:
+            # We already have one of these scheduled.
+            return
+        if delay is None:
+            delay = self.tps_bucket.delay()
+        self._tps_delayedCall = self.clock.callLater(
+            delay, self._check_stop_tps_throttling)
+
+    @inlineCallbacks
+    def _check_stop_tps_throttling(self):
+        """
+        Stop throttling once the token bucket has refilled enough for us to
+        send again.
+        """
+        self._tps_delayedCall = None
+        if not self.throttled:
+            return
+        if not self.is_bound():
+            # We don't have a bound SMPP connection, so try again later.
+            self.log.msg("Can't stop throttling while unbound, trying later.")
+            self.check_stop_tps_throttling(1)
+            return
+        delay = self.tps_bucket.delay()
+        if delay > 0:
+            self.check_stop_tps_throttling(delay)
+            return
+        if self._throttled_pdus:
+            # The SMSC is throttling us too, so we leave it to the throttled
+            # message retries to stop throttling.
+            return
+        yield self.stop_throttling()
 
     def _append_throttle_retry(self, seq_no):
         if seq_no not in self._throttled_pdus:
@@ -147,6 +172,13 @@ class SmppService(ReconnectingClientService):
             return
 
         if not self._throttled_pdus:
+            if self.tps_bucket is not None:
+                delay = self.tps_bucket.delay()
+                if delay > 0:
+                    # We're still over our TPS limit, so we leave it to the
+                    # TPS check to stop throttling.
+                    self.check_stop_tps_throttling(delay)
+                    return
             # We have no throttled messages waiting, so stop throttling.
             self.log.msg("No more throttled messages to retry.")
             yield self.stop_throttling()
@@ -181,7 +213,7 @@ class SmppService(ReconnectingClientService):
             return
         self.log.msg("Throttling outbound messages.")
         self.throttled = True
-        yield self.transport.pause_connectors()
+        yield self.transport.on_bind_unavailable(self)
         yield self.transport.on_throttled()
 
     @inlineCallbacks
@@ -190,12 +222,12 @@ class SmppService(ReconnectingClientService):
             return
         self.log.msg("No longer throttling outbound messages.")
         self.throttled = False
-        self.transport.unpause_connectors()
+        yield self.transport.on_bind_available(self)
         yield self.transport.on_throttled_end()
 
     @inlineCallbacks
     def on_smpp_bind(self):
-        self.transport.unpause_connectors()
+        yield self.transport.on_bind_available(self)
         yield self.transport.on_smpp_bind()
 
     @inlineCallbacks
@@ -212,7 +244,7 @@ class SmppService(ReconnectingClientService):
 
     @inlineCallbacks
     def on_connection_lost(self, reason):
-        yield self.transport.pause_connectors()
+        yield self.transport.on_bind_unavailable(self)
         yield self.transport.on_connection_lost(reason)
 
     def handle_submit_sm_resp(self, message_id, smpp_id, pdu_status, seq_no):
@@ -253,11 +253,12 @@ class SmppTransceiverTransport(Transport):
     clock = reactor
     start_message_consumer = False
     service = None
+    services = ()
     redis = None
 
     @property
     def throttled(self):
-        return self.service.throttled
+        return all(service.throttled for service in self._outbound_services)
 
     @inlineCallbacks
     def setup_transport(self):
@@ -282,19 +283,40 @@ class SmppTransceiverTransport(Transport):
         self.disable_ack = config.disable_ack
         self.disable_delivery_report = config.disable_delivery_report
         self.message_stash = SmppMessageDataStash(self.redis, config)
-        self.service = self.start_service()
 
-    def start_service(self):
-        config = self.get_static_config()
-        service = SmppService(config.twisted_endpoint, self.bind_type, self)
+        # All the binds in the pool share the Redis prefix (and therefore the
+        # sequence numbers and message stash), so responses and delivery
+        # reports are matched up no matter which bind they arrive on.
+        bind_types = config.bind_pool or [self.bind_type]
+        self.services = [
+            self.start_service(bind_type, index)
+            for index, bind_type in enumerate(bind_types)]
+        self.service = self.services[0]
+        self._outbound_services = [
+            service for service in self.services
+            if service.bind_type != 'RX'] or self.services
+        self._next_outbound_index = 0
+
+    def get_bind_endpoint(self, index):
+        """
+        Return the endpoint for the bind at position ``index`` in the bind
+        pool. All binds connect to the configured endpoint by default.
+        """
+        return self.get_static_config().twisted_endpoint
+
+    def start_service(self, bind_type=None, index=0):
+        if bind_type is None:
+            bind_type = self.bind_type
+        service = SmppService(
+            self.get_bind_endpoint(index), bind_type, self)
         service.clock = self.clock
         service.startService()
         return service
 
     @inlineCallbacks
     def teardown_transport(self):
-        if self.service:
-            yield self.service.stopService()
+        for service in self.services:
+            yield service.stopService()
         if self.redis:
             yield self.redis._close()
 
@@ -309,6 +331,44 @@ class SmppTransceiverTransport(Transport):
         return self.publish_nack(
             message['message_id'], u'Invalid %s: %s' % (field, message[field]))
 
+    def _can_send(self, service):
+        return service.is_bound() and not service.throttled
+
+    def has_outbound_capacity(self):
+        return any(self._can_send(s) for s in self._outbound_services)
+
+    def get_outbound_service(self):
+        """
+        Return the next bound and unthrottled transmitting bind, in round
+        robin order, or ``None`` if there aren't any.
+        """
+        services = self._outbound_services
+        for i in range(len(services)):
+            index = (self._next_outbound_index + i) % len(services)
+            service = services[index]
+            if self._can_send(service):
+                self._next_outbound_index = (index + 1) % len(services)
+                return service
+        return None
+
+    def on_bind_available(self, service):
+        """
+        Called when a bind becomes available for sending, either because it
+        has bound or because it is no longer throttled.
+        """
+        if service in self._outbound_services or self.has_outbound_capacity():
+            self.unpause_connectors()
+
+    def on_bind_unavailable(self, service):
+        """
+        Called when a bind can no longer send, either because it has lost
+        its connection or because it is throttled. We only stop consuming
+        outbound messages once none of the binds in the pool can send.
+        """
+        if not self.has_outbound_capacity():
+            return self.pause_connectors()
+        return succeed(None)
+
     @inlineCallbacks
     def on_smpp_binding(self):
         yield self.publish_status_binding()
@@ -326,7 +386,9 @@ class SmppTransceiverTransport(Transport):
 
     @inlineCallbacks
     def on_throttled(self):
-        yield self.publish_throttled()
+        # With a bind pool we're only throttled once all the binds are.
+        if self.throttled:
+            yield self.publish_throttled()
 
     @inlineCallbacks
     def on_throttled_resume(self):
@@ -334,7 +396,12 @@ class SmppTransceiverTransport(Transport):
 
     @inlineCallbacks
     def on_throttled_end(self):
-        yield self.publish_throttled_end()
+        unthrottled = [
+            service for service in self._outbound_services
+            if not service.throttled]
+        if len(unthrottled) == 1:
+            # This is the first bind to stop throttling.
+            yield self.publish_throttled_end()
 
     @inlineCallbacks
     def on_smpp_bind_timeout(self):
@@ -409,8 +476,11 @@ class SmppTransceiverTransport(Transport):
             yield self._reject_for_invalid_address(message, 'from_addr')
             return
         yield self.message_stash.cache_message(message)
+        # If no bind is available (we may have received a message while
+        # pausing), we use the first one and let it fail or throttle.
+        service = self.get_outbound_service() or self._outbound_services[0]
         yield self.submit_sm_processor.handle_outbound_message(
-            message, self.service)
+            message, service)
 
     @inlineCallbacks
     def process_submit_sm_event(self, message_id, event_type, remote_id,
@@ -9,7 +9,7 @@ from vumi.tests.helpers import VumiTestCase, PersistenceHelper
 from vumi.transports.smpp.smpp_transport import (
     SmppTransceiverTransport, SmppMessageDataStash)
 from vumi.transports.smpp.protocol import (
-    EsmeProtocol, EsmeProtocolFactory)
+    EsmeProtocol, EsmeProtocolFactory, EsmeProtocolError, SubmitSmWindow)
 from vumi.transports.smpp.pdu_utils import (
     seq_no, command_status, command_id, short_message)
 from vumi.transports.smpp.sequence import RedisSequence
@@ -280,6 +280,61 @@ class TestEsmeProtocol(VumiTestCase):
         stored_ids = yield self.lookup_message_ids(protocol, seq_nums)
         self.assertEqual(['abc123'], stored_ids)
 
+    @inlineCallbacks
+    def test_submit_sm_window(self):
+        protocol = yield self.get_protocol({'submit_sm_window': 2})
+        yield self.fake_smsc.bind()
+        protocol.on_submit_sm_resp = lambda *a: None
+        yield protocol.submit_sm('abc1', 'dest_addr', short_message='foo1')
+        yield protocol.submit_sm('abc2', 'dest_addr', short_message='foo2')
+        submit_d = protocol.submit_sm(
+            'abc3', 'dest_addr', short_message='foo3')
+        [pdu1, pdu2] = yield self.fake_smsc.await_pdus(2)
+        self.assertNoResult(submit_d)
+        self.assertEqual(self.fake_smsc.waiting_pdu_count(), 0)
+
+        self.clock.advance(0.5)
+        yield self.fake_smsc.send_pdu(
+            SubmitSMResp(seq_no(pdu1), message_id='foo'))
+        yield submit_d
+        pdu3 = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(pdu3), 'foo3')
+        stats = protocol.submit_sm_window.stats()
+        self.assertEqual(stats['in_flight'], 2)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['resp_count'], 1)
+        self.assertEqual(stats['latency_avg'], 0.5)
+
+    @inlineCallbacks
+    def test_submit_sm_window_resp_timeout(self):
+        protocol = yield self.get_protocol({
+            'submit_sm_window': 1,
+            'submit_sm_resp_timeout': 10,
+        })
+        yield self.fake_smsc.bind()
+        yield protocol.submit_sm('abc1', 'dest_addr', short_message='foo1')
+        submit_d = protocol.submit_sm(
+            'abc2', 'dest_addr', short_message='foo2')
+        yield self.fake_smsc.await_pdu()
+        self.assertNoResult(submit_d)
+        self.clock.advance(10)
+        yield submit_d
+        pdu2 = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(pdu2), 'foo2')
+        self.assertEqual(protocol.submit_sm_window.timeout_count, 1)
+
+    @inlineCallbacks
+    def test_submit_sm_window_connection_lost(self):
+        protocol = yield self.get_protocol({'submit_sm_window': 1})
+        yield self.fake_smsc.bind()
+        yield protocol.submit_sm('abc1', 'dest_addr', short_message='foo1')
+        submit_d = protocol.submit_sm(
+            'abc2', 'dest_addr', short_message='foo2')
+        yield self.fake_smsc.await_pdu()
+        yield self.fake_smsc.disconnect()
+        yield self.assertFailure(submit_d, EsmeProtocolError)
+        self.assertEqual(protocol.submit_sm_window.stats()['in_flight'], 0)
+
     @inlineCallbacks
     def test_submit_sm_configured_parameters(self):
         protocol = yield self.get_protocol({
@@ -373,3 +428,63 @@ class TestEsmeProtocol(VumiTestCase):
         }
         protocol.on_pdu(invalid_pdu)
         self.assertEqual(calls, [invalid_pdu])
+
+
+class TestSubmitSmWindow(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.window = SubmitSmWindow(2, 10, self.clock, WrappingLogger())
+
+    def test_acquire_and_release(self):
+        d1 = self.window.acquire()
+        d2 = self.window.acquire()
+        d3 = self.window.acquire()
+        self.assertTrue(d1.called)
+        self.assertTrue(d2.called)
+        self.assertFalse(d3.called)
+        self.assertTrue(self.window.is_full())
+        self.window.release()
+        self.assertTrue(d3.called)
+        self.assertEqual(self.window.slots_used, 2)
+        self.window.release()
+        self.assertEqual(self.window.slots_used, 1)
+
+    def test_unlimited(self):
+        window = SubmitSmWindow(0, 10, self.clock, WrappingLogger())
+        for i in range(100):
+            self.assertTrue(window.acquire().called)
+        self.assertFalse(window.is_full())
+
+    def test_latency(self):
+        for sequence_number in [1, 2]:
+            self.window.acquire()
+            self.window.sent(sequence_number)
+        self.clock.advance(1)
+        self.window.responded(1)
+        self.clock.advance(1)
+        self.window.responded(2)
+        stats = self.window.stats()
+        self.assertEqual(stats['resp_count'], 2)
+        self.assertEqual(stats['latency_max'], 2)
+        self.assertEqual(stats['latency_avg'], 1.1)
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertEqual(self.window.slots_used, 0)
+
+    def test_unknown_response(self):
+        self.window.acquire()
+        self.window.sent(1)
+        self.window.responded(7)
+        self.assertEqual(self.window.slots_used, 1)
+        self.assertEqual(self.window.resp_count, 0)
+
+    def test_timeout(self):
+        self.window.acquire()
+        self.window.sent(1)
+        self.clock.advance(10)
+        self.assertEqual(self.window.slots_used, 0)
+        self.assertEqual(self.window.timeout_count, 1)
+        # A late response is ignored.
+        self.window.responded(1)
+        self.assertEqual(self.window.slots_used, 0)
+        self.assertEqual(self.window.resp_count, 0)
@@ -47,6 +47,12 @@ class DummySmppTransport(object):
     def unpause_connectors(self):
         self.paused = False
 
+    def on_bind_available(self, service):
+        self.unpause_connectors()
+
+    def on_bind_unavailable(self, service):
+        self.pause_connectors()
+
     def on_smpp_binding(self):
         pass
 
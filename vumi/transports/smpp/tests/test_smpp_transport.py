@@ -1038,6 +1038,56 @@ class SmppTransceiverTransportTestCase(SmppTransportTestCase):
         self.assertEqual(short_message(pdu3_1)[-5:], '33333')
         self.assertEqual(short_message(pdu3_2)[-5:], '3333c')
 
+    @inlineCallbacks
+    def test_mt_sms_tps_limits_smooth(self):
+        """
+        TPS throttling ends as soon as there's capacity to send again rather
+        than at the end of the second.
+        """
+        transport = yield self.get_transport({'mt_tps': 4})
+        for i in range(4):
+            yield self.tx_helper.make_dispatch_outbound('hello %s' % (i,))
+        self.assertTrue(transport.throttled)
+        yield self.fake_smsc.await_pdus(4)
+
+        self.clock.advance(0.2)
+        self.assertTrue(transport.throttled)
+        self.clock.advance(0.05)
+        self.assertFalse(transport.throttled)
+        yield self.tx_helper.make_dispatch_outbound('hello 4')
+        self.assertTrue(transport.throttled)
+        submit_sm_pdu = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(submit_sm_pdu), 'hello 4')
+
+    @inlineCallbacks
+    def test_mt_sms_submit_sm_resp_while_tps_throttled(self):
+        """
+        A successful submit_sm_resp doesn't stop TPS throttling before the
+        token bucket has refilled.
+        """
+        transport = yield self.get_transport({'mt_tps': 2})
+        msg1 = yield self.tx_helper.make_dispatch_outbound('hello world 1')
+        yield self.tx_helper.make_dispatch_outbound('hello world 2')
+        msg3_d = self.tx_helper.make_dispatch_outbound('hello world 3')
+        self.assertTrue(transport.throttled)
+        [submit_sm_pdu1, _] = yield self.fake_smsc.await_pdus(2)
+
+        # We call the service directly so that the response has been fully
+        # handled before we check the throttling state.
+        yield transport.service.handle_submit_sm_resp(
+            msg1['message_id'], 'foo', 'ESME_ROK', seq_no(submit_sm_pdu1))
+        [event] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(event['event_type'], 'ack')
+        self.clock.advance(0)
+        self.assertTrue(transport.throttled)
+        self.assertNoResult(msg3_d)
+
+        self.clock.advance(1)
+        self.assertFalse(transport.throttled)
+        yield msg3_d
+        submit_sm_pdu3 = yield self.fake_smsc.await_pdu()
+        self.assertEqual(short_message(submit_sm_pdu3), 'hello world 3')
+
     @inlineCallbacks
     def test_mt_sms_reconnect_while_tps_throttled(self):
         """
@@ -2092,6 +2142,147 @@ class SmppTransceiverTransportWithOldConfigTestCase(
         return cfg
 
 
+class SmppBindPoolTestCase(SmppTransportTestCase):
+
+    transport_class = SmppTransceiverTransport
+
+    def setUp(self):
+        super(SmppBindPoolTestCase, self).setUp()
+        self.fake_smscs = [self.fake_smsc, FakeSMSC(), FakeSMSC()]
+        self.patch(
+            self.transport_class, 'get_bind_endpoint',
+            lambda transport, index: self.fake_smscs[index].endpoint)
+
+    @inlineCallbacks
+    def get_pool_transport(self, bind_pool, config={}):
+        cfg = {'bind_pool': bind_pool}
+        cfg.update(config)
+        transport = yield self.get_transport(cfg, bind=False)
+        for fake_smsc in self.fake_smscs[:len(bind_pool)]:
+            yield fake_smsc.bind()
+        returnValue(transport)
+
+    def test_invalid_bind_type(self):
+        config = self._get_transport_config({'bind_pool': ['TRX', 'FOO']})
+        self.assertRaises(
+            ConfigError, self.transport_class.CONFIG_CLASS, config,
+            static=True)
+
+    @inlineCallbacks
+    def test_bind_types(self):
+        transport = yield self.get_transport(
+            {'bind_pool': ['TRX', 'TX', 'RX']}, bind=False)
+        self.assertEqual(
+            [service.bind_type for service in transport.services],
+            ['TRX', 'TX', 'RX'])
+        self.assertEqual(transport.service, transport.services[0])
+        bind_pdus = []
+        for fake_smsc in self.fake_smscs:
+            bind_pdus.append((yield fake_smsc.await_pdu()))
+        self.assertEqual([command_id(pdu) for pdu in bind_pdus], [
+            'bind_transceiver', 'bind_transmitter', 'bind_receiver'])
+
+    @inlineCallbacks
+    def test_outbound_balanced_across_binds(self):
+        yield self.get_pool_transport(['TRX', 'TX', 'RX'])
+        for i in range(4):
+            yield self.tx_helper.make_dispatch_outbound('hello %s' % (i,))
+        [pdu1, pdu3] = yield self.fake_smscs[0].await_pdus(2)
+        [pdu2, pdu4] = yield self.fake_smscs[1].await_pdus(2)
+        self.assertEqual(
+            [short_message(pdu) for pdu in [pdu1, pdu2, pdu3, pdu4]],
+            ['hello 0', 'hello 1', 'hello 2', 'hello 3'])
+        # Nothing is sent over the receiver bind.
+        self.assertEqual(self.fake_smscs[2].waiting_pdu_count(), 0)
+        # Sequence numbers are shared across the pool.
+        self.assertEqual(
+            len(set(seq_no(pdu) for pdu in [pdu1, pdu2, pdu3, pdu4])), 4)
+
+    @inlineCallbacks
+    def test_unbound_bind_skipped(self):
+        transport = yield self.get_transport(
+            {'bind_pool': ['TRX', 'TRX']}, bind=False)
+        yield self.fake_smscs[1].bind()
+        self.assertFalse(transport.services[0].is_bound())
+        for i in range(2):
+            yield self.tx_helper.make_dispatch_outbound('hello %s' % (i,))
+        pdus = yield self.fake_smscs[1].await_pdus(2)
+        self.assertEqual(
+            [short_message(pdu) for pdu in pdus], ['hello 0', 'hello 1'])
+
+    @inlineCallbacks
+    def test_delivery_report_on_other_bind(self):
+        yield self.get_pool_transport(['TX', 'RX'])
+        msg = yield self.tx_helper.make_dispatch_outbound('hello world')
+        submit_sm_pdu = yield self.fake_smscs[0].await_pdu()
+        self.fake_smscs[0].send_pdu(
+            SubmitSMResp(sequence_number=seq_no(submit_sm_pdu),
+                         message_id='foo'))
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['event_type'], 'ack')
+        self.tx_helper.clear_dispatched_events()
+
+        pdu = DeliverSM(sequence_number=1, esm_class=4)
+        pdu.add_optional_parameter('receipted_message_id', 'foo')
+        pdu.add_optional_parameter('message_state', 2)
+        yield self.fake_smscs[1].handle_pdu(pdu)
+
+        [dr] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(dr['event_type'], 'delivery_report')
+        self.assertEqual(dr['user_message_id'], msg['message_id'])
+        self.assertEqual(dr['delivery_status'], 'delivered')
+
+    @inlineCallbacks
+    def test_throttled_bind_skipped(self):
+        transport = yield self.get_pool_transport(['TRX', 'TRX'])
+        yield self.tx_helper.make_dispatch_outbound('hello 0')
+        submit_sm_pdu = yield self.fake_smscs[0].await_pdu()
+        yield self.fake_smscs[0].handle_pdu(
+            SubmitSMResp(sequence_number=seq_no(submit_sm_pdu),
+                         message_id='foo',
+                         command_status='ESME_RTHROTTLED'))
+        self.assertTrue(transport.services[0].throttled)
+        self.assertFalse(transport.throttled)
+        connector = transport.connectors[transport.transport_name]
+        self.assertFalse(connector._consumers['outbound'].paused)
+
+        for i in range(1, 3):
+            yield self.tx_helper.make_dispatch_outbound('hello %s' % (i,))
+        pdus = yield self.fake_smscs[1].await_pdus(2)
+        self.assertEqual(
+            [short_message(pdu) for pdu in pdus], ['hello 1', 'hello 2'])
+        self.assertEqual(self.fake_smscs[0].waiting_pdu_count(), 0)
+
+    @inlineCallbacks
+    def test_all_binds_throttled(self):
+        transport = yield self.get_pool_transport(
+            ['TRX', 'TRX'], {'mt_tps': 1, 'publish_status': True})
+        self.tx_helper.clear_dispatched_statuses()
+        connector = transport.connectors[transport.transport_name]
+
+        yield self.tx_helper.make_dispatch_outbound('hello 0')
+        yield self.fake_smscs[0].await_pdu()
+        self.assertFalse(transport.throttled)
+        self.assertFalse(connector._consumers['outbound'].paused)
+        self.assertEqual(self.tx_helper.get_dispatched_statuses(), [])
+
+        yield self.tx_helper.make_dispatch_outbound('hello 1')
+        yield self.fake_smscs[1].await_pdu()
+        self.assertTrue(transport.throttled)
+        self.assertTrue(connector._consumers['outbound'].paused)
+        [status] = self.tx_helper.get_dispatched_statuses()
+        self.assertEqual(status['type'], 'throttled')
+        self.tx_helper.clear_dispatched_statuses()
+
+        # The per-bind TPS counters reset and both binds stop throttling,
+        # but we only report that once.
+        self.clock.advance(1)
+        self.assertFalse(transport.throttled)
+        self.assertFalse(connector._consumers['outbound'].paused)
+        [status] = yield self.tx_helper.wait_for_dispatched_statuses()
+        self.assertEqual(status['type'], 'throttled_end')
+
+
 class TataUssdSmppTransportTestCase(SmppTransportTestCase):
 
     transport_class = SmppTransceiverTransport
@@ -6,6 +6,7 @@ import sys
 import base64
 import pkg_resources
 import warnings
+from collections import OrderedDict
 from functools import wraps
 
 from zope.interface import implements
@@ -558,3 +559,177 @@ class StatusEdgeDetector(object):
             self._add_type(component, type_)
             return True
         return False
+
+
+class LRUCache(object):
+    """
+    A size-bounded cache that evicts the least recently used entries.
+
+    Entries can optionally expire a fixed number of seconds after they were
+    set. Hits, misses and evictions are counted so that callers can report
+    on how effective the cache is.
+
+    :param int max_size:
+        The maximum number of entries to keep.
+    :param float ttl:
+        The number of seconds an entry stays valid, or ``None`` if entries
+        should never expire.
+    :param clock:
+        An ``IReactorTime`` provider to use for expiry. Defaults to the
+        global reactor.
+    """
+
+    def __init__(self, max_size, ttl=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self._get_entry(key) is not None
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, _value = entry
+        if expires_at is not None and expires_at <= self.clock.seconds():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for ``key``, or ``default`` if there isn't
+        one.
+        """
+        entry = self._get_entry(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # Move this entry to the most recently used end.
+        del self._entries[key]
+        self._entries[key] = entry
+        return entry[1]
+
+    def set(self, key, value):
+        """
+        Cache ``value`` for ``key``, evicting old entries if necessary.
+        """
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = self.clock.seconds() + self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (expires_at, value)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        """
+        Remove ``key`` from the cache, returning its value if it had one.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """
+        Return a dict of cache statistics.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class TokenBucket(object):
+    """
+    A token bucket rate limiter.
+
+    Tokens are added continuously at ``rate`` per second, up to
+    ``capacity``. Taking tokens may leave the bucket in debt, which has to be
+    repaid before tokens are available again. This lets a caller finish
+    something it has started (for example, all the parts of a multipart
+    message) without exceeding the rate on average.
+
+    :param float rate:
+        The number of tokens added per second.
+    :param float capacity:
+        The maximum number of tokens the bucket holds, which limits the size
+        of bursts. Defaults to ``rate`` (one second's worth of tokens).
+    :param clock:
+        An ``IReactorTime`` provider. Defaults to the global reactor.
+    """
+
+    def __init__(self, rate, capacity=None, clock=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        if capacity is None:
+            capacity = rate
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._last_refill = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    @property
+    def tokens(self):
+        """
+        The number of tokens currently in the bucket. This is negative if
+        the bucket is in debt.
+        """
+        self._refill()
+        return self._tokens
+
+    def take(self, count=1):
+        """
+        Take ``count`` tokens from the bucket, whether or not they're
+        available.
+        """
+        self._refill()
+        self._tokens -= count
+
+    def try_take(self, count=1):
+        """
+        Take ``count`` tokens if they're available. Returns ``True`` if the
+        tokens were taken and ``False`` otherwise.
+        """
+        if self.tokens < count:
+            return False
+        self._tokens -= count
+        return True
+
+    def delay(self, count=1):
+        """
+        Return the number of seconds until ``count`` tokens are available.
+        """
+        missing = count - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
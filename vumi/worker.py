@@ -15,9 +15,10 @@ from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import (
     ReceiveInboundConnector, ReceiveOutboundConnector,
     PublishStatusConnector, ReceiveStatusConnector)
-from vumi.config import Config, ConfigInt
+from vumi.config import (
+    Config, ConfigInt, ConfigFloat, ConfigBool, ConfigDict, ConfigText)
 from vumi.errors import DuplicateConnectorError
-from vumi.utils import generate_worker_id
+from vumi.utils import generate_worker_id, LRUCache
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
 
@@ -36,6 +37,59 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    amqp_publish_content_type = ConfigText(
+        "The content type to serialize published messages with. Consumers "
+        "decode messages according to their content type, so this can be "
+        "changed without reconfiguring the workers on the other side. "
+        "Defaults to JSON. Use `application/x-msgpack` for msgpack (which "
+        "requires the `msgpack` package).",
+        default=None, static=True)
+    amqp_publish_batch_size = ConfigInt(
+        "If set, messages published to AMQP are buffered and published in "
+        "batches of at most this many messages.",
+        default=None, static=True)
+    amqp_publish_batch_interval = ConfigFloat(
+        "The maximum number of seconds a message may be buffered before its "
+        "batch is published. Only used if batching or confirms are enabled.",
+        default=0.01, static=True)
+    amqp_publish_confirm = ConfigBool(
+        "If set, messages are published in AMQP transactions and a publish "
+        "only completes once the broker has committed it.",
+        default=False, static=True)
+    amqp_connector_publish_options = ConfigDict(
+        "Per-connector overrides for the AMQP publishing options, keyed by "
+        "connector name. Each value is a dict that may contain any of "
+        "`content_type`, `batch_size`, `batch_interval` and `confirm`.",
+        default={}, static=True)
+    amqp_consume_concurrency = ConfigInt(
+        "The maximum number of messages from each AMQP queue that are "
+        "processed at the same time. This should not be larger than "
+        "`amqp_prefetch_count`.",
+        default=1, static=True)
+    amqp_consume_ordering = ConfigText(
+        "How to keep related messages in order when consuming concurrently. "
+        "May be `from_addr` (messages from the same address are processed "
+        "in order) or `session` (messages between the same pair of addresses "
+        "are processed in order). If unset, no ordering is guaranteed.",
+        default=None, static=True)
+    amqp_consume_datetime_fields_only = ConfigBool(
+        "If set, only the standard datetime fields of consumed messages (the "
+        "`timestamp`, for example) are decoded as datetimes. This is much "
+        "faster, but datetimes nested elsewhere in a message (in its "
+        "`helper_metadata`, for example) arrive as strings.",
+        default=False, static=True)
+    amqp_connector_consume_options = ConfigDict(
+        "Per-connector overrides for the AMQP consuming options, keyed by "
+        "connector name. Each value is a dict that may contain "
+        "`concurrency`, `ordering` and `datetime_fields_only`.",
+        default={}, static=True)
+    config_cache_size = ConfigInt(
+        "The maximum number of per-message config objects to cache.",
+        default=1000, static=True)
+    config_cache_ttl = ConfigFloat(
+        "The number of seconds a cached per-message config object stays "
+        "valid. If unset, cached configs never expire.",
+        default=None, static=True)
 
 
 class BaseWorker(Worker):
@@ -53,6 +107,9 @@ class BaseWorker(Worker):
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config_cache = LRUCache(
+            self._static_config.config_cache_size,
+            ttl=self._static_config.config_cache_ttl)
         self._hb_pub = None
         self._worker_id = None
         self.log = WrappingLogger(system=self.config.get('worker_name'))
@@ -158,8 +215,39 @@ class BaseWorker(Worker):
         It deliberately returns a deferred even when this isn't strictly
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
+
+        The default config doesn't depend on the message, so we build it once
+        and reuse it.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        return succeed(self.get_cached_config(None))
+
+    def get_cached_config(self, cache_key, get_config_data=None):
+        """Return a (possibly cached) config object for ``cache_key``.
+
+        :param cache_key:
+            A hashable key identifying the config. Configs that vary by tag or
+            account, for example, should include the tag or account in the
+            key.
+        :param get_config_data:
+            A function that returns the config data to build the config
+            object from on a cache miss. Defaults to the worker config.
+
+        Config objects are cheap to read from but expensive to build, because
+        building one validates every field.
+        """
+        config = self._config_cache.get(cache_key)
+        if config is None:
+            if get_config_data is None:
+                config_data = self.config
+            else:
+                config_data = get_config_data()
+            config = self.CONFIG_CLASS(config_data)
+            self._config_cache.set(cache_key, config)
+        return config
+
+    def get_config_cache_stats(self):
+        """Return hit, miss and eviction counts for the config cache."""
+        return self._config_cache.stats()
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -179,16 +267,49 @@ class BaseWorker(Worker):
         #       config classes.
         pass
 
+    def get_publisher_options(self, connector_name):
+        """
+        Return the AMQP publishing options for the given connector.
+        """
+        config = self.get_static_config()
+        options = {
+            'content_type': config.amqp_publish_content_type,
+            'batch_size': config.amqp_publish_batch_size,
+            'batch_interval': config.amqp_publish_batch_interval,
+            'confirm': config.amqp_publish_confirm,
+        }
+        options.update(
+            config.amqp_connector_publish_options.get(connector_name, {}))
+        return options
+
+    def get_consumer_options(self, connector_name):
+        """
+        Return the AMQP consuming options for the given connector.
+        """
+        config = self.get_static_config()
+        options = {
+            'concurrency': config.amqp_consume_concurrency,
+            'ordering': config.amqp_consume_ordering,
+            'datetime_fields_only': config.amqp_consume_datetime_fields_only,
+        }
+        options.update(
+            config.amqp_connector_consume_options.get(connector_name, {}))
+        return options
+
     def setup_connector(self, connector_cls, connector_name, middleware=False):
         if connector_name in self.connectors:
             raise DuplicateConnectorError("Attempt to add duplicate connector"
                                           " with name %r" % (connector_name,))
         prefetch_count = self.get_static_config().amqp_prefetch_count
         middlewares = self.middlewares if middleware else None
+        publisher_options = self.get_publisher_options(connector_name)
+        consumer_options = self.get_consumer_options(connector_name)
 
         connector = connector_cls(self, connector_name,
                                   prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+                                  middlewares=middlewares,
+                                  publisher_options=publisher_options,
+                                  consumer_options=consumer_options)
         self.connectors[connector_name] = connector
 
         d = connector.setup()